@@ -5,6 +5,7 @@ from pydantic import BaseModel, EmailStr, Field, validator, ConfigDict
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List, Tuple, Literal, Union
 from enum import Enum
+from abc import ABC, abstractmethod
 import secrets
 import hashlib
 import jwt
@@ -13,13 +14,14 @@ import re
 import json
 import logging
 import os
-from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks, status, APIRouter, Query, File, UploadFile, Form, Header, Body, Cookie
+from fastapi import FastAPI, HTTPException, Depends, Request, status, APIRouter, Query, Header, Body, Cookie
 from fastapi.exceptions import RequestValidationError
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, StreamingResponse, PlainTextResponse, RedirectResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request as StarletteRequest
 from starlette.responses import Response
@@ -27,27 +29,53 @@ import uvicorn
 import asyncio
 import time
 import math
+import bisect
 import smtplib
 from pathlib import Path
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import ssl
 from datetime import datetime, timezone, timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from dotenv import load_dotenv
 import uuid
 import shutil
+import tempfile
+from glob import escape as glob_escape
+import functools
+import csv
+import io
+import random
+import socket
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
+import cloudinary.exceptions
 import hmac
 import base64
 import aiohttp
+import certifi
 import requests
 import sys
 import inspect
 import html as html_module
 from urllib.parse import urlparse, urlunparse
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+from cryptography.x509.verification import PolicyBuilder, Store
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+try:
+    from PIL import Image
+except ImportError:  # Optional, not in requirements.txt: `pip install Pillow` to get media variants on the local storage backend
+    Image = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -222,35 +250,328 @@ app.add_middleware(CSRFMiddleware)
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
-# PRODUCTION METRICS: In-memory metrics for observability
-# In production, export these to Prometheus/Grafana/CloudWatch
-class ProductionMetrics:
-    """Thread-safe metrics collector for production monitoring"""
-    def __init__(self):
-        self._metrics = defaultdict(int)
-        self._lock = asyncio.Lock()
+# PRODUCTION METRICS: counters, gauges and fixed-bucket histograms with labels.
+# Updates are plain dict arithmetic with no lock: every writer runs on the event loop thread.
+# With METRICS_MULTIPROC_DIR set, each worker process writes its values to
+# <dir>/metrics-<pid>.json every METRICS_FLUSH_SECONDS and reads merge every worker's file, so
+# /api/metrics covers all gunicorn workers. Empty the directory when deploying.
+METRICS_MULTIPROC_DIR = os.environ.get("METRICS_MULTIPROC_DIR") or None
+METRICS_FLUSH_SECONDS = 5
+METRICS_STALE_SECONDS = 3 * METRICS_FLUSH_SECONDS  # Gauges of workers silent this long are dropped
+METRICS_SCRAPE_TOKEN = os.environ.get("METRICS_SCRAPE_TOKEN")  # Bearer token for /api/metrics/prometheus
+METRICS_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """A metric family: one value per tuple of label values."""
+    kind = "untyped"
     
-    async def increment(self, metric_name: str, value: int = 1):
-        """Increment a counter metric"""
-        async with self._lock:
-            self._metrics[metric_name] += value
+    def __init__(self, name: str, help: str = "", labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], Any] = {}
     
-    async def get_all(self) -> Dict[str, int]:
-        """Get all metrics (for /metrics endpoint)"""
-        async with self._lock:
-            return dict(self._metrics)
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
     
-    async def reset(self):
-        """Reset all metrics (for testing)"""
-        async with self._lock:
-            self._metrics.clear()
+    def describe(self) -> dict:
+        return {"kind": self.kind, "help": self.help, "labelnames": list(self.labelnames)}
+
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, value: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def __init__(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (),
+                 multiprocess_mode: Literal["sum", "max"] = "sum"):
+        super().__init__(name, help, labelnames)
+        self.multiprocess_mode = multiprocess_mode
+    
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+    
+    def inc(self, value: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+    
+    def dec(self, value: float = 1, **labels) -> None:
+        self.inc(-value, **labels)
+    
+    def describe(self) -> dict:
+        return {**super().describe(), "mode": self.multiprocess_mode}
+
+
+class Histogram(Metric):
+    """Values are [per-bucket counts (last is +Inf), sum]; buckets are cumulated on export."""
+    kind = "histogram"
+    
+    def __init__(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = METRICS_DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+    
+    def describe(self) -> dict:
+        return {**super().describe(), "buckets": list(self.buckets)}
+
+
+class MetricsRegistry:
+    """
+    Process-local metric families plus the multiprocess file exchange. Snapshots are
+    {name: {kind, help, labelnames, [mode|buckets], values: {label tuple: value}}}.
+    """
+    
+    def __init__(self, multiprocess_dir: Optional[str] = None):
+        self.multiprocess_dir = multiprocess_dir
+        self._metrics: Dict[str, Metric] = {}
+    
+    def _register(self, cls, name: str, help: str, labelnames: Tuple[str, ...], **kwargs) -> Metric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+        elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"Metric {name} is already a {metric.kind} with labels {metric.labelnames}")
+        return metric
+    
+    def counter(self, name: str, help: str = "", labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter, name, help, labelnames)
+    
+    def gauge(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (),
+              multiprocess_mode: Literal["sum", "max"] = "sum") -> Gauge:
+        return self._register(Gauge, name, help, labelnames, multiprocess_mode=multiprocess_mode)
+    
+    def histogram(self, name: str, help: str = "", labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = METRICS_DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+    
+    def increment(self, name: str, value: float = 1) -> None:
+        """Bump an unlabelled counter, registering it on first use."""
+        self.counter(name).inc(value)
+    
+    def snapshot(self) -> Dict[str, dict]:
+        """This process's values (copied, so they can be merged or serialized later)."""
+        snapshot = {}
+        for metric in self._metrics.values():
+            if metric.kind == "histogram":
+                values = {key: [list(counts), total] for key, (counts, total) in metric.values.items()}
+            else:
+                values = dict(metric.values)
+            snapshot[metric.name] = {**metric.describe(), "values": values}
+        return snapshot
+    
+    def _file(self, pid: int) -> Path:
+        return Path(self.multiprocess_dir) / f"metrics-{pid}.json"
+    
+    async def flush(self) -> None:
+        """Publish this process's values for the other workers (multiprocess mode only)."""
+        if not self.multiprocess_dir:
+            return
+        snapshot = self.snapshot()
+        for entry in snapshot.values():
+            entry["values"] = [[list(key), value] for key, value in entry["values"].items()]
+        payload = json.dumps({"pid": os.getpid(), "metrics": snapshot})
+        await asyncio.to_thread(self._write, self._file(os.getpid()), payload)
+    
+    @staticmethod
+    def _write(path: Path, payload: str) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(payload)
+        os.replace(tmp_path, path)
+    
+    def _read_workers(self) -> List[Dict[str, dict]]:
+        snapshots = []
+        own_file = self._file(os.getpid())
+        for path in Path(self.multiprocess_dir).glob("metrics-*.json"):
+            if path == own_file:
+                continue
+            try:
+                stale = time.time() - path.stat().st_mtime > METRICS_STALE_SECONDS
+                data = json.loads(path.read_text())["metrics"]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"[metrics] Skipping unreadable {path.name}: {e}")
+                continue
+            snapshot = {}
+            for name, entry in data.items():
+                if stale and entry["kind"] == "gauge":
+                    continue  # The worker is gone; its counters still count, its gauges do not
+                entry["values"] = {tuple(key): value for key, value in entry["values"]}
+                snapshot[name] = entry
+            snapshots.append(snapshot)
+        return snapshots
+    
+    async def collect(self) -> Dict[str, dict]:
+        """Values across all workers (just this process without METRICS_MULTIPROC_DIR)."""
+        own = self.snapshot()
+        if not self.multiprocess_dir:
+            return own
+        return merge_metric_snapshots([own] + await asyncio.to_thread(self._read_workers))
+
+
+def merge_metric_snapshots(snapshots: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """Sum counters and histograms across processes; gauges sum or max per their mode."""
+    merged: Dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, entry in snapshot.items():
+            target = merged.setdefault(name, {**entry, "values": {}})
+            if target["kind"] != entry["kind"] or target.get("buckets") != entry.get("buckets"):
+                logging.warning(f"[metrics] Conflicting definitions of {name} across workers, keeping the first")
+                continue
+            values = target["values"]
+            for key, value in entry["values"].items():
+                current = values.get(key)
+                if current is None:
+                    values[key] = [list(value[0]), value[1]] if entry["kind"] == "histogram" else value
+                elif entry["kind"] == "histogram":
+                    values[key] = [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1]]
+                elif entry["kind"] == "gauge" and entry.get("mode") == "max":
+                    values[key] = max(current, value)
+                else:
+                    values[key] = current + value
+    return merged
+
+
+def _metric_series_name(name: str, labelnames: List[str], key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(labelnames, key)) + ([extra] if extra else [])
+    if not pairs:
+        return name
+    labels = []
+    for label, value in pairs:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        labels.append(f'{label}="{value}"')
+    return name + "{" + ",".join(labels) + "}"
+
+
+def _format_metric_value(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(value)
+
+
+def histogram_quantile(q: float, buckets: List[float], counts: List[int]) -> Optional[float]:
+    """Estimate a quantile from per-bucket counts by linear interpolation (as Prometheus does)."""
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            if i == len(buckets):
+                return buckets[-1] if buckets else None  # +Inf bucket: report the highest finite bound
+            lower = buckets[i - 1] if i > 0 else 0.0
+            return lower + (buckets[i] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1] if buckets else None
+
+
+def render_metrics_json(collected: Dict[str, dict]) -> Tuple[Dict[str, float], Dict[str, dict]]:
+    """(counters and gauges by series name, histogram summaries by series name) for /api/metrics."""
+    flat: Dict[str, float] = {}
+    histograms: Dict[str, dict] = {}
+    for name, entry in sorted(collected.items()):
+        for key, value in sorted(entry["values"].items()):
+            series = _metric_series_name(name, entry["labelnames"], key)
+            if entry["kind"] == "histogram":
+                counts, total = value
+                observations = sum(counts)
+                histograms[series] = {
+                    "count": observations,
+                    "sum": round(total, 6),
+                    "avg": round(total / observations, 6) if observations else None,
+                    **{f"p{int(q * 100)}": histogram_quantile(q, entry["buckets"], counts) for q in (0.5, 0.95, 0.99)},
+                }
+            else:
+                flat[series] = value
+    return flat, histograms
+
+
+def render_metrics_prometheus(collected: Dict[str, dict]) -> str:
+    """Prometheus text exposition format 0.0.4."""
+    lines = []
+    for name, entry in sorted(collected.items()):
+        metric_name = re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+        if entry.get("help"):
+            lines.append(f"# HELP {metric_name} {entry['help']}")
+        lines.append(f"# TYPE {metric_name} {entry['kind']}")
+        for key, value in sorted(entry["values"].items()):
+            if entry["kind"] != "histogram":
+                lines.append(f"{_metric_series_name(metric_name, entry['labelnames'], key)} {_format_metric_value(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(entry["buckets"]) + [math.inf], counts):
+                cumulative += count
+                le = ("le", _format_metric_value(float(bound)))
+                lines.append(f"{_metric_series_name(metric_name + '_bucket', entry['labelnames'], key, le)} {cumulative}")
+            lines.append(f"{_metric_series_name(metric_name + '_sum', entry['labelnames'], key)} {_format_metric_value(total)}")
+            lines.append(f"{_metric_series_name(metric_name + '_count', entry['labelnames'], key)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(METRICS_MULTIPROC_DIR)
+http_request_duration = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route", "status")
+)
+http_requests_in_flight = metrics.gauge("http_requests_in_flight", "HTTP requests being served")
+task_duration = metrics.histogram(
+    "task_duration_seconds", "Task queue handler run time", ("task", "outcome"),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+
 
-metrics = ProductionMetrics()
+async def metrics_flush_loop():
+    """Publish this worker's metrics every METRICS_FLUSH_SECONDS (multiprocess mode)."""
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            await metrics.flush()
+        except Exception as e:
+            logging.warning(f"[metrics] Flush failed: {e}")
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    http_requests_in_flight.inc()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        http_requests_in_flight.dec()
+        route = request.scope.get("route")
+        # Route templates, not raw paths, keep label cardinality bounded
+        http_request_duration.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status_code
+        )
 
 # PRODUCTION ALERTS: Alert conditions (log when triggered)
-async def check_alert_conditions():
-    """Check alert conditions and log violations"""
-    all_metrics = await metrics.get_all()
+async def check_alert_conditions(all_metrics: Optional[Dict[str, float]] = None):
+    """Check alert conditions (across all workers) and log violations"""
+    if all_metrics is None:
+        all_metrics, _ = render_metrics_json(await metrics.collect())
     
     # Alert: Access granted without timestamps (MUST NEVER HAPPEN)
     if all_metrics.get('access_granted_no_timestamps', 0) > 0:
@@ -285,6 +606,7 @@ class KillSwitch:
         self.webhook_processing_enabled = True
         self.scheduled_reconciliation_enabled = True
         self.user_reconciliation_enabled = True
+        self.media_gc_enabled = True
     
     def disable_all_except_scheduled(self):
         """Emergency: Disable all except scheduled reconciliation"""
@@ -299,16 +621,29 @@ class KillSwitch:
         self.webhook_processing_enabled = True
         self.scheduled_reconciliation_enabled = True
         self.user_reconciliation_enabled = True
+        self.media_gc_enabled = True
         logging.info("╬ô┬ú├á KILL SWITCH: Re-enabled all features")
 
 kill_switch = KillSwitch()
 
-# Cloudinary Configuration (MANDATORY for persistent file storage)
-# Local filesystem storage is NOT supported - files will be lost on redeploy
+# Cloudinary Configuration (MANDATORY for persistent file storage in production)
+# The local filesystem backend exists for offline development and load testing only -
+# files stored on local disk will be lost on redeploy
 CLOUDINARY_CLOUD_NAME = os.environ.get('CLOUDINARY_CLOUD_NAME')
 CLOUDINARY_API_KEY = os.environ.get('CLOUDINARY_API_KEY')
 CLOUDINARY_API_SECRET = os.environ.get('CLOUDINARY_API_SECRET')
 
+# Storage backend: "cloudinary" (production) or "local" (offline/load testing)
+# The local backend only generates responsive image variants when Pillow is installed
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'cloudinary').lower()
+STORAGE_LOCAL_ROOT = Path(os.environ.get('STORAGE_LOCAL_ROOT', str(ROOT_DIR / 'uploads')))
+STORAGE_EXECUTOR_WORKERS = int(os.environ.get('STORAGE_EXECUTOR_WORKERS', '8'))  # Max concurrent provider calls per process
+STORAGE_BATCH_DELETE_LIMIT = 100  # Cloudinary delete_resources accepts at most 100 public_ids per call
+STORAGE_CHUNKED_UPLOAD_THRESHOLD_BYTES = 20 * 1024 * 1024  # Files above this use Cloudinary's chunked upload API
+MEDIA_VARIANT_WIDTHS = (320, 640, 960, 1280, 1920)  # srcset width buckets in the publish-time media manifest
+MEDIA_VARIANT_DIR = ".variants"  # Local backend: generated variants live under STORAGE_LOCAL_ROOT/.variants/<public_id>/
+MEDIA_VARIANT_NAME_PATTERN = re.compile(r'^[a-z0-9_]+\.(webp|jpg)$')
+
 # PayPal Configuration
 PAYPAL_CLIENT_ID = os.environ.get('PAYPAL_CLIENT_ID')
 PAYPAL_CLIENT_SECRET = os.environ.get('PAYPAL_CLIENT_SECRET')
@@ -346,9 +681,12 @@ FB_APP_ID = os.environ.get('FB_APP_ID')
 # - Sandbox UI behavior does not affect backend truth - all state changes require PayPal API/webhook confirmation
 # - All audit logging works identically in sandbox and production
 
-USE_CLOUDINARY = all([CLOUDINARY_CLOUD_NAME, CLOUDINARY_API_KEY, CLOUDINARY_API_SECRET])
+if STORAGE_BACKEND not in ("cloudinary", "local"):
+    raise RuntimeError(f"Unsupported STORAGE_BACKEND '{STORAGE_BACKEND}'. Use 'cloudinary' or 'local'.")
+
+USE_CLOUDINARY = STORAGE_BACKEND == "cloudinary"
 
-if not USE_CLOUDINARY:
+if USE_CLOUDINARY and not all([CLOUDINARY_CLOUD_NAME, CLOUDINARY_API_KEY, CLOUDINARY_API_SECRET]):
     # Cloudinary is MANDATORY - fail startup if not configured
     error_msg = (
         "=" * 80 + "\n"
@@ -387,13 +725,361 @@ logging.info(f"[EMAIL] RESEND_FROM_EMAIL: {RESEND_FROM_EMAIL}")
 logging.info("[EMAIL] SMTP disabled")
 
 # Configure Cloudinary
-cloudinary.config(
-    cloud_name=CLOUDINARY_CLOUD_NAME,
-    api_key=CLOUDINARY_API_KEY,
-    api_secret=CLOUDINARY_API_SECRET,
-    secure=True  # Use HTTPS
-)
-logging.info("Cloudinary configured for persistent file storage")
+if USE_CLOUDINARY:
+    cloudinary.config(
+        cloud_name=CLOUDINARY_CLOUD_NAME,
+        api_key=CLOUDINARY_API_KEY,
+        api_secret=CLOUDINARY_API_SECRET,
+        secure=True  # Use HTTPS
+    )
+    logging.info("Cloudinary configured for persistent file storage")
+else:
+    logging.warning(f"[STORAGE] Local filesystem storage active at {STORAGE_LOCAL_ROOT} - NOT for production use")
+
+# ==========================================
+# STORAGE PROVIDERS
+# ==========================================
+# All media storage goes through a StorageProvider. Provider SDKs are synchronous,
+# so every call is dispatched to a dedicated bounded thread pool and awaited -
+# request handlers never block the event loop on a storage network round trip.
+
+StorageSource = Union[bytes, str, Path, Any]  # bytes, filesystem path, or binary file object
+
+
+class StorageProvider(ABC):
+    """Async interface over the media object store."""
+    name = "base"
+
+    def __init__(self, max_workers: int = STORAGE_EXECUTOR_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"storage-{self.name}")
+
+    async def _run(self, fn, *args, **kwargs):
+        """Run a blocking call on the provider's executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    @abstractmethod
+    async def upload(
+        self,
+        source: StorageSource,
+        *,
+        public_id: str,
+        folder: str,
+        resource_type: str = "auto",
+        filename: Optional[str] = None,
+        size: Optional[int] = None,
+        options: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Store a blob. File objects are read from their current position and never loaded
+        whole into memory. Returns a Cloudinary-shaped result (secure_url, public_id,
+        resource_type, bytes, format, width, height).
+        """
+
+    @abstractmethod
+    async def destroy(self, public_id: str, resource_type: str = "image") -> bool:
+        """Delete one blob. Returns True if it was removed or was already absent."""
+
+    @abstractmethod
+    async def stat(self, public_id: str, resource_type: str = "image") -> Optional[Dict[str, Any]]:
+        """Return blob metadata (secure_url, bytes, ...) or None if it does not exist."""
+
+    async def delete_batch(self, public_ids: List[str], resource_type: str = "image") -> Dict[str, str]:
+        """Delete many blobs. Returns {public_id: "deleted" | "not_found" | "error"}."""
+        results: Dict[str, str] = {}
+        for public_id in public_ids:
+            try:
+                results[public_id] = "deleted" if await self.destroy(public_id, resource_type) else "not_found"
+            except Exception as e:
+                logging.warning(f"[STORAGE] Delete failed for {public_id}: {e}")
+                results[public_id] = "error"
+        return results
+
+    def owns_url(self, url: str) -> bool:
+        """True if the URL points at a blob held by this provider."""
+        return False
+
+    def local_path(self, public_id: str) -> Optional[Path]:
+        """Filesystem path for a blob, if the provider stores blobs locally."""
+        return None
+
+    async def media_variants(self, url: str, kind: str, public_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Responsive variants of a stored image, GIF or video (kind) for the media manifest:
+        {"srcset": [{"width", "url"}], "sources": [{"type", "url"}], "poster": url or None}.
+        Returns None when the provider cannot produce any.
+        """
+        return None
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class CloudinaryStorageProvider(StorageProvider):
+    """Cloudinary-backed storage (production)."""
+    name = "cloudinary"
+
+    async def upload(self, source, *, public_id, folder, resource_type="auto", filename=None, size=None, options=None):
+        if isinstance(source, Path):
+            source = str(source)
+        params = {
+            "public_id": public_id,
+            "resource_type": resource_type,
+            "folder": folder,
+            "overwrite": False,
+            "invalidate": True,
+        }
+        params.update(options or {})
+        if size is not None and size > STORAGE_CHUNKED_UPLOAD_THRESHOLD_BYTES and not isinstance(source, (bytes, bytearray)):
+            # Chunked upload API: streams the file in STORAGE_CHUNKED_UPLOAD_THRESHOLD_BYTES pieces
+            params["chunk_size"] = STORAGE_CHUNKED_UPLOAD_THRESHOLD_BYTES
+            return await self._run(cloudinary.uploader.upload_large, source, **params)
+        return await self._run(cloudinary.uploader.upload, source, **params)
+
+    async def destroy(self, public_id, resource_type="image"):
+        result = await self._run(cloudinary.uploader.destroy, public_id, resource_type=resource_type)
+        return (result or {}).get("result") in ("ok", "not found")
+
+    async def stat(self, public_id, resource_type="image"):
+        try:
+            return await self._run(cloudinary.api.resource, public_id, resource_type=resource_type)
+        except cloudinary.exceptions.NotFound:
+            return None
+
+    async def delete_batch(self, public_ids, resource_type="image"):
+        results: Dict[str, str] = {}
+        for start in range(0, len(public_ids), STORAGE_BATCH_DELETE_LIMIT):
+            chunk = public_ids[start:start + STORAGE_BATCH_DELETE_LIMIT]
+            try:
+                response = await self._run(cloudinary.api.delete_resources, chunk, resource_type=resource_type)
+                deleted = (response or {}).get("deleted", {})
+                for public_id in chunk:
+                    outcome = deleted.get(public_id)
+                    results[public_id] = "deleted" if outcome == "deleted" else ("not_found" if outcome == "not_found" else "error")
+            except Exception as e:
+                logging.warning(f"[STORAGE] Cloudinary batch delete failed for {len(chunk)} resources: {e}")
+                for public_id in chunk:
+                    results[public_id] = "error"
+        return results
+
+    def owns_url(self, url):
+        return bool(url) and 'res.cloudinary.com' in url
+
+    @staticmethod
+    def _transform(url: str, transformation: str, extension: Optional[str] = None) -> str:
+        """Delivery URL with a transformation (and optionally a new format extension) applied."""
+        head, _, tail = url.partition('/upload/')
+        if extension:
+            stem, dot, current = tail.rpartition('.')
+            tail = f"{stem}.{extension}" if dot and '/' not in current else f"{tail}.{extension}"
+        return f"{head}/upload/{transformation}/{tail}"
+
+    async def media_variants(self, url, kind, public_id=None):
+        # Variants are on-the-fly URL transformations, generated by the CDN on first request
+        if not self.owns_url(url) or '/upload/' not in url:
+            return None
+        if kind == "image":
+            return {
+                "srcset": [{"width": width, "url": self._transform(url, f"c_limit,w_{width},q_auto,f_auto")} for width in MEDIA_VARIANT_WIDTHS],
+                "sources": [],
+                "poster": None,
+            }
+        if kind in ("gif", "video"):
+            # Animated GIFs are delivered re-encoded as video, typically a fraction of the size
+            return {
+                "srcset": [],
+                "sources": [
+                    {"type": "video/webm", "url": self._transform(url, "q_auto", "webm")},
+                    {"type": "video/mp4", "url": self._transform(url, "q_auto", "mp4")},
+                ],
+                "poster": self._transform(url, "pg_1,q_auto" if kind == "gif" else "so_0,q_auto", "jpg"),
+            }
+        return None
+
+
+class LocalStorageProvider(StorageProvider):
+    """Filesystem-backed storage for offline development and load testing.
+
+    Blobs are written under STORAGE_LOCAL_ROOT/<folder>/<public_id><ext> and served
+    through /api/media/{file_id}.
+    """
+    name = "local"
+
+    def __init__(self, root: Path = STORAGE_LOCAL_ROOT, max_workers: int = STORAGE_EXECUTOR_WORKERS):
+        super().__init__(max_workers=max_workers)
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _resolve(self, public_id: str) -> Path:
+        path = (self.root / public_id).resolve()
+        if not path.is_relative_to(self.root):
+            raise ValueError(f"Invalid public_id: {public_id}")
+        return path
+
+    def local_path(self, public_id):
+        try:
+            base = self._resolve(public_id)
+        except ValueError:
+            return None
+        if base.is_file():
+            return base
+        if not base.parent.is_dir():
+            return None
+        matches = sorted(base.parent.glob(f"{glob_escape(base.name)}.*"))
+        return matches[0] if matches else None
+
+    def _write(self, source, target: Path) -> int:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                tmp_path.write_bytes(source)
+            elif isinstance(source, (str, Path)):
+                shutil.copyfile(source, tmp_path)
+            else:
+                with open(tmp_path, "wb") as out:
+                    shutil.copyfileobj(source, out, 1024 * 1024)
+            os.replace(tmp_path, target)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return target.stat().st_size
+
+    def _remove_variants(self, public_id: str) -> None:
+        try:
+            shutil.rmtree(self._resolve(f"{MEDIA_VARIANT_DIR}/{public_id}"), ignore_errors=True)
+        except ValueError:
+            pass
+
+    async def upload(self, source, *, public_id, folder, resource_type="auto", filename=None, size=None, options=None):
+        full_public_id = f"{folder.strip('/')}/{public_id}" if folder else public_id
+        extension = Path(filename).suffix.lower() if filename else ""
+        target = self._resolve(full_public_id + extension)
+        size = await self._run(self._write, source, target)
+        return {
+            "secure_url": f"/api/media/{public_id}{extension}",
+            "public_id": full_public_id,
+            "resource_type": resource_type,
+            "bytes": size,
+            "format": extension.lstrip(".") or None,
+            "width": None,
+            "height": None,
+        }
+
+    async def destroy(self, public_id, resource_type="image"):
+        path = self.local_path(public_id)
+        if path is not None:
+            await self._run(path.unlink, missing_ok=True)
+        await self._run(self._remove_variants, public_id)
+        return True
+
+    async def delete_batch(self, public_ids, resource_type="image"):
+        results: Dict[str, str] = {}
+        for public_id in public_ids:
+            path = self.local_path(public_id)
+            if path is None:
+                results[public_id] = "not_found"
+                continue
+            try:
+                await self._run(path.unlink, missing_ok=True)
+                await self._run(self._remove_variants, public_id)
+                results[public_id] = "deleted"
+            except OSError as e:
+                logging.warning(f"[STORAGE] Local delete failed for {public_id}: {e}")
+                results[public_id] = "error"
+        return results
+
+    async def stat(self, public_id, resource_type="image"):
+        path = self.local_path(public_id)
+        if path is None:
+            return None
+        st = await self._run(path.stat)
+        return {
+            "secure_url": f"/api/media/{path.name}",
+            "public_id": public_id,
+            "resource_type": resource_type,
+            "bytes": st.st_size,
+            "format": path.suffix.lstrip(".") or None,
+        }
+
+    def owns_url(self, url):
+        return bool(url) and url.startswith('/api/media/')
+
+    def variant_path(self, public_id: str, name: str) -> Optional[Path]:
+        """Filesystem path of a generated variant, if it exists."""
+        if not MEDIA_VARIANT_NAME_PATTERN.match(name):
+            return None
+        try:
+            path = self._resolve(f"{MEDIA_VARIANT_DIR}/{public_id}/{name}")
+        except ValueError:
+            return None
+        return path if path.is_file() else None
+
+    @staticmethod
+    def _save_image(image, target: Path, **params) -> None:
+        tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            image.save(tmp_path, **params)
+            os.replace(tmp_path, target)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def _generate_variants(self, source: Path, target_dir: Path, kind: str) -> Dict[str, Any]:
+        """Write WebP width buckets (images) or an animated WebP and a poster (GIFs). Existing files are reused."""
+        generated: Dict[str, Any] = {"srcset": [], "sources": [], "poster": None}
+        target_dir.mkdir(parents=True, exist_ok=True)
+        with Image.open(source) as image:
+            width = image.size[0]
+            if kind == "gif" and getattr(image, "is_animated", False):
+                animated = target_dir / "animated.webp"
+                if not animated.exists():
+                    self._save_image(image, animated, format="WEBP", save_all=True, quality=75, method=4, loop=0)
+                generated["sources"].append({"type": "image/webp", "name": animated.name})
+                image.seek(0)
+                poster = target_dir / "poster.jpg"
+                if not poster.exists():
+                    self._save_image(image.convert("RGB"), poster, format="JPEG", quality=80)
+                generated["poster"] = poster.name
+                return generated
+            frame = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+            for bucket in MEDIA_VARIANT_WIDTHS:
+                if bucket >= width:
+                    break
+                variant = target_dir / f"w{bucket}.webp"
+                if not variant.exists():
+                    resized = frame.copy()
+                    resized.thumbnail((bucket, resized.size[1]), Image.LANCZOS)
+                    self._save_image(resized, variant, format="WEBP", quality=80, method=4)
+                generated["srcset"].append({"width": bucket, "name": variant.name})
+        return generated
+
+    async def media_variants(self, url, kind, public_id=None):
+        # Without ffmpeg there is no local video transcoding; GIFs get an animated WebP instead of MP4/WebM video
+        if Image is None or kind not in ("image", "gif") or not public_id or not self.owns_url(url):
+            return None
+        source = self.local_path(public_id)
+        if source is None or source.suffix.lower() == ".svg":
+            return None
+        target_dir = self._resolve(f"{MEDIA_VARIANT_DIR}/{public_id}")
+        generated = await self._run(self._generate_variants, source, target_dir, kind)
+        if not (generated["srcset"] or generated["sources"] or generated["poster"]):
+            return None  # Already small enough
+        base_url = f"/api/media/{media_key_from_url(url)}/variants"
+        return {
+            "srcset": [{"width": item["width"], "url": f"{base_url}/{item['name']}"} for item in generated["srcset"]],
+            "sources": [{"type": item["type"], "url": f"{base_url}/{item['name']}"} for item in generated["sources"]],
+            "poster": f"{base_url}/{generated['poster']}" if generated["poster"] else None,
+        }
+
+
+def create_storage_provider() -> StorageProvider:
+    if STORAGE_BACKEND == "local":
+        return LocalStorageProvider()
+    return CloudinaryStorageProvider()
+
+
+storage_provider = create_storage_provider()
 
 # Enums
 class UserRole(str, Enum):
@@ -545,6 +1231,14 @@ class ExtensionResolveResponse(BaseModel):
     updated_at: Optional[datetime] = None  # Track modifications
 
 
+EXTENSION_RESOLVE_BATCH_MAX_URLS = 50
+
+
+class ExtensionResolveBatchRequest(BaseModel):
+    urls: List[str] = Field(..., min_length=1, max_length=EXTENSION_RESOLVE_BATCH_MAX_URLS)
+    include_walkthroughs: bool = False  # Also return title/steps of every matched walkthrough
+
+
 class ExtensionAdminStep(BaseModel):
     id: str
     title: str
@@ -558,6 +1252,11 @@ class ExtensionAdminWalkthrough(BaseModel):
     status: Optional[str] = None
     steps: List[ExtensionAdminStep] = []
 
+
+class ExtensionResolveBatchResponse(BaseModel):
+    results: Dict[str, List[ExtensionResolveMatch]]  # Keyed by URL as sent
+    walkthroughs: Dict[str, ExtensionAdminWalkthrough] = {}  # Keyed by walkthrough_id (include_walkthroughs)
+
 # Capability-binding models
 class WorkspaceBindingToken(BaseModel):
     _id: Optional[str] = None
@@ -584,6 +1283,15 @@ class ExtensionWalkthrough(BaseModel):
 class ExtensionWalkthroughsResponse(BaseModel):
     walkthroughs: List[ExtensionWalkthrough]
 
+
+class ExtensionSyncResponse(BaseModel):
+    seq: int  # Pass back as `since` on the next sync
+    full: bool = False  # True: replace local state; False: apply as a delta
+    walkthroughs: List[ExtensionWalkthrough] = []
+    targets: List[ExtensionTarget] = []
+    deleted_walkthrough_ids: List[str] = []  # Deleted or archived
+    deleted_target_ids: List[str] = []
+
 class WorkspaceCreate(BaseModel):
     name: str
     logo: Optional[str] = None
@@ -820,10 +1528,68 @@ class FileRecord(BaseModel):
     idempotency_key: str  # Unique key for deduplication
     reference_type: Optional[str] = None  # "walkthrough_icon", "step_media", "block_image", "workspace_logo", etc.
     reference_id: Optional[str] = None  # walkthrough_id, step_id, block_id, etc.
+    content_hash: Optional[str] = None  # sha256 of the content (content-addressed de-duplication)
+    blob_id: Optional[str] = None  # media_blobs entry shared by identical uploads in the same workspace
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     deleted_at: Optional[datetime] = None
 
+class UploadSessionStatus(str, Enum):
+    OPEN = "open"
+    COMMITTING = "committing"
+    COMMITTED = "committed"
+    ABORTED = "aborted"
+    EXPIRED = "expired"
+
+class UploadSession(BaseModel):
+    """Resumable chunked upload. Holds a PENDING FileRecord and its quota reservation until commit."""
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    file_id: str  # PENDING FileRecord activated on commit
+    user_id: str  # Uploader
+    quota_user_id: str  # Workspace owner whose quota is reserved
+    workspace_id: str
+    filename: str
+    resource_type: str
+    folder: str  # Storage folder resolved at session creation
+    size_bytes: int
+    chunk_size: int
+    total_chunks: int
+    sha256: Optional[str] = None  # Optional whole-file checksum verified at commit
+    idempotency_key: str
+    status: UploadSessionStatus = UploadSessionStatus.OPEN
+    expires_at: datetime
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+class Job(BaseModel):
+    """Durable background job. Phases run in order; checkpoint/progress survive restarts."""
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    type: str  # "workspace_deletion", "user_deletion"
+    target_id: str
+    requested_by: str
+    params: Dict[str, Any] = Field(default_factory=dict)
+    status: JobStatus = JobStatus.QUEUED
+    phase: Optional[str] = None  # Phase currently (or last) running
+    completed_phases: List[str] = Field(default_factory=list)
+    checkpoint: Dict[str, Any] = Field(default_factory=dict)  # Resume position within the current phase
+    progress: Dict[str, int] = Field(default_factory=dict)
+    active_key: Optional[str] = None  # "type:target_id" while queued/running - unique, so submission is idempotent
+    attempts: int = 0
+    lease_expires_at: Optional[datetime] = None  # A running job whose lease expired is resumed by another worker
+    lease_id: Optional[str] = None  # Set per claim; heartbeats and saves only touch the job while it matches
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    completed_at: Optional[datetime] = None
+
 class Notification(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -892,30 +1658,23 @@ def verify_verification_token(token: str, hashed: str) -> bool:
     except Exception:
         return False
 
-def send_verification_email(email: str, verify_url: str, name: Optional[str] = None) -> bool:
+def render_verification_email(email: str, verify_url: str, name: Optional[str] = None) -> Dict[str, str]:
     """
-    Send verification email via Resend HTTP API.
-    Never raises exceptions - returns True on success, False on failure.
-    This function is called from background tasks, so exceptions would be lost.
+    Render the email verification message (queue it with queue_email()).
     
     Args:
         email: Recipient email address
         verify_url: Full verification URL with token
         name: Optional recipient name (defaults to email username if not provided)
     """
-    if not RESEND_API_KEY or not RESEND_FROM_EMAIL:
-        logging.warning(f"[EMAIL][FAILED] email={email} error=Resend not configured")
-        return False
+    expiry_hours = EMAIL_VERIFICATION_EXPIRY_HOURS
     
-    try:
-        expiry_hours = EMAIL_VERIFICATION_EXPIRY_HOURS
-        
-        # Use provided name or extract from email for personalization
-        if not name:
-            name = email.split('@')[0].replace('.', ' ').title()
-        
-        # Plain text version
-        text_content = f"""Hi {name},
+    # Use provided name or extract from email for personalization
+    if not name:
+        name = email.split('@')[0].replace('.', ' ').title()
+    
+    # Plain text version
+    text_content = f"""Hi {name},
 
 Please verify your email address by clicking the link below:
 
@@ -928,9 +1687,9 @@ If you didn't create an account, you can safely ignore this email.
 Best regards,
 Guide2026
 """
-        
-        # HTML version
-        html_content = f"""<!DOCTYPE html>
+    
+    # HTML version
+    html_content = f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="utf-8">
@@ -957,69 +1716,24 @@ Guide2026
 </body>
 </html>
 """
-        
-        # Send email via Resend HTTP API
-        headers = {
-            "Authorization": f"Bearer {RESEND_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "from": RESEND_FROM_EMAIL,
-            "to": [email],
-            "subject": "Verify your email address",
-            "text": text_content,
-            "html": html_content
-        }
-        
-        logging.info(f"[EMAIL][REQUEST] Resend API call for email={email} from={RESEND_FROM_EMAIL}")
-        response = requests.post(RESEND_API_URL, json=payload, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            resend_id = response_data.get('id', 'unknown')
-            logging.info(f"[EMAIL][SUCCESS] email={email} resend_id={resend_id}")
-            return True
-        else:
-            # Try to parse error response
-            try:
-                error_data = response.json()
-                error_detail = error_data.get('message', str(error_data))
-            except:
-                error_detail = response.text or f"HTTP {response.status_code}"
-            
-            logging.error(f"[EMAIL][FAILED] email={email} status={response.status_code} error={error_detail} from={RESEND_FROM_EMAIL}")
-            return False
-            
-    except requests.exceptions.Timeout:
-        logging.error(f"[EMAIL][FAILED] email={email} error=Resend API timeout (10s)")
-        return False
-    except requests.exceptions.RequestException as e:
-        logging.error(f"[EMAIL][FAILED] email={email} error=Resend API request error: {str(e)}")
-        return False
-    except Exception as e:
-        logging.error(f"[EMAIL][FAILED] email={email} error={str(e)}", exc_info=True)
-        return False
 
-def send_password_reset_email(email: str, reset_url: str, name: Optional[str] = None) -> bool:
-    """
-    Send password reset email via Resend HTTP API.
-    Returns True on success, False on failure.
-    Never raises exceptions - called from background tasks.
-    """
-    if not RESEND_API_KEY or not RESEND_FROM_EMAIL:
-        logging.warning(f"[EMAIL][FAILED] email={email} error=Resend not configured")
-        return False
+    return {
+        "to": email,
+        "subject": "Verify your email address",
+        "text": text_content,
+        "html": html_content
+    }
 
-    try:
-        # Use provided name or extract from email for personalization
-        if not name:
-            name = email.split('@')[0].replace('.', ' ').title()
+def render_password_reset_email(email: str, reset_url: str, name: Optional[str] = None) -> Dict[str, str]:
+    """Render the password reset message (queue it with queue_email())."""
+    # Use provided name or extract from email for personalization
+    if not name:
+        name = email.split('@')[0].replace('.', ' ').title()
 
-        subject = "Reset your InterGuide password"
+    subject = "Reset your InterGuide password"
 
-        # Plain text version
-        text_content = f"""Hi {name},
+    # Plain text version
+    text_content = f"""Hi {name},
 
 You requested a password reset for your InterGuide account.
 
@@ -1034,8 +1748,8 @@ Best regards,
 InterGuide Team
 """
 
-        # HTML version
-        html_content = f"""<!DOCTYPE html>
+    # HTML version
+    html_content = f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="utf-8">
@@ -1073,120 +1787,131 @@ InterGuide Team
 </body>
 </html>"""
 
-        payload = {
-            "from": RESEND_FROM_EMAIL,
-            "to": [email],
-            "subject": subject,
-            "text": text_content,
-            "html": html_content
-        }
+    return {
+        "to": email,
+        "subject": subject,
+        "text": text_content,
+        "html": html_content
+    }
 
-        headers = {
-            "Authorization": f"Bearer {RESEND_API_KEY}",
-            "Content-Type": "application/json"
-        }
+def render_invitation_email(
+    email: str,
+    workspace_name: str,
+    inviter_name: str,
+    role: str,
+    invite_expires_at: Optional[datetime] = None
+) -> Dict[str, str]:
+    """Render the workspace invitation message (queue it with queue_email())."""
+    # The invitation is waiting in the invitee's notifications once they sign in
+    invite_url = f"{MAIN_DOMAIN}/dashboard"
+    expiry_line = ""
+    if invite_expires_at:
+        expires = invite_expires_at if isinstance(invite_expires_at, datetime) else datetime.fromisoformat(str(invite_expires_at).replace('Z', '+00:00'))
+        expiry_line = f"This invitation expires on {expires.strftime('%B %d, %Y')}."
+    safe_workspace = html_module.escape(workspace_name or "a workspace")
+    safe_inviter = html_module.escape(inviter_name or "A teammate")
 
-        logging.info(f"[EMAIL][REQUEST] Password reset email to {email}")
-        response = requests.post(RESEND_API_URL, json=payload, headers=headers, timeout=10)
+    text_content = f"""Hi,
 
-        if response.status_code == 200:
-            response_data = response.json()
-            resend_id = response_data.get('id', 'unknown')
-            logging.info(f"[EMAIL][SUCCESS] Password reset email sent to {email}, resend_id={resend_id}")
-            return True
-        else:
-            try:
-                error_data = response.json()
-                error_detail = error_data.get('message', str(error_data))
-            except:
-                error_detail = response.text or f"HTTP {response.status_code}"
+{inviter_name or "A teammate"} invited you to join the workspace "{workspace_name}" on InterGuide as {role}.
 
-            logging.error(f"[EMAIL][FAILED] Password reset email to {email}, status={response.status_code}, error={error_detail}")
-            return False
+Sign in to accept or decline the invitation:
+{invite_url}
 
-    except requests.exceptions.Timeout:
-        logging.error(f"[EMAIL][FAILED] Password reset email to {email}, error=Resend API timeout (10s)")
-        return False
-    except requests.exceptions.RequestException as e:
-        logging.error(f"[EMAIL][FAILED] Password reset email to {email}, error=Resend API request error: {str(e)}")
-        return False
-    except Exception as e:
-        logging.error(f"[EMAIL][FAILED] Password reset email to {email}, error={str(e)}", exc_info=True)
-        return False
+{expiry_line}
 
-        
-        headers = {
-            "Authorization": f"Bearer {RESEND_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "from": RESEND_FROM_EMAIL,
-            "to": [email],
-            "subject": "You’ve been invited to join a workspace on Interguide",
-            "text": text_content,
-            "html": html_content
-        }
-        
-        logging.info(f"[EMAIL][REQUEST] Invitation email to {email} for workspace {workspace_name}")
-        response = requests.post(RESEND_API_URL, json=payload, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            resend_id = response_data.get('id', 'unknown')
-            logging.info(f"[EMAIL][SUCCESS] Invitation email sent to {email} resend_id={resend_id}")
-            return True
-        else:
-            try:
-                error_data = response.json()
-                error_detail = error_data.get('message', str(error_data))
-            except:
-                error_detail = response.text or f"HTTP {response.status_code}"
-            logging.error(f"[EMAIL][FAILED] Invitation email to {email} status={response.status_code} error={error_detail}")
-            return False
-            
-    except Exception as e:
-        logging.error(f"[EMAIL][FAILED] Invitation email to {email} error={str(e)}", exc_info=True)
-        return False
+Best regards,
+InterGuide Team
+"""
 
-async def send_verification_email_background(user_id: str, email: str, name: str, token: str):
-    """
-    Background task to send verification email via Resend HTTP API.
-    Non-blocking - runs after HTTP response is sent.
-    """
-    try:
-        logging.info(f"[EMAIL][START] user_id={user_id} email={email} name={name}")
-        
-        # Verify configuration before attempting send
-        if not RESEND_API_KEY:
-            logging.error(f"[EMAIL][FAILED] user_id={user_id} email={email} error=RESEND_API_KEY not configured")
-            return
-        
-        if not RESEND_FROM_EMAIL:
-            logging.error(f"[EMAIL][FAILED] user_id={user_id} email={email} error=RESEND_FROM_EMAIL not configured")
-            return
-        
-        verification_url = f"{MAIN_DOMAIN}/verify-email?token={token}"
-        logging.info(f"[EMAIL][URL] user_id={user_id} verification_url={verification_url}")
-        
-        # Call the Resend email function (sync, but in background task)
-        success = send_verification_email(email, verification_url, name=name)
-        
-        if success:
-            logging.info(f"[EMAIL][SUCCESS] user_id={user_id} email={email}")
-        else:
-            logging.error(f"[EMAIL][FAILED] user_id={user_id} email={email} error=Email send failed (check logs above)")
-    except Exception as e:
-        logging.error(f"[EMAIL][FAILED] user_id={user_id} email={email} error=Background task exception: {str(e)}", exc_info=True)
+    html_content = f"""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <style>
+        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+        .button {{ display: inline-block; padding: 12px 24px; background-color: #4f46e5; color: white; text-decoration: none; border-radius: 5px; margin: 20px 0; }}
+        .footer {{ margin-top: 30px; font-size: 12px; color: #666; }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h2>You're invited to {safe_workspace}</h2>
 
-def _log_text_block_diff(raw: dict, sanitized: dict) -> None:
-    if not raw or not sanitized:
-        return
-    diffs = []
-    raw_steps = raw.get("steps") if isinstance(raw.get("steps"), list) else []
-    sanitized_steps = sanitized.get("steps") if isinstance(sanitized.get("steps"), list) else []
-    for step_index, raw_step in enumerate(raw_steps):
-        if step_index >= len(sanitized_steps):
+        <p>{safe_inviter} invited you to join the workspace <strong>{safe_workspace}</strong> on InterGuide as {html_module.escape(role)}.</p>
+
+        <p><a href="{invite_url}" class="button">Review Invitation</a></p>
+
+        <p>{expiry_line}</p>
+
+        <div class="footer">
+            <p>Best regards,<br>InterGuide Team</p>
+        </div>
+    </div>
+</body>
+</html>"""
+
+    return {
+        "to": email,
+        "subject": "You’ve been invited to join a workspace on Interguide",
+        "text": text_content,
+        "html": html_content
+    }
+
+def render_test_email(email: str, test_url: str) -> Dict[str, str]:
+    """Render the admin configuration test message."""
+    expiry_hours = EMAIL_VERIFICATION_EXPIRY_HOURS
+    name = email.split('@')[0].replace('.', ' ').title()
+
+    text_content = f"""Hi {name},
+
+This is a test email from Guide2026.
+
+Verification URL: {test_url}
+
+This link will expire in {expiry_hours} hours.
+
+Best regards,
+Guide2026
+"""
+
+    html_content = f"""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <style>
+        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+        .button {{ display: inline-block; padding: 12px 24px; background-color: #4f46e5; color: white; text-decoration: none; border-radius: 5px; margin: 20px 0; }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h2>Hi {name},</h2>
+        <p>This is a test email from Guide2026.</p>
+        <a href="{test_url}" class="button">Test Verification Link</a>
+        <p style="word-break: break-all;">{test_url}</p>
+    </div>
+</body>
+</html>
+"""
+
+    return {
+        "to": email,
+        "subject": "Test Email - Guide2026",
+        "text": text_content,
+        "html": html_content
+    }
+
+def _log_text_block_diff(raw: dict, sanitized: dict) -> None:
+    if not raw or not sanitized:
+        return
+    diffs = []
+    raw_steps = raw.get("steps") if isinstance(raw.get("steps"), list) else []
+    sanitized_steps = sanitized.get("steps") if isinstance(sanitized.get("steps"), list) else []
+    for step_index, raw_step in enumerate(raw_steps):
+        if step_index >= len(sanitized_steps):
             continue
         raw_blocks = raw_step.get("blocks") if isinstance(raw_step.get("blocks"), list) else []
         sanitized_blocks = sanitized_steps[step_index].get("blocks") if isinstance(sanitized_steps[step_index].get("blocks"), list) else []
@@ -1349,6 +2074,8 @@ async def ensure_walkthrough_step_ids(walkthrough: dict) -> dict:
         if result.modified_count == 0:
             refreshed = await db.walkthroughs.find_one({"id": walkthrough.get("id")}, {"_id": 0})
             return refreshed or walkthrough
+        if changed and walkthrough.get("workspace_id") and walkthrough.get("id"):
+            await record_extension_change(walkthrough["workspace_id"], "walkthrough", walkthrough["id"])
 
     return walkthrough
 
@@ -1523,6 +2250,61 @@ async def get_admin_workspace_ids(user_id: str) -> List[str]:
 def _hash_token(token: str) -> str:
     return hashlib.sha256(token.encode()).hexdigest()
 
+BINDING_TOKEN_CACHE_TTL_SECONDS = 30
+BINDING_TOKEN_NEGATIVE_TTL_SECONDS = 5  # Revoked/unknown tokens
+BINDING_TOKEN_CACHE_SIZE = 10000
+
+
+class BindingTokenCache:
+    """
+    token_hash -> (state, workspace_id, bound_extension_id) for _validate_binding_token, where
+    state is "active", "revoked" or "invalid". Active entries live BINDING_TOKEN_CACHE_TTL_SECONDS,
+    negative ones BINDING_TOKEN_NEGATIVE_TTL_SECONDS; the least recently used entry is dropped
+    beyond max_size.
+    
+    Token regeneration and binding record a "binding" change in the extension change log,
+    which drops the workspace's entries in every process (immediately in the one that made
+    the change, within EXTENSION_INDEX_POLL_SECONDS elsewhere).
+    """
+    
+    def __init__(self, ttl: float = BINDING_TOKEN_CACHE_TTL_SECONDS,
+                 negative_ttl: float = BINDING_TOKEN_NEGATIVE_TTL_SECONDS,
+                 max_size: int = BINDING_TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, str, Optional[str], Optional[str]]]" = OrderedDict()
+    
+    def get(self, token_hash: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        entry = self._entries.get(token_hash)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[token_hash]
+            return None
+        self._entries.move_to_end(token_hash)
+        return entry[1:]
+    
+    def put(self, token_hash: str, state: str, workspace_id: Optional[str],
+            bound_extension_id: Optional[str] = None) -> Tuple[str, Optional[str], Optional[str]]:
+        ttl = self.ttl if state == "active" else self.negative_ttl
+        self._entries[token_hash] = (time.monotonic() + ttl, state, workspace_id, bound_extension_id)
+        self._entries.move_to_end(token_hash)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return state, workspace_id, bound_extension_id
+    
+    def invalidate_workspace(self, workspace_id: str) -> None:
+        for token_hash in [key for key, entry in self._entries.items() if entry[2] == workspace_id]:
+            del self._entries[token_hash]
+    
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+binding_token_cache = BindingTokenCache()
+
+
 async def _validate_binding_token(request: Request) -> Tuple[str, str]:
     """Validate X-Workspace-Binding header, return (workspace_id, extension_id).
     
@@ -1530,25 +2312,41 @@ async def _validate_binding_token(request: Request) -> Tuple[str, str]:
     - No cookie/JWT fallback allowed
     - Revoked tokens return 403 (immediate termination)
     - Mismatched extension_id returns 403 (single-extension enforcement)
+    Lookups are cached by token hash (BindingTokenCache); regeneration and binding invalidate.
     """
     raw = request.headers.get("X-Workspace-Binding")
     if not raw:
         raise HTTPException(status_code=401, detail="Missing binding token")
     token_hash = _hash_token(raw)
-    selector = {"token_hash": token_hash, "revoked_at": None}
-    record = await db.workspace_binding_tokens.find_one(selector, sort=[("created_at", -1)])
-    if not record:
-        stale = await db.workspace_binding_tokens.find_one(
-            {"token_hash": token_hash},
+    # Apply pending revocations/bindings from other instances before trusting the cache
+    await extension_target_index.sync()
+    cached = binding_token_cache.get(token_hash)
+    if cached is None:
+        record = await db.workspace_binding_tokens.find_one(
+            {"token_hash": token_hash, "revoked_at": None},
+            {"_id": 0, "workspace_id": 1, "bound_extension_id": 1},
             sort=[("created_at", -1)]
         )
-        if stale and stale.get("revoked_at"):
-            raise HTTPException(status_code=403, detail="Token revoked")
+        if record:
+            cached = binding_token_cache.put(token_hash, "active", record["workspace_id"], record.get("bound_extension_id"))
+        else:
+            stale = await db.workspace_binding_tokens.find_one(
+                {"token_hash": token_hash},
+                {"_id": 0, "workspace_id": 1, "revoked_at": 1},
+                sort=[("created_at", -1)]
+            )
+            if stale and stale.get("revoked_at"):
+                cached = binding_token_cache.put(token_hash, "revoked", stale.get("workspace_id"))
+            else:
+                cached = binding_token_cache.put(token_hash, "invalid", stale.get("workspace_id") if stale else None)
+    state, workspace_id, bound_ext_id = cached
+    if state == "revoked":
+        raise HTTPException(status_code=403, detail="Token revoked")
+    if state != "active":
         raise HTTPException(status_code=401, detail="Invalid token")
-    bound_ext_id = record.get("bound_extension_id")
     if bound_ext_id and bound_ext_id != request.headers.get("X-Extension-Id"):
         raise HTTPException(status_code=403, detail="Token bound to another extension")
-    return record["workspace_id"], request.headers.get("X-Extension-Id")
+    return workspace_id, request.headers.get("X-Extension-Id")
 
 def normalize_url(url: str) -> str:
     parsed = urlparse(url)
@@ -1563,6 +2361,366 @@ def url_rule_matches(rule: ExtensionTargetUrlRule, url: str) -> bool:
         return url.startswith(rule.value)
     return False
 
+
+# ==========================================
+# EXTENSION TARGET INDEX
+# ==========================================
+# URL resolution for the browser extension runs against compiled in-memory indexes instead
+# of scanning extension_targets per page view: one per workspace (its active targets) and
+# one global index (active targets whose walkthrough is published and public). Every change
+# to a target or to a walkthrough's publish state appends to db.extension_changes under a
+# global sequence number; each process tails that log and patches its indexes, so a change
+# made on any instance is picked up everywhere within EXTENSION_INDEX_POLL_SECONDS. The same
+# log carries binding-token regenerations, which invalidate BindingTokenCache entries.
+
+EXTENSION_INDEX_POLL_SECONDS = 1.0  # How often resolution checks the change log
+EXTENSION_CHANGE_GAP_SECONDS = 5.0  # A sequence gap older than this is a change that never committed
+EXTENSION_CHANGE_BATCH = 500  # More pending changes than this: drop the indexes and rebuild lazily
+EXTENSION_INDEX_MAX_AGE_SECONDS = 900  # Rebuild from scratch this often as a backstop
+EXTENSION_INDEX_MAX_WORKSPACES = 2000  # Workspace indexes kept per process (least recently used dropped)
+EXTENSION_CHANGE_RETENTION_DAYS = 7
+
+
+class UrlTargetRecord:
+    """An active extension target, compiled for matching."""
+    __slots__ = ("target_id", "workspace_id", "walkthrough_id", "step_id", "selector", "order")
+
+    def __init__(self, target_id: str, workspace_id: str, walkthrough_id: str,
+                 step_id: Optional[str], selector: Optional[str], order: int = 0):
+        self.target_id = target_id
+        self.workspace_id = workspace_id
+        self.walkthrough_id = walkthrough_id
+        self.step_id = step_id
+        self.selector = selector
+        self.order = order
+
+
+class _UrlTrieNode:
+    __slots__ = ("children", "records")
+
+    def __init__(self):
+        self.children: Dict[str, "_UrlTrieNode"] = {}
+        self.records: Optional[List[UrlTargetRecord]] = None  # Prefix rules ending at this node
+
+
+class UrlRuleIndex:
+    """
+    Exact rules in a dict keyed by URL, prefix rules in a character trie. match() does one
+    dict lookup and one walk down the trie along the URL, so it costs O(len(url)) however
+    many rules there are. Matches come back in the order their rules were added.
+    """
+    __slots__ = ("exact", "root", "rules", "_next_order")
+
+    def __init__(self):
+        self.exact: Dict[str, List[UrlTargetRecord]] = {}
+        self.root = _UrlTrieNode()
+        self.rules: Dict[str, Tuple[str, str, UrlTargetRecord]] = {}  # target_id -> (type, value, record)
+        self._next_order = 0
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def add(self, rule_type: str, value: str, record: UrlTargetRecord) -> None:
+        self.remove(record.target_id)
+        record.order = self._next_order
+        self._next_order += 1
+        if rule_type == "exact":
+            self.exact.setdefault(value, []).append(record)
+        elif rule_type == "prefix":
+            node = self.root
+            for char in value:
+                node = node.children.setdefault(char, _UrlTrieNode())
+            if node.records is None:
+                node.records = []
+            node.records.append(record)
+        else:
+            return
+        self.rules[record.target_id] = (rule_type, value, record)
+
+    def remove(self, target_id: str) -> bool:
+        rule = self.rules.pop(target_id, None)
+        if rule is None:
+            return False
+        rule_type, value, record = rule
+        if rule_type == "exact":
+            bucket = self.exact[value]
+            bucket.remove(record)
+            if not bucket:
+                del self.exact[value]
+            return True
+        path = [self.root]
+        for char in value:
+            path.append(path[-1].children[char])
+        path[-1].records.remove(record)
+        if not path[-1].records:
+            path[-1].records = None
+        # Prune nodes that no longer lead to any rule
+        for depth in range(len(value), 0, -1):
+            node = path[depth]
+            if node.children or node.records:
+                break
+            del path[depth - 1].children[value[depth - 1]]
+        return True
+
+    def match(self, url: str) -> List[UrlTargetRecord]:
+        matches = list(self.exact.get(url, ()))
+        node = self.root
+        if node.records:
+            matches.extend(node.records)
+        for char in url:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.records:
+                matches.extend(node.records)
+        matches.sort(key=lambda record: record.order)
+        return matches
+
+
+def _url_target_record(doc: dict) -> Tuple[str, str, UrlTargetRecord]:
+    rule = doc.get("url_rule") or {}
+    record = UrlTargetRecord(doc["id"], doc["workspace_id"], doc["walkthrough_id"], doc.get("step_id"), doc.get("selector"))
+    return rule.get("type"), rule.get("value", ""), record
+
+
+def _is_public_walkthrough(doc: Optional[dict]) -> bool:
+    return bool(doc) and doc.get("status") == WalkthroughStatus.PUBLISHED and doc.get("privacy") == Privacy.PUBLIC
+
+
+EXTENSION_TARGET_PROJECTION = {"_id": 0, "id": 1, "workspace_id": 1, "walkthrough_id": 1, "step_id": 1, "selector": 1, "url_rule": 1, "status": 1}
+
+
+async def current_extension_change_seq() -> int:
+    counter = await db.counters.find_one({"_id": "extension_changes"})
+    return counter["seq"] if counter else 0
+
+
+async def record_extension_change(workspace_id: str, kind: Literal["target", "walkthrough", "binding"], entity_id: str) -> int:
+    """Append a change to the extension change log; call after the write it describes."""
+    counter = await db.counters.find_one_and_update(
+        {"_id": "extension_changes"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=True
+    )
+    await db.extension_changes.insert_one({
+        "seq": counter["seq"],
+        "workspace_id": workspace_id,
+        "kind": kind,
+        "entity_id": entity_id,
+        "at": datetime.now(timezone.utc).isoformat(),
+    })
+    # Read-your-writes on this instance: the next resolve applies the log right away
+    if kind == "binding":
+        binding_token_cache.invalidate_workspace(workspace_id)
+    extension_target_index.poke()
+    return counter["seq"]
+
+
+class ExtensionTargetIndex:
+    """
+    Lazily built UrlRuleIndex per workspace plus the global public one, kept current by
+    applying db.extension_changes in sequence order. Changes are applied contiguously: a gap
+    (a sequence allocated but not yet inserted) stops the scan until it fills in or is older
+    than EXTENSION_CHANGE_GAP_SECONDS.
+    
+    last_seq is a complete watermark only from exact_since on: every change in
+    (exact_since, last_seq] has been seen. Changes at or below exact_since may have been
+    missed, either because the position was (re)read from the counter while writes were in
+    flight or because a gap was skipped, so sync deltas must not start below it.
+    """
+
+    def __init__(self):
+        self.workspaces: "OrderedDict[str, UrlRuleIndex]" = OrderedDict()
+        self.public: Optional[UrlRuleIndex] = None
+        self.public_walkthroughs: set = set()  # (workspace_id, walkthrough_id) that are published + public
+        self.last_seq: Optional[int] = None
+        self.exact_since: Optional[int] = None
+        self._last_poll = 0.0
+        self._built_at = 0.0
+        self._gap_since: Optional[float] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def poke(self) -> None:
+        self._last_poll = 0.0
+
+    def reset(self) -> None:
+        self._drop_indexes()
+        self.last_seq = None
+        self.exact_since = None
+        self._gap_since = None
+
+    def _drop_indexes(self) -> None:
+        self.workspaces.clear()
+        self.public = None
+        self.public_walkthroughs = set()
+        binding_token_cache.clear()
+    
+    async def sync(self) -> None:
+        """Apply pending change log entries (at most one poll per EXTENSION_INDEX_POLL_SECONDS)."""
+        if time.monotonic() - self._last_poll < EXTENSION_INDEX_POLL_SECONDS:
+            return
+        async with self._get_lock():
+            await self._sync_locked()
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _sync_locked(self) -> None:
+        now = time.monotonic()
+        if now - self._last_poll < EXTENSION_INDEX_POLL_SECONDS:
+            return
+        if now - self._built_at > EXTENSION_INDEX_MAX_AGE_SECONDS:
+            # Indexes reload from the database; the log position is kept, so replaying
+            # changes they already reflect is harmless and sync deltas stay exact
+            self._drop_indexes()
+            self._built_at = now
+        self._last_poll = now
+        if self.last_seq is None:
+            # Read the sequence before loading anything: changes after it are replayed on top
+            self.last_seq = self.exact_since = await current_extension_change_seq()
+            self._built_at = now
+            return
+        changes = await db.extension_changes.find(
+            {"seq": {"$gt": self.last_seq}}, {"_id": 0}
+        ).sort("seq", ASCENDING).to_list(EXTENSION_CHANGE_BATCH + 1)
+        if len(changes) > EXTENSION_CHANGE_BATCH:
+            logging.info(f"[extension-index] {len(changes)}+ pending changes, rebuilding")
+            self.reset()
+            self.last_seq = self.exact_since = await current_extension_change_seq()
+            self._built_at = now
+            return
+        for change in changes:
+            if change["seq"] != self.last_seq + 1:
+                if self._gap_since is None:
+                    self._gap_since = now
+                if now - self._gap_since < EXTENSION_CHANGE_GAP_SECONDS:
+                    self._last_poll = 0.0  # Look again on the next call
+                    return
+                logging.warning(f"[extension-index] Skipping change sequence gap {self.last_seq + 1}..{change['seq'] - 1}")
+                # A skipped change may still land later: deltas over the gap could miss it
+                self.exact_since = change["seq"] - 1
+            self._gap_since = None
+            await self._apply(change)
+            self.last_seq = change["seq"]
+
+    async def _apply(self, change: dict) -> None:
+        workspace_id = change["workspace_id"]
+        if change["kind"] == "binding":
+            binding_token_cache.invalidate_workspace(workspace_id)
+            return
+        workspace_index = self.workspaces.get(workspace_id)
+        if change["kind"] == "target":
+            target_id = change["entity_id"]
+            if workspace_index is not None:
+                workspace_index.remove(target_id)
+            if self.public is not None:
+                self.public.remove(target_id)
+            doc = await db.extension_targets.find_one({"id": target_id}, EXTENSION_TARGET_PROJECTION)
+            if not doc or doc.get("status") != "active":
+                return
+            if workspace_index is not None:
+                workspace_index.add(*_url_target_record(doc))
+            if self.public is not None and (doc["workspace_id"], doc["walkthrough_id"]) in self.public_walkthroughs:
+                self.public.add(*_url_target_record(doc))
+        elif change["kind"] == "walkthrough" and self.public is not None:
+            key = (workspace_id, change["entity_id"])
+            walkthrough = await db.walkthroughs.find_one(
+                {"id": change["entity_id"], "workspace_id": workspace_id},
+                {"_id": 0, "status": 1, "privacy": 1}
+            )
+            is_public = _is_public_walkthrough(walkthrough)
+            if is_public == (key in self.public_walkthroughs):
+                return
+            if is_public:
+                self.public_walkthroughs.add(key)
+                async for doc in db.extension_targets.find(
+                    {"workspace_id": workspace_id, "walkthrough_id": change["entity_id"], "status": "active"},
+                    EXTENSION_TARGET_PROJECTION
+                ):
+                    self.public.add(*_url_target_record(doc))
+            else:
+                self.public_walkthroughs.discard(key)
+                stale = [target_id for target_id, (_, _, record) in self.public.rules.items()
+                         if (record.workspace_id, record.walkthrough_id) == key]
+                for target_id in stale:
+                    self.public.remove(target_id)
+
+    async def workspace(self, workspace_id: str) -> UrlRuleIndex:
+        """Current index of a workspace's active targets."""
+        async with self._get_lock():
+            await self._sync_locked()
+            index = self.workspaces.get(workspace_id)
+            if index is None:
+                index = UrlRuleIndex()
+                async for doc in db.extension_targets.find({"workspace_id": workspace_id, "status": "active"}, EXTENSION_TARGET_PROJECTION):
+                    index.add(*_url_target_record(doc))
+                self.workspaces[workspace_id] = index
+                while len(self.workspaces) > EXTENSION_INDEX_MAX_WORKSPACES:
+                    self.workspaces.popitem(last=False)
+            else:
+                self.workspaces.move_to_end(workspace_id)
+            return index
+
+    async def public_index(self) -> UrlRuleIndex:
+        """Current index of active targets on published, public walkthroughs across all workspaces."""
+        async with self._get_lock():
+            await self._sync_locked()
+            if self.public is None:
+                public_walkthroughs = set()
+                async for doc in db.walkthroughs.find(
+                    {"status": WalkthroughStatus.PUBLISHED, "privacy": Privacy.PUBLIC},
+                    {"_id": 0, "id": 1, "workspace_id": 1}
+                ):
+                    public_walkthroughs.add((doc["workspace_id"], doc["id"]))
+                index = UrlRuleIndex()
+                async for doc in db.extension_targets.find({"status": "active"}, EXTENSION_TARGET_PROJECTION):
+                    if (doc["workspace_id"], doc["walkthrough_id"]) in public_walkthroughs:
+                        index.add(*_url_target_record(doc))
+                self.public_walkthroughs = public_walkthroughs
+                self.public = index
+            return self.public
+
+
+extension_target_index = ExtensionTargetIndex()
+
+
+async def prune_extension_changes() -> None:
+    """Delete change log entries older than EXTENSION_CHANGE_RETENTION_DAYS."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=EXTENSION_CHANGE_RETENTION_DAYS)).isoformat()
+    await db.extension_changes.delete_many({"at": {"$lt": cutoff}})
+
+
+async def extension_change_floor() -> int:
+    """Highest sequence that may have been pruned: deltas can only start at or after it."""
+    oldest = await db.extension_changes.find_one({}, {"_id": 0, "seq": 1}, sort=[("seq", ASCENDING)])
+    if oldest:
+        return oldest["seq"] - 1
+    return await current_extension_change_seq()
+
+
+async def extension_walkthroughs_etag(workspace_id: str) -> str:
+    """
+    ETag for the extension walkthrough list: the workspace's latest walkthrough change, or the
+    prune floor once that has aged out (the floor is then above any sequence issued earlier).
+    """
+    latest = await db.extension_changes.find_one(
+        {"workspace_id": workspace_id, "kind": "walkthrough"},
+        {"_id": 0, "seq": 1},
+        sort=[("seq", DESCENDING)]
+    )
+    version = latest["seq"] if latest else await extension_change_floor()
+    return f'"{workspace_id}-{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
 def clear_auth_cookie(response: Response) -> None:
     response.delete_cookie(
         key=AUTH_COOKIE_NAME,
@@ -2454,17 +3612,38 @@ async def require_subscription_access(current_user: User = Depends(get_current_u
     
     return current_user
 
-async def get_user_storage_usage(user_id: str) -> int:
+def sum_stored_bytes(files: List[dict]) -> int:
+    """Total size of file records; de-duplicated references to one blob count once."""
+    counted_blobs = set()
+    total = 0
+    for file in files:
+        blob_id = file.get('blob_id')
+        if blob_id:
+            if blob_id in counted_blobs:
+                continue
+            counted_blobs.add(blob_id)
+        total += file.get('size_bytes', 0)
+    return total
+
+async def _compute_user_storage_usage(user_id: str) -> int:
     """Calculate total storage used by user (only active files).
     Includes both File records and files from existing walkthroughs that don't have File records yet.
     """
+    file_storage, untracked_storage = await _compute_user_storage_breakdown(user_id)
+    return file_storage + untracked_storage
+
+async def _compute_user_storage_breakdown(user_id: str) -> Tuple[int, int]:
+    """
+    (bytes of ACTIVE file records, estimated bytes of walkthrough media without a record) -
+    the two parts of _compute_user_storage_usage.
+    """
     # Count storage from File records
     active_files = await db.files.find(
         {"user_id": user_id, "status": FileStatus.ACTIVE},
-        {"size_bytes": 1, "url": 1}
+        {"size_bytes": 1, "url": 1, "blob_id": 1}
     ).to_list(10000)
     
-    file_storage = sum(file.get('size_bytes', 0) for file in active_files)
+    file_storage = sum_stored_bytes(active_files)
     tracked_urls = {file.get('url') for file in active_files if file.get('url')}
     
     # Also count storage from existing walkthroughs that don't have File records yet
@@ -2473,7 +3652,7 @@ async def get_user_storage_usage(user_id: str) -> int:
     workspace_ids = [w["id"] for w in workspaces]
     
     if not workspace_ids:
-        return file_storage
+        return file_storage, 0
     
     # Get all walkthroughs in user's workspaces
     walkthroughs = await db.walkthroughs.find(
@@ -2521,7 +3700,7 @@ async def get_user_storage_usage(user_id: str) -> int:
                             
                             # Try to get resource info from Cloudinary
                             try:
-                                resource = cloudinary.api.resource(public_id)
+                                resource = await storage_provider.stat(public_id) or {}
                                 file_size = resource.get('bytes', 0)
                                 if file_size > 0:
                                     untracked_storage += file_size
@@ -2546,7 +3725,50 @@ async def get_user_storage_usage(user_id: str) -> int:
                 untracked_storage += 200 * 1024  # Estimate 200KB for local files
             # Skip external URLs (not from our storage) - they don't count toward quota
     
-    return file_storage + untracked_storage
+    return file_storage, untracked_storage
+
+async def get_user_storage_usage(user_id: str) -> int:
+    """
+    Total storage used by a user (see _compute_user_storage_usage). Every computation is also
+    recorded on the user document (storage_used_bytes, storage_computed_at) for listings that
+    cannot afford computing it per row, together with its file-record part (storage_file_bytes)
+    for quota reconciliation.
+    """
+    file_storage, untracked_storage = await _compute_user_storage_breakdown(user_id)
+    used = file_storage + untracked_storage
+    try:
+        await db.users.update_one(
+            {"id": user_id},
+            {"$set": {
+                "storage_used_bytes": used,
+                "storage_file_bytes": file_storage,
+                "storage_computed_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+    except Exception as e:
+        logging.warning(f"[storage_usage] Failed to record storage figure for user {user_id}: {e}")
+    return used
+
+USER_STORAGE_FIGURE_MAX_AGE_SECONDS = 3600  # Recorded storage figures older than this are refreshed in the background
+USER_STORAGE_REFRESH_CONCURRENCY = 4
+_storage_refresh_in_flight: set = set()
+_storage_refresh_semaphore = asyncio.Semaphore(USER_STORAGE_REFRESH_CONCURRENCY)
+
+def schedule_storage_refresh(user_ids: List[str]) -> None:
+    """Recompute users' recorded storage figures in the background (each user once at a time)."""
+    async def refresh(user_id: str):
+        try:
+            async with _storage_refresh_semaphore:
+                await get_user_storage_usage(user_id)
+        except Exception as e:
+            logging.warning(f"[storage_usage] Background refresh failed for user {user_id}: {e}")
+        finally:
+            _storage_refresh_in_flight.discard(user_id)
+    
+    for user_id in user_ids:
+        if user_id and user_id not in _storage_refresh_in_flight:
+            _storage_refresh_in_flight.add(user_id)
+            asyncio.create_task(refresh(user_id))
 
 async def get_user_allowed_storage(user_id: str) -> int:
     """Get total storage allowed for user (plan storage + extra storage).
@@ -2623,104 +3845,614 @@ async def extract_file_urls_from_walkthrough(walkthrough: dict) -> List[str]:
     
     return urls
 
-async def delete_files_by_urls(urls: List[str], workspace_id: str) -> int:
+def _storage_delete_resource_types(resource_type: Optional[str]) -> List[str]:
+    """Resource types to try when deleting. "auto" uploads may have been stored as any of them."""
+    if resource_type in ("image", "video", "raw"):
+        return [resource_type]
+    return ["image", "video", "raw"]
+
+async def delete_files_batch(urls: List[str], workspace_id: str) -> Dict[str, Any]:
     """
-    Delete files by their URLs (for cascade deletion). Returns count of deleted files.
+    Batched cascade deletion of the ACTIVE file records behind urls in a workspace.
+    
+    One $in lookup finds the records, one update claims them (ACTIVE -> DELETING, tagged
+    with a batch id so concurrent deletions never process the same record), storage blobs
+    are removed with provider batch deletes (STORAGE_BATCH_DELETE_LIMIT per call, off the
+    event loop) and a single bulk_write records the outcome. Each URL occurrence deletes one
+    record, so a URL listed twice releases two de-duplicated references.
+    
+    Records whose blob could not be deleted stay DELETING (with deletion_error) and are
+    retried by retry_file_deletions.
+    
+    Returns {"requested", "deleted", "failed", "untracked", "items": [{file_id, url, result}]}
+    with result "deleted" | "not_found" (blob already gone) | "shared" (a de-duplicated
+    reference was released, the blob is still used) | "no_public_id" | "error".
     
     CRITICAL: Uses workspace_id instead of user_id because file records store
     user_id = workspace['owner_id'] for quota tracking. This ensures files uploaded
     by collaborators can be deleted correctly.
     """
-    if not urls:
-        return 0
-    
-    deleted_count = 0
+    report: Dict[str, Any] = {"requested": len(urls), "deleted": 0, "failed": 0, "untracked": 0, "items": []}
+    wanted = defaultdict(int)
     for url in urls:
-        # Find file record by URL and workspace_id
-        # Note: We use workspace_id because file.user_id = workspace.owner_id for quota tracking
-        file_record = await db.files.find_one(
-            {"url": url, "workspace_id": workspace_id, "status": FileStatus.ACTIVE},
-            {"_id": 0}
-        )
-        
-        if file_record:
-            # Delete file (idempotent)
-            try:
-                file_id = file_record['id']
-                
-                # Mark as deleting
-                await db.files.update_one(
-                    {"id": file_id},
-                    {"$set": {
-                        "status": FileStatus.DELETING,
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                
-                # Delete from Cloudinary (all files are stored in Cloudinary)
-                if file_record.get('public_id'):
-                    try:
-                        cloudinary.uploader.destroy(
-                            file_record['public_id'],
-                            resource_type=file_record.get('resource_type', 'auto')
-                        )
-                        logging.info(f"Deleted file {file_id} from Cloudinary: {file_record['public_id']}")
-                    except Exception as e:
-                        logging.warning(f"Cloudinary deletion failed for {file_id}: {str(e)}")
-                else:
-                    logging.warning(f"File {file_id} has no public_id, cannot delete from Cloudinary")
-                
-                # Mark as deleted
-                await db.files.update_one(
-                    {"id": file_id},
-                    {"$set": {
-                        "deleted_at": datetime.now(timezone.utc).isoformat(),
-                        "status": "deleted",
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                
-                deleted_count += 1
-            except Exception as e:
-                logging.error(f"Failed to delete file {file_record.get('id')}: {str(e)}")
-    
-    return deleted_count
+        if url:
+            wanted[url] += 1
+    if not wanted:
+        return report
+    
+    # Single lookup for every URL, then one record per URL occurrence
+    records = await db.files.find(
+        {"url": {"$in": list(wanted)}, "workspace_id": workspace_id, "status": FileStatus.ACTIVE},
+        {"_id": 0, "id": 1, "url": 1}
+    ).to_list(None)
+    records_by_url = defaultdict(list)
+    for record in records:
+        records_by_url[record["url"]].append(record["id"])
+    selected_ids = []
+    for url, count in wanted.items():
+        matches = records_by_url.get(url, [])
+        selected_ids.extend(matches[:count])
+        report["untracked"] += max(0, count - len(matches))
+    if not selected_ids:
+        return report
+    
+    await _delete_file_records(selected_ids, report)
+    logging.info(f"[delete_files_batch] workspace={workspace_id}: {report['deleted']} deleted, {report['failed']} failed, {report['untracked']} untracked of {report['requested']} URLs")
+    return report
+
+async def _delete_file_records(selected_ids: List[str], report: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Delete the given ACTIVE file records and their storage blobs, filling report's
+    deleted/failed/items. Records that are no longer ACTIVE are skipped.
+    """
+    # Claim: ACTIVE -> DELETING. Only records this batch moved are processed further.
+    batch_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    await db.files.update_many(
+        {"id": {"$in": selected_ids}, "status": FileStatus.ACTIVE},
+        {"$set": {"status": FileStatus.DELETING, "deletion_batch_id": batch_id, "updated_at": now}}
+    )
+    return await _destroy_claimed_files(batch_id, report)
 
-async def create_file_record_from_url(url: str, user_id: str, workspace_id: str, reference_type: str, reference_id: str) -> Optional[str]:
+async def _destroy_claimed_files(batch_id: str, report: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Lazy migration: Create file record from existing URL if it's an uploaded file.
-    Returns file_id if record created, None if external URL.
+    Release and destroy the storage blobs of the DELETING records tagged with batch_id.
+    
+    A record that failed before keeps the public_id/resource_type it has to destroy; when
+    that is a de-duplicated blob whose last reference it released, released_blob_id names the
+    media_blobs entry, which is removed only once the provider confirmed the delete.
+    """
+    claimed = await db.files.find(
+        {"deletion_batch_id": batch_id},
+        {"_id": 0, "id": 1, "url": 1, "public_id": 1, "resource_type": 1, "blob_id": 1, "released_blob_id": 1}
+    ).to_list(None)
+    media_url_cache.invalidate(*(record["id"] for record in claimed))
+    
+    # De-duplicated references: release per blob; only blobs whose last reference went are destroyed
+    results: Dict[str, str] = {}
+    to_destroy: Dict[str, Tuple[str, Optional[str]]] = {}  # file_id -> (public_id, resource_type)
+    released_blob_ids: Dict[str, str] = {}  # file_id -> media_blobs id to drop once its blob is destroyed
+    references_per_blob = defaultdict(list)
+    for record in claimed:
+        if record.get("blob_id"):
+            references_per_blob[record["blob_id"]].append(record)
+        elif record.get("public_id"):
+            to_destroy[record["id"]] = (record["public_id"], record.get("resource_type"))
+            if record.get("released_blob_id"):
+                released_blob_ids[record["id"]] = record["released_blob_id"]
+        else:
+            results[record["id"]] = "no_public_id"
+    for blob_id, blob_records in references_per_blob.items():
+        released_blob = await _release_media_blob(blob_id, len(blob_records))
+        for record in blob_records:
+            results[record["id"]] = "shared"
+        if released_blob:
+            # The blob's URL embeds its origin record's id, which was served through the blob
+            media_url_cache.invalidate(released_blob.get("origin_file_id"))
+            owner = blob_records[0]
+            to_destroy[owner["id"]] = (released_blob["public_id"], released_blob.get("resource_type"))
+            released_blob_ids[owner["id"]] = blob_id
+    
+    # Provider batch deletes, grouped by resource type
+    outcome_by_public_id: Dict[str, str] = {}
+    pending_by_type = defaultdict(list)
+    for public_id, resource_type in set(to_destroy.values()):
+        pending_by_type[tuple(_storage_delete_resource_types(resource_type))].append(public_id)
+    for resource_types, public_ids in pending_by_type.items():
+        remaining = public_ids
+        for resource_type in resource_types:
+            batch_results = await storage_provider.delete_batch(remaining, resource_type=resource_type)
+            outcome_by_public_id.update(batch_results)
+            # An "auto" upload that is not an image is retried as video, then raw
+            remaining = [pid for pid in remaining if batch_results.get(pid) == "not_found"]
+            if not remaining:
+                break
+    for file_id, (public_id, _) in to_destroy.items():
+        results[file_id] = outcome_by_public_id.get(public_id, "error")
+    
+    # A blob entry goes only after its stored object did; until then a failed record points at it
+    destroyed_blob_ids = [blob_id for file_id, blob_id in released_blob_ids.items() if results[file_id] != "error"]
+    if destroyed_blob_ids:
+        await db.media_blobs.delete_many({"id": {"$in": destroyed_blob_ids}, "ref_count": {"$lte": 0}})
+    
+    # Record outcomes in one round-trip; failed storage deletes stay DELETING for retry_file_deletions
+    done_ids = [file_id for file_id, result in results.items() if result != "error"]
+    failed_ids = [file_id for file_id, result in results.items() if result == "error"]
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    if done_ids:
+        operations.append(UpdateMany(
+            {"id": {"$in": done_ids}},
+            {"$set": {"status": "deleted", "deleted_at": now, "updated_at": now}, "$unset": {"deletion_batch_id": ""}}
+        ))
+    for file_id in failed_ids:
+        # The record carries what is left to destroy, so a retry does not depend on the blob entry
+        public_id, resource_type = to_destroy[file_id]
+        update: Dict[str, Any] = {"$set": {
+            "deletion_error": "storage delete failed",
+            "public_id": public_id,
+            "resource_type": resource_type,
+            "updated_at": now
+        }}
+        if file_id in released_blob_ids:
+            update["$set"]["released_blob_id"] = released_blob_ids[file_id]
+            update["$unset"] = {"blob_id": ""}
+        operations.append(UpdateOne({"id": file_id}, update))
+    if operations:
+        await db.files.bulk_write(operations, ordered=False)
+    
+    urls_by_id = {record["id"]: record["url"] for record in claimed}
+    report["items"] = [{"file_id": file_id, "url": urls_by_id.get(file_id), "result": result} for file_id, result in results.items()]
+    report["deleted"] = len(done_ids)
+    report["failed"] = len(failed_ids)
+    return report
+
+FILE_DELETION_RETRY_MINUTES = int(os.environ.get('FILE_DELETION_RETRY_MINUTES', '15'))
+FILE_DELETION_RETRY_BATCH = 200
+
+async def retry_file_deletions() -> Dict[str, int]:
+    """
+    Re-process file records stuck in DELETING: a failed storage delete, or a deletion that
+    died between claim and outcome. Records idle for FILE_DELETION_RETRY_MINUTES are
+    re-claimed under a new batch id, so a deletion still in progress is left alone.
+    Scheduled on the cluster scheduler.
     """
+    totals = {"retried": 0, "deleted": 0, "failed": 0}
+    while True:
+        now = datetime.now(timezone.utc)
+        cutoff = (now - timedelta(minutes=FILE_DELETION_RETRY_MINUTES)).isoformat()
+        stuck_query = {"status": FileStatus.DELETING, "updated_at": {"$lt": cutoff}}
+        stuck = await db.files.find(stuck_query, {"_id": 0, "id": 1}).limit(FILE_DELETION_RETRY_BATCH).to_list(None)
+        if not stuck:
+            break
+        batch_id = str(uuid.uuid4())
+        await db.files.update_many(
+            {**stuck_query, "id": {"$in": [record["id"] for record in stuck]}},
+            {"$set": {"deletion_batch_id": batch_id, "updated_at": now.isoformat()}}
+        )
+        report = await _destroy_claimed_files(batch_id, {"deleted": 0, "failed": 0, "items": []})
+        totals["retried"] += len(report["items"])
+        totals["deleted"] += report["deleted"]
+        totals["failed"] += report["failed"]
+    if totals["retried"]:
+        logging.info(f"[FILE_DELETION_RETRY] {totals['retried']} stuck deletions retried: {totals['deleted']} deleted, {totals['failed']} still failing")
+    return totals
+
+async def delete_files_by_urls(urls: List[str], workspace_id: str) -> int:
+    """Delete files by their URLs (for cascade deletion). Returns count of deleted files."""
+    report = await delete_files_batch(urls, workspace_id)
+    return report["deleted"]
+
+# ==========================================
+# MEDIA REFERENCE INDEX & ORPHAN GC
+# ==========================================
+# db.media_references is a reverse index: one entry per document that can embed uploaded media
+# (a walkthrough together with its version snapshots, a workspace, a category, a knowledge
+# system) listing the media keys it references. It is refreshed after every write to those
+# documents, so "is this file still used?" is one indexed query instead of a scan of every
+# walkthrough.
+#
+# A media key is the last path segment of a media URL without its extension. Every upload's
+# public_id and /api/media URL end in its file id, so the key is the file id (for de-duplicated
+# references: the origin record's id, which all references share). Legacy URLs fall back to
+# their own last segment. Extraction scans every string in the document rather than known
+# fields, so media inside rich text or new block types is never missed - a false reference only
+# delays collection, a missed one would delete live media.
+
+MEDIA_REFERENCE_SOURCES = {
+    "walkthrough": "walkthroughs",
+    "workspace": "workspaces",
+    "category": "categories",
+    "knowledge_system": "knowledge_systems",
+}
+MEDIA_URL_PATTERN = re.compile(r'(?:https?://res\.cloudinary\.com/|/api/media/)[^\s"\'<>()\\]+')
+
+MEDIA_GC_INTERVAL_HOURS = int(os.environ.get('MEDIA_GC_INTERVAL_HOURS', '24'))
+MEDIA_GC_GRACE_HOURS = int(os.environ.get('MEDIA_GC_GRACE_HOURS', '72'))  # Minimum file age, and minimum time marked orphaned before deletion
+MEDIA_GC_DRY_RUN = os.environ.get('MEDIA_GC_DRY_RUN', 'true').lower() == 'true'  # Scheduled runs only report until explicitly enabled
+MEDIA_GC_SCAN_BATCH = 500
+MEDIA_GC_DELETE_BATCH = 100
+MEDIA_GC_DELETES_PER_SECOND = float(os.environ.get('MEDIA_GC_DELETES_PER_SECOND', '10'))
+MEDIA_GC_REPORT_ITEMS = 200  # Items kept in a stored run report
+
+def media_key_from_url(url: Optional[str]) -> Optional[str]:
+    """Reference-index key for a media URL (the upload's file id for uploads made by this app)."""
     if not url:
         return None
+    path = url.split('?', 1)[0].split('#', 1)[0].rstrip('/')
+    segment = path.rsplit('/', 1)[-1]
+    key = segment.rsplit('.', 1)[0] if '.' in segment else segment
+    return key or None
+
+def extract_media_keys(document: Any) -> List[str]:
+    """Media keys referenced anywhere in a document (nested dicts/lists, rich text included)."""
+    keys = set()
+    pending = [document]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, str):
+            if 'res.cloudinary.com' in value or '/api/media/' in value:
+                for url in MEDIA_URL_PATTERN.findall(value):
+                    key = media_key_from_url(url)
+                    if key:
+                        keys.add(key)
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+    return sorted(keys)
+
+async def refresh_media_references(owner_type: str, owner_id: str) -> None:
+    """
+    Recompute one document's entry in the reference index; the entry is removed when the
+    document is gone. Never raises - the GC re-indexes a workspace before deleting from it,
+    so a missed refresh only delays collection.
+    """
+    entry_id = f"{owner_type}:{owner_id}"
+    try:
+        document = await db[MEDIA_REFERENCE_SOURCES[owner_type]].find_one({"id": owner_id}, {"_id": 0})
+        if not document:
+            await db.media_references.delete_one({"id": entry_id})
+            return
+        sources = [document]
+        if owner_type == "walkthrough":
+            # Rollback can restore media from any retained version
+            sources.extend(await db.walkthrough_versions.find(
+                {"walkthrough_id": owner_id}, {"_id": 0, "snapshot": 1}
+            ).to_list(None))
+        workspace_id = owner_id if owner_type == "workspace" else document.get("workspace_id")
+        await db.media_references.update_one(
+            {"id": entry_id},
+            {"$set": {
+                "owner_type": owner_type,
+                "owner_id": owner_id,
+                "workspace_id": workspace_id,
+                "media_keys": extract_media_keys(sources),
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
+        )
+    except Exception as e:
+        logging.warning(f"[MEDIA_REFS] Failed to refresh {entry_id}: {e}")
+
+async def rebuild_media_references(workspace_id: Optional[str] = None) -> int:
+    """Re-index every referencing document (or those of one workspace). Returns documents indexed."""
+    indexed = 0
+    for owner_type, collection_name in MEDIA_REFERENCE_SOURCES.items():
+        if workspace_id is None:
+            query = {}
+        elif owner_type == "workspace":
+            query = {"id": workspace_id}
+        else:
+            query = {"workspace_id": workspace_id}
+        async for document in db[collection_name].find(query, {"_id": 0, "id": 1}).batch_size(MEDIA_GC_SCAN_BATCH):
+            await refresh_media_references(owner_type, document["id"])
+            indexed += 1
+    if workspace_id is None:
+        # Entries of deleted documents (removed outside the refresh hooks) would pin their media forever
+        for owner_type, collection_name in MEDIA_REFERENCE_SOURCES.items():
+            async for entry in db.media_references.find({"owner_type": owner_type}, {"_id": 0, "owner_id": 1}).batch_size(MEDIA_GC_SCAN_BATCH):
+                if not await db[collection_name].find_one({"id": entry["owner_id"]}, {"_id": 0, "id": 1}):
+                    await db.media_references.delete_one({"id": f"{owner_type}:{entry['owner_id']}"})
+    return indexed
+
+async def referenced_media_keys(keys: List[str]) -> set:
+    """The subset of keys referenced by any indexed document."""
+    if not keys:
+        return set()
+    wanted = set(keys)
+    found = await db.media_references.distinct("media_keys", {"media_keys": {"$in": list(wanted)}})
+    return wanted.intersection(found)
+
+async def run_media_gc(dry_run: bool = True, max_files: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Mark-and-sweep collection of uploaded media no document references.
     
-    # Check if URL is from our storage (Cloudinary or local)
-    is_uploaded_file = False
-    public_id = None
+    Mark: ACTIVE files older than the grace period are scanned in keyset pages of
+    MEDIA_GC_SCAN_BATCH (by id) and checked against the reference index. Unreferenced files
+    get orphaned_at; files that are referenced again lose it.
     
-    if USE_CLOUDINARY:
-        # Check if it's a Cloudinary URL
-        if 'res.cloudinary.com' in url:
-            is_uploaded_file = True
-            # Extract public_id from URL
-            try:
-                # Cloudinary URL format: https://res.cloudinary.com/{cloud_name}/{resource_type}/upload/{transformations}/{public_id}.{format}
-                parts = url.split('/')
-                if 'upload' in parts:
-                    upload_idx = parts.index('upload')
-                    if upload_idx + 1 < len(parts):
-                        # Get public_id (everything after upload, minus extension)
-                        public_id_part = parts[-1]
-                        public_id = public_id_part.rsplit('.', 1)[0] if '.' in public_id_part else public_id_part
-            except Exception:
-                pass
-    else:
-        # Check if it's a local storage URL
-        if url.startswith('/api/media/'):
-            is_uploaded_file = True
+    Sweep: one workspace at a time, files marked for longer than the grace period are read
+    back in keyset pages of MEDIA_GC_DELETE_BATCH, re-checked after the workspace is
+    re-indexed from source, then deleted through _delete_file_records, throttled to
+    MEDIA_GC_DELETES_PER_SECOND. Neither phase holds more than a page of files in memory.
     
-    if not is_uploaded_file:
-        # External URL, don't create file record
+    dry_run only reports what each phase would do. The reference index is backfilled once
+    before the first sweep, so files uploaded before it existed are never judged against an
+    empty index. Every run is stored in db.media_gc_runs.
+    """
+    started_at = datetime.now(timezone.utc)
+    grace_cutoff = (started_at - timedelta(hours=MEDIA_GC_GRACE_HOURS)).isoformat()
+    report: Dict[str, Any] = {
+        "id": str(uuid.uuid4()),
+        "dry_run": dry_run,
+        "started_at": started_at.isoformat(),
+        "grace_hours": MEDIA_GC_GRACE_HOURS,
+        "scanned": 0,
+        "referenced": 0,
+        "newly_marked": 0,
+        "unmarked": 0,
+        "eligible": 0,
+        "rescued": 0,
+        "deleted": 0,
+        "failed": 0,
+        "reclaimable_bytes": 0,
+        "items": [],
+    }
+    
+    index_state = await db.media_gc_state.find_one({"id": "reference_index"}, {"_id": 0})
+    if not index_state or not index_state.get("backfilled_at"):
+        report["backfilled"] = await rebuild_media_references()
+        await db.media_gc_state.update_one(
+            {"id": "reference_index"},
+            {"$set": {"backfilled_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+    
+    # Mark
+    last_id = ""
+    while max_files is None or report["scanned"] < max_files:
+        page_size = MEDIA_GC_SCAN_BATCH if max_files is None else min(MEDIA_GC_SCAN_BATCH, max_files - report["scanned"])
+        page = await db.files.find(
+            {"status": FileStatus.ACTIVE, "created_at": {"$lt": grace_cutoff}, "id": {"$gt": last_id}},
+            {"_id": 0, "id": 1, "workspace_id": 1, "url": 1, "size_bytes": 1, "blob_id": 1, "orphaned_at": 1}
+        ).sort("id", ASCENDING).limit(page_size).to_list(None)
+        if not page:
+            break
+        last_id = page[-1]["id"]
+        report["scanned"] += len(page)
+        
+        keys = {record["id"]: media_key_from_url(record.get("url")) for record in page}
+        referenced = await referenced_media_keys([key for key in keys.values() if key])
+        now = datetime.now(timezone.utc).isoformat()
+        unmark_ids, mark_ids = [], []
+        for record in page:
+            key = keys[record["id"]]
+            if not key or key in referenced:
+                report["referenced"] += 1
+                if record.get("orphaned_at"):
+                    unmark_ids.append(record["id"])
+            elif not record.get("orphaned_at"):
+                mark_ids.append(record["id"])
+        report["newly_marked"] += len(mark_ids)
+        report["unmarked"] += len(unmark_ids)
+        if not dry_run:
+            if unmark_ids:
+                await db.files.update_many({"id": {"$in": unmark_ids}}, {"$unset": {"orphaned_at": ""}})
+            if mark_ids:
+                await db.files.update_many({"id": {"$in": mark_ids}, "orphaned_at": {"$exists": False}}, {"$set": {"orphaned_at": now}})
+    
+    # Sweep: only files this run scanned (ids up to last_id) that were marked before the grace cutoff
+    eligible_query = {
+        "status": FileStatus.ACTIVE,
+        "created_at": {"$lt": grace_cutoff},
+        "orphaned_at": {"$lt": grace_cutoff},
+        "id": {"$lte": last_id}
+    }
+    min_interval = 1.0 / MEDIA_GC_DELETES_PER_SECOND if MEDIA_GC_DELETES_PER_SECOND > 0 else 0
+    workspaces = db.files.aggregate([
+        {"$match": eligible_query},
+        {"$group": {"_id": "$workspace_id"}},
+        {"$sort": {"_id": ASCENDING}}
+    ])
+    async for group in workspaces:
+        workspace_id = group["_id"]
+        workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0, "id": 1, "deletion_job_id": 1}) if workspace_id else None
+        if workspace and workspace.get("deletion_job_id"):
+            continue  # The workspace deletion job owns these files
+        if workspace:
+            # Writes that missed their refresh must not cost live media
+            await rebuild_media_references(workspace_id)
+        
+        last_candidate_id = ""
+        while True:
+            candidates = await db.files.find(
+                {**eligible_query, "workspace_id": workspace_id, "id": {"$gt": last_candidate_id, "$lte": last_id}},
+                {"_id": 0, "id": 1, "url": 1, "size_bytes": 1, "blob_id": 1}
+            ).sort("id", ASCENDING).limit(MEDIA_GC_DELETE_BATCH).to_list(None)
+            if not candidates:
+                break
+            last_candidate_id = candidates[-1]["id"]
+            still_referenced = await referenced_media_keys([media_key_from_url(record.get("url")) for record in candidates])
+            orphans = [record for record in candidates if media_key_from_url(record.get("url")) not in still_referenced]
+            report["rescued"] += len(candidates) - len(orphans)
+            report["eligible"] += len(orphans)
+            # De-duplicated references share a blob; only count its bytes once per page
+            report["reclaimable_bytes"] += sum_stored_bytes(orphans)
+            if not orphans:
+                continue
+            
+            if dry_run:
+                results = [{"file_id": record["id"], "url": record.get("url"), "result": "would_delete"} for record in orphans]
+            else:
+                batch_started = time.monotonic()
+                batch_report = await _delete_file_records([record["id"] for record in orphans], {"items": []})
+                report["deleted"] += batch_report.get("deleted", 0)
+                report["failed"] += batch_report.get("failed", 0)
+                results = batch_report["items"]
+                # Rate limit provider deletes across the whole sweep
+                await asyncio.sleep(max(0.0, len(orphans) * min_interval - (time.monotonic() - batch_started)))
+            for item in results:
+                if len(report["items"]) < MEDIA_GC_REPORT_ITEMS:
+                    report["items"].append({**item, "workspace_id": workspace_id})
+    
+    report["finished_at"] = datetime.now(timezone.utc).isoformat()
+    try:
+        await db.media_gc_runs.insert_one(dict(report))
+    except Exception as e:
+        logging.warning(f"[MEDIA_GC] Failed to store run report: {e}")
+    logging.info(
+        f"[MEDIA_GC] {'Dry run' if dry_run else 'Run'}: scanned={report['scanned']} marked={report['newly_marked']} "
+        f"unmarked={report['unmarked']} eligible={report['eligible']} rescued={report['rescued']} "
+        f"deleted={report['deleted']} failed={report['failed']}"
+    )
+    return report
+
+async def ensure_media_reference_indexes():
+    """Indexes for the media reference index and orphan GC."""
+    try:
+        await db.media_references.create_index([("id", ASCENDING)], unique=True, name="media_references_id_unique")
+        await db.media_references.create_index([("media_keys", ASCENDING)], name="media_references_keys")
+        await db.media_references.create_index([("owner_type", ASCENDING), ("owner_id", ASCENDING)], name="media_references_owner")
+        await db.files.create_index([("status", ASCENDING), ("id", ASCENDING)], name="files_status_id")
+        await db.files.create_index(
+            [("workspace_id", ASCENDING), ("id", ASCENDING)],
+            partialFilterExpression={"orphaned_at": {"$exists": True}},
+            name="files_orphaned_workspace_id"
+        )
+        await db.media_gc_runs.create_index([("started_at", DESCENDING)], name="media_gc_runs_started_at")
+        logging.info("[ensure_media_reference_indexes] Media reference indexes ensured")
+        return True
+    except Exception as e:
+        logging.error(f"[ensure_media_reference_indexes] Failed to create indexes: {e}", exc_info=True)
+        return False
+
+# ==========================================
+# MEDIA MANIFEST
+# ==========================================
+# Publishing a walkthrough stores a manifest of responsive variants of its media on the
+# walkthrough (media_manifest). Portal payloads carry it unchanged so clients can pick the
+# smallest suitable asset: a srcset width bucket for images, a video or animated WebP
+# alternate for GIFs, a poster frame. Media without an entry is served from its original URL.
+
+MEDIA_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+MEDIA_VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mov', '.avi', '.mkv')
+
+def media_kind(url: str, media_type: Optional[str] = None) -> Optional[str]:
+    """"image", "gif" or "video" for a media URL (media_type is the editor's hint), None otherwise."""
+    path = url.split('?', 1)[0].lower()
+    if path.endswith('.svg'):
+        return None
+    if path.endswith('.gif'):
+        return "gif"
+    if '/video/upload/' in path or path.endswith(MEDIA_VIDEO_EXTENSIONS):
+        return "video"
+    if '/image/upload/' in path or path.endswith(MEDIA_IMAGE_EXTENSIONS):
+        return "image"
+    return media_type if media_type in ("image", "gif", "video") else None
+
+def collect_walkthrough_media(walkthrough: dict) -> List[Tuple[str, Optional[str]]]:
+    """(url, media_type hint) of the icon, step media and image/GIF/video blocks, in order, without duplicates."""
+    found: Dict[str, Optional[str]] = {}
+    
+    def add(url, media_type=None):
+        if isinstance(url, str) and url and url not in found:
+            found[url] = media_type
+    
+    add(walkthrough.get('icon_url'), "image")
+    for step in walkthrough.get('steps') or []:
+        add(step.get('media_url'), step.get('media_type'))
+        for block in step.get('blocks') or []:
+            data = block.get('data') or {}
+            block_type = block.get('type')
+            if block_type in ('image', 'annotated_image'):
+                add(data.get('url'), "image")
+            elif block_type == 'video' and data.get('type') != 'youtube':
+                add(data.get('url'), "video")
+            elif block_type == 'carousel':
+                for slide in data.get('slides') or []:
+                    add(slide.get('url'), slide.get('media_type'))
+    return list(found.items())
+
+async def build_media_manifest(walkthrough: dict, previous: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    Media manifest for a walkthrough:
+    {"provider", "generated_at", "items": [{"url", "kind", "srcset", "sources", "poster"}]}.
+    
+    Items of a previous manifest built by the same provider are reused, so republishing
+    only processes new media. Media the provider cannot (or failed to) process gets no item.
+    """
+    reusable: Dict[str, Dict[str, Any]] = {}
+    if previous and previous.get("provider") == storage_provider.name:
+        reusable = {item["url"]: item for item in previous.get("items", []) if item.get("url")}
+    
+    wanted = []
+    for url, media_type in collect_walkthrough_media(walkthrough):
+        kind = media_kind(url, media_type)
+        if kind and storage_provider.owns_url(url):
+            wanted.append((url, kind))
+    pending = [(url, kind) for url, kind in wanted if url not in reusable]
+    
+    public_ids: Dict[str, Optional[str]] = {}
+    if pending:
+        records = await db.files.find(
+            {"url": {"$in": [url for url, _ in pending]}, "status": FileStatus.ACTIVE},
+            {"_id": 0, "url": 1, "public_id": 1}
+        ).to_list(None)
+        public_ids = {record["url"]: record.get("public_id") for record in records}
+    
+    async def manifest_item(url: str, kind: str) -> Optional[Dict[str, Any]]:
+        try:
+            variants = await storage_provider.media_variants(url, kind, public_ids.get(url))
+        except Exception as e:
+            logging.warning(f"[MEDIA_MANIFEST] Variant generation failed for {url}: {e}")
+            return None
+        return {"url": url, "kind": kind, **variants} if variants else None
+    
+    generated = await asyncio.gather(*(manifest_item(url, kind) for url, kind in pending))
+    fresh = {item["url"]: item for item in generated if item}
+    items = [reusable.get(url) or fresh.get(url) for url, _ in wanted]
+    return {
+        "provider": storage_provider.name,
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "items": [item for item in items if item],
+    }
+
+async def create_file_record_from_url(url: str, user_id: str, workspace_id: str, reference_type: str, reference_id: str) -> Optional[str]:
+    """
+    Lazy migration: Create file record from existing URL if it's an uploaded file.
+    Returns file_id if record created, None if external URL.
+    """
+    if not url:
+        return None
+    
+    # Check if URL is from our storage (Cloudinary or local)
+    is_uploaded_file = False
+    public_id = None
+    
+    if USE_CLOUDINARY:
+        # Check if it's a Cloudinary URL
+        if 'res.cloudinary.com' in url:
+            is_uploaded_file = True
+            # Extract public_id from URL
+            try:
+                # Cloudinary URL format: https://res.cloudinary.com/{cloud_name}/{resource_type}/upload/{transformations}/{public_id}.{format}
+                parts = url.split('/')
+                if 'upload' in parts:
+                    upload_idx = parts.index('upload')
+                    if upload_idx + 1 < len(parts):
+                        # Get public_id (everything after upload, minus extension)
+                        public_id_part = parts[-1]
+                        public_id = public_id_part.rsplit('.', 1)[0] if '.' in public_id_part else public_id_part
+            except Exception:
+                pass
+    else:
+        # Check if it's a local storage URL
+        if url.startswith('/api/media/'):
+            is_uploaded_file = True
+    
+    if not is_uploaded_file:
+        # External URL, don't create file record
         return None
     
     # Check if file record already exists
@@ -2732,7 +4464,7 @@ async def create_file_record_from_url(url: str, user_id: str, workspace_id: str,
     size_bytes = 0
     if USE_CLOUDINARY and public_id:
         try:
-            resource = cloudinary.api.resource(public_id)
+            resource = await storage_provider.stat(public_id) or {}
             size_bytes = resource.get('bytes', 0)
         except Exception:
             # If can't get size, estimate or use 0 (will be recalculated)
@@ -2886,7 +4618,7 @@ async def assign_free_plan_to_user(user_id: str):
 
 # Auth Routes
 @api_router.post("/auth/signup")
-async def signup(user_data: UserCreate, background_tasks: BackgroundTasks, response: Response, request: Request):
+async def signup(user_data: UserCreate, response: Response, request: Request):
     client_ip = request.client.host if request.client else "unknown"
     enforce_auth_rate_limit(f"signup:{client_ip}:{user_data.email}")
     existing = await db.users.find_one({"email": user_data.email})
@@ -2919,20 +4651,14 @@ async def signup(user_data: UserCreate, background_tasks: BackgroundTasks, respo
     # Automatically assign Free plan to new users
     await assign_free_plan_to_user(user.id)
     
-    # Schedule verification email sending as background task (non-blocking)
-    # Email will be sent after HTTP response is returned - never blocks signup
-    logging.info(f"[SIGNUP] Scheduling email background task for user_id={user.id} email={user_data.email}")
+    # Queue the verification email (outbox, never blocks signup)
+    logging.info(f"[SIGNUP] Queueing verification email for user_id={user.id} email={user_data.email}")
     try:
-        background_tasks.add_task(
-            send_verification_email_background,
-            user.id,
-            user_data.email,
-            user_data.name,
-            verification_token
-        )
-        logging.info(f"[SIGNUP] Background task scheduled successfully for user_id={user.id}")
+        verify_url = f"{MAIN_DOMAIN}/verify-email?token={verification_token}"
+        await queue_email(render_verification_email(user_data.email, verify_url, user_data.name), "verification", priority=TASK_PRIORITY_HIGH)
+        logging.info(f"[SIGNUP] Verification email queued for user_id={user.id}")
     except Exception as e:
-        logging.error(f"[SIGNUP] Failed to schedule background task for user_id={user.id}: {str(e)}", exc_info=True)
+        logging.error(f"[SIGNUP] Failed to queue verification email for user_id={user.id}: {str(e)}", exc_info=True)
     
     # Refresh user data to include plan_id
     user_doc = await db.users.find_one({"id": user.id}, {"_id": 0})
@@ -3087,7 +4813,6 @@ async def verify_email(token: str = Query(..., description="Email verification t
 
 @api_router.post("/auth/resend-verification")
 async def resend_verification_email(
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -3134,15 +4859,9 @@ async def resend_verification_email(
         }
     )
     
-    # Schedule verification email sending as background task (non-blocking)
-    # Email will be sent after HTTP response is returned - never blocks the request
-    background_tasks.add_task(
-        send_verification_email_background,
-        current_user.id,
-        current_user.email,
-        current_user.name,
-        verification_token
-    )
+    # Queue the verification email (outbox, never blocks the request)
+    verify_url = f"{MAIN_DOMAIN}/verify-email?token={verification_token}"
+    await queue_email(render_verification_email(current_user.email, verify_url, current_user.name), "verification", priority=TASK_PRIORITY_HIGH)
     
     # Return immediately - email sending happens in background
     return {
@@ -3194,7 +4913,6 @@ async def dismiss_onboarding(current_user: User = Depends(get_current_user)):
 @api_router.post("/auth/forgot-password")
 async def forgot_password(
     request: ForgotPasswordRequest,
-    background_tasks: BackgroundTasks,
     http_request: Request
 ):
     """
@@ -3226,14 +4944,9 @@ async def forgot_password(
                 }
             )
 
-            # Send reset email in background
+            # Queue the reset email
             reset_url = f"{MAIN_DOMAIN}/reset-password?token={reset_token}"
-            background_tasks.add_task(
-                send_password_reset_email,
-                request.email,
-                reset_url,
-                user_doc.get('name')
-            )
+            await queue_email(render_password_reset_email(request.email, reset_url, user_doc.get('name')), "password_reset", priority=TASK_PRIORITY_HIGH)
 
         # Always return success to prevent user enumeration
         return {
@@ -3424,7 +5137,6 @@ async def can_user_share_workspaces(user_id: str) -> bool:
 async def invite_user_to_workspace(
     workspace_id: str,
     invite_data: InviteRequest,
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user)
 ):
     """
@@ -3540,15 +5252,10 @@ async def invite_user_to_workspace(
             raise HTTPException(status_code=400, detail="User already has a pending or accepted invitation")
         raise HTTPException(status_code=500, detail=f"Failed to create invitation: {error_detail}")
     
-    # Send invitation email (background task)
-    background_tasks.add_task(
-        send_invitation_email,
-        invite_data.email,
-        workspace['name'],
-        current_user.name,
-        member.role.value,
-        invite_token,
-        invite_expires_at
+    # Queue the invitation email
+    await queue_email(
+        render_invitation_email(invite_data.email, workspace['name'], current_user.name, member.role.value, invite_expires_at),
+        "invitation"
     )
     
     return {
@@ -4134,6 +5841,7 @@ async def create_workspace(workspace_data: WorkspaceCreate, current_user: User =
     workspace_dict = workspace.model_dump()
     workspace_dict['created_at'] = workspace_dict['created_at'].isoformat()
     await db.workspaces.insert_one(workspace_dict)
+    await refresh_media_references("workspace", workspace.id)
     
     member = WorkspaceMember(
         workspace_id=workspace.id,
@@ -4188,7 +5896,11 @@ async def get_workspaces(current_user: User = Depends(require_subscription_acces
     if not all_workspace_ids:
         return []
     
-    workspaces = await db.workspaces.find({"id": {"$in": all_workspace_ids}}, {"_id": 0}).to_list(100)
+    # Workspaces being deleted by a background job are hidden
+    workspaces = await db.workspaces.find(
+        {"id": {"$in": all_workspace_ids}, "deletion_job_id": {"$exists": False}},
+        {"_id": 0}
+    ).to_list(100)
     return [Workspace(**w) for w in workspaces]
 
 @api_router.get("/workspaces/{workspace_id}", response_model=Workspace)
@@ -4197,7 +5909,7 @@ async def get_workspace(workspace_id: str, current_user: User = Depends(require_
     workspace = await db.workspaces.find_one({"slug": workspace_id}, {"_id": 0})
     if not workspace:
         workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0})
-    if not workspace:
+    if not workspace or workspace.get("deletion_job_id"):
         raise HTTPException(status_code=404, detail="Workspace not found")
     
     # Use the actual workspace ID for access check
@@ -4218,6 +5930,7 @@ async def update_workspace(workspace_id: str, workspace_data: WorkspaceCreate, c
         {"id": workspace_id},
         {"$set": update_data}
     )
+    await refresh_media_references("workspace", workspace_id)
     
     workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0})
     
@@ -4235,173 +5948,38 @@ async def update_workspace(workspace_id: str, workspace_data: WorkspaceCreate, c
     
     return Workspace(**workspace)
 
-@api_router.delete("/workspaces/{workspace_id}")
+@api_router.delete("/workspaces/{workspace_id}", status_code=202)
 async def delete_workspace(workspace_id: str, current_user: User = Depends(get_current_user)):
     """
-    Delete workspace and all associated data (cascade delete).
+    Delete workspace and all associated data (cascade delete) as a background job.
     This will permanently delete:
-    - All walkthroughs (and their files)
+    - All walkthroughs and their versions
     - All categories
-    - All workspace files (logo, background)
+    - All workspace files (walkthrough media, logo, background, category icons)
     - All workspace members
     Only workspace owner can delete workspace.
     All members are notified when workspace is deleted.
+    
+    Returns 202 with the job; progress is available from GET /api/jobs/{job_id}. The
+    workspace disappears from listings immediately and repeating the call returns the same job.
     """
-    try:
-        workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0, "owner_id": 1, "name": 1})
-        if not workspace:
-            raise HTTPException(status_code=404, detail="Workspace not found")
-        if current_user.role != UserRole.ADMIN and workspace.get("owner_id") != current_user.id:
-            raise HTTPException(status_code=403, detail="Only workspace owner or admin can delete workspace")
-
-        # Get workspace name for notifications
-        try:
-            workspace_name = workspace.get("name", "Unknown")
-        except Exception as db_error:
-            logging.error(f"Failed to get workspace name: {db_error}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error while accessing workspace")
-
-        # Get all members to notify
-        try:
-            members = await get_workspace_members(workspace_id)
-        except Exception as member_error:
-            logging.error(f"Failed to get workspace members: {member_error}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error while getting workspace members")
-
-        try:
-            workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0})
-        except Exception as workspace_error:
-            logging.error(f"Failed to get workspace details: {workspace_error}", exc_info=True)
-            raise
-
-        # HARDENING LAYER A: Force-release all locks before deletion
-        try:
-            all_locks = await db.workspace_locks.find({"workspace_id": workspace_id}, {"_id": 0}).to_list(100)
-            for lock_doc in all_locks:
-                await release_workspace_lock(workspace_id, lock_doc['locked_by_user_id'], force=True, reason="Workspace deleted")
-        except Exception as lock_error:
-            logging.error(f"Failed to release workspace locks: {lock_error}", exc_info=True)
-            # Continue with deletion even if lock release fails
-
-        # HARDENING LAYER C: Audit log
-        try:
-            await log_workspace_audit(
-                action_type=WorkspaceAuditAction.WORKSPACE_DELETED,
-                workspace_id=workspace_id,
-                actor_user_id=current_user.id,
-                metadata={"workspace_name": workspace_name, "deleted_by_name": current_user.name, "member_count": len(members)}
-            )
-        except Exception as audit_error:
-            logging.error(f"Failed to log workspace deletion audit: {audit_error}", exc_info=True)
-            # Continue with deletion even if audit logging fails
-
-        # Notify all members that workspace is being deleted (not batched - workspace deletion is never batched)
-        for member in members:
-            try:
-                await create_notification(
-                    user_id=member.user_id,
-                    notification_type=NotificationType.WORKSPACE_DELETED,
-                    title="Workspace Deleted",
-                    message=f"The workspace \"{workspace_name}\" has been deleted by {current_user.name}. You no longer have access to this workspace.",
-                    metadata={"workspace_id": workspace_id, "deleted_by_id": current_user.id, "deleted_by_name": current_user.name}
-                )
-            except Exception as notification_error:
-                logging.error(f"Failed to notify member {member.user_id}: {notification_error}", exc_info=True)
-                # Continue with deletion even if notification fails
-
-        # Get all walkthroughs in workspace for cascade file deletion
-        try:
-            walkthroughs = await db.walkthroughs.find({"workspace_id": workspace_id}, {"_id": 0}).to_list(10000)
-        except Exception as walkthrough_error:
-            logging.error(f"Failed to get walkthroughs for deletion: {walkthrough_error}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error while accessing walkthroughs")
-
-        # Delete all files associated with walkthroughs
-        total_deleted_files = 0
-        for walkthrough in walkthroughs:
-            try:
-                file_urls = await extract_file_urls_from_walkthrough(walkthrough)
-                deleted_count = await delete_files_by_urls(file_urls, workspace_id)
-                total_deleted_files += deleted_count
-            except Exception as file_error:
-                logging.error(f"Failed to delete files for walkthrough {walkthrough.get('id')}: {file_error}", exc_info=True)
-                # Continue with other walkthroughs
-
-        # Delete workspace logo and background files
-        workspace_file_urls = []
-        if workspace.get('logo'):
-            workspace_file_urls.append(workspace['logo'])
-        if workspace.get('portal_background_url'):
-            workspace_file_urls.append(workspace['portal_background_url'])
-
-        if workspace_file_urls:
-            try:
-                deleted_count = await delete_files_by_urls(workspace_file_urls, workspace_id)
-                total_deleted_files += deleted_count
-            except Exception as workspace_file_error:
-                logging.error(f"Failed to delete workspace files: {workspace_file_error}", exc_info=True)
-                # Continue with deletion
-
-        # Delete all walkthroughs (including archived)
-        try:
-            await db.walkthroughs.delete_many({"workspace_id": workspace_id})
-        except Exception as delete_error:
-            logging.error(f"Failed to delete walkthroughs: {delete_error}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error while deleting walkthroughs")
-
-        # Delete all walkthrough versions
-        try:
-            await db.walkthrough_versions.delete_many({"workspace_id": workspace_id})
-        except Exception as version_error:
-            logging.error(f"Failed to delete walkthrough versions: {version_error}", exc_info=True)
-            # Continue with deletion
-
-        # Delete all categories (cascade deletes sub-categories)
-        # First get all categories to handle parent-child relationships
-        try:
-            all_categories = await db.categories.find({"workspace_id": workspace_id}, {"_id": 0, "id": 1}).to_list(1000)
-            category_ids = [c["id"] for c in all_categories]
-
-            # Delete category icon files
-            for cat in all_categories:
-                try:
-                    cat_full = await db.categories.find_one({"id": cat["id"]}, {"_id": 0})
-                    if cat_full and cat_full.get('icon_url'):
-                        await delete_files_by_urls([cat_full['icon_url']], workspace_id)
-                except Exception as cat_file_error:
-                    logging.error(f"Failed to delete category icon files: {cat_file_error}", exc_info=True)
-
-            # Delete all categories (including sub-categories)
-            await db.categories.delete_many({"workspace_id": workspace_id})
-        except Exception as category_error:
-            logging.error(f"Failed to delete categories: {category_error}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error while deleting categories")
-
-        # Delete all workspace members
-        try:
-            await db.workspace_members.delete_many({"workspace_id": workspace_id})
-        except Exception as member_delete_error:
-            logging.error(f"Failed to delete workspace members: {member_delete_error}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error while deleting workspace members")
-
-        # Finally delete the workspace
-        try:
-            await db.workspaces.delete_one({"id": workspace_id})
-        except Exception as workspace_delete_error:
-            logging.error(f"Failed to delete workspace: {workspace_delete_error}", exc_info=True)
-            raise HTTPException(status_code=500, detail="Database error while deleting workspace")
-
-        logging.info(f"Deleted workspace {workspace_id} and {total_deleted_files} associated files")
+    workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0, "owner_id": 1, "name": 1})
+    if not workspace:
+        raise HTTPException(status_code=404, detail="Workspace not found")
+    if current_user.role != UserRole.ADMIN and workspace.get("owner_id") != current_user.id:
+        raise HTTPException(status_code=403, detail="Only workspace owner or admin can delete workspace")
 
-        return {
-            "message": "Workspace deleted successfully",
-            "deleted_files": total_deleted_files,
-            "deleted_walkthroughs": len(walkthroughs),
-            "deleted_categories": len(category_ids)
-        }
-    except Exception as unexpected_error:
-        logging.error(f"Unexpected error during workspace deletion: {unexpected_error}", exc_info=True)
-        raise HTTPException(status_code=500, detail="An unexpected error occurred while deleting the workspace. Please try again or contact support.")
+    job = await submit_job("workspace_deletion", workspace_id, current_user.id, params={
+        "workspace_name": workspace.get("name", "Unknown"),
+        "actor_name": current_user.name,
+    })
+    # Hide the workspace while the job runs
+    await db.workspaces.update_one(
+        {"id": workspace_id},
+        {"$set": {"deletion_job_id": job["id"], "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    logging.info(f"Workspace {workspace_id} deletion started as job {job['id']}")
+    return {"message": "Workspace deletion started", **_job_view(job)}
 
 # Category Routes
 @api_router.post("/workspaces/{workspace_id}/categories", response_model=Category)
@@ -4435,6 +6013,7 @@ async def create_category(workspace_id: str, category_data: CategoryCreate, curr
     category_dict = category.model_dump()
     category_dict['created_at'] = category_dict['created_at'].isoformat()
     await db.categories.insert_one(category_dict)
+    await refresh_media_references("category", category.id)
     
     # Notify all members of category creation (HARDENING LAYER B: Uses batched notifications)
     workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0, "name": 1})
@@ -4488,6 +6067,7 @@ async def update_category(workspace_id: str, category_id: str, category_data: Ca
             {"id": category_id, "workspace_id": workspace_id},
             {"$set": update_dict}
         )
+        await refresh_media_references("category", category_id)
         category.update(update_dict)
     
     # Notify all members of category update
@@ -4536,6 +6116,8 @@ async def delete_category(workspace_id: str, category_id: str, current_user: Use
     
     # Delete the category itself
     await db.categories.delete_one({"id": category_id, "workspace_id": workspace_id})
+    for deleted_category_id in all_category_ids:
+        await refresh_media_references("category", deleted_category_id)
     
     # Notify all members of category deletion
     workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0, "name": 1})
@@ -4644,6 +6226,8 @@ async def create_walkthrough(workspace_id: str, walkthrough_data: WalkthroughCre
     walkthrough_dict['created_at'] = walkthrough_dict['created_at'].isoformat()
     walkthrough_dict['updated_at'] = walkthrough_dict['updated_at'].isoformat()
     await db.walkthroughs.insert_one(walkthrough_dict)
+    await refresh_media_references("walkthrough", walkthrough.id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough.id)
     
     # Lazy migration: Create file record for icon_url if it's an uploaded file
     if walkthrough.icon_url:
@@ -4860,6 +6444,12 @@ async def update_walkthrough(workspace_id: str, walkthrough_id: str, walkthrough
                 "version": {"$nin": versions_to_keep}
             })
             logging.info(f"Auto-cleaned up versions for walkthrough {walkthrough_id}: kept {len(versions_to_keep)}, deleted {len(all_versions) - len(versions_to_keep)}")
+        
+        # Responsive variants of the published media for the portal; never blocks publishing
+        try:
+            update_data["media_manifest"] = await build_media_manifest({**existing, **update_data}, existing.get("media_manifest"))
+        except Exception as e:
+            logging.error(f"[MEDIA_MANIFEST] Failed to build manifest for walkthrough {walkthrough_id}: {e}", exc_info=True)
 
     update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
     
@@ -4867,6 +6457,9 @@ async def update_walkthrough(workspace_id: str, walkthrough_id: str, walkthrough
         {"id": walkthrough_id, "workspace_id": workspace_id, "archived": {"$ne": True}},
         {"$set": update_data}
     )
+    # Also covers the version snapshot inserted and pruned above
+    await refresh_media_references("walkthrough", walkthrough_id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     
     # Lazy migration: Create file record for icon_url if it's an uploaded file and changed
     if "icon_url" in update_data and update_data.get("icon_url"):
@@ -4929,6 +6522,7 @@ async def archive_walkthrough(workspace_id: str, walkthrough_id: str, current_us
     )
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Walkthrough not found")
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     return {"message": "Walkthrough archived"}
 
 @api_router.post("/workspaces/{workspace_id}/walkthroughs/{walkthrough_id}/restore")
@@ -4943,6 +6537,7 @@ async def restore_walkthrough(workspace_id: str, walkthrough_id: str, current_us
     )
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Walkthrough not found")
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     return {"message": "Walkthrough restored"}
 
 @api_router.delete("/workspaces/{workspace_id}/walkthroughs/{walkthrough_id}/permanent")
@@ -4967,6 +6562,8 @@ async def permanently_delete_walkthrough(workspace_id: str, walkthrough_id: str,
     result = await db.walkthroughs.delete_one({"id": walkthrough_id, "workspace_id": workspace_id, "archived": True})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Archived walkthrough not found")
+    await refresh_media_references("walkthrough", walkthrough_id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     
     return {
         "message": "Walkthrough permanently deleted",
@@ -5015,6 +6612,7 @@ async def delete_walkthrough_version(workspace_id: str, walkthrough_id: str, ver
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Version not found")
+    await refresh_media_references("walkthrough", walkthrough_id)
     
     return {"message": f"Version {version} deleted successfully"}
 
@@ -5301,6 +6899,8 @@ async def recover_blocks_from_version(workspace_id: str, walkthrough_id: str, bo
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
+    await refresh_media_references("walkthrough", walkthrough_id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     
     return {
         "message": f"Recovered {recovered_count} image blocks from version {version.get('version')}",
@@ -5361,6 +6961,8 @@ async def rollback_walkthrough(workspace_id: str, walkthrough_id: str, version:
         {"id": walkthrough_id, "workspace_id": workspace_id, "archived": {"$ne": True}},
         {"$set": snapshot}
     )
+    await refresh_media_references("walkthrough", walkthrough_id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
 
     updated = await db.walkthroughs.find_one({"id": walkthrough_id, "workspace_id": workspace_id}, {"_id": 0})
     return Walkthrough(**updated)
@@ -5382,6 +6984,7 @@ async def delete_walkthrough(workspace_id: str, walkthrough_id: str, current_use
     )
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Walkthrough not found")
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     return {"message": "Walkthrough archived"}
 
 # ==========================================
@@ -5411,6 +7014,7 @@ async def create_knowledge_system(
     )
     
     await db.knowledge_systems.insert_one(knowledge_system.model_dump(by_alias=True))
+    await refresh_media_references("knowledge_system", knowledge_system.id)
     return knowledge_system
 
 @api_router.get("/workspaces/{workspace_id}/knowledge-systems")
@@ -5480,6 +7084,7 @@ async def update_knowledge_system(
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Knowledge system not found")
+    await refresh_media_references("knowledge_system", system_id)
     
     # Return updated system
     system = await db.knowledge_systems.find_one(
@@ -5505,6 +7110,7 @@ async def delete_knowledge_system(
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Knowledge system not found")
+    await refresh_media_references("knowledge_system", system_id)
     
     return {"message": "Knowledge system deleted"}
 
@@ -5640,6 +7246,7 @@ async def bind_extension(request: Request, payload: ExtensionBindRequest):
         {"_id": record["_id"]},
         {"$set": {"bound_extension_id": payload.extensionId}}
     )
+    await record_extension_change(record["workspace_id"], "binding", record["workspace_id"])
     logging.info(
         "[ExtensionBind] updated token=%s workspace=%s bound_extension_id=%s",
         record.get("_id"),
@@ -5695,6 +7302,7 @@ async def generate_binding_token(workspace_id: str, current_user: User = Depends
         "bound_extension_id": None
     }
     await db.workspace_binding_tokens.insert_one(doc)
+    await record_extension_change(workspace_id, "binding", workspace_id)
     logging.info(
         "[BindingToken] generated workspace=%s token_doc=%s",
         workspace_id,
@@ -5812,20 +7420,79 @@ async def regenerate_binding_token(workspace_id: str, current_user: User = Depen
 
 
 @api_router.get("/extension/walkthroughs", response_model=ExtensionWalkthroughsResponse)
-async def list_extension_walkthroughs(request: Request):
+async def list_extension_walkthroughs(request: Request, response: Response):
     """Return walkthroughs scoped ONLY by binding token workspace.
     
+    Served with an ETag; a matching If-None-Match gets 304.
+    
     SECURITY: No user auth. Workspace derived solely from validated binding token.
     """
     workspace_id, _ = await _validate_binding_token(request)
-    cursor = db.walkthroughs.find(
-        {"workspace_id": workspace_id, "archived": {"$ne": True}},
-        {"_id": 0, "id": 1, "title": 1, "description": 1, "steps": 1}
+    # Tag before reading: the body is never older than the tag it is served with
+    etag = await extension_walkthroughs_etag(workspace_id)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return ExtensionWalkthroughsResponse(walkthroughs=await _extension_walkthroughs(workspace_id))
+
+
+async def _extension_walkthroughs(workspace_id: str, walkthrough_ids: Optional[List[str]] = None) -> List[ExtensionWalkthrough]:
+    query = {"workspace_id": workspace_id, "archived": {"$ne": True}}
+    if walkthrough_ids is not None:
+        query["id"] = {"$in": walkthrough_ids}
+    cursor = db.walkthroughs.find(query, {"_id": 0, "id": 1, "title": 1, "description": 1, "steps": 1})
+    return [ExtensionWalkthrough(**doc) async for doc in cursor]
+
+
+async def _extension_targets(workspace_id: str, target_ids: Optional[List[str]] = None) -> List[ExtensionTarget]:
+    query = {"workspace_id": workspace_id}
+    if target_ids is not None:
+        query["id"] = {"$in": target_ids}
+    cursor = db.extension_targets.find(query, {"_id": 0})
+    return [ExtensionTarget(**doc) async for doc in cursor]
+
+
+@api_router.get("/extension/sync", response_model=ExtensionSyncResponse)
+async def sync_extension(request: Request, since: Optional[int] = Query(None, ge=0)):
+    """Walkthroughs and targets changed since a previous sync's `seq`, with tombstones.
+    
+    Without `since`, or when it predates the retained change log, predates what this
+    instance's index has seen completely (exact_since: rebuilt, or a sequence gap skipped),
+    is ahead of the index, or too much changed, returns a full snapshot with full=true.
+    SECURITY: No user auth. Workspace derived solely from validated binding token.
+    """
+    workspace_id, _ = await _validate_binding_token(request)
+    # Every change in (exact_since, seq] has been inserted, so a delta over that range is complete
+    seq = extension_target_index.last_seq
+    exact_since = extension_target_index.exact_since
+    if seq is None or exact_since is None:
+        seq = await current_extension_change_seq()
+    elif since is not None and exact_since <= since <= seq and since >= await extension_change_floor():
+        changes = await db.extension_changes.find(
+            {"workspace_id": workspace_id, "seq": {"$gt": since, "$lte": seq}},
+            {"_id": 0, "kind": 1, "entity_id": 1}
+        ).sort("seq", ASCENDING).to_list(EXTENSION_CHANGE_BATCH + 1)
+        if len(changes) <= EXTENSION_CHANGE_BATCH:
+            walkthrough_ids = list({c["entity_id"] for c in changes if c["kind"] == "walkthrough"})
+            target_ids = list({c["entity_id"] for c in changes if c["kind"] == "target"})
+            walkthroughs = await _extension_walkthroughs(workspace_id, walkthrough_ids) if walkthrough_ids else []
+            targets = await _extension_targets(workspace_id, target_ids) if target_ids else []
+            present_walkthroughs = {w.id for w in walkthroughs}
+            present_targets = {t.id for t in targets}
+            return ExtensionSyncResponse(
+                seq=seq,
+                walkthroughs=walkthroughs,
+                targets=targets,
+                deleted_walkthrough_ids=[i for i in walkthrough_ids if i not in present_walkthroughs],
+                deleted_target_ids=[i for i in target_ids if i not in present_targets]
+            )
+    return ExtensionSyncResponse(
+        seq=seq,
+        full=True,
+        walkthroughs=await _extension_walkthroughs(workspace_id),
+        targets=await _extension_targets(workspace_id)
     )
-    walkthroughs = []
-    async for doc in cursor:
-        walkthroughs.append(ExtensionWalkthrough(**doc))
-    return ExtensionWalkthroughsResponse(walkthroughs=walkthroughs)
 
 @api_router.post("/extension/targets", response_model=ExtensionTargetResponse)
 async def create_extension_target(
@@ -5868,6 +7535,7 @@ async def create_extension_target(
         created_by=extension_id,  # Use extension_id as creator identifier
     )
     await db.extension_targets.insert_one(target.model_dump())
+    await record_extension_change(workspace_id, "target", target.id)
     return target
 
 
@@ -5878,13 +7546,7 @@ async def list_extension_targets(request: Request):
     SECURITY: No user auth. Returns only targets belonging to the token's workspace.
     """
     workspace_id, _ = await _validate_binding_token(request)
-    
-    cursor = db.extension_targets.find({"workspace_id": workspace_id})
-    results = []
-    async for doc in cursor:
-        doc.pop("_id", None)
-        results.append(ExtensionTarget(**doc))
-    return results
+    return await _extension_targets(workspace_id)
 
 
 @api_router.put("/extension/targets/{target_id}", response_model=ExtensionTargetResponse)
@@ -5932,6 +7594,7 @@ async def update_extension_target(request: Request, target_id: str, payload: Ext
         {"id": target_id},
         {"$set": update_data}
     )
+    await record_extension_change(workspace_id, "target", target_id)
     
     # Return updated target
     updated = await db.extension_targets.find_one({"id": target_id})
@@ -5955,6 +7618,7 @@ async def delete_extension_target(request: Request, target_id: str):
         raise HTTPException(status_code=404, detail="Target not found in workspace")
     
     await db.extension_targets.delete_one({"id": target_id, "workspace_id": workspace_id})
+    await record_extension_change(workspace_id, "target", target_id)
     return {"message": "Target deleted"}
 
 
@@ -5997,36 +7661,35 @@ async def list_admin_walkthroughs(current_user: User = Depends(get_current_user)
         {"_id": 0, "id": 1, "workspace_id": 1, "title": 1, "steps": 1}
     )
 
-    walkthroughs: List[ExtensionAdminWalkthrough] = []
-    async for doc in cursor:
-        steps_data = []
-        for idx, step in enumerate(doc.get("steps", [])):
-            if not isinstance(step, dict):
-                continue
-            step_identifier = step.get("step_id") or step.get("id") or f"step-{idx}"
-            order = step.get("order")
-            try:
-                order_value = int(order) if order is not None else idx
-            except (TypeError, ValueError):
-                order_value = idx
-            steps_data.append(
-                ExtensionAdminStep(
-                    id=str(step_identifier),
-                    title=step.get("title", "Untitled step"),
-                    order=order_value
-                )
-            )
+    return [_extension_admin_walkthrough(doc) async for doc in cursor]
+
 
-        walkthroughs.append(
-            ExtensionAdminWalkthrough(
-                walkthrough_id=doc["id"],
-                workspace_id=doc["workspace_id"],
-                title=doc.get("title", "Untitled walkthrough"),
-                steps=steps_data
+def _extension_admin_walkthrough(doc: dict) -> ExtensionAdminWalkthrough:
+    steps_data = []
+    for idx, step in enumerate(doc.get("steps", [])):
+        if not isinstance(step, dict):
+            continue
+        step_identifier = step.get("step_id") or step.get("id") or f"step-{idx}"
+        order = step.get("order")
+        try:
+            order_value = int(order) if order is not None else idx
+        except (TypeError, ValueError):
+            order_value = idx
+        steps_data.append(
+            ExtensionAdminStep(
+                id=str(step_identifier),
+                title=step.get("title", "Untitled step"),
+                order=order_value
             )
         )
 
-    return walkthroughs
+    return ExtensionAdminWalkthrough(
+        walkthrough_id=doc["id"],
+        workspace_id=doc["workspace_id"],
+        title=doc.get("title", "Untitled walkthrough"),
+        status=doc.get("status"),
+        steps=steps_data
+    )
 
 
 @api_router.get("/extension/resolve", response_model=ExtensionResolveResponse)
@@ -6037,57 +7700,48 @@ async def resolve_extension_targets(request: Request, url: str = Query(..., desc
     Returns only targets belonging to the token's workspace.
     """
     workspace_id, _ = await _validate_binding_token(request)
-    normalized = normalize_url(url)
-    cursor = db.extension_targets.find({
-        "workspace_id": workspace_id,
-        "status": "active"
-    })
-    matches: List[ExtensionResolveMatch] = []
-    async for doc in cursor:
-        doc.pop("_id", None)
-        target = ExtensionTarget(**doc)
-        if url_rule_matches(target.url_rule, normalized):
-            matches.append(ExtensionResolveMatch(
-                walkthrough_id=target.walkthrough_id,
-                step_id=target.step_id,
-                selector=target.selector
-            ))
+    index = await extension_target_index.workspace(workspace_id)
+    matches = [
+        ExtensionResolveMatch(walkthrough_id=record.walkthrough_id, step_id=record.step_id, selector=record.selector)
+        for record in index.match(normalize_url(url))
+    ]
     return ExtensionResolveResponse(matches=matches)
 
 
-@api_router.get("/extension/resolve-public", response_model=ExtensionResolveResponse)
-async def resolve_extension_targets_public(url: str = Query(..., description="Current page URL")):
-    normalized = normalize_url(url)
-
-    cursor = db.extension_targets.find({"status": "active"})
-    matches: List[ExtensionResolveMatch] = []
-    walkthrough_cache: Dict[str, Optional[Dict[str, Any]]] = {}
-
-    async for doc in cursor:
-        doc.pop("_id", None)
-        target = ExtensionTarget(**doc)
-        if not url_rule_matches(target.url_rule, normalized):
-            continue
-
-        walkthrough = walkthrough_cache.get(target.walkthrough_id)
-        if walkthrough is None:
-            walkthrough = await db.walkthroughs.find_one(
-                {
-                    "id": target.walkthrough_id,
-                    "workspace_id": target.workspace_id,
-                    "status": WalkthroughStatus.PUBLISHED,
-                    "privacy": Privacy.PUBLIC,
-                },
-                {"_id": 0, "id": 1}
-            )
-            walkthrough_cache[target.walkthrough_id] = walkthrough
+@api_router.post("/extension/resolve/batch", response_model=ExtensionResolveBatchResponse)
+async def resolve_extension_targets_batch(request: Request, payload: ExtensionResolveBatchRequest):
+    """Resolve targets for up to EXTENSION_RESOLVE_BATCH_MAX_URLS URLs (open tabs, SPA routes) at once.
+    
+    SECURITY: No user auth. Single-workspace enforced by _validate_binding_token.
+    """
+    workspace_id, _ = await _validate_binding_token(request)
+    index = await extension_target_index.workspace(workspace_id)
+    results: Dict[str, List[ExtensionResolveMatch]] = {}
+    for url in payload.urls:
+        if url not in results:
+            results[url] = [
+                ExtensionResolveMatch(walkthrough_id=record.walkthrough_id, step_id=record.step_id, selector=record.selector)
+                for record in index.match(normalize_url(url))
+            ]
+    walkthroughs: Dict[str, ExtensionAdminWalkthrough] = {}
+    walkthrough_ids = list({match.walkthrough_id for matches in results.values() for match in matches})
+    if payload.include_walkthroughs and walkthrough_ids:
+        cursor = db.walkthroughs.find(
+            {"id": {"$in": walkthrough_ids}, "workspace_id": workspace_id, "archived": {"$ne": True}},
+            {"_id": 0, "id": 1, "workspace_id": 1, "title": 1, "status": 1, "steps.id": 1, "steps.step_id": 1, "steps.title": 1, "steps.order": 1}
+        )
+        async for doc in cursor:
+            walkthroughs[doc["id"]] = _extension_admin_walkthrough(doc)
+    return ExtensionResolveBatchResponse(results=results, walkthroughs=walkthroughs)
 
-        if walkthrough:
-            matches.append(ExtensionResolveMatch(
-                walkthrough_id=target.walkthrough_id,
-                step_id=target.step_id
-            ))
 
+@api_router.get("/extension/resolve-public", response_model=ExtensionResolveResponse)
+async def resolve_extension_targets_public(url: str = Query(..., description="Current page URL")):
+    index = await extension_target_index.public_index()
+    matches = [
+        ExtensionResolveMatch(walkthrough_id=record.walkthrough_id, step_id=record.step_id)
+        for record in index.match(normalize_url(url))
+    ]
     return ExtensionResolveResponse(matches=matches)
 
 @api_router.post("/workspaces/{workspace_id}/walkthroughs/{walkthrough_id}/steps")
@@ -6175,6 +7829,8 @@ async def add_step(workspace_id: str, walkthrough_id: str, step_data: StepCreate
         {"id": walkthrough_id, "workspace_id": workspace_id},
         {"$set": {"steps": steps, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await refresh_media_references("walkthrough", walkthrough_id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     
     return step
 
@@ -6317,6 +7973,8 @@ async def update_step(workspace_id: str, walkthrough_id: str, step_id: str, step
         {"id": walkthrough_id},
         {"$set": {"steps": steps, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await refresh_media_references("walkthrough", walkthrough_id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     
     logger.info(f"[update_step] Step {step_id}: Successfully saved to database")
     return steps[step_index]
@@ -6337,6 +7995,8 @@ async def delete_step(workspace_id: str, walkthrough_id: str, step_id: str, curr
         {"id": walkthrough_id},
         {"$set": {"steps": steps, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await refresh_media_references("walkthrough", walkthrough_id)
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     
     return {"message": "Step deleted"}
 
@@ -6436,6 +8096,7 @@ async def reorder_steps(workspace_id: str, walkthrough_id: str, body: StepsReord
         {"id": walkthrough_id, "workspace_id": workspace_id},
         {"$set": {"steps": ordered, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await record_extension_change(workspace_id, "walkthrough", walkthrough_id)
     
     logging.info(f"[reorder_steps] Successfully reordered {len(ordered)} steps")
     return {"message": "Steps reordered"}
@@ -6766,186 +8427,522 @@ async def get_feedback(workspace_id: str, walkthrough_id: str, current_user: Use
     ).to_list(1000)
     return feedback_list
 
-# Media Upload Route - Two-Phase Commit with Quota Enforcement
-@api_router.post("/upload")
-async def upload_file(
-    file: UploadFile = File(...),
-    workspace_id: Optional[str] = Form(None),
-    idempotency_key: Optional[str] = Form(None),
-    reference_type: Optional[str] = Form(None),
-    reference_id: Optional[str] = Form(None),
+@api_router.get("/workspaces/{workspace_id}/feedback/export")
+async def export_feedback(
+    workspace_id: str,
+    request: Request,
+    format: str = Query("ndjson", description="ndjson or csv"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields"),
+    cursor: Optional[str] = Query(None, description="_cursor of the last row received, to resume"),
+    since: Optional[str] = Query(None, description="ISO timestamp lower bound (inclusive)"),
+    until: Optional[str] = Query(None, description="ISO timestamp upper bound (exclusive)"),
     current_user: User = Depends(get_current_user)
 ):
-    """
-    Upload file with quota enforcement and two-phase commit.
-    
-    Two-phase commit:
-    1. Create file record in DB with status=pending (reserves quota)
-    2. Upload to object storage
-    3. Update file record to status=active on success, or status=failed on failure
-    
-    Idempotent: If idempotency_key provided and file exists, returns existing file.
-    """
-    file_id = None
-    try:
-        # Defensive check: filename can be None
-        filename = file.filename or "uploaded_file"
-        logging.info(f"[upload_file] Upload request received: user={current_user.id}, workspace_id={workspace_id}, reference_type={reference_type}, reference_id={reference_id}, filename={filename}")
-        
-        # Generate idempotency key if not provided
-        if not idempotency_key:
-            idempotency_key = str(uuid.uuid4())
-        
-        # CRITICAL: workspace_id is REQUIRED - do not fallback to owner's workspace
-        # This ensures shared workspace members can upload files
-        if not workspace_id:
-            raise HTTPException(status_code=400, detail="workspace_id is required. Please specify workspace_id in the upload request.")
-        
-        # Verify user has access to workspace (handles both owners and members)
-        # This check ensures collaborators can upload files
-        try:
-            await check_workspace_access(workspace_id, current_user.id)
-        except HTTPException:
-            raise
-        except Exception as access_error:
-            logging.error(f"[upload_file] Failed to check workspace access: {access_error}", exc_info=True)
-            raise HTTPException(status_code=403, detail="Access denied to workspace")
-        
-        # Get workspace by workspace_id (not by owner_id)
-        workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0, "owner_id": 1})
-        if not workspace:
-            raise HTTPException(status_code=404, detail="Workspace not found")
-        
-        # For idempotency check, use workspace owner's user_id for shared users
-        # This ensures idempotency works correctly for all collaborators
-        idempotency_user_id = workspace['owner_id'] if workspace['owner_id'] != current_user.id else current_user.id
-        
-        # Check for existing file with same idempotency key (idempotency check)
-        existing_file = await db.files.find_one(
-            {"idempotency_key": idempotency_key, "user_id": idempotency_user_id},
-            {"_id": 0}
-        )
-        if existing_file:
-            if existing_file.get('status') == FileStatus.ACTIVE:
-                # Return existing file
-                return {
-                    "file_id": existing_file['id'],
-                    "url": existing_file['url'],
-                    "size_bytes": existing_file['size_bytes'],
-                    "status": "existing"
-                }
-            elif existing_file.get('status') == FileStatus.PENDING:
-                # Upload in progress, return pending status
-                raise HTTPException(
-                    status_code=409,
-                    detail="Upload already in progress with this idempotency key"
-                )
-        
-        # Read file content
-        file_content = await file.read()
-        file_size = len(file_content)
-        
-        # Defensive check: file must have content
-        if file_size == 0:
-            raise HTTPException(status_code=400, detail="File is empty")
-        
-        # Get user's plan and check file size limit
-        plan = await get_user_plan(current_user.id)
-        if not plan:
-            raise HTTPException(status_code=400, detail="User has no plan assigned")
-        
-        # Check file size limit
-        if file_size > plan.max_file_size_bytes:
+    """Stream a workspace's feedback as NDJSON or CSV; ?walkthrough_id= and ?rating= filter it."""
+    member = await get_workspace_member(workspace_id, current_user.id)
+    if not member:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return stream_export("feedback", request, format, fields, cursor, since, until, scope={"workspace_id": workspace_id})
+
+# Streaming upload configuration
+UPLOAD_SPOOL_MAX_MEMORY_BYTES = int(os.environ.get('UPLOAD_SPOOL_MAX_MEMORY_BYTES', str(2 * 1024 * 1024)))  # Larger uploads spill to a temp file
+UPLOAD_MAX_FILE_SIZE_BYTES = int(os.environ.get('UPLOAD_MAX_FILE_SIZE_BYTES', str(500 * 1024 * 1024)))  # Hard cap until plan limits are known
+UPLOAD_MULTIPART_OVERHEAD_BYTES = 64 * 1024  # Allowance for form fields and part headers in Content-Length checks
+
+
+class UploadLimits:
+    """Size ceilings for a single upload, checked on every received chunk."""
+
+    def __init__(self, max_file_size_bytes: int, storage_used: int = 0, storage_allowed: Optional[int] = None):
+        self.max_file_size_bytes = max_file_size_bytes
+        self.storage_used = storage_used
+        self.storage_allowed = storage_allowed
+
+    def enforce(self, size: int) -> None:
+        if size > self.max_file_size_bytes:
             raise HTTPException(
                 status_code=413,
-                detail=f"File size ({file_size} bytes) exceeds maximum allowed ({plan.max_file_size_bytes} bytes) for your plan"
+                detail=f"File size ({size} bytes) exceeds maximum allowed ({self.max_file_size_bytes} bytes) for your plan"
             )
-        
-        # For shared users, count storage against workspace owner's quota
-        # For owners, use their own quota
-        quota_user_id = workspace['owner_id'] if workspace['owner_id'] != current_user.id else current_user.id
-        
-        # Check quota: current storage + file size <= allowed storage
-        storage_used = await get_user_storage_usage(quota_user_id)
-        storage_allowed = await get_user_allowed_storage(quota_user_id)
-        
-        if storage_used + file_size > storage_allowed:
+        if self.storage_allowed is not None and self.storage_used + size > self.storage_allowed:
             raise HTTPException(
                 status_code=402,
-                detail=f"Storage quota exceeded. Used: {storage_used} bytes, Allowed: {storage_allowed} bytes, File size: {file_size} bytes"
+                detail=f"Storage quota exceeded. Used: {self.storage_used} bytes, Allowed: {self.storage_allowed} bytes, File size: {size} bytes"
             )
+
+
+class StreamingUploadReader:
+    """
+    Incremental multipart/form-data reader for the upload endpoint.
+    
+    Starlette's form parsing buffers the whole request before the handler runs. This reader
+    consumes request.stream() chunk by chunk, spools file bytes to a SpooledTemporaryFile
+    (in memory up to UPLOAD_SPOOL_MAX_MEMORY_BYTES, on disk beyond) and enforces limits as
+    bytes arrive, so an oversized upload is rejected as soon as it crosses a limit. The
+    sha256 of the file is computed on the way through for content-addressed de-duplication.
+    
+    Form fields sent before the file part are available to on_file_start, which can
+    tighten limits (plan/quota) or stop reading altogether (idempotent replay).
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.fields: Dict[str, str] = {}
+        self.filename: Optional[str] = None
+        self.file = None
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.limits = UploadLimits(UPLOAD_MAX_FILE_SIZE_BYTES)
+        self._stopped = False
+        self._events: List[Tuple[str, Any]] = []
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._part_name: Optional[str] = None
+        self._part_is_file = False
+        self._field_data = b""
+
+    def stop(self) -> None:
+        self._stopped = True
+
+    def enforce_content_length(self) -> None:
+        """Reject before reading when the declared body size already exceeds the limits."""
+        content_length = self.request.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            self.limits.enforce(max(0, int(content_length) - UPLOAD_MULTIPART_OVERHEAD_BYTES))
+
+    # python-multipart callbacks (synchronous - they only record events)
+    def _on_part_begin(self):
+        self._disposition = b""
+        self._part_name = None
+        self._part_is_file = False
+        self._field_data = b""
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        self._part_name = options.get(b"name", b"").decode("utf-8", errors="replace")
+        if b"filename" in options:
+            if self.filename is not None:
+                raise HTTPException(status_code=400, detail="Only one file may be uploaded per request")
+            self._part_is_file = True
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            self._events.append(("file_start", None))
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._part_is_file:
+            self._events.append(("data", data[start:end]))
+        else:
+            self._field_data += data[start:end]
+            if len(self._field_data) > UPLOAD_MULTIPART_OVERHEAD_BYTES:
+                raise HTTPException(status_code=400, detail="Form field too large")
+
+    def _on_part_end(self):
+        if not self._part_is_file and self._part_name:
+            self.fields[self._part_name] = self._field_data.decode("utf-8", errors="replace")
+
+    async def _write(self, data: bytes) -> None:
+        self.size += len(data)
+        self.limits.enforce(self.size)
+        self.sha256.update(data)
+        if getattr(self.file, "_rolled", True):
+            await asyncio.to_thread(self.file.write, data)
+        else:
+            self.file.write(data)
+
+    async def read(self, on_file_start) -> None:
+        """Consume the request body. on_file_start(reader) is awaited when the file part begins."""
+        _, params = parse_options_header(self.request.headers.get("content-type", ""))
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise HTTPException(status_code=400, detail="Expected multipart/form-data upload")
+        parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+        async for chunk in self.request.stream():
+            parser.write(chunk)
+            events, self._events = self._events, []
+            for kind, payload in events:
+                if kind == "file_start":
+                    self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY_BYTES)
+                    await on_file_start(self)
+                    if self._stopped:
+                        return
+                else:
+                    await self._write(payload)
+        parser.finalize()
+        if self.file is not None:
+            self.file.seek(0)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+
+def _upload_resource_type(filename: str) -> str:
+    """Map a filename extension to the storage resource_type."""
+    file_extension = Path(filename).suffix.lower()
+    if file_extension == '.gif':
+        return "image"  # Upload GIFs as images (not video - conversion caused issues)
+    if file_extension in ['.jpg', '.jpeg', '.png', '.webp', '.bmp', '.svg']:
+        return "image"
+    if file_extension in ['.mp4', '.webm', '.mov', '.avi', '.mkv']:
+        return "video"
+    if file_extension in ['.pdf', '.doc', '.docx', '.txt']:
+        return "raw"
+    return "auto"
+
+
+def _upload_options(resource_type: str) -> Dict[str, Any]:
+    """
+    Provider optimization parameters for an upload.
+    Note: format="auto" and fetch_format are NOT valid upload parameters.
+    Format optimization is done at delivery time via URL transformations, not upload.
+    """
+    if resource_type == "image":
+        return {"quality": "auto:good"}
+    if resource_type == "video":
+        return {
+            "quality": "auto:good",
+            "video_codec": "auto",
+            "bit_rate": "1m",
+            "max_video_bitrate": 1000000,
+        }
+    return {}
+
+
+async def _build_upload_folder(workspace_id: str, owner_id: str, reference_type: Optional[str], reference_id: Optional[str]) -> str:
+    """
+    Build the storage folder: guide2026/workspace_owner_id/workspace_id/category_id/walkthrough_id.
+    Uses the workspace owner's ID so the structure is consistent for all collaborators.
+    """
+    # Determine category_id and walkthrough_id from reference_type and reference_id
+    category_id = None
+    walkthrough_id = None
+    
+    if reference_type and reference_id:
+        if reference_type == "walkthrough_icon":
+            # reference_id is walkthrough_id
+            walkthrough_id = reference_id
+            # Get walkthrough to find category_id
+            walkthrough = await db.walkthroughs.find_one(
+                {"id": walkthrough_id, "workspace_id": workspace_id},
+                {"_id": 0, "category_ids": 1}
+            )
+            if walkthrough and walkthrough.get("category_ids"):
+                # Use first category if multiple
+                category_id = walkthrough["category_ids"][0] if isinstance(walkthrough["category_ids"], list) else walkthrough["category_ids"]
+        elif reference_type == "category_icon":
+            # reference_id is category_id
+            category_id = reference_id
+        elif reference_type == "step_media":
+            # reference_id is step_id - need to find walkthrough
+            walkthrough = await db.walkthroughs.find_one(
+                {"workspace_id": workspace_id, "steps.id": reference_id},
+                {"_id": 0, "id": 1, "category_ids": 1}
+            )
+            if walkthrough:
+                walkthrough_id = walkthrough["id"]
+                if walkthrough.get("category_ids"):
+                    category_id = walkthrough["category_ids"][0] if isinstance(walkthrough["category_ids"], list) else walkthrough["category_ids"]
+        elif reference_type == "block_image":
+            # reference_id is block_id - need to find step, then walkthrough
+            walkthrough = await db.walkthroughs.find_one(
+                {"workspace_id": workspace_id, "steps.blocks.id": reference_id},
+                {"_id": 0, "id": 1, "category_ids": 1}
+            )
+            if walkthrough:
+                walkthrough_id = walkthrough["id"]
+                if walkthrough.get("category_ids"):
+                    category_id = walkthrough["category_ids"][0] if isinstance(walkthrough["category_ids"], list) else walkthrough["category_ids"]
+        # workspace_logo, workspace_background don't have category/walkthrough
+    
+    folder_parts = ["guide2026", owner_id, workspace_id]
+    if category_id:
+        folder_parts.append(category_id)
+    if walkthrough_id:
+        folder_parts.append(walkthrough_id)
+    return "/".join(folder_parts)
+
+
+async def get_reserved_upload_bytes(quota_user_id: str) -> int:
+    """Bytes reserved by open upload sessions (counted against quota before commit)."""
+    result = await db.upload_sessions.aggregate([
+        {"$match": {"quota_user_id": quota_user_id, "status": {"$in": [UploadSessionStatus.OPEN, UploadSessionStatus.COMMITTING]}}},
+        {"$group": {"_id": None, "total": {"$sum": "$size_bytes"}}}
+    ]).to_list(1)
+    return result[0]["total"] if result else 0
+
+
+# Content-addressed de-duplication: the same bytes uploaded again into the same workspace
+# become another FileRecord pointing at the stored blob instead of a second copy. media_blobs
+# holds one entry per (workspace, sha256) with a reference count; the blob is destroyed only
+# when the last FileRecord referencing it is deleted. content_hash is always the sha256 the
+# server computed over the received bytes - never a client-supplied value.
+
+async def _claim_media_blob(workspace_id: str, content_hash: Optional[str]) -> Optional[dict]:
+    """Take a reference on the workspace's blob with this content. Returns None when there is none."""
+    if not content_hash:
+        return None
+    blob = await db.media_blobs.find_one_and_update(
+        # ref_count > 0: a blob whose last reference is being released can't be revived
+        {"workspace_id": workspace_id, "content_hash": content_hash, "ref_count": {"$gt": 0}},
+        {"$inc": {"ref_count": 1}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        return_document=True
+    )
+    if blob:
+        blob.pop("_id", None)
+    return blob
+
+
+async def _register_media_blob(file_id: str, owner_id: str, workspace_id: str, content_hash: str, url: str, public_id: str, resource_type: str, size_bytes: int) -> Optional[str]:
+    """Record a freshly stored blob with its first reference (file_id). Returns the blob id."""
+    blob_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    try:
+        await db.media_blobs.insert_one({
+            "id": blob_id,
+            "user_id": owner_id,
+            "workspace_id": workspace_id,
+            "content_hash": content_hash,
+            "url": url,
+            "public_id": public_id,
+            "resource_type": resource_type,
+            "size_bytes": size_bytes,
+            "ref_count": 1,
+            "origin_file_id": file_id,
+            "created_at": now,
+            "updated_at": now
+        })
+    except DuplicateKeyError:
+        # A concurrent upload of the same content registered first; this copy stays unshared
+        return None
+    await db.files.update_one({"id": file_id}, {"$set": {"blob_id": blob_id}})
+    return blob_id
+
+
+async def _release_media_blob(blob_id: str, references: int = 1) -> Optional[dict]:
+    """
+    Drop references. Returns the blob when the last one went - the caller destroys the stored
+    object and then removes the entry. An entry already at zero references (its destroy never
+    completed) is returned again, so a retry destroys it instead of leaking it.
+    """
+    blob = await db.media_blobs.find_one_and_update(
+        {"id": blob_id, "ref_count": {"$gt": 0}},
+        {"$inc": {"ref_count": -references}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0},
+        return_document=True
+    )
+    if blob is None:
+        return await db.media_blobs.find_one({"id": blob_id, "ref_count": {"$lte": 0}}, {"_id": 0})
+    if blob["ref_count"] > 0:
+        return None
+    return blob
+
+
+def _blob_reference_response(file_id: str, blob: dict) -> Dict[str, Any]:
+    return {
+        "file_id": file_id,
+        "url": blob["url"],
+        "public_id": blob["public_id"],
+        "size_bytes": blob["size_bytes"],
+        "status": "active",
+        "deduplicated": True
+    }
+
+
+async def _prepare_upload(fields: Dict[str, str], current_user: User) -> Dict[str, Any]:
+    """
+    Resolve workspace access, idempotency and plan/quota limits for an upload.
+    Returns {"existing": response} for an idempotent replay of a completed upload.
+    """
+    workspace_id = fields.get("workspace_id") or None
+    idempotency_key = fields.get("idempotency_key") or str(uuid.uuid4())
+    
+    # CRITICAL: workspace_id is REQUIRED - do not fallback to owner's workspace
+    # This ensures shared workspace members can upload files
+    if not workspace_id:
+        raise HTTPException(status_code=400, detail="workspace_id is required. Please specify workspace_id in the upload request.")
+    
+    # Verify user has access to workspace (handles both owners and members)
+    # This check ensures collaborators can upload files
+    try:
+        await check_workspace_access(workspace_id, current_user.id)
+    except HTTPException:
+        raise
+    except Exception as access_error:
+        logging.error(f"[upload_file] Failed to check workspace access: {access_error}", exc_info=True)
+        raise HTTPException(status_code=403, detail="Access denied to workspace")
+    
+    # Get workspace by workspace_id (not by owner_id)
+    workspace = await db.workspaces.find_one({"id": workspace_id}, {"_id": 0, "owner_id": 1, "deletion_job_id": 1})
+    if not workspace or workspace.get("deletion_job_id"):
+        raise HTTPException(status_code=404, detail="Workspace not found")
+    
+    # For idempotency check, use workspace owner's user_id for shared users
+    # This ensures idempotency works correctly for all collaborators
+    idempotency_user_id = workspace['owner_id'] if workspace['owner_id'] != current_user.id else current_user.id
+    
+    # Check for existing file with same idempotency key (idempotency check)
+    existing_file = await db.files.find_one(
+        {"idempotency_key": idempotency_key, "user_id": idempotency_user_id},
+        {"_id": 0}
+    )
+    if existing_file:
+        if existing_file.get('status') == FileStatus.ACTIVE:
+            # Return existing file
+            return {"existing": {
+                "file_id": existing_file['id'],
+                "url": existing_file['url'],
+                "size_bytes": existing_file['size_bytes'],
+                "status": "existing"
+            }}
+        elif existing_file.get('status') == FileStatus.PENDING:
+            # Upload in progress, return pending status
+            raise HTTPException(
+                status_code=409,
+                detail="Upload already in progress with this idempotency key"
+            )
+    
+    # Get user's plan (file size limit)
+    plan = await get_user_plan(current_user.id)
+    if not plan:
+        raise HTTPException(status_code=400, detail="User has no plan assigned")
+    
+    # For shared users, count storage against workspace owner's quota
+    # For owners, use their own quota
+    quota_user_id = workspace['owner_id'] if workspace['owner_id'] != current_user.id else current_user.id
+    # Open resumable upload sessions hold reservations that count as used storage
+    storage_used = await get_user_storage_usage(quota_user_id) + await get_reserved_upload_bytes(quota_user_id)
+    storage_allowed = await get_user_allowed_storage(quota_user_id)
+    
+    return {
+        "workspace_id": workspace_id,
+        "workspace": workspace,
+        "idempotency_key": idempotency_key,
+        "reference_type": fields.get("reference_type") or None,
+        "reference_id": fields.get("reference_id") or None,
+        "limits": UploadLimits(plan.max_file_size_bytes, storage_used, storage_allowed),
+    }
+
+# Media Upload Route - Two-Phase Commit with Quota Enforcement
+@api_router.post("/upload")
+async def upload_file(
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Upload file with quota enforcement and two-phase commit.
+    
+    Multipart form fields: file, workspace_id, idempotency_key, reference_type, reference_id.
+    The body is streamed: when the form fields precede the file part, plan and quota limits
+    are enforced while the file arrives and the request is rejected as soon as one is crossed.
+    
+    Two-phase commit:
+    1. Create file record in DB with status=pending (reserves quota)
+    2. Upload to object storage
+    3. Update file record to status=active on success, or status=failed on failure
+    
+    Idempotent: If idempotency_key provided and file exists, returns existing file.
+    """
+    file_id = None
+    reader = StreamingUploadReader(request)
+    context: Dict[str, Any] = {}
+    
+    async def on_file_start(upload_reader: StreamingUploadReader):
+        if not upload_reader.fields.get("workspace_id"):
+            # Older clients send the file before the form fields; limits are applied after the body is read
+            return
+        context.update(await _prepare_upload(upload_reader.fields, current_user))
+        if "existing" in context:
+            upload_reader.stop()
+            return
+        upload_reader.limits = context["limits"]
+        upload_reader.enforce_content_length()
+    
+    try:
+        await reader.read(on_file_start)
+        if "existing" in context:
+            return context["existing"]
+        
+        if reader.file is None:
+            raise HTTPException(status_code=400, detail="No file provided")
+        
+        if not context:
+            context.update(await _prepare_upload(reader.fields, current_user))
+            if "existing" in context:
+                return context["existing"]
+        
+        workspace_id = context["workspace_id"]
+        workspace = context["workspace"]
+        idempotency_key = context["idempotency_key"]
+        reference_type = context["reference_type"]
+        reference_id = context["reference_id"]
+        
+        # Defensive check: filename can be None
+        filename = reader.filename or "uploaded_file"
+        file_size = reader.size
+        logging.info(f"[upload_file] Upload received: user={current_user.id}, workspace_id={workspace_id}, reference_type={reference_type}, reference_id={reference_id}, filename={filename}")
+        
+        # Defensive check: file must have content
+        if file_size == 0:
+            raise HTTPException(status_code=400, detail="File is empty")
+        
+        # Identical content already stored in this workspace is referenced, not re-uploaded
+        content_hash = reader.sha256.hexdigest()
+        blob = await _claim_media_blob(workspace_id, content_hash)
+        if blob:
+            file_record = FileRecord(
+                user_id=workspace['owner_id'],
+                workspace_id=workspace_id,
+                status=FileStatus.ACTIVE,
+                size_bytes=blob['size_bytes'],
+                url=blob['url'],
+                public_id=blob['public_id'],
+                resource_type=blob['resource_type'],
+                idempotency_key=idempotency_key,
+                reference_type=reference_type,
+                reference_id=reference_id,
+                content_hash=content_hash,
+                blob_id=blob['id']
+            )
+            file_dict = file_record.model_dump()
+            file_dict['created_at'] = file_dict['created_at'].isoformat()
+            file_dict['updated_at'] = file_dict['updated_at'].isoformat()
+            await db.files.insert_one(file_dict)
+            logging.info(f"[upload_file] Deduplicated upload: file {file_record.id} references blob {blob['id']} ({blob['ref_count']} references)")
+            return _blob_reference_response(file_record.id, blob)
+        
+        # Final check of plan file size limit and quota against the complete size
+        context["limits"].enforce(file_size)
+        
+        # Determine resource type based on file extension
+        file_extension = Path(filename).suffix.lower()
+        resource_type = _upload_resource_type(filename)
+        
+        logging.info(f"[upload_file] File type determined: extension={file_extension}, resource_type={resource_type}, size={file_size} bytes")
+        
+        # Build Cloudinary folder structure: guide2026/workspace_owner_id/workspace_id/category_id/walkthrough_id
+        cloudinary_folder = await _build_upload_folder(workspace_id, workspace['owner_id'], reference_type, reference_id)
+        logging.info(f"[upload_file] Cloudinary folder: {cloudinary_folder} (user={current_user.id}, workspace={workspace_id})")
         
-        # Determine resource type based on file extension
-        file_extension = Path(filename).suffix.lower()
-        resource_type = "auto"
-        if file_extension == '.gif':
-            resource_type = "image"  # Upload GIFs as images (not video - conversion caused issues)
-            logging.info(f"[upload_file] GIF detected, using resource_type=image for file {filename}")
-        elif file_extension in ['.jpg', '.jpeg', '.png', '.webp', '.bmp', '.svg']:
-            resource_type = "image"
-        elif file_extension in ['.mp4', '.webm', '.mov', '.avi', '.mkv']:
-            resource_type = "video"
-        elif file_extension in ['.pdf', '.doc', '.docx', '.txt']:
-            resource_type = "raw"
-        
-        logging.info(f"[upload_file] File type determined: extension={file_extension}, resource_type={resource_type}, size={file_size} bytes")
-        
-        # Build Cloudinary folder structure: guide2026/user_id/workspace_id/category_id/walkthrough_id
-        # Determine category_id and walkthrough_id from reference_type and reference_id
-        category_id = None
-        walkthrough_id = None
-        
-        if reference_type and reference_id:
-            if reference_type == "walkthrough_icon":
-                # reference_id is walkthrough_id
-                walkthrough_id = reference_id
-                # Get walkthrough to find category_id
-                walkthrough = await db.walkthroughs.find_one(
-                    {"id": walkthrough_id, "workspace_id": workspace_id},
-                    {"_id": 0, "category_ids": 1}
-                )
-                if walkthrough and walkthrough.get("category_ids"):
-                    # Use first category if multiple
-                    category_id = walkthrough["category_ids"][0] if isinstance(walkthrough["category_ids"], list) else walkthrough["category_ids"]
-            elif reference_type == "category_icon":
-                # reference_id is category_id
-                category_id = reference_id
-            elif reference_type == "step_media":
-                # reference_id is step_id - need to find walkthrough
-                # Search for walkthrough containing this step
-                walkthrough = await db.walkthroughs.find_one(
-                    {"workspace_id": workspace_id, "steps.id": reference_id},
-                    {"_id": 0, "id": 1, "category_ids": 1}
-                )
-                if walkthrough:
-                    walkthrough_id = walkthrough["id"]
-                    if walkthrough.get("category_ids"):
-                        category_id = walkthrough["category_ids"][0] if isinstance(walkthrough["category_ids"], list) else walkthrough["category_ids"]
-            elif reference_type == "block_image":
-                # reference_id is block_id - need to find step, then walkthrough
-                # Search for walkthrough containing this block
-                walkthrough = await db.walkthroughs.find_one(
-                    {"workspace_id": workspace_id, "steps.blocks.id": reference_id},
-                    {"_id": 0, "id": 1, "category_ids": 1}
-                )
-                if walkthrough:
-                    walkthrough_id = walkthrough["id"]
-                    if walkthrough.get("category_ids"):
-                        category_id = walkthrough["category_ids"][0] if isinstance(walkthrough["category_ids"], list) else walkthrough["category_ids"]
-            # workspace_logo, workspace_background don't have category/walkthrough
-        
-        # Build folder path: guide2026/workspace_owner_id/workspace_id/category_id/walkthrough_id
-        # Use workspace owner's ID for folder structure (consistent for all collaborators)
-        folder_user_id = workspace['owner_id']
-        folder_parts = ["guide2026", folder_user_id, workspace_id]
-        if category_id:
-            folder_parts.append(category_id)
-        if walkthrough_id:
-            folder_parts.append(walkthrough_id)
-        
-        cloudinary_folder = "/".join(folder_parts)
-        logging.info(f"[upload_file] Cloudinary folder: {cloudinary_folder} (user={current_user.id}, workspace={workspace_id}, category={category_id}, walkthrough_id={walkthrough_id})")
-        
         # Phase 1: Create file record with status=pending (reserves quota)
         # For shared users, file records are associated with workspace owner for quota tracking
         file_owner_id = workspace['owner_id']
@@ -6962,7 +8959,8 @@ async def upload_file(
             resource_type=resource_type,
             idempotency_key=idempotency_key,
             reference_type=reference_type,
-            reference_id=reference_id
+            reference_id=reference_id,
+            content_hash=content_hash
         )
         
         file_dict = file_record.model_dump()
@@ -6979,38 +8977,21 @@ async def upload_file(
         # Insert file record (this reserves the quota)
         await db.files.insert_one(file_dict)
         
-        # Phase 2: Upload to Cloudinary (MANDATORY - no local storage fallback)
+        # Phase 2: Upload to object storage (Cloudinary in production)
         try:
-            upload_params = {
-                "public_id": file_id,
-                "resource_type": resource_type,
-                "folder": cloudinary_folder,  # Organized: guide2026/workspace_owner_id/workspace_id/category_id/walkthrough_id
-                "overwrite": False,
-                "invalidate": True
-            }
+            upload_params = _upload_options(resource_type)
+            logging.info(f"[upload_file] Upload params for {resource_type}: {upload_params}")
             
-            # Add optimization parameters for upload
-            # Note: format="auto" and fetch_format are NOT valid upload parameters
-            # Format optimization is done at delivery time via URL transformations, not upload
-            if resource_type == "image":
-                upload_params.update({
-                    "quality": "auto:good"
-                })
-                logging.info(f"[upload_file] Image upload params: {upload_params}")
-            elif resource_type == "video":
-                upload_params.update({
-                    "quality": "auto:good",
-                    "video_codec": "auto",
-                    "bit_rate": "1m",
-                    "max_video_bitrate": 1000000,
-                })
-                logging.info(f"[upload_file] Video upload params: {upload_params}")
-            
-            # CRITICAL: Upload to Cloudinary - this is the only storage mechanism
-            logging.info(f"[upload_file] Uploading file {file_id} to Cloudinary with resource_type={resource_type}")
-            upload_result = cloudinary.uploader.upload(
-                file_content,
-                **upload_params
+            # CRITICAL: Upload through the storage provider - runs off the event loop
+            logging.info(f"[upload_file] Uploading file {file_id} to {storage_provider.name} with resource_type={resource_type}")
+            upload_result = await storage_provider.upload(
+                reader.file,
+                size=file_size,
+                public_id=file_id,
+                folder=cloudinary_folder,  # Organized: guide2026/workspace_owner_id/workspace_id/category_id/walkthrough_id
+                resource_type=resource_type,
+                filename=filename,
+                options=upload_params
             )
             
             secure_url = upload_result.get('secure_url') or upload_result.get('url')
@@ -7053,6 +9034,11 @@ async def upload_file(
             else:
                 logging.error(f"[upload_file] CRITICAL: File record not found after update for {file_id}")
             
+            try:
+                await _register_media_blob(file_id, file_owner_id, workspace_id, content_hash, secure_url, public_id, resource_type, file_size)
+            except Exception as blob_error:
+                logging.warning(f"[upload_file] Could not register media blob for {file_id}: {blob_error}")
+            
             return {
                 "file_id": file_id,
                 "url": secure_url,
@@ -7113,30 +9099,574 @@ async def upload_file(
             status_code=500,
             detail=f"File upload failed: {str(e)}. Please try again or contact support."
         )
+    finally:
+        reader.close()
 
-# Media serving route (fallback for local storage)
-# Note: If using Cloudinary, files are served directly from Cloudinary CDN
-# This route is only used for local storage fallback
-@api_router.get("/media/{filename}")
-async def get_media(filename: str):
+# ==========================================
+# RESUMABLE UPLOAD SESSIONS
+# ==========================================
+# Large media (videos, big GIFs) is uploaded in numbered, checksummed chunks so a
+# flaky connection only re-sends the missing chunks instead of the whole file.
+# Flow: create session (reserves quota, inserts PENDING FileRecord) -> PUT chunks ->
+# GET session for received ranges -> commit (assemble, upload, FileRecord ACTIVE).
+# Chunk metadata lives in MongoDB (upload_chunks) so any worker can accept any chunk.
+# The bytes go to UPLOAD_CHUNK_DIR when it is set (a directory shared by every instance),
+# otherwise into the chunk documents themselves. Chunk documents expire through a TTL
+# index shortly after their session does, so abandoned uploads never wait for cleanup.
+
+UPLOAD_SESSION_DEFAULT_CHUNK_BYTES = 5 * 1024 * 1024
+UPLOAD_SESSION_MIN_CHUNK_BYTES = 256 * 1024
+UPLOAD_SESSION_MAX_CHUNK_BYTES = 8 * 1024 * 1024  # Stays well below MongoDB's 16 MB document limit
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', '24'))
+UPLOAD_CHUNK_DIR = os.environ.get('UPLOAD_CHUNK_DIR')  # Shared chunk spool; unset keeps chunk bytes in MongoDB
+UPLOAD_CHUNK_TTL_GRACE_HOURS = 1  # Chunks outlive their session this long, so a commit started just before expiry can finish
+UPLOAD_CHUNK_SWEEP_SECONDS = 3600
+UPLOAD_CHUNK_CHECKSUM_HEADER = "x-chunk-sha256"
+UPLOAD_COMMIT_HEARTBEAT_SECONDS = 30
+UPLOAD_COMMIT_STALE_SECONDS = 300  # COMMITTING without a heartbeat this long: the committing worker died
+
+
+class UploadSessionCreate(BaseModel):
+    workspace_id: str
+    filename: str
+    size_bytes: int = Field(..., gt=0)
+    chunk_size: Optional[int] = None
+    sha256: Optional[str] = None  # Optional whole-file checksum, verified at commit
+    idempotency_key: Optional[str] = None
+    reference_type: Optional[str] = None
+    reference_id: Optional[str] = None
+
+
+def _upload_session_view(session: dict, received: List[dict]) -> Dict[str, Any]:
+    """Public session state: received chunk indices, missing indices and coalesced byte ranges."""
+    received_indices = sorted(chunk["index"] for chunk in received)
+    received_set = set(received_indices)
+    ranges = []
+    for index in received_indices:
+        start = index * session["chunk_size"]
+        end = min(start + session["chunk_size"], session["size_bytes"]) - 1
+        if ranges and ranges[-1]["end"] + 1 == start:
+            ranges[-1]["end"] = end
+        else:
+            ranges.append({"start": start, "end": end})
+    return {
+        "session_id": session["id"],
+        "file_id": session["file_id"],
+        "status": session["status"],
+        "size_bytes": session["size_bytes"],
+        "chunk_size": session["chunk_size"],
+        "total_chunks": session["total_chunks"],
+        "received_chunks": received_indices,
+        "missing_chunks": [i for i in range(session["total_chunks"]) if i not in received_set],
+        "received_ranges": ranges,
+        "received_bytes": sum(chunk["size"] for chunk in received),
+        "expires_at": session["expires_at"],
+    }
+
+
+async def _get_owned_upload_session(session_id: str, current_user: User) -> dict:
+    session = await db.upload_sessions.find_one({"id": session_id, "user_id": current_user.id}, {"_id": 0})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+
+def _upload_session_expired(session: dict) -> bool:
+    expires_at = _parse_iso_datetime(session.get("expires_at"))
+    return expires_at is not None and expires_at <= datetime.now(timezone.utc)
+
+
+def _stale_commit_filter() -> dict:
+    """Sessions left COMMITTING by a commit that stopped heartbeating (crashed worker)."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_COMMIT_STALE_SECONDS)).isoformat()
+    return {"status": UploadSessionStatus.COMMITTING, "updated_at": {"$lt": cutoff}}
+
+
+def _upload_chunk_path(session_id: str, index: int) -> Path:
+    return Path(UPLOAD_CHUNK_DIR) / session_id / f"{index}.part"
+
+
+def _write_upload_chunk(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+async def _read_upload_chunk(session_id: str, chunk: dict) -> bytes:
+    if "data" in chunk:
+        return chunk["data"]
+    return await asyncio.to_thread(_upload_chunk_path(session_id, chunk["index"]).read_bytes)
+
+
+async def _drop_upload_chunks(session_id: str) -> None:
+    await db.upload_chunks.delete_many({"session_id": session_id})
+    if UPLOAD_CHUNK_DIR:
+        await asyncio.to_thread(shutil.rmtree, Path(UPLOAD_CHUNK_DIR) / session_id, True)
+
+
+async def sweep_upload_chunk_dir() -> None:
+    """Remove spooled chunks whose session is no longer open or committing (expired sessions never discarded)."""
+    root = Path(UPLOAD_CHUNK_DIR)
+    if not root.is_dir():
+        return
+    session_ids = await asyncio.to_thread(lambda: [entry.name for entry in root.iterdir() if entry.is_dir()])
+    # Past expiry plus the grace period the chunk documents are gone too, so an open session's files go as well
+    grace_cutoff = (datetime.now(timezone.utc) - timedelta(hours=UPLOAD_CHUNK_TTL_GRACE_HOURS)).isoformat()
+    live = set(await db.upload_sessions.distinct("id", {
+        "id": {"$in": session_ids},
+        "status": {"$in": [UploadSessionStatus.OPEN, UploadSessionStatus.COMMITTING]},
+        "expires_at": {"$gte": grace_cutoff}
+    }))
+    removed = 0
+    for session_id in session_ids:
+        if session_id not in live:
+            await asyncio.to_thread(shutil.rmtree, root / session_id, True)
+            removed += 1
+    if removed:
+        logging.info(f"[upload_session] Swept spooled chunks of {removed} finished or expired sessions")
+
+
+async def _discard_upload_session(session: dict, status: UploadSessionStatus) -> None:
+    """Drop chunks, fail the PENDING file record and release the quota reservation."""
+    now = datetime.now(timezone.utc).isoformat()
+    await _drop_upload_chunks(session["id"])
+    await db.files.update_one(
+        {"id": session["file_id"], "status": FileStatus.PENDING},
+        {"$set": {"status": FileStatus.FAILED, "updated_at": now}}
+    )
+    await db.upload_sessions.update_one(
+        {"id": session["id"]},
+        {"$set": {"status": status, "updated_at": now}}
+    )
+
+
+@api_router.post("/uploads/sessions")
+async def create_upload_session(body: UploadSessionCreate, current_user: User = Depends(get_current_user)):
     """
-    Serve media files from Cloudinary. Only serves ACTIVE files (not PENDING or FAILED).
+    Start a resumable upload. Reserves quota for the full size and creates the PENDING
+    FileRecord up front. Re-posting with the same idempotency_key resumes the open session.
+    """
+    # Resume: an open session for this idempotency key is returned instead of starting over
+    if body.idempotency_key:
+        existing_session = await db.upload_sessions.find_one(
+            {"idempotency_key": body.idempotency_key, "user_id": current_user.id, "workspace_id": body.workspace_id, "status": UploadSessionStatus.OPEN},
+            {"_id": 0}
+        )
+        if existing_session and not _upload_session_expired(existing_session):
+            received = await db.upload_chunks.find({"session_id": existing_session["id"]}, {"_id": 0, "index": 1, "size": 1}).to_list(None)
+            return _upload_session_view(existing_session, received)
+    
+    context = await _prepare_upload({
+        "workspace_id": body.workspace_id,
+        "idempotency_key": body.idempotency_key or "",
+        "reference_type": body.reference_type or "",
+        "reference_id": body.reference_id or "",
+    }, current_user)
+    if "existing" in context:
+        return context["existing"]
+    
+    idempotency_key = context["idempotency_key"]
+    workspace = context["workspace"]
+    
+    # No de-duplication here: body.sha256 is only the client's claim. The commit hashes the
+    # received bytes and references an existing blob then.
+    context["limits"].enforce(body.size_bytes)
+    
+    chunk_size = body.chunk_size or UPLOAD_SESSION_DEFAULT_CHUNK_BYTES
+    if not UPLOAD_SESSION_MIN_CHUNK_BYTES <= chunk_size <= UPLOAD_SESSION_MAX_CHUNK_BYTES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"chunk_size must be between {UPLOAD_SESSION_MIN_CHUNK_BYTES} and {UPLOAD_SESSION_MAX_CHUNK_BYTES} bytes"
+        )
     
-    CRITICAL: All files are stored in Cloudinary. Local filesystem storage is NOT supported.
-    This endpoint redirects to Cloudinary URLs for persistent file serving.
+    resource_type = _upload_resource_type(body.filename)
+    folder = await _build_upload_folder(body.workspace_id, workspace["owner_id"], context["reference_type"], context["reference_id"])
+    now = datetime.now(timezone.utc)
+    
+    # Phase 1 of the two-phase commit: PENDING file record
+    file_record = FileRecord(
+        user_id=workspace["owner_id"],  # Use workspace owner's ID for quota tracking
+        workspace_id=body.workspace_id,
+        status=FileStatus.PENDING,
+        size_bytes=body.size_bytes,
+        url="",  # Will be set at commit
+        resource_type=resource_type,
+        idempotency_key=idempotency_key,
+        reference_type=context["reference_type"],
+        reference_id=context["reference_id"]
+    )
+    file_dict = file_record.model_dump()
+    file_dict['created_at'] = file_dict['created_at'].isoformat()
+    file_dict['updated_at'] = file_dict['updated_at'].isoformat()
+    await db.files.insert_one(file_dict)
+    
+    session = UploadSession(
+        file_id=file_record.id,
+        user_id=current_user.id,
+        quota_user_id=workspace["owner_id"],
+        workspace_id=body.workspace_id,
+        filename=body.filename,
+        resource_type=resource_type,
+        folder=folder,
+        size_bytes=body.size_bytes,
+        chunk_size=chunk_size,
+        total_chunks=math.ceil(body.size_bytes / chunk_size),
+        sha256=body.sha256.lower() if body.sha256 else None,
+        idempotency_key=idempotency_key,
+        expires_at=now + timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    )
+    session_dict = session.model_dump()
+    for key in ("expires_at", "created_at", "updated_at"):
+        session_dict[key] = session_dict[key].isoformat()
+    await db.upload_sessions.insert_one(session_dict)
+    session_dict.pop("_id", None)
+    
+    logging.info(f"[upload_session] Created session {session.id} for file {file_record.id}: {body.size_bytes} bytes in {session.total_chunks} chunks")
+    return _upload_session_view(session_dict, [])
+
+
+@api_router.get("/uploads/sessions/{session_id}")
+async def get_upload_session(session_id: str, current_user: User = Depends(get_current_user)):
+    """Report which chunks (and byte ranges) have been received."""
+    session = await _get_owned_upload_session(session_id, current_user)
+    received = await db.upload_chunks.find({"session_id": session_id}, {"_id": 0, "index": 1, "size": 1}).to_list(None)
+    return _upload_session_view(session, received)
+
+
+@api_router.put("/uploads/sessions/{session_id}/chunks/{index}")
+async def put_upload_chunk(session_id: str, index: int, request: Request, current_user: User = Depends(get_current_user)):
     """
-    # Extract file_id from filename (remove extension)
-    file_id = filename.rsplit('.', 1)[0] if '.' in filename else filename
+    Store one chunk. The raw request body is the chunk; the X-Chunk-SHA256 header carries
+    its hex sha256. Re-sending a chunk overwrites it, so retries are safe.
+    """
+    session = await _get_owned_upload_session(session_id, current_user)
+    if session["status"] != UploadSessionStatus.OPEN:
+        raise HTTPException(status_code=409, detail=f"Upload session is {session['status']}")
+    if _upload_session_expired(session):
+        raise HTTPException(status_code=410, detail="Upload session expired")
+    if not 0 <= index < session["total_chunks"]:
+        raise HTTPException(status_code=400, detail=f"Chunk index must be between 0 and {session['total_chunks'] - 1}")
+    
+    expected_checksum = (request.headers.get(UPLOAD_CHUNK_CHECKSUM_HEADER) or "").lower()
+    if not expected_checksum:
+        raise HTTPException(status_code=400, detail="Missing X-Chunk-SHA256 header")
+    
+    is_last = index == session["total_chunks"] - 1
+    expected_size = session["size_bytes"] - session["chunk_size"] * index if is_last else session["chunk_size"]
+    
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    async for data in request.stream():
+        if len(buffer) + len(data) > expected_size:
+            raise HTTPException(status_code=413, detail=f"Chunk {index} exceeds expected size of {expected_size} bytes")
+        buffer.extend(data)
+        digest.update(data)
+    
+    if len(buffer) != expected_size:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} has {len(buffer)} bytes, expected {expected_size}")
+    if not hmac.compare_digest(digest.hexdigest(), expected_checksum):
+        raise HTTPException(status_code=422, detail=f"Checksum mismatch for chunk {index}")
+    
+    chunk = {
+        "session_id": session_id,
+        "index": index,
+        "size": len(buffer),
+        "sha256": expected_checksum,
+        # A real date: the TTL index drops chunks of sessions nobody commits or aborts
+        "expires_at": _parse_iso_datetime(session["expires_at"]) + timedelta(hours=UPLOAD_CHUNK_TTL_GRACE_HOURS),
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    if UPLOAD_CHUNK_DIR:
+        await asyncio.to_thread(_write_upload_chunk, _upload_chunk_path(session_id, index), bytes(buffer))
+        update = {"$set": chunk, "$unset": {"data": ""}}
+    else:
+        update = {"$set": {**chunk, "data": bytes(buffer)}}
+    await db.upload_chunks.update_one({"session_id": session_id, "index": index}, update, upsert=True)
+    return {"session_id": session_id, "index": index, "size": len(buffer), "status": "received"}
+
+
+@api_router.post("/uploads/sessions/{session_id}/commit")
+async def commit_upload_session(session_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Assemble the chunks, upload to object storage and move the FileRecord PENDING -> ACTIVE.
+    Idempotent: committing a committed session returns the stored result. If the storage
+    upload fails the session reopens so the commit can simply be retried.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    # A commit abandoned by a crashed worker is taken over once it stops heartbeating
+    session = await db.upload_sessions.find_one_and_update(
+        {"id": session_id, "user_id": current_user.id, "$or": [{"status": UploadSessionStatus.OPEN}, _stale_commit_filter()]},
+        {"$set": {"status": UploadSessionStatus.COMMITTING, "updated_at": now}},
+        return_document=True
+    )
+    if session:
+        session.pop("_id", None)
+    else:
+        existing = await _get_owned_upload_session(session_id, current_user)
+        if existing["status"] == UploadSessionStatus.COMMITTED and existing.get("result"):
+            return existing["result"]
+        raise HTTPException(status_code=409, detail=f"Upload session is {existing['status']}")
+    
+    async def keep_committing():
+        while True:
+            await asyncio.sleep(UPLOAD_COMMIT_HEARTBEAT_SECONDS)
+            await db.upload_sessions.update_one(
+                {"id": session_id, "status": UploadSessionStatus.COMMITTING},
+                {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+            )
+    
+    heartbeat = asyncio.create_task(keep_committing())
+    try:
+        return await _commit_claimed_upload_session(session)
+    finally:
+        heartbeat.cancel()
+
+
+async def _commit_claimed_upload_session(session: dict) -> Dict[str, Any]:
+    """Assemble, store and activate a session this worker holds in COMMITTING."""
+    session_id = session["id"]
+    
+    async def reopen():
+        await db.upload_sessions.update_one(
+            {"id": session_id, "status": UploadSessionStatus.COMMITTING},
+            {"$set": {"status": UploadSessionStatus.OPEN, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    
+    if _upload_session_expired(session):
+        await _discard_upload_session(session, UploadSessionStatus.EXPIRED)
+        raise HTTPException(status_code=410, detail="Upload session expired")
     
+    received = await db.upload_chunks.find({"session_id": session_id}, {"_id": 0, "index": 1, "size": 1}).to_list(None)
+    if len(received) != session["total_chunks"]:
+        await reopen()
+        view = _upload_session_view(session, received)
+        raise HTTPException(status_code=409, detail=f"Upload incomplete. Missing chunks: {view['missing_chunks'][:100]}")
+    
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY_BYTES)
+    try:
+        digest = hashlib.sha256()
+        cursor = db.upload_chunks.find({"session_id": session_id}, {"_id": 0, "index": 1, "data": 1}).sort("index", ASCENDING).batch_size(2)
+        async for chunk in cursor:
+            try:
+                data = await _read_upload_chunk(session_id, chunk)
+            except FileNotFoundError:
+                # Written on an instance that does not share UPLOAD_CHUNK_DIR with this one
+                await db.upload_chunks.delete_one({"session_id": session_id, "index": chunk["index"]})
+                await reopen()
+                raise HTTPException(status_code=409, detail=f"Chunk {chunk['index']} is no longer stored. Re-send it and commit again.")
+            digest.update(data)
+            await asyncio.to_thread(spool.write, data)
+        spool.seek(0)
+        
+        content_hash = digest.hexdigest()
+        if session.get("sha256") and not hmac.compare_digest(content_hash, session["sha256"]):
+            await reopen()
+            raise HTTPException(status_code=422, detail="Assembled file checksum does not match")
+        
+        # Identical content already stored in the workspace is referenced, not re-uploaded
+        blob = await _claim_media_blob(session["workspace_id"], content_hash)
+        if not blob:
+            try:
+                upload_result = await storage_provider.upload(
+                    spool,
+                    size=session["size_bytes"],
+                    public_id=session["file_id"],
+                    folder=session["folder"],
+                    resource_type=session["resource_type"],
+                    filename=session["filename"],
+                    options=_upload_options(session["resource_type"])
+                )
+            except Exception as e:
+                logging.error(f"[upload_session] Storage upload failed for session {session_id}: {e}", exc_info=True)
+                await reopen()
+                raise HTTPException(status_code=502, detail="Storage upload failed. Retry the commit; received chunks are kept.")
+    finally:
+        spool.close()
+    
+    if blob:
+        # Phase 2 of the two-phase commit: PENDING -> ACTIVE, pointing at the shared blob
+        await db.files.update_one(
+            {"id": session["file_id"]},
+            {"$set": {
+                "status": FileStatus.ACTIVE,
+                "url": blob["url"],
+                "public_id": blob["public_id"],
+                "resource_type": blob["resource_type"],
+                "size_bytes": blob["size_bytes"],
+                "content_hash": content_hash,
+                "blob_id": blob["id"],
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+        result = _blob_reference_response(session["file_id"], blob)
+    else:
+        secure_url = upload_result.get('secure_url') or upload_result.get('url')
+        public_id = upload_result.get('public_id')
+        if not secure_url or not public_id:
+            await reopen()
+            raise HTTPException(status_code=502, detail="Storage upload returned no URL")
+        
+        # Phase 2 of the two-phase commit: PENDING -> ACTIVE
+        await db.files.update_one(
+            {"id": session["file_id"]},
+            {"$set": {
+                "status": FileStatus.ACTIVE,
+                "url": secure_url,
+                "public_id": public_id,
+                "content_hash": content_hash,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+        try:
+            await _register_media_blob(session["file_id"], session["quota_user_id"], session["workspace_id"], content_hash, secure_url, public_id, session["resource_type"], session["size_bytes"])
+        except Exception as blob_error:
+            logging.warning(f"[upload_session] Could not register media blob for {session['file_id']}: {blob_error}")
+        result = {
+            "file_id": session["file_id"],
+            "url": secure_url,
+            "public_id": public_id,
+            "size_bytes": session["size_bytes"],
+            "format": upload_result.get('format'),
+            "width": upload_result.get('width'),
+            "height": upload_result.get('height'),
+            "bytes": upload_result.get('bytes'),
+            "status": "active"
+        }
+    # The file id is known from session creation, so a client may already have a cached 404 for it
+    media_url_cache.invalidate(session["file_id"])
+    await db.upload_sessions.update_one(
+        {"id": session_id},
+        {"$set": {"status": UploadSessionStatus.COMMITTED, "result": result, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    await _drop_upload_chunks(session_id)
+    logging.info(f"[upload_session] Committed session {session_id} as file {session['file_id']}")
+    return result
+
+
+@api_router.delete("/uploads/sessions/{session_id}")
+async def abort_upload_session(session_id: str, current_user: User = Depends(get_current_user)):
+    """
+    Abort an open session: drop its chunks and release the quota reservation. A session
+    stuck in COMMITTING by a crashed commit can be aborted once it stops heartbeating.
+    """
+    session = await db.upload_sessions.find_one_and_update(
+        {
+            "id": session_id,
+            "user_id": current_user.id,
+            "$or": [{"status": {"$in": [UploadSessionStatus.OPEN, UploadSessionStatus.EXPIRED]}}, _stale_commit_filter()]
+        },
+        {"$set": {"status": UploadSessionStatus.ABORTED, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0},
+        return_document=True
+    )
+    if not session:
+        existing = await _get_owned_upload_session(session_id, current_user)
+        raise HTTPException(status_code=409, detail=f"Upload session is {existing['status']}")
+    await _discard_upload_session(session, UploadSessionStatus.ABORTED)
+    return {"session_id": session_id, "status": UploadSessionStatus.ABORTED}
+
+# Media serving route
+# Resolution of file_id -> storage location is cached in-process: a hit serves the redirect
+# without touching MongoDB or the storage API. Entries are dropped when a file leaves ACTIVE
+# (cascade deletion) and expire after MEDIA_CACHE_TTL_SECONDS so other workers converge.
+MEDIA_CACHE_MAX_ENTRIES = int(os.environ.get('MEDIA_CACHE_MAX_ENTRIES', '10000'))
+MEDIA_CACHE_TTL_SECONDS = int(os.environ.get('MEDIA_CACHE_TTL_SECONDS', '300'))
+MEDIA_NEGATIVE_CACHE_TTL_SECONDS = int(os.environ.get('MEDIA_NEGATIVE_CACHE_TTL_SECONDS', '30'))
+# file_id -> content is immutable, so clients and CDNs may keep the redirect for a long time
+MEDIA_REDIRECT_MAX_AGE_SECONDS = int(os.environ.get('MEDIA_REDIRECT_MAX_AGE_SECONDS', str(7 * 24 * 3600)))
+# Local files can be replaced in place (variants are regenerated), so they revalidate by ETag
+MEDIA_LOCAL_MAX_AGE_SECONDS = int(os.environ.get('MEDIA_LOCAL_MAX_AGE_SECONDS', '60'))
+
+
+class MediaResolutionCache:
+    """
+    LRU of file_id -> resolved media location plus a negative cache of ids that resolved to 404.
+    Single event loop, no awaits inside methods, so no locking is needed.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, negative_ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._missing: "OrderedDict[str, float]" = OrderedDict()
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        item = self._entries.get(file_id)
+        if item is None:
+            return None
+        expires_at, entry = item
+        if expires_at <= time.monotonic():
+            del self._entries[file_id]
+            return None
+        self._entries.move_to_end(file_id)
+        return entry
+
+    def put(self, file_id: str, entry: Dict[str, Any]) -> None:
+        self._missing.pop(file_id, None)
+        self._entries[file_id] = (time.monotonic() + self.ttl_seconds, entry)
+        self._entries.move_to_end(file_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def is_missing(self, file_id: str) -> bool:
+        expires_at = self._missing.get(file_id)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del self._missing[file_id]
+            return False
+        return True
+
+    def mark_missing(self, file_id: str) -> None:
+        self._missing[file_id] = time.monotonic() + self.negative_ttl_seconds
+        self._missing.move_to_end(file_id)
+        while len(self._missing) > self.max_entries:
+            self._missing.popitem(last=False)
+
+    def invalidate(self, *file_ids: str) -> None:
+        for file_id in file_ids:
+            self._entries.pop(file_id, None)
+            self._missing.pop(file_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._missing.clear()
+
+
+media_url_cache = MediaResolutionCache(MEDIA_CACHE_MAX_ENTRIES, MEDIA_CACHE_TTL_SECONDS, MEDIA_NEGATIVE_CACHE_TTL_SECONDS)
+
+
+def _media_redirect_entry(url: str) -> Dict[str, Any]:
+    return {"redirect_url": url, "etag": f'"{hashlib.sha256(url.encode()).hexdigest()[:32]}"'}
+
+
+async def _resolve_media_location(file_id: str) -> Dict[str, Any]:
+    """
+    Resolve an ACTIVE file to {"redirect_url", "etag"} or {"local_public_id"}.
+    Raises 404 when the file is missing, not ACTIVE or not found in storage.
+    """
     # Check if file record exists and is ACTIVE
     file_record = await db.files.find_one({"id": file_id}, {"_id": 0})
     if not file_record:
         logging.warning(f"[get_media] File record not found for file_id: {file_id}")
         raise HTTPException(status_code=404, detail="File not found")
     
+    # A de-duplicated blob outlives the record that first stored it (its URL embeds that
+    # record's id), so a released origin record is still served while the blob is referenced
+    if file_record.get('status') != FileStatus.ACTIVE and file_record.get('blob_id'):
+        blob = await db.media_blobs.find_one({"id": file_record['blob_id'], "ref_count": {"$gt": 0}}, {"_id": 0})
+        if blob:
+            file_record = {**file_record, "status": FileStatus.ACTIVE, "url": blob['url'], "public_id": blob['public_id'], "resource_type": blob['resource_type']}
+    
     # Only serve ACTIVE files - block PENDING, FAILED, DELETING
     if file_record.get('status') != FileStatus.ACTIVE:
-        logging.warning(f"[get_media] File {file_id} not available (status: {file_record.get('status')})")
+        logging.debug(f"[get_media] File {file_id} not available (status: {file_record.get('status')})")
         raise HTTPException(
             status_code=404, 
             detail=f"File not available (status: {file_record.get('status')})"
@@ -7146,29 +9676,29 @@ async def get_media(filename: str):
     public_id = file_record.get('public_id')
     resource_type = file_record.get('resource_type', 'auto')
     
-    logging.info(f"[get_media] File record for {file_id}: url={stored_url}, public_id={public_id}, resource_type={resource_type}")
-    
     # CRITICAL: If stored URL is a Cloudinary URL, redirect directly
     # This is the primary path for all files uploaded after Cloudinary migration
     if stored_url and 'res.cloudinary.com' in stored_url:
-        logging.info(f"[get_media] File {file_id} has Cloudinary URL, redirecting: {stored_url}")
-        return RedirectResponse(url=stored_url)
+        return _media_redirect_entry(stored_url)
+    
+    # Local filesystem backend: serve the blob directly
+    if storage_provider.local_path(public_id or file_id) is not None:
+        return {"local_public_id": public_id or file_id}
     
     # CRITICAL: If URL is not Cloudinary but we have public_id, look up in Cloudinary
     # This handles files that were uploaded but URL wasn't saved correctly
     if public_id:
         try:
-            logging.info(f"[get_media] Looking up file {file_id} in Cloudinary by public_id: {public_id}, resource_type: {resource_type}")
-            resource = cloudinary.api.resource(public_id, resource_type=resource_type)
+            resource = await storage_provider.stat(public_id, resource_type=resource_type) or {}
             cloudinary_url = resource.get('secure_url') or resource.get('url')
             if cloudinary_url:
-                logging.info(f"[get_media] Found file {file_id} in Cloudinary, redirecting: {cloudinary_url}")
+                logging.info(f"[get_media] Found file {file_id} in Cloudinary by public_id, repairing stored URL: {cloudinary_url}")
                 # CRITICAL: Update file record with Cloudinary URL for future requests
                 await db.files.update_one(
                     {"id": file_id},
                     {"$set": {"url": cloudinary_url, "public_id": public_id, "resource_type": resource_type}}
                 )
-                return RedirectResponse(url=cloudinary_url)
+                return _media_redirect_entry(cloudinary_url)
             else:
                 logging.error(f"[get_media] Cloudinary resource found but no URL: {resource}")
         except Exception as e:
@@ -7177,12 +9707,11 @@ async def get_media(filename: str):
     # CRITICAL: If we have file_id but no public_id, try to look up by file_id
     # This handles edge cases where public_id wasn't saved
     try:
-        logging.info(f"[get_media] Attempting Cloudinary lookup for file {file_id} by file_id, resource_type: {resource_type}")
-        resource = cloudinary.api.resource(file_id, resource_type=resource_type)
+        resource = await storage_provider.stat(file_id, resource_type=resource_type) or {}
         cloudinary_url = resource.get('secure_url') or resource.get('url')
         returned_public_id = resource.get('public_id')
         if cloudinary_url:
-            logging.info(f"[get_media] Found file {file_id} in Cloudinary by file_id, redirecting: {cloudinary_url}")
+            logging.info(f"[get_media] Found file {file_id} in Cloudinary by file_id, repairing stored URL: {cloudinary_url}")
             # CRITICAL: Update file record with Cloudinary URL and public_id
             await db.files.update_one(
                 {"id": file_id},
@@ -7192,7 +9721,7 @@ async def get_media(filename: str):
                     "resource_type": resource_type
                 }}
             )
-            return RedirectResponse(url=cloudinary_url)
+            return _media_redirect_entry(cloudinary_url)
         else:
             logging.error(f"[get_media] Cloudinary resource found by file_id but no URL: {resource}")
     except Exception as e:
@@ -7205,13 +9734,76 @@ async def get_media(filename: str):
         detail="File not found in Cloudinary. The file may have been deleted or never uploaded successfully."
     )
 
-# Subscription & Quota Routes
-@api_router.put("/users/me/plan")
-async def change_user_plan(plan_name: str = Query(..., description="Plan name to change to"), current_user: User = Depends(get_current_user)):
-    """
-    Change user's plan.
-    Handles plan upgrades and downgrades gracefully.
-    - Allows downgrades even if user is over new plan's quota (read-only mode for uploads)
+async def _cached_media_location(file_id: str) -> Dict[str, Any]:
+    """Resolve a file through media_url_cache, remembering 404s briefly."""
+    location = media_url_cache.get(file_id)
+    if location is None:
+        if media_url_cache.is_missing(file_id):
+            raise HTTPException(status_code=404, detail="File not found")
+        try:
+            location = await _resolve_media_location(file_id)
+        except HTTPException as e:
+            if e.status_code == 404:
+                media_url_cache.mark_missing(file_id)
+            raise
+        media_url_cache.put(file_id, location)
+    return location
+
+
+def _local_media_response(path: str, request: Request) -> Response:
+    """Serve a local file with a short max-age and an mtime/size ETag, answering If-None-Match with 304."""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    etag = f'"{hashlib.sha256(f"{stat_result.st_mtime_ns}-{stat_result.st_size}".encode()).hexdigest()[:32]}"'
+    headers = {"Cache-Control": f"public, max-age={MEDIA_LOCAL_MAX_AGE_SECONDS}", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers, stat_result=stat_result)
+
+@api_router.get("/media/{filename}")
+async def get_media(filename: str, request: Request):
+    """
+    Serve media files. Only serves ACTIVE files (not PENDING or FAILED).
+    
+    Cloudinary files are redirected to the CDN with long-lived Cache-Control/ETag headers;
+    the local storage backend serves the file directly with a short max-age and an ETag.
+    Resolutions (and 404s, briefly) are cached in-process so repeated hits skip MongoDB and
+    the storage API.
+    """
+    # Extract file_id from filename (remove extension)
+    file_id = filename.rsplit('.', 1)[0] if '.' in filename else filename
+    
+    location = await _cached_media_location(file_id)
+    if "local_public_id" in location:
+        local_path = storage_provider.local_path(location["local_public_id"])
+        if local_path is None:
+            media_url_cache.invalidate(file_id)
+            raise HTTPException(status_code=404, detail="File not found")
+        return _local_media_response(local_path, request)
+    
+    cache_headers = {"Cache-Control": f"public, max-age={MEDIA_REDIRECT_MAX_AGE_SECONDS}", "ETag": location["etag"]}
+    if request.headers.get("if-none-match") == location["etag"]:
+        return Response(status_code=304, headers=cache_headers)
+    return RedirectResponse(url=location["redirect_url"], headers=cache_headers)
+
+@api_router.get("/media/{file_id}/variants/{name}")
+async def get_media_variant(file_id: str, name: str, request: Request):
+    """Serve a generated media variant (local storage backend; Cloudinary variants are CDN URLs)."""
+    location = await _cached_media_location(file_id)
+    variant_path = storage_provider.variant_path(location["local_public_id"], name) if "local_public_id" in location else None
+    if variant_path is None:
+        raise HTTPException(status_code=404, detail="Variant not found")
+    return _local_media_response(variant_path, request)
+
+# Subscription & Quota Routes
+@api_router.put("/users/me/plan")
+async def change_user_plan(plan_name: str = Query(..., description="Plan name to change to"), current_user: User = Depends(get_current_user)):
+    """
+    Change user's plan.
+    Handles plan upgrades and downgrades gracefully.
+    - Allows downgrades even if user is over new plan's quota (read-only mode for uploads)
     - Blocks downgrades if user exceeds new plan's workspace/walkthrough/category limits
     - Never auto-deletes user files
     
@@ -7812,24 +10404,19 @@ async def cancel_paypal_subscription(current_user: User = Depends(get_current_us
             })
         
         # Cancel via PayPal API
-        async with aiohttp.ClientSession() as session:
-            cancel_url = f"{PAYPAL_API_BASE}/v1/billing/subscriptions/{paypal_subscription_id}/cancel"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            payload = {"reason": "User requested cancellation"}
-            
-            async with session.post(cancel_url, json=payload, headers=headers) as response:
-                if response.status != 204:
-                    logging.error(f"PayPal cancel API failed: {response.status}")
-                    return JSONResponse({
-                        "success": False,
-                        "message": "PayPal cancellation failed. Please manage via PayPal directly.",
-                        "status": "cancel_failed"
-                    })
-                
-                logging.info(f"PayPal cancel API succeeded: user={current_user.id}, subscription={subscription.id}")
+        payload = {"reason": "User requested cancellation"}
+        response = await paypal_client.request(
+            "POST", f"/v1/billing/subscriptions/{paypal_subscription_id}/cancel", json_body=payload
+        )
+        if response is None or response.status != 204:
+            logging.error(f"PayPal cancel API failed: {response.status if response else 'no access token'}")
+            return JSONResponse({
+                "success": False,
+                "message": "PayPal cancellation failed. Please manage via PayPal directly.",
+                "status": "cancel_failed"
+            })
+        
+        logging.info(f"PayPal cancel API succeeded: user={current_user.id}, subscription={subscription.id}")
         
         # CRITICAL: Immediately reconcile to fetch PayPal timestamps
         # PayPal provides next_billing_time (until paid period ends) for Auto Pay = OFF
@@ -7980,7 +10567,7 @@ async def reconcile_my_subscription(current_user: User = Depends(get_current_use
     now = datetime.now(timezone.utc)
     
     # METRICS: Track user-triggered reconciliation
-    await metrics.increment('reconcile_user_triggered')
+    metrics.increment('reconcile_user_triggered')
     
     # Rate limiting check
     if user_id in _reconciliation_cache:
@@ -8159,38 +10746,175 @@ async def subscribe_paypal(
         "message": "Subscription created. Access will be activated when PayPal confirms payment."
     })
 
+# PayPal HTTP client configuration
+PAYPAL_HTTP_TIMEOUT_SECONDS = float(os.environ.get('PAYPAL_HTTP_TIMEOUT_SECONDS', '20'))
+PAYPAL_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('PAYPAL_CONNECT_TIMEOUT_SECONDS', '5'))
+PAYPAL_MAX_RETRIES = int(os.environ.get('PAYPAL_MAX_RETRIES', '2'))  # Retries after the first attempt
+PAYPAL_RETRY_BACKOFF_SECONDS = float(os.environ.get('PAYPAL_RETRY_BACKOFF_SECONDS', '0.5'))  # Doubles per retry
+PAYPAL_POOL_SIZE = int(os.environ.get('PAYPAL_POOL_SIZE', '20'))
+PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS = 60  # Refresh a cached token this long before PayPal expires it
+PAYPAL_RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class PayPalResponse:
+    """A fully read PayPal response; `data` is the parsed JSON body when there is one."""
+    
+    def __init__(self, status: int, text: str, data: Any):
+        self.status = status
+        self.text = text
+        self.data = data
+
+
+class PayPalClient:
+    """
+    PayPal REST client over one long-lived pooled aiohttp session.
+    
+    The OAuth token is cached until shortly before its expires_in and refreshed by a single
+    caller while concurrent callers wait for it. Requests retry connection errors, timeouts,
+    429 and 5xx with exponential backoff (honoring Retry-After); POSTs carry a PayPal-Request-Id
+    that stays the same across retries, so PayPal applies them once. A 401 drops the cached
+    token and retries once with a fresh one.
+    """
+    
+    def __init__(
+        self,
+        base_url: str,
+        client_id: Optional[str],
+        client_secret: Optional[str],
+        timeout: float = PAYPAL_HTTP_TIMEOUT_SECONDS,
+        connect_timeout: float = PAYPAL_CONNECT_TIMEOUT_SECONDS,
+        max_retries: int = PAYPAL_MAX_RETRIES,
+        backoff: float = PAYPAL_RETRY_BACKOFF_SECONDS,
+        pool_size: int = PAYPAL_POOL_SIZE
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock: Optional[asyncio.Lock] = None
+    
+    @property
+    def configured(self) -> bool:
+        return bool(self.client_id and self.client_secret)
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+    
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    def invalidate_token(self) -> None:
+        self._token = None
+        self._token_expires_at = 0.0
+    
+    async def access_token(self) -> Optional[str]:
+        """Cached OAuth access token, or None when PayPal cannot be authenticated with."""
+        if not self.configured:
+            logging.error("PayPal credentials not configured")
+            return None
+        if self._token and time.monotonic() < self._token_expires_at:
+            return self._token
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            # Another caller may have refreshed it while this one waited
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            auth_string = base64.b64encode(f"{self.client_id}:{self.client_secret}".encode()).decode()
+            try:
+                response = await self._send(
+                    "POST", "/v1/oauth2/token",
+                    headers={'Authorization': f'Basic {auth_string}', 'Content-Type': 'application/x-www-form-urlencoded'},
+                    data={'grant_type': 'client_credentials'}
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"Error getting PayPal access token: {str(e)}")
+                return None
+            if response.status != 200 or not isinstance(response.data, dict) or not response.data.get('access_token'):
+                logging.error(f"Failed to get PayPal access token: {response.status}")
+                return None
+            expires_in = float(response.data.get('expires_in') or 0)
+            self._token = response.data['access_token']
+            self._token_expires_at = time.monotonic() + max(expires_in - PAYPAL_TOKEN_REFRESH_MARGIN_SECONDS, 0)
+            return self._token
+    
+    async def request(self, method: str, path: str, json_body: Optional[Dict[str, Any]] = None) -> Optional[PayPalResponse]:
+        """
+        Authenticated API call. Returns None when no access token can be obtained; raises
+        aiohttp.ClientError / asyncio.TimeoutError once retries are exhausted.
+        """
+        headers = {'Content-Type': 'application/json'}
+        if method.upper() == "POST":
+            headers['PayPal-Request-Id'] = str(uuid.uuid4())
+        for token_attempt in range(2):
+            access_token = await self.access_token()
+            if not access_token:
+                return None
+            response = await self._send(method, path, headers={**headers, 'Authorization': f'Bearer {access_token}'}, json_body=json_body)
+            if response.status != 401 or token_attempt:
+                return response
+            self.invalidate_token()
+        return response
+    
+    async def _send(
+        self,
+        method: str,
+        path: str,
+        headers: Dict[str, str],
+        json_body: Optional[Dict[str, Any]] = None,
+        data: Optional[Dict[str, str]] = None
+    ) -> PayPalResponse:
+        """One logical HTTP call with retry/backoff on transient failures."""
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff * (2 ** attempt)
+            try:
+                async with self._get_session().request(method, url, headers=headers, json=json_body, data=data) as response:
+                    text = await response.text()
+                    if response.status not in PAYPAL_RETRY_STATUSES or attempt == self.max_retries:
+                        try:
+                            body = json.loads(text) if text else None
+                        except ValueError:
+                            body = None
+                        return PayPalResponse(response.status, text, body)
+                    retry_after = response.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = max(delay, float(retry_after))
+                    logging.warning(f"[paypal] {method} {path} returned {response.status}, retrying (attempt {attempt + 1})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"[paypal] {method} {path} failed: {e}, retrying (attempt {attempt + 1})")
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+        raise RuntimeError("unreachable")
+    
+    async def fetch_bytes(self, url: str) -> bytes:
+        """GET an absolute URL (such as a webhook cert URL) over the pooled session, without auth or retries."""
+        async with self._get_session().get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+paypal_client = PayPalClient(PAYPAL_API_BASE, PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET)
+
+
 async def get_paypal_access_token() -> Optional[str]:
     """
-    Get PayPal OAuth access token for API calls.
+    Get PayPal OAuth access token for API calls (cached by paypal_client).
     Returns access token or None if authentication fails.
     """
-    if not all([PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET]):
-        logging.error("PayPal credentials not configured")
-        return None
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            auth_url = f"{PAYPAL_API_BASE}/v1/oauth2/token"
-            auth_data = aiohttp.FormData()
-            auth_data.add_field('grant_type', 'client_credentials')
-            
-            auth_string = base64.b64encode(f"{PAYPAL_CLIENT_ID}:{PAYPAL_CLIENT_SECRET}".encode()).decode()
-            auth_headers = {
-                'Authorization': f'Basic {auth_string}',
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-            
-            async with session.post(auth_url, data=auth_data, headers=auth_headers) as auth_response:
-                if auth_response.status != 200:
-                    logging.error(f"Failed to get PayPal access token: {auth_response.status}")
-                    return None
-                
-                auth_data = await auth_response.json()
-                access_token = auth_data.get('access_token')
-                return access_token
-    except Exception as e:
-        logging.error(f"Error getting PayPal access token: {str(e)}")
-        return None
+    return await paypal_client.access_token()
 
 async def log_paypal_action(
     action: str,
@@ -8278,58 +11002,53 @@ async def get_paypal_subscription_details(paypal_subscription_id: str, user_id:
         return None
     
     try:
-        async with aiohttp.ClientSession() as session:
-            subscription_url = f"{PAYPAL_API_BASE}{endpoint}"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
+        response = await paypal_client.request("GET", endpoint)
+        if response is None:
+            raise RuntimeError("Failed to get PayPal access token")
+        response_status = response.status
+        paypal_status = None
+        raw_response = None
+        
+        if response_status == 200:
+            subscription_details = response.data
+            raw_response = subscription_details
+            paypal_status = subscription_details.get('status', '').upper() if subscription_details else None
             
-            async with session.get(subscription_url, headers=headers) as response:
-                response_status = response.status
-                paypal_status = None
-                raw_response = None
-                
-                if response_status == 200:
-                    subscription_details = await response.json()
-                    raw_response = subscription_details
-                    paypal_status = subscription_details.get('status', '').upper() if subscription_details else None
-                    
-                    # AUDIT LOG: AFTER successful PayPal API call
-                    await log_paypal_action(
-                        action=f"{action}_after",
-                        paypal_endpoint=endpoint,
-                        http_method="GET",
-                        source=source,
-                        user_id=user_id,
-                        subscription_id=subscription_id,
-                        http_status_code=response_status,
-                        paypal_status=paypal_status,
-                        verified=(paypal_status in ['ACTIVE', 'CANCELLED', 'EXPIRED', 'SUSPENDED']),
-                        raw_paypal_response=raw_response
-                    )
-                    
-                    return subscription_details
-                else:
-                    error_text = await response.text()
-                    raw_response = {"error": error_text, "status_code": response_status}
-                    
-                    # AUDIT LOG: AFTER failed PayPal API call
-                    await log_paypal_action(
-                        action=f"{action}_failed",
-                        paypal_endpoint=endpoint,
-                        http_method="GET",
-                        source=source,
-                        user_id=user_id,
-                        subscription_id=subscription_id,
-                        http_status_code=response_status,
-                        paypal_status="UNKNOWN",
-                        verified=False,
-                        raw_paypal_response=raw_response
-                    )
-                    
-                    logging.error(f"Failed to fetch PayPal subscription details: status={response_status}")
-                    return None
+            # AUDIT LOG: AFTER successful PayPal API call
+            await log_paypal_action(
+                action=f"{action}_after",
+                paypal_endpoint=endpoint,
+                http_method="GET",
+                source=source,
+                user_id=user_id,
+                subscription_id=subscription_id,
+                http_status_code=response_status,
+                paypal_status=paypal_status,
+                verified=(paypal_status in ['ACTIVE', 'CANCELLED', 'EXPIRED', 'SUSPENDED']),
+                raw_paypal_response=raw_response
+            )
+            
+            return subscription_details
+        else:
+            error_text = response.text
+            raw_response = {"error": error_text, "status_code": response_status}
+            
+            # AUDIT LOG: AFTER failed PayPal API call
+            await log_paypal_action(
+                action=f"{action}_failed",
+                paypal_endpoint=endpoint,
+                http_method="GET",
+                source=source,
+                user_id=user_id,
+                subscription_id=subscription_id,
+                http_status_code=response_status,
+                paypal_status="UNKNOWN",
+                verified=False,
+                raw_paypal_response=raw_response
+            )
+            
+            logging.error(f"Failed to fetch PayPal subscription details: status={response_status}")
+            return None
     except Exception as e:
         error_msg = str(e)
         # AUDIT LOG: Exception during PayPal API call
@@ -8393,7 +11112,7 @@ async def reconcile_subscription_with_paypal(
     now = datetime.now(timezone.utc)
     
     # METRICS: Track reconciliation attempt
-    await metrics.increment('reconcile_total')
+    metrics.increment('reconcile_total')
     
     # Fetch subscription from database
     subscription_doc = await db.subscriptions.find_one({"id": subscription_id}, {"_id": 0})
@@ -8547,14 +11266,14 @@ async def reconcile_subscription_with_paypal(
                 next_billing_dt = datetime.fromisoformat(next_billing_time.replace('Z', '+00:00'))
             except Exception as e:
                 logging.error(f"[RECONCILE] Invalid next_billing_time format: {next_billing_time}, error: {e}")
-                await metrics.increment('reconcile_timestamp_parse_error')
+                metrics.increment('reconcile_timestamp_parse_error')
         
         if final_payment_time:
             try:
                 final_payment_dt = datetime.fromisoformat(final_payment_time.replace('Z', '+00:00'))
             except Exception as e:
                 logging.error(f"[RECONCILE] Invalid final_payment_time format: {final_payment_time}, error: {e}")
-                await metrics.increment('reconcile_timestamp_parse_error')
+                metrics.increment('reconcile_timestamp_parse_error')
         
         # PRODUCTION RULE: Access granted IFF billing timestamps prove it
         access_granted = (
@@ -8577,20 +11296,20 @@ async def reconcile_subscription_with_paypal(
         
         # METRICS & ALERT: Track access decisions
         if access_granted:
-            await metrics.increment('access_granted_total')
+            metrics.increment('access_granted_total')
             if next_billing_dt:
-                await metrics.increment('access_granted_next_billing')
+                metrics.increment('access_granted_next_billing')
             if final_payment_dt:
-                await metrics.increment('access_granted_final_payment')
+                metrics.increment('access_granted_final_payment')
             # Track fallback access
             if not next_billing_dt and not final_payment_dt and last_payment_time:
-                await metrics.increment('access_granted_last_payment_fallback')
+                metrics.increment('access_granted_last_payment_fallback')
                 logging.info(
                     f"📊 [RECONCILE] Access granted via last_payment fallback: "
                     f"subscription_id={subscription_id}, last_payment={last_payment_time}"
                 )
         else:
-            await metrics.increment('access_denied_total')
+            metrics.increment('access_denied_total')
         
         # Access reason (for audit)
         if access_granted:
@@ -8708,10 +11427,10 @@ async def reconcile_subscription_with_paypal(
         )
         
         # METRICS: Track successful reconciliation
-        await metrics.increment('reconcile_success')
-        await metrics.increment(f'reconcile_status_{paypal_status.lower()}')
+        metrics.increment('reconcile_success')
+        metrics.increment(f'reconcile_status_{paypal_status.lower()}')
         if paypal_status in TERMINAL_FOR_POLLING:
-            await metrics.increment('reconcile_terminal')
+            metrics.increment('reconcile_terminal')
         
         # STEP 7: Return complete state
         return {
@@ -8733,7 +11452,7 @@ async def reconcile_subscription_with_paypal(
         
     except Exception as e:
         # METRICS: Track failed reconciliation
-        await metrics.increment('reconcile_failed')
+        metrics.increment('reconcile_failed')
         logging.error(f"[RECONCILE] Error for subscription {subscription_id}: {str(e)}", exc_info=True)
         return {
             "success": False,
@@ -8757,6 +11476,132 @@ async def reconcile_pending_subscription(subscription: Subscription) -> Optional
         return Subscription(**updated_sub) if updated_sub else None
     return None
 
+PAYPAL_WEBHOOK_LOCAL_VERIFY = os.environ.get('PAYPAL_WEBHOOK_LOCAL_VERIFY', 'true').lower() == 'true'
+PAYPAL_CERT_HOSTS = frozenset(
+    host.strip().lower()
+    for host in os.environ.get(
+        'PAYPAL_CERT_HOSTS', 'api.paypal.com,api-m.paypal.com,api.sandbox.paypal.com,api-m.sandbox.paypal.com'
+    ).split(',')
+    if host.strip()
+)
+PAYPAL_CERT_CACHE_SIZE = 16  # Certificates kept per process, keyed by cert URL
+PAYPAL_WEBHOOK_SIGNATURE_HASHES = {"SHA256withRSA": hashes.SHA256}
+
+
+class PayPalWebhookVerifier:
+    """
+    Offline PayPal webhook signature check.
+    
+    PayPal signs "<transmission_id>|<transmission_time>|<webhook_id>|<crc32 of body>" with the
+    key of the certificate at PAYPAL-CERT-URL. Certificates are only fetched over HTTPS from
+    allow-listed PayPal hosts, must chain to a trusted root for their PayPal host name, and
+    are kept in an LRU keyed by URL until they expire.
+    
+    verify() returns None whenever it cannot reach a trustworthy verdict (unknown algorithm,
+    certificate unavailable or untrusted) so the caller can fall back to PayPal's API.
+    """
+    
+    def __init__(
+        self,
+        fetch,
+        allowed_hosts=PAYPAL_CERT_HOSTS,
+        trust_roots: Optional[List[x509.Certificate]] = None,
+        cache_size: int = PAYPAL_CERT_CACHE_SIZE
+    ):
+        self.fetch = fetch  # async (url) -> PEM bytes
+        self.allowed_hosts = frozenset(allowed_hosts)
+        self.cache_size = cache_size
+        self._trust_roots = trust_roots
+        self._certs: "OrderedDict[str, x509.Certificate]" = OrderedDict()
+        self._fetch_lock: Optional[asyncio.Lock] = None
+    
+    def cert_url_allowed(self, cert_url: Optional[str]) -> bool:
+        parsed = urlparse(cert_url or "")
+        return parsed.scheme == "https" and (parsed.hostname or "") in self.allowed_hosts and parsed.port in (None, 443)
+    
+    def _store(self) -> Store:
+        if self._trust_roots is None:
+            with open(certifi.where(), "rb") as bundle:
+                self._trust_roots = x509.load_pem_x509_certificates(bundle.read())
+        return Store(self._trust_roots)
+    
+    def _verified_leaf(self, pem: bytes) -> x509.Certificate:
+        """Leaf of a PEM bundle, verified to chain to a trusted root for its PayPal host name. Raises otherwise."""
+        certs = x509.load_pem_x509_certificates(pem)
+        leaf, intermediates = certs[0], certs[1:]
+        names = leaf.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        common_name = str(names[0].value).lower() if names else ""
+        if common_name != "paypal.com" and not common_name.endswith(".paypal.com"):
+            raise ValueError(f"certificate issued to {common_name!r}")
+        verifier = PolicyBuilder().store(self._store()).build_server_verifier(x509.DNSName(common_name))
+        verifier.verify(leaf, intermediates)
+        return leaf
+    
+    def _cached(self, cert_url: str) -> Optional[x509.Certificate]:
+        cert = self._certs.get(cert_url)
+        if cert is None:
+            return None
+        if cert.not_valid_after_utc <= datetime.now(timezone.utc):
+            del self._certs[cert_url]
+            return None
+        self._certs.move_to_end(cert_url)
+        return cert
+    
+    async def certificate(self, cert_url: str) -> Optional[x509.Certificate]:
+        """Trusted certificate for an allow-listed URL, fetched at most once while cached."""
+        cert = self._cached(cert_url)
+        if cert is not None:
+            return cert
+        if self._fetch_lock is None:
+            self._fetch_lock = asyncio.Lock()
+        async with self._fetch_lock:
+            # Another caller may have fetched it while this one waited
+            cert = self._cached(cert_url)
+            if cert is not None:
+                return cert
+            try:
+                cert = self._verified_leaf(await self.fetch(cert_url))
+            except Exception as e:
+                logging.warning(f"[paypal] Webhook certificate {cert_url} not usable for local verification: {e}")
+                return None
+            self._certs[cert_url] = cert
+            while len(self._certs) > self.cache_size:
+                self._certs.popitem(last=False)
+            return cert
+    
+    async def verify(
+        self,
+        webhook_id: str,
+        transmission_id: str,
+        cert_url: str,
+        auth_algo: str,
+        transmission_sig: str,
+        transmission_time: str,
+        webhook_body: bytes
+    ) -> Optional[bool]:
+        if not self.cert_url_allowed(cert_url):
+            logging.error(f"[paypal] Webhook cert URL is not an allowed PayPal host: {cert_url}")
+            return False
+        hash_algorithm = PAYPAL_WEBHOOK_SIGNATURE_HASHES.get(auth_algo)
+        if hash_algorithm is None:
+            return None
+        cert = await self.certificate(cert_url)
+        if cert is None:
+            return None
+        public_key = cert.public_key()
+        if not isinstance(public_key, rsa.RSAPublicKey):
+            return None
+        message = f"{transmission_id}|{transmission_time}|{webhook_id}|{zlib.crc32(webhook_body)}".encode()
+        try:
+            public_key.verify(base64.b64decode(transmission_sig or "", validate=True), message, padding.PKCS1v15(), hash_algorithm())
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+
+paypal_webhook_verifier = PayPalWebhookVerifier(paypal_client.fetch_bytes)
+
+
 async def verify_paypal_webhook_signature(
     webhook_id: str,
     transmission_id: str,
@@ -8765,58 +11610,82 @@ async def verify_paypal_webhook_signature(
     transmission_sig: str,
     transmission_time: str,
     webhook_body: bytes
-) -> bool:
+) -> Optional[bool]:
     """
-    Verify PayPal webhook signature using PayPal's verify-webhook-signature API.
-    Returns True if verification succeeds, False otherwise.
+    Verify PayPal webhook signature, locally against PayPal's signing certificate when
+    possible (PayPalWebhookVerifier), otherwise with PayPal's verify-webhook-signature API.
+    Returns True if verification succeeds, False if the signature is rejected,
+    and None if PayPal could not be asked (token or API unavailable) so the caller can retry.
     """
+    if PAYPAL_WEBHOOK_LOCAL_VERIFY and webhook_id:
+        local_result = await paypal_webhook_verifier.verify(
+            webhook_id=webhook_id,
+            transmission_id=transmission_id,
+            cert_url=cert_url,
+            auth_algo=auth_algo,
+            transmission_sig=transmission_sig,
+            transmission_time=transmission_time,
+            webhook_body=webhook_body
+        )
+        if local_result is not None:
+            metrics.increment('webhook_verify_local_total')
+            return local_result
+    
+    metrics.increment('webhook_verify_remote_total')
     if not all([PAYPAL_CLIENT_ID, PAYPAL_CLIENT_SECRET, webhook_id]):
         logging.error("PayPal credentials not configured - cannot verify webhook signature")
-        return False
+        return None
     
     try:
         # Get PayPal access token using helper function
         access_token = await get_paypal_access_token()
         if not access_token:
+            return None
+        
+        # Verify webhook signature
+        verify_payload = {
+            "auth_algo": auth_algo,
+            "cert_url": cert_url,
+            "transmission_id": transmission_id,
+            "transmission_sig": transmission_sig,
+            "transmission_time": transmission_time,
+            "webhook_id": webhook_id,
+            "webhook_event": json.loads(webhook_body.decode('utf-8'))
+        }
+        
+        verify_response = await paypal_client.request("POST", "/v1/notifications/verify-webhook-signature", json_body=verify_payload)
+        if verify_response is None or verify_response.status >= 500:
+            logging.error(f"PayPal webhook verification unavailable: {verify_response.status if verify_response else 'no access token'}")
+            return None
+        if verify_response.status != 200:
+            logging.error(f"PayPal webhook verification failed: {verify_response.status}")
             return False
         
-        async with aiohttp.ClientSession() as session:
-            
-            # Verify webhook signature
-            verify_url = f"{PAYPAL_API_BASE}/v1/notifications/verify-webhook-signature"
-            verify_payload = {
-                "auth_algo": auth_algo,
-                "cert_url": cert_url,
-                "transmission_id": transmission_id,
-                "transmission_sig": transmission_sig,
-                "transmission_time": transmission_time,
-                "webhook_id": webhook_id,
-                "webhook_event": json.loads(webhook_body.decode('utf-8'))
-            }
-            
-            verify_headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            async with session.post(verify_url, json=verify_payload, headers=verify_headers) as verify_response:
-                if verify_response.status != 200:
-                    logging.error(f"PayPal webhook verification failed: {verify_response.status}")
-                    return False
-                
-                verify_result = await verify_response.json()
-                verification_status = verify_result.get('verification_status')
-                
-                if verification_status == 'SUCCESS':
-                    logging.info("PayPal webhook signature verified successfully")
-                    return True
-                else:
-                    logging.error(f"PayPal webhook signature verification failed: {verification_status}")
-                    return False
+        verification_status = (verify_response.data or {}).get('verification_status')
+        
+        if verification_status == 'SUCCESS':
+            logging.info("PayPal webhook signature verified successfully")
+            return True
+        else:
+            logging.error(f"PayPal webhook signature verification failed: {verification_status}")
+            return False
     
     except Exception as e:
         logging.error(f"Error verifying PayPal webhook signature: {str(e)}", exc_info=True)
-        return False
+        return None
+
+PAYPAL_WEBHOOK_SWEEP_SECONDS = 60  # Received events older than this without a queued task are re-queued
+PAYPAL_WEBHOOK_BATCH_SIZE = 50  # Pending events folded into one reconciliation pass
+PAYPAL_WEBHOOK_RETENTION_DAYS = 90  # Processed/rejected raw events are kept this long
+PAYPAL_WEBHOOK_MAX_BODY_BYTES = 64 * 1024  # PayPal events are a few KB; larger bodies are refused before storing
+
+
+class PayPalWebhookStatus(str, Enum):
+    RECEIVED = "received"  # Persisted by the handler, not yet verified
+    VERIFIED = "verified"  # Signature valid, waiting for reconciliation
+    PROCESSED = "processed"
+    REJECTED = "rejected"  # Signature invalid
+
 
 @api_router.post("/billing/paypal/webhook")
 async def paypal_webhook(
@@ -8828,16 +11697,16 @@ async def paypal_webhook(
     paypal_transmission_time: str = Header(None, alias="PAYPAL-TRANSMISSION-TIME")
 ):
     """
-    PRODUCTION HARDENING: PayPal Webhook Handler
+    PRODUCTION HARDENING: PayPal Webhook Handler (fast ack)
     
-    This handler is OPTIMISTIC ONLY. It:
-    1. Verifies webhook signature (security)
-    2. Prevents duplicate processing (idempotency)
-    3. Delegates ALL business logic to reconcile_subscription_with_paypal()
-    4. Contains ZERO independent decision logic
+    This handler only:
+    1. Checks the event is well-formed (size cap, event ID, subscription ID, signature headers)
+    2. Persists the raw event under its composite idempotency key (event_id, transmission_time)
+    3. Queues process_paypal_webhook_events() for the subscription and returns 200
     
-    All state changes are determined by reconciliation function querying PayPal directly.
-    Webhooks exist only for optimistic updates - system works even if webhooks never arrive.
+    Signature verification and reconciliation happen in the task worker, so a slow
+    PayPal API never delays the acknowledgement. Webhooks exist only for optimistic
+    updates - system works even if webhooks never arrive.
     """
     # KILL SWITCH: Check if webhook processing is enabled
     if not kill_switch.webhook_processing_enabled:
@@ -8846,20 +11715,32 @@ async def paypal_webhook(
         return JSONResponse({"status": "disabled", "message": "Webhook processing temporarily disabled"})
     
     try:
-        body = await request.body()
+        # The body is stored before its signature is checked, so unauthenticated callers
+        # must not be able to write arbitrarily large documents
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > PAYPAL_WEBHOOK_MAX_BODY_BYTES:
+            metrics.increment('webhook_error_body_too_large')
+            return JSONResponse({"status": "error", "message": "Payload too large"}, status_code=413)
+        body = bytearray()
+        async for chunk in request.stream():
+            if len(body) + len(chunk) > PAYPAL_WEBHOOK_MAX_BODY_BYTES:
+                metrics.increment('webhook_error_body_too_large')
+                return JSONResponse({"status": "error", "message": "Payload too large"}, status_code=413)
+            body.extend(chunk)
+        body = bytes(body)
         webhook_data = json.loads(body)
         
-        event_type = webhook_data.get('event_type')
+        event_type = webhook_data.get('event_type') or "unknown"
         event_id = webhook_data.get('id')
         resource = webhook_data.get('resource', {})
         
         # METRICS: Track webhook receipt
-        await metrics.increment('webhook_received_total')
-        await metrics.increment(f'webhook_event_{event_type.lower().replace(".", "_")}')
+        metrics.increment('webhook_received_total')
+        metrics.increment(f'webhook_event_{event_type.lower().replace(".", "_")}')
         
         if not event_id:
             logging.error("[WEBHOOK] Missing event ID")
-            await metrics.increment('webhook_error_missing_event_id')
+            metrics.increment('webhook_error_missing_event_id')
             return JSONResponse({"status": "error", "message": "Missing event ID"}, status_code=400)
         
         # PRODUCTION HARDENING: Composite key idempotency (event_id, transmission_time)
@@ -8868,21 +11749,8 @@ async def paypal_webhook(
             logging.error("[WEBHOOK] Missing transmission_time for idempotency")
             return JSONResponse({"status": "error", "message": "Missing transmission_time"}, status_code=400)
         
-        existing_event = await db.processed_webhook_events.find_one(
-            {
-                "paypal_event_id": event_id,
-                "transmission_time": paypal_transmission_time
-            },
-            {"_id": 0}
-        )
-        if existing_event:
-            logging.info(f"[WEBHOOK] Event already processed: {event_id} at {paypal_transmission_time}")
-            return JSONResponse({"status": "success", "message": "Event already processed"})
-        
-        logging.info(f"[WEBHOOK] Received: event_type={event_type}, event_id={event_id}, resource_id={resource.get('id')}")
-        
-        # Verify webhook signature (CRITICAL for security)
-        if not all([paypal_transmission_id, paypal_cert_url, paypal_auth_algo, paypal_transmission_sig, paypal_transmission_time]):
+        # Signature headers are checked here and verified by the worker
+        if not all([paypal_transmission_id, paypal_cert_url, paypal_auth_algo, paypal_transmission_sig]):
             logging.error("[WEBHOOK] Missing required headers for signature verification")
             return JSONResponse({"status": "error", "message": "Missing webhook headers"}, status_code=400)
         
@@ -8890,96 +11758,209 @@ async def paypal_webhook(
             logging.error("[WEBHOOK] PAYPAL_WEBHOOK_ID not configured")
             return JSONResponse({"status": "error", "message": "Webhook not configured"}, status_code=500)
         
-        signature_valid = await verify_paypal_webhook_signature(
-            webhook_id=PAYPAL_WEBHOOK_ID,
-            transmission_id=paypal_transmission_id,
-            cert_url=paypal_cert_url,
-            auth_algo=paypal_auth_algo,
-            transmission_sig=paypal_transmission_sig,
-            transmission_time=paypal_transmission_time,
-            webhook_body=body
-        )
-        
-        if not signature_valid:
-            logging.error(f"[WEBHOOK] Signature verification failed for event {event_id}")
-            return JSONResponse({"status": "error", "message": "Invalid webhook signature"}, status_code=401)
-        
-        # AUDIT LOG: Webhook received
-        await log_paypal_action(
-            action="webhook_received",
-            paypal_endpoint="/v1/notifications/webhooks",
-            http_method="POST",
-            source="webhook",
-            http_status_code=None,
-            paypal_status=None,
-            verified=True,
-            raw_paypal_response=webhook_data
-        )
-        
         # PRODUCTION HARDENING: Extract PayPal subscription ID
         paypal_subscription_id = resource.get('id') or resource.get('billing_agreement_id')
         if not paypal_subscription_id:
             logging.error(f"[WEBHOOK] Missing PayPal subscription ID in event {event_id}")
             return JSONResponse({"status": "error", "message": "Missing subscription ID"}, status_code=400)
         
-        # Find our subscription record
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            await db.paypal_webhook_events.insert_one({
+                "id": str(uuid.uuid4()),
+                "paypal_event_id": event_id,
+                "transmission_time": paypal_transmission_time,
+                "event_type": event_type,
+                "paypal_subscription_id": paypal_subscription_id,
+                "transmission_id": paypal_transmission_id,
+                "cert_url": paypal_cert_url,
+                "auth_algo": paypal_auth_algo,
+                "transmission_sig": paypal_transmission_sig,
+                "body": body.decode('utf-8'),
+                "status": PayPalWebhookStatus.RECEIVED,
+                "received_at": now,
+                "updated_at": now,
+            })
+        except DuplicateKeyError:
+            logging.info(f"[WEBHOOK] Event already received: {event_id} at {paypal_transmission_time}")
+            return JSONResponse({"status": "success", "message": "Event already processed"})
+        
+        logging.info(f"[WEBHOOK] Received: event_type={event_type}, event_id={event_id}, resource_id={paypal_subscription_id}")
+        
+        # One queued task per subscription: events arriving before it runs are folded into it.
+        # If queueing fails the event is still stored and sweep_paypal_webhook_events() picks it up.
+        try:
+            await enqueue_paypal_webhook_processing(paypal_subscription_id)
+        except Exception as e:
+            logging.error(f"[WEBHOOK] Failed to queue processing for {paypal_subscription_id}: {e}", exc_info=True)
+        
+        return JSONResponse({"status": "success"})
+    
+    except Exception as e:
+        logging.error(f"[WEBHOOK] Error: {str(e)}", exc_info=True)
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+
+async def enqueue_paypal_webhook_processing(paypal_subscription_id: str) -> dict:
+    return await enqueue_task(
+        "process_paypal_webhook_events",
+        {"paypal_subscription_id": paypal_subscription_id},
+        priority=TASK_PRIORITY_HIGH,
+        dedupe_key=f"paypal-webhook:{paypal_subscription_id}"
+    )
+
+
+async def process_paypal_webhook_events(paypal_subscription_id: str) -> None:
+    """
+    Verify and apply every pending webhook event of one PayPal subscription.
+    
+    Events are verified one by one (invalid signatures are rejected), then a single
+    reconcile_subscription_with_paypal() call covers all verified events, since it reads
+    the current state from PayPal regardless of which events arrived. The loop repeats
+    while new events keep arriving for the subscription.
+    
+    Raises when PayPal cannot be reached for verification or reconciliation fails, so the
+    task queue retries with backoff; verified events are not re-verified on retry.
+    """
+    while True:
+        events = await db.paypal_webhook_events.find(
+            {
+                "paypal_subscription_id": paypal_subscription_id,
+                "status": {"$in": [PayPalWebhookStatus.RECEIVED, PayPalWebhookStatus.VERIFIED]}
+            },
+            {"_id": 0}
+        ).sort("transmission_time", ASCENDING).to_list(PAYPAL_WEBHOOK_BATCH_SIZE)
+        if not events:
+            return
+        
+        verified = []
+        for event in events:
+            if event["status"] == PayPalWebhookStatus.RECEIVED:
+                signature_valid = await verify_paypal_webhook_signature(
+                    webhook_id=PAYPAL_WEBHOOK_ID,
+                    transmission_id=event["transmission_id"],
+                    cert_url=event["cert_url"],
+                    auth_algo=event["auth_algo"],
+                    transmission_sig=event["transmission_sig"],
+                    transmission_time=event["transmission_time"],
+                    webhook_body=event["body"].encode('utf-8')
+                )
+                if signature_valid is None:
+                    raise RuntimeError(f"PayPal signature verification unavailable for event {event['paypal_event_id']}")
+                now = datetime.now(timezone.utc).isoformat()
+                if not signature_valid:
+                    logging.error(f"[WEBHOOK] Signature verification failed for event {event['paypal_event_id']}")
+                    metrics.increment('webhook_error_invalid_signature')
+                    await db.paypal_webhook_events.update_one(
+                        {"id": event["id"]},
+                        {"$set": {"status": PayPalWebhookStatus.REJECTED, "updated_at": now}}
+                    )
+                    continue
+                # AUDIT LOG: Webhook received
+                await log_paypal_action(
+                    action="webhook_received",
+                    paypal_endpoint="/v1/notifications/webhooks",
+                    http_method="POST",
+                    source="webhook",
+                    http_status_code=None,
+                    paypal_status=None,
+                    verified=True,
+                    raw_paypal_response=json.loads(event["body"])
+                )
+                await db.paypal_webhook_events.update_one(
+                    {"id": event["id"]},
+                    {"$set": {"status": PayPalWebhookStatus.VERIFIED, "updated_at": now}}
+                )
+            verified.append(event)
+        
+        if not verified:
+            continue
+        
+        event_types = sorted({event["event_type"] for event in verified})
         subscription_doc = await db.subscriptions.find_one(
             {"provider_subscription_id": paypal_subscription_id, "provider": "paypal"},
-            {"_id": 0}
+            {"_id": 0, "id": 1}
         )
-        
-        subscription_id = None
-        if subscription_doc:
-            subscription_id = subscription_doc['id']
-            
+        subscription_id = subscription_doc['id'] if subscription_doc else None
+        if subscription_id:
             # PRODUCTION HARDENING: Delegate ALL logic to reconciliation
             # Webhooks contain ZERO independent business logic
-            logging.info(f"[WEBHOOK] Delegating to reconciliation: subscription_id={subscription_id}, event_type={event_type}")
-            
+            logging.info(
+                f"[WEBHOOK] Delegating to reconciliation: subscription_id={subscription_id}, "
+                f"events={len(verified)}, event_types={event_types}"
+            )
             reconcile_result = await reconcile_subscription_with_paypal(
                 subscription_id=subscription_id,
                 force=True  # Force reconciliation even if terminal
             )
-            
-            if reconcile_result.get("success"):
-                logging.info(
-                    f"[WEBHOOK] Reconciliation complete: subscription_id={subscription_id}, "
-                    f"paypal_status={reconcile_result.get('paypal_status')}, "
-                    f"access_granted={reconcile_result.get('access_granted')}, "
-                    f"event_type={event_type}"
-                )
-            else:
-                logging.error(
-                    f"[WEBHOOK] Reconciliation failed: subscription_id={subscription_id}, "
-                    f"error={reconcile_result.get('error')}, event_type={event_type}"
-                )
+            if not reconcile_result.get("success"):
+                raise RuntimeError(f"Reconciliation failed for {subscription_id}: {reconcile_result.get('error')}")
+            logging.info(
+                f"[WEBHOOK] Reconciliation complete: subscription_id={subscription_id}, "
+                f"paypal_status={reconcile_result.get('paypal_status')}, "
+                f"access_granted={reconcile_result.get('access_granted')}, "
+                f"events={len(verified)}"
+            )
         else:
-            # Subscription not found - log for debugging
-            all_paypal_subs = await db.subscriptions.find(
-                {"provider": "paypal"},
-                {"provider_subscription_id": 1, "user_id": 1, "status": 1, "_id": 0}
-            ).to_list(20)
             logging.warning(
                 f"[WEBHOOK] Subscription not found for PayPal ID: {paypal_subscription_id}. "
-                f"Event: {event_type}. Available PayPal subscriptions: {all_paypal_subs}"
+                f"Event types: {event_types}"
             )
         
-        # Record processed event for idempotency (composite key)
-        processed_event = ProcessedWebhookEvent(
-            paypal_event_id=event_id,
-            event_type=event_type,
-            subscription_id=subscription_id
+        # Record processed events, upserted on the composite key: a retry after a failure
+        # before the status update below must not record them twice
+        processed_at = datetime.now(timezone.utc)
+        processed_events = []
+        for event in verified:
+            processed_event_dict = ProcessedWebhookEvent(
+                paypal_event_id=event["paypal_event_id"],
+                event_type=event["event_type"],
+                processed_at=processed_at,
+                subscription_id=subscription_id
+            ).model_dump()
+            processed_event_dict['processed_at'] = processed_at.isoformat()
+            processed_event_dict['transmission_time'] = event["transmission_time"]
+            processed_events.append(UpdateOne(
+                {"paypal_event_id": event["paypal_event_id"], "transmission_time": event["transmission_time"]},
+                {"$setOnInsert": processed_event_dict},
+                upsert=True
+            ))
+        await db.processed_webhook_events.bulk_write(processed_events, ordered=False)
+        await db.paypal_webhook_events.update_many(
+            {"id": {"$in": [event["id"] for event in verified]}},
+            {"$set": {
+                "status": PayPalWebhookStatus.PROCESSED,
+                "subscription_id": subscription_id,
+                "processed_at": processed_at.isoformat(),
+                "updated_at": processed_at.isoformat()
+            }}
         )
-        processed_event_dict = processed_event.model_dump()
-        processed_event_dict['processed_at'] = processed_event_dict['processed_at'].isoformat()
-        processed_event_dict['transmission_time'] = paypal_transmission_time  # Composite key component
-        await db.processed_webhook_events.insert_one(processed_event_dict)
-        
-        return JSONResponse({"status": "success"})
-    
-    except Exception as e:
-        logging.error(f"[WEBHOOK] Error: {str(e)}", exc_info=True)
-        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+
+async def sweep_paypal_webhook_events() -> None:
+    """
+    Re-queue subscriptions whose webhook events were stored but never picked up
+    (queueing failed, or an event landed just as its subscription's task finished),
+    and delete processed/rejected raw events past PAYPAL_WEBHOOK_RETENTION_DAYS.
+    """
+    now = datetime.now(timezone.utc)
+    stale_before = (now - timedelta(seconds=PAYPAL_WEBHOOK_SWEEP_SECONDS)).isoformat()
+    pipeline = [
+        {"$match": {"status": {"$in": [PayPalWebhookStatus.RECEIVED, PayPalWebhookStatus.VERIFIED]}, "received_at": {"$lt": stale_before}}},
+        {"$group": {"_id": "$paypal_subscription_id"}},
+    ]
+    requeued = 0
+    async for row in db.paypal_webhook_events.aggregate(pipeline):
+        await enqueue_paypal_webhook_processing(row["_id"])
+        requeued += 1
+    if requeued:
+        logging.info(f"[WEBHOOK] Sweep re-queued processing for {requeued} subscriptions")
+    
+    retention_cutoff = (now - timedelta(days=PAYPAL_WEBHOOK_RETENTION_DAYS)).isoformat()
+    await db.paypal_webhook_events.delete_many({
+        "status": {"$in": [PayPalWebhookStatus.PROCESSED, PayPalWebhookStatus.REJECTED]},
+        "updated_at": {"$lt": retention_cutoff}
+    })
 
 # DEPRECATED: Old webhook logic preserved below for reference/rollback
 # Delete after confirming new webhook works in production
@@ -9420,9 +12401,9 @@ OLD_WEBHOOK_LOGIC_END
 async def get_production_metrics(current_user: User = Depends(require_admin)):
     """
     PRODUCTION OBSERVABILITY: Get real-time metrics
-    Admin-only endpoint for monitoring.
+    Admin-only endpoint for monitoring. Aggregated across workers in multiprocess mode.
     """
-    all_metrics = await metrics.get_all()
+    all_metrics, histograms = render_metrics_json(await metrics.collect())
     
     # Calculate derived metrics
     total_reconciles = all_metrics.get('reconcile_total', 0)
@@ -9435,11 +12416,12 @@ async def get_production_metrics(current_user: User = Depends(require_admin)):
     grant_rate = (granted_access / total_access * 100) if total_access > 0 else 0
     
     # Check alert conditions
-    await check_alert_conditions()
+    await check_alert_conditions(all_metrics)
     
     return {
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "metrics": all_metrics,
+        "histograms": histograms,
         "derived": {
             "reconciliation_success_rate_pct": round(success_rate, 2),
             "access_grant_rate_pct": round(grant_rate, 2),
@@ -9450,10 +12432,29 @@ async def get_production_metrics(current_user: User = Depends(require_admin)):
             "frontend_polling_enabled": kill_switch.frontend_polling_enabled,
             "webhook_processing_enabled": kill_switch.webhook_processing_enabled,
             "scheduled_reconciliation_enabled": kill_switch.scheduled_reconciliation_enabled,
-            "user_reconciliation_enabled": kill_switch.user_reconciliation_enabled
+            "user_reconciliation_enabled": kill_switch.user_reconciliation_enabled,
+            "media_gc_enabled": kill_switch.media_gc_enabled
         }
     }
 
+async def require_metrics_reader(
+    request: Request,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False))
+) -> None:
+    """Prometheus scrapers present METRICS_SCRAPE_TOKEN; otherwise an admin session is required."""
+    if METRICS_SCRAPE_TOKEN and credentials and hmac.compare_digest(credentials.credentials, METRICS_SCRAPE_TOKEN):
+        return
+    await require_admin(await get_current_user(request, credentials))
+
+
+@api_router.get("/metrics/prometheus", response_class=PlainTextResponse)
+async def get_prometheus_metrics(_: None = Depends(require_metrics_reader)):
+    """The /metrics registry in Prometheus text format (histogram buckets included)."""
+    return PlainTextResponse(
+        render_metrics_prometheus(await metrics.collect()),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 @api_router.post("/admin/kill-switch")
 async def control_kill_switch(
     action: str = Query(..., description="enable_all | disable_all | disable_except_scheduled"),
@@ -9471,6 +12472,7 @@ async def control_kill_switch(
         kill_switch.webhook_processing_enabled = False
         kill_switch.scheduled_reconciliation_enabled = False
         kill_switch.user_reconciliation_enabled = False
+        kill_switch.media_gc_enabled = False
         logging.critical("Γëí╞Æ├£┬┐ KILL SWITCH: All features disabled")
         return {"status": "success", "message": "All features disabled"}
     elif action == "disable_except_scheduled":
@@ -9506,9 +12508,9 @@ async def get_workspace_quota(workspace_id: str, current_user: User = Depends(ge
     # Calculate workspace storage (files in this workspace)
     workspace_files = await db.files.find(
         {"workspace_id": workspace_id, "status": FileStatus.ACTIVE},
-        {"size_bytes": 1}
+        {"size_bytes": 1, "blob_id": 1}
     ).to_list(10000)
-    workspace_storage = sum(file.get('size_bytes', 0) for file in workspace_files)
+    workspace_storage = sum_stored_bytes(workspace_files)
     
     return {
         "workspace_id": workspace_id,
@@ -9527,69 +12529,44 @@ async def get_workspace_quota(workspace_id: str, current_user: User = Depends(ge
         }
     }
 
-@api_router.post("/admin/reconcile-quota")
+@api_router.post("/admin/reconcile-quota", status_code=202)
 async def reconcile_quota(
     user_id: Optional[str] = Query(None, description="Specific user ID to reconcile (optional, admin only)"),
     fix_discrepancies: bool = Query(False, description="Whether to fix discrepancies automatically"),
     current_user: User = Depends(require_admin)
 ):
     """
-    Reconcile quota usage by recalculating storage from file records.
-    Compares calculated storage with expected values and reports discrepancies.
+    Reconcile recorded storage usage against file records, as a background job.
+    Returns 202 with the job; progress is at status_url and discrepancies stream from
+    /admin/reconcile-quota/{job_id}/report. With fix_discrepancies the recorded figure of
+    every mismatched user is recomputed.
     Admin-only endpoint.
     """
+    if user_id and not await db.users.find_one({"id": user_id}, {"_id": 0, "id": 1}):
+        raise HTTPException(status_code=404, detail="User not found")
+    job = await submit_job("quota_reconciliation", user_id or QUOTA_RECONCILE_ALL_USERS, current_user.id, params={
+        "fix_discrepancies": fix_discrepancies,
+    })
+    return {"message": "Quota reconciliation started", **_job_view(job)}
+
+@api_router.get("/admin/reconcile-quota/{job_id}/report")
+async def get_quota_reconciliation_report(job_id: str, current_user: User = Depends(require_admin)):
+    """
+    Discrepancies found by a quota reconciliation job, streamed as NDJSON: a job summary
+    line, then one line per user. Available while the job is still running.
+    Admin-only endpoint.
+    """
+    job = await db.jobs.find_one({"id": job_id, "type": "quota_reconciliation"}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
     
-    discrepancies = []
-    fixed_count = 0
-    
-    # Get users to reconcile
-    if user_id:
-        users = [await db.users.find_one({"id": user_id}, {"_id": 0})]
-        if not users[0]:
-            raise HTTPException(status_code=404, detail="User not found")
-    else:
-        # Reconcile all users
-        users = await db.users.find({}, {"_id": 0, "id": 1}).to_list(10000)
-    
-    for user in users:
-        user_id_to_check = user["id"]
-        
-        # Recalculate storage from file records
-        active_files = await db.files.find(
-            {"user_id": user_id_to_check, "status": FileStatus.ACTIVE},
-            {"size_bytes": 1}
-        ).to_list(10000)
-        
-        calculated_storage = sum(file.get('size_bytes', 0) for file in active_files)
-        
-        # Get expected storage (from get_user_storage_usage)
-        expected_storage = await get_user_storage_usage(user_id_to_check)
-        
-        if calculated_storage != expected_storage:
-            discrepancy = {
-                "user_id": user_id_to_check,
-                "calculated_storage": calculated_storage,
-                "expected_storage": expected_storage,
-                "difference": calculated_storage - expected_storage
-            }
-            discrepancies.append(discrepancy)
-            
-            if fix_discrepancies:
-                # The get_user_storage_usage function already calculates from DB, so this shouldn't happen
-                # But if it does, we log it
-                logging.warning(
-                    f"Storage discrepancy for user {user_id_to_check}: "
-                    f"calculated={calculated_storage}, expected={expected_storage}"
-                )
-                fixed_count += 1
+    async def lines():
+        yield json.dumps({"job": _job_view(job)}) + "\n"
+        cursor = db.quota_reconciliation_items.find({"job_id": job_id}, {"_id": 0, "job_id": 0}).sort("user_id", ASCENDING)
+        async for item in cursor.batch_size(QUOTA_RECONCILE_PAGE_SIZE):
+            yield json.dumps(item) + "\n"
     
-    return {
-        "reconciled_users": len(users),
-        "discrepancies_found": len(discrepancies),
-        "discrepancies": discrepancies,
-        "fixed_count": fixed_count if fix_discrepancies else 0,
-        "timestamp": datetime.now(timezone.utc).isoformat()
-    }
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 @api_router.post("/admin/cleanup-files")
 async def cleanup_files(
@@ -9599,9 +12576,10 @@ async def cleanup_files(
     current_user: User = Depends(require_admin)
 ):
     """
-    Cleanup old PENDING and FAILED file records.
+    Cleanup old PENDING and FAILED file records and expired upload sessions.
     - PENDING files older than pending_hours are likely abandoned uploads
     - FAILED files older than failed_days are failed uploads that won't be retried
+    - Expired resumable upload sessions have their chunks dropped and their file marked FAILED
     Admin-only endpoint.
     """
     
@@ -9609,11 +12587,21 @@ async def cleanup_files(
     pending_threshold = now - timedelta(hours=pending_hours)
     failed_threshold = now - timedelta(days=failed_days)
     
+    # PENDING records held by live resumable upload sessions are not abandoned
+    live_session_file_ids = await db.upload_sessions.distinct(
+        "file_id",
+        {
+            "status": {"$in": [UploadSessionStatus.OPEN, UploadSessionStatus.COMMITTING]},
+            "expires_at": {"$gt": now.isoformat()}
+        }
+    )
+    
     # Find old PENDING files
     pending_files = await db.files.find(
         {
             "status": FileStatus.PENDING,
-            "created_at": {"$lt": pending_threshold.isoformat()}
+            "created_at": {"$lt": pending_threshold.isoformat()},
+            "id": {"$nin": live_session_file_ids}
         },
         {"_id": 0, "id": 1, "url": 1, "public_id": 1, "resource_type": 1, "created_at": 1}
     ).to_list(10000)
@@ -9627,24 +12615,51 @@ async def cleanup_files(
         {"_id": 0, "id": 1, "url": 1, "public_id": 1, "resource_type": 1, "created_at": 1}
     ).to_list(10000)
     
+    # Find expired resumable upload sessions (chunks still stored); a commit still heartbeating is left alone
+    expired_sessions = await db.upload_sessions.find(
+        {
+            "$or": [{"status": UploadSessionStatus.OPEN}, _stale_commit_filter()],
+            "expires_at": {"$lt": now.isoformat()}
+        },
+        {"_id": 0, "id": 1, "file_id": 1}
+    ).to_list(10000)
+    # Unexpired sessions whose commit died go back to OPEN so the client can commit again
+    stale_commit_query = {**_stale_commit_filter(), "expires_at": {"$gte": now.isoformat()}}
+    stale_commits = await db.upload_sessions.count_documents(stale_commit_query)
+    
     deleted_count = 0
+    expired_sessions_collected = 0
     errors = []
     
     if not dry_run:
-        # Delete PENDING files
+        if stale_commits:
+            await db.upload_sessions.update_many(
+                stale_commit_query,
+                {"$set": {"status": UploadSessionStatus.OPEN, "updated_at": now.isoformat()}}
+            )
+        
+        # Garbage-collect expired upload sessions (chunks + PENDING record -> FAILED)
+        for session in expired_sessions:
+            try:
+                await _discard_upload_session(session, UploadSessionStatus.EXPIRED)
+                expired_sessions_collected += 1
+            except Exception as e:
+                errors.append({"upload_session_id": session.get('id'), "error": str(e)})
+        
+        # Delete PENDING files
         for file_record in pending_files:
             try:
                 file_id = file_record['id']
                 
                 # Try to delete from storage if it exists
-                if USE_CLOUDINARY and file_record.get('public_id'):
+                if file_record.get('public_id'):
                     try:
-                        cloudinary.uploader.destroy(
+                        await storage_provider.destroy(
                             file_record['public_id'],
                             resource_type=file_record.get('resource_type', 'auto')
                         )
                     except Exception as e:
-                        logging.warning(f"Cloudinary deletion failed for {file_id}: {str(e)}")
+                        logging.warning(f"Storage deletion failed for {file_id}: {str(e)}")
                 
                 # Delete DB record
                 await db.files.delete_one({"id": file_id})
@@ -9658,14 +12673,14 @@ async def cleanup_files(
                 file_id = file_record['id']
                 
                 # Try to delete from storage if it exists
-                if USE_CLOUDINARY and file_record.get('public_id'):
+                if file_record.get('public_id'):
                     try:
-                        cloudinary.uploader.destroy(
+                        await storage_provider.destroy(
                             file_record['public_id'],
                             resource_type=file_record.get('resource_type', 'auto')
                         )
                     except Exception as e:
-                        logging.warning(f"Cloudinary deletion failed for {file_id}: {str(e)}")
+                        logging.warning(f"Storage deletion failed for {file_id}: {str(e)}")
                 
                 # Delete DB record
                 await db.files.delete_one({"id": file_id})
@@ -9677,6 +12692,10 @@ async def cleanup_files(
         "dry_run": dry_run,
         "pending_files_found": len(pending_files),
         "failed_files_found": len(failed_files),
+        "expired_upload_sessions_found": len(expired_sessions),
+        "expired_upload_sessions_collected": expired_sessions_collected,
+        "stale_commits_found": stale_commits,
+        "stale_commits_reopened": stale_commits if not dry_run else 0,
         "deleted_count": deleted_count if not dry_run else 0,
         "errors": errors,
         "pending_threshold": pending_threshold.isoformat(),
@@ -9684,6 +12703,43 @@ async def cleanup_files(
         "timestamp": now.isoformat()
     }
 
+@api_router.post("/admin/media-gc")
+async def trigger_media_gc(
+    dry_run: bool = Query(True, description="If True, only report what would be marked and deleted"),
+    max_files: Optional[int] = Query(None, ge=1, description="Stop after scanning this many files"),
+    current_user: User = Depends(require_admin)
+):
+    """
+    Run orphaned-media collection now (see run_media_gc). Files are deleted only after they
+    stayed unreferenced for MEDIA_GC_GRACE_HOURS across runs.
+    Admin-only endpoint.
+    """
+    logging.info(f"[MEDIA_GC] Triggered by admin {current_user.id} (dry_run={dry_run})")
+    report = await run_media_gc(dry_run=dry_run, max_files=max_files)
+    report.pop("_id", None)
+    return report
+
+@api_router.get("/admin/media-gc/runs")
+async def list_media_gc_runs(
+    limit: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(require_admin)
+):
+    """Recent orphaned-media collection reports, newest first. Admin-only endpoint."""
+    runs = await db.media_gc_runs.find({}, {"_id": 0}).sort("started_at", DESCENDING).limit(limit).to_list(limit)
+    return {"runs": runs}
+
+@api_router.get("/admin/files/{file_id}/references")
+async def get_file_references(file_id: str, current_user: User = Depends(require_admin)):
+    """Documents that reference a file according to the media reference index. Admin-only endpoint."""
+    file_record = await db.files.find_one({"id": file_id}, {"_id": 0, "id": 1, "url": 1, "status": 1, "orphaned_at": 1})
+    if not file_record:
+        raise HTTPException(status_code=404, detail="File not found")
+    key = media_key_from_url(file_record.get("url"))
+    references = await db.media_references.find(
+        {"media_keys": key}, {"_id": 0, "owner_type": 1, "owner_id": 1, "workspace_id": 1, "updated_at": 1}
+    ).to_list(1000) if key else []
+    return {"file": file_record, "media_key": key, "references": references}
+
 # Health check endpoint (no auth required)
 # Available at both /health and /api/health for flexibility
 @app.get("/health")
@@ -9692,7 +12748,8 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now(timezone.utc).isoformat(),
-        "cloudinary_configured": USE_CLOUDINARY
+        "cloudinary_configured": USE_CLOUDINARY,
+        "storage_backend": storage_provider.name
     }
 
 @api_router.get("/health")
@@ -9701,7 +12758,8 @@ async def health_check_api():
     return {
         "status": "healthy",
         "timestamp": datetime.now(timezone.utc).isoformat(),
-        "cloudinary_configured": USE_CLOUDINARY
+        "cloudinary_configured": USE_CLOUDINARY,
+        "storage_backend": storage_provider.name
     }
 
 
@@ -10099,6 +13157,8 @@ async def get_email_config(current_user: User = Depends(require_admin)):
         "resend_api_key_set": bool(RESEND_API_KEY),
         "resend_from_email": RESEND_FROM_EMAIL,
         "resend_api_url": RESEND_API_URL,
+        "transport": email_transport.name,
+        "outbox": {row["_id"]: row["count"] async for row in db.email_outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])},
         "frontend_url": FRONTEND_URL,
         "smtp_disabled": True
     }
@@ -10142,67 +13202,12 @@ async def test_email(
     # Create a test verification URL (won't work, but shows the format)
     test_url = f"{FRONTEND_URL}/verify-email?token=TEST_TOKEN"
     
-    # Send test email and capture detailed response
+    # Send directly (not via the outbox) so the provider response can be returned
     try:
-        expiry_hours = EMAIL_VERIFICATION_EXPIRY_HOURS
-        name = email.split('@')[0].replace('.', ' ').title()
-        
-        text_content = f"""Hi {name},
-
-This is a test email from Guide2026.
-
-Verification URL: {test_url}
-
-This link will expire in {expiry_hours} hours.
-
-Best regards,
-Guide2026
-"""
-        
-        html_content = f"""<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="utf-8">
-    <style>
-        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-        .button {{ display: inline-block; padding: 12px 24px; background-color: #4f46e5; color: white; text-decoration: none; border-radius: 5px; margin: 20px 0; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h2>Hi {name},</h2>
-        <p>This is a test email from Guide2026.</p>
-        <a href="{test_url}" class="button">Test Verification Link</a>
-        <p style="word-break: break-all;">{test_url}</p>
-    </div>
-</body>
-</html>
-"""
-        
-        headers = {
-            "Authorization": f"Bearer {RESEND_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "from": RESEND_FROM_EMAIL,
-            "to": [email],
-            "subject": "Test Email - Guide2026",
-            "text": text_content,
-            "html": html_content
-        }
-        
-        logging.info(f"[EMAIL][TEST][REQUEST] Resend API call for email={email} from={RESEND_FROM_EMAIL}")
-        response = requests.post(RESEND_API_URL, json=payload, headers=headers, timeout=10)
+        logging.info(f"[EMAIL][TEST][REQUEST] {email_transport.name} call for email={email} from={RESEND_FROM_EMAIL}")
+        status_code, response_data = await email_transport.send(render_test_email(email, test_url))
         
-        response_data = {}
-        try:
-            response_data = response.json()
-        except:
-            response_data = {"raw_response": response.text}
-        
-        if response.status_code == 200:
+        if status_code == 200:
             resend_id = response_data.get('id', 'unknown')
             logging.info(f"[EMAIL][TEST][SUCCESS] email={email} resend_id={resend_id}")
             return {
@@ -10213,22 +13218,22 @@ Guide2026
                 "resend_response": response_data
             }
         else:
-            error_detail = response_data.get('message', response.text) or f"HTTP {response.status_code}"
-            logging.error(f"[EMAIL][TEST][FAILED] email={email} status={response.status_code} error={error_detail}")
+            error_detail = response_data.get('message', response_data.get('raw_response')) or f"HTTP {status_code}"
+            logging.error(f"[EMAIL][TEST][FAILED] email={email} status={status_code} error={error_detail}")
             return {
                 "success": False,
                 "error": f"Resend API error: {error_detail}",
                 "email": email,
-                "status_code": response.status_code,
+                "status_code": status_code,
                 "resend_response": response_data,
                 "from_email": RESEND_FROM_EMAIL
             }
             
-    except requests.exceptions.Timeout:
-        logging.error(f"[EMAIL][TEST][FAILED] email={email} error=Resend API timeout (10s)")
+    except asyncio.TimeoutError:
+        logging.error(f"[EMAIL][TEST][FAILED] email={email} error=Resend API timeout ({EMAIL_HTTP_TIMEOUT_SECONDS}s)")
         return {
             "success": False,
-            "error": "Resend API timeout (10s)",
+            "error": f"Resend API timeout ({EMAIL_HTTP_TIMEOUT_SECONDS}s)",
             "email": email
         }
     except Exception as e:
@@ -10373,6 +13378,55 @@ async def ensure_workspace_lock_index():
             logging.warning("[startup] Continuing without unique index - application-level atomic operations provide protection")
             return False
 
+async def ensure_upload_session_indexes():
+    """
+    Ensure indexes for resumable upload sessions.
+    upload_chunks is keyed by (session_id, index) so re-sent chunks overwrite in place,
+    and expires through a TTL index on expires_at.
+    Idempotent: create_index is a no-op when the index already exists.
+    """
+    try:
+        await db.upload_chunks.create_index(
+            [("session_id", ASCENDING), ("index", ASCENDING)],
+            unique=True,
+            name="session_chunk_unique"
+        )
+        await db.upload_chunks.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0, name="upload_chunk_ttl")
+        await db.upload_sessions.create_index([("id", ASCENDING)], unique=True, name="upload_session_id_unique")
+        await db.upload_sessions.create_index([("status", ASCENDING), ("expires_at", ASCENDING)], name="upload_session_expiry")
+        await db.upload_sessions.create_index([("quota_user_id", ASCENDING), ("status", ASCENDING)], name="upload_session_quota")
+        logging.info("[startup] Upload session indexes ensured")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create upload session indexes: {e}", exc_info=True)
+        return False
+
+async def ensure_media_blob_indexes():
+    """
+    Ensure indexes for content-addressed de-duplication.
+    media_blobs is unique per (workspace, sha256); files are looked up by blob and content hash.
+    Idempotent: create_index is a no-op when the index already exists.
+    """
+    try:
+        try:
+            # Blobs used to be shared across all workspaces of an owner
+            await db.media_blobs.drop_index("media_blob_owner_hash_unique")
+        except OperationFailure:
+            pass
+        await db.media_blobs.create_index(
+            [("workspace_id", ASCENDING), ("content_hash", ASCENDING)],
+            unique=True,
+            name="media_blob_workspace_hash_unique"
+        )
+        await db.media_blobs.create_index([("id", ASCENDING)], unique=True, name="media_blob_id_unique")
+        await db.files.create_index([("user_id", ASCENDING), ("content_hash", ASCENDING)], name="file_owner_content_hash")
+        await db.files.create_index([("blob_id", ASCENDING)], sparse=True, name="file_blob_id")
+        logging.info("[startup] Media blob indexes ensured")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create media blob indexes: {e}", exc_info=True)
+        return False
+
 async def cleanup_duplicate_workspace_locks():
     """
     Audit and clean up duplicate workspace_id records in workspace_locks.
@@ -10452,67 +13506,119 @@ async def cleanup_duplicate_workspace_locks():
 class UpdateUserRoleRequest(BaseModel):
     role: UserRole
 
+def encode_list_cursor(values: Dict[str, Any]) -> str:
+    """Opaque keyset pagination cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_list_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def _user_search_filter(search: str) -> Dict[str, Any]:
+    """
+    Index-backed user search: email prefix (as typed and lowercased, both anchored so the
+    email index bounds the scan) or whole words of the name through the users_name_text index.
+    """
+    term = search.strip()
+    prefixes = {f"^{re.escape(term)}", f"^{re.escape(term.lower())}"}
+    email_clauses = [{"email": {"$regex": prefix}} for prefix in sorted(prefixes)]
+    if "@" in term:
+        return {"$or": email_clauses}
+    return {"$or": email_clauses + [{"$text": {"$search": term}}]}
+
+@api_router.get("/admin/paypal/reconciliation-runs")
+async def list_reconciliation_runs(
+    limit: int = Query(20, ge=1, le=60),
+    current_user: User = Depends(require_admin)
+):
+    """Recent scheduled reconciliation runs with per-tier counts, checkpoint and throughput. Admin-only endpoint."""
+    runs = await db.reconciliation_runs.find({}, {"_id": 0}).sort("started_at", DESCENDING).limit(limit).to_list(limit)
+    return {"runs": runs}
+
 @api_router.get("/admin/users")
 async def list_users(
-    page: int = Query(1, ge=1, description="Page number"),
     limit: int = Query(50, ge=1, le=100, description="Items per page"),
-    search: Optional[str] = Query(None, description="Search by email or name"),
+    search: Optional[str] = Query(None, description="Search by email prefix or name"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
     current_user: User = Depends(require_admin)
 ):
     """
-    List all users with pagination and search.
+    List users, newest first, with plan, subscription and storage figures.
+    
+    One aggregation joins plan and subscription ($lookup); storage comes from the figure
+    recorded on the user document, and stale or missing figures are refreshed in the
+    background. Pages are keyset-paginated on (created_at, id) - pass next_cursor to get the
+    next page.
     Admin-only endpoint.
     """
-    skip = (page - 1) * limit
-    
-    # Build query
-    query = {}
-    if search:
-        query = {
-            "$or": [
-                {"email": {"$regex": search, "$options": "i"}},
-                {"name": {"$regex": search, "$options": "i"}}
-            ]
-        }
-    
-    # Get total count
-    total = await db.users.count_documents(query)
+    search_filter = _user_search_filter(search) if search and search.strip() else {}
+    conditions = [search_filter] if search_filter else []
+    if cursor:
+        position = decode_list_cursor(cursor)
+        last_created_at, last_id = position.get("created_at"), position.get("id")
+        if last_created_at is None:
+            # Users without created_at sort last
+            conditions.append({"created_at": None, "id": {"$lt": last_id}})
+        else:
+            conditions.append({"$or": [
+                {"created_at": {"$lt": last_created_at}},
+                {"created_at": last_created_at, "id": {"$lt": last_id}},
+                {"created_at": None},
+            ]})
+    query = {"$and": conditions} if len(conditions) > 1 else (conditions[0] if conditions else {})
+    
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"created_at": -1, "id": -1}},
+        {"$limit": limit + 1},
+        {"$project": {"_id": 0, "password_hash": 0}},
+        {"$lookup": {"from": "plans", "localField": "plan_id", "foreignField": "id", "as": "plan"}},
+        {"$lookup": {"from": "subscriptions", "localField": "subscription_id", "foreignField": "id", "as": "subscription"}},
+    ]
+    # Total of the whole listing (not the remaining pages); unfiltered it comes from collection metadata
+    total_task = db.users.count_documents(search_filter) if search_filter else db.users.estimated_document_count()
+    users, total = await asyncio.gather(db.users.aggregate(pipeline).to_list(limit + 1), total_task)
     
-    # Get users
-    users_cursor = db.users.find(query, {"_id": 0, "password_hash": 0}).skip(skip).limit(limit).sort("created_at", -1)
-    users = await users_cursor.to_list(limit)
+    has_more = len(users) > limit
+    users = users[:limit]
     
-    # Enrich with plan and subscription info
+    stale_before = (datetime.now(timezone.utc) - timedelta(seconds=USER_STORAGE_FIGURE_MAX_AGE_SECONDS)).isoformat()
+    stale_user_ids = []
     enriched_users = []
     for user in users:
+        plan = user.pop("plan", None) or []
+        subscription = user.pop("subscription", None) or []
         user_dict = dict(user)
-        
-        # Get plan
-        plan_id = user.get('plan_id')
-        if plan_id:
-            plan = await db.plans.find_one({"id": plan_id}, {"_id": 0, "name": 1, "display_name": 1})
-            user_dict["plan"] = plan
-        
-        # Get subscription (include grace period fields)
-        subscription_id = user.get('subscription_id')
-        if subscription_id:
-            subscription = await db.subscriptions.find_one(
-                {"id": subscription_id}, 
-                {"_id": 0, "status": 1, "started_at": 1, "grace_started_at": 1, "grace_ends_at": 1}
+        if user.get("plan_id"):
+            user_dict["plan"] = {key: plan[0].get(key) for key in ("name", "display_name")} if plan else None
+        if user.get("subscription_id"):
+            # Include grace period fields
+            user_dict["subscription"] = (
+                {key: subscription[0].get(key) for key in ("status", "started_at", "grace_started_at", "grace_ends_at") if key in subscription[0]}
+                if subscription else None
             )
-            user_dict["subscription"] = subscription
-        
-        # Get storage usage
-        user_dict["storage_used"] = await get_user_storage_usage(user.get("id"))
-        
+        user_dict["storage_used"] = user.get("storage_used_bytes")
+        if user.get("storage_computed_at") is None or user["storage_computed_at"] < stale_before:
+            stale_user_ids.append(user.get("id"))
         enriched_users.append(user_dict)
+    schedule_storage_refresh(stale_user_ids)
+    
+    next_cursor = None
+    if has_more and users:
+        last = users[-1]
+        next_cursor = encode_list_cursor({"created_at": last.get("created_at"), "id": last.get("id")})
     
     return {
         "users": enriched_users,
         "total": total,
-        "page": page,
         "limit": limit,
-        "pages": (total + limit - 1) // limit
+        "next_cursor": next_cursor,
+        "has_more": has_more
     }
 
 @api_router.get("/admin/users/{user_id}")
@@ -10626,6 +13732,171 @@ async def get_user_memberships(
         "pages": (total + limit - 1) // limit
     }
 
+# ============================================================================
+# STREAMING EXPORTS
+# ============================================================================
+
+EXPORT_BATCH_SIZE = 500  # Cursor batch size and rows per flushed chunk
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+class ExportDataset:
+    """
+    An exportable collection: the fields callers may select (secrets are never listed),
+    the default selection, equality filters (query parameter -> field) and the timestamp
+    field that since/until bound. Rows stream in id order, so the `_cursor` of any row
+    resumes the export right after it.
+    """
+    
+    def __init__(self, collection: str, fields: List[str], default_fields: List[str],
+                 filters: Dict[str, str], time_field: str = "created_at"):
+        self.collection = collection
+        self.fields = fields
+        self.default_fields = default_fields
+        self.filters = filters
+        self.time_field = time_field
+
+
+EXPORT_DATASETS: Dict[str, ExportDataset] = {
+    "users": ExportDataset(
+        "users",
+        fields=["id", "email", "name", "role", "plan_id", "email_verified", "storage_used_bytes",
+                "storage_computed_at", "created_at", "updated_at"],
+        default_fields=["id", "email", "name", "role", "plan_id", "created_at"],
+        filters={"role": "role", "plan_id": "plan_id"},
+    ),
+    "memberships": ExportDataset(
+        "workspace_members",
+        fields=["id", "workspace_id", "user_id", "role", "status", "invited_by_user_id", "invited_email",
+                "invited_at", "responded_at", "joined_at"],
+        default_fields=["id", "workspace_id", "user_id", "role", "status", "joined_at"],
+        filters={"user_id": "user_id", "workspace_id": "workspace_id", "status": "status", "role": "role"},
+        time_field="joined_at",
+    ),
+    "paypal-audit": ExportDataset(
+        "paypal_audit_logs",
+        fields=["id", "user_id", "subscription_id", "action", "paypal_endpoint", "http_method", "http_status_code",
+                "paypal_status", "verified", "source", "raw_paypal_response", "created_at"],
+        default_fields=["id", "user_id", "subscription_id", "action", "http_status_code", "paypal_status",
+                        "verified", "source", "created_at"],
+        filters={"subscription_id": "subscription_id", "user_id": "user_id", "action": "action",
+                 "source": "source", "paypal_status": "paypal_status"},
+    ),
+    "feedback": ExportDataset(
+        "feedback",
+        fields=["id", "walkthrough_id", "workspace_id", "rating", "comment", "hesitation_step", "timestamp"],
+        default_fields=["id", "walkthrough_id", "rating", "comment", "hesitation_step", "timestamp"],
+        filters={"walkthrough_id": "walkthrough_id", "rating": "rating"},
+        time_field="timestamp",
+    ),
+}
+
+
+# Leading characters that make spreadsheet applications evaluate a CSV cell as a formula
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _export_cell(value: Any) -> Any:
+    """CSV cell for a field value. Text that would be read as a formula is prefixed with '."""
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream_export(
+    name: str,
+    request: Request,
+    fmt: str,
+    fields: Optional[str],
+    cursor: Optional[str],
+    since: Optional[str],
+    until: Optional[str],
+    scope: Optional[Dict[str, Any]] = None
+) -> StreamingResponse:
+    """
+    Stream a dataset as NDJSON or CSV straight from a Mongo cursor, EXPORT_BATCH_SIZE rows
+    at a time. Filters come from the dataset's query parameters; scope is a filter the caller
+    cannot widen (e.g. the workspace of a member-facing export).
+    """
+    dataset = EXPORT_DATASETS[name]
+    if fmt not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported format. Use one of: {', '.join(EXPORT_MEDIA_TYPES)}")
+    selected = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(dataset.default_fields)
+    unknown = [f for f in selected if f not in dataset.fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    
+    clauses: List[Dict[str, Any]] = [scope] if scope else []
+    for param, field in dataset.filters.items():
+        value = request.query_params.get(param)
+        if value is not None:
+            clauses.append({field: value})
+    time_range = {op: bound for op, bound in (("$gte", since), ("$lt", until)) if bound}
+    if time_range:
+        clauses.append({dataset.time_field: time_range})
+    if cursor:
+        after = decode_list_cursor(cursor).get("after")
+        if not isinstance(after, str):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        clauses.append({"id": {"$gt": after}})
+    query = {"$and": clauses} if clauses else {}
+    projection = {"_id": 0, "id": 1, **{f: 1 for f in selected}}
+    
+    async def rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer) if fmt == "csv" else None
+        if writer:
+            writer.writerow(selected + ["_cursor"])
+        pending = 0
+        documents = db[dataset.collection].find(query, projection).sort("id", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+        async for document in documents:
+            token = encode_list_cursor({"after": document["id"]})
+            if writer:
+                writer.writerow([_export_cell(document.get(f)) for f in selected] + [token])
+            else:
+                buffer.write(json.dumps({**{f: document.get(f) for f in selected}, "_cursor": token}, default=str) + "\n")
+            pending += 1
+            if pending >= EXPORT_BATCH_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+        if buffer.tell():
+            yield buffer.getvalue()
+    
+    filename = f"{name}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.{fmt}"
+    return StreamingResponse(
+        rows(),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"}
+    )
+
+@api_router.get("/admin/export/{dataset}")
+async def export_admin_dataset(
+    dataset: str,
+    request: Request,
+    format: str = Query("ndjson", description="ndjson or csv"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields (defaults to the dataset's summary fields)"),
+    cursor: Optional[str] = Query(None, description="_cursor of the last row received, to resume"),
+    since: Optional[str] = Query(None, description="ISO timestamp lower bound (inclusive)"),
+    until: Optional[str] = Query(None, description="ISO timestamp upper bound (exclusive)"),
+    current_user: User = Depends(require_admin)
+):
+    """
+    Stream an admin dataset (users, memberships, paypal-audit, feedback) as NDJSON or CSV.
+    Dataset filters are plain query parameters, e.g. ?user_id= for memberships or
+    ?subscription_id= for paypal-audit. Every row carries a _cursor to resume from.
+    Admin-only endpoint.
+    """
+    if dataset not in EXPORT_DATASETS:
+        raise HTTPException(status_code=404, detail="Unknown dataset")
+    logging.info(f"[ADMIN] User {current_user.id} exporting {dataset} as {format}")
+    return stream_export(dataset, request, format, fields, cursor, since, until)
+
 class UpdateUserRoleRequest(BaseModel):
     role: UserRole
 
@@ -11086,60 +14357,127 @@ async def get_user_subscription_details(
     
     return result
 
-@api_router.get("/admin/stats")
-async def get_admin_stats(
-    current_user: User = Depends(require_admin)
-):
+ADMIN_STATS_TTL_SECONDS = 30  # Served from cache without recomputing
+ADMIN_STATS_MAX_STALE_SECONDS = 600  # Older cached stats are still served (while one refresh runs) up to this age
+ADMIN_STATS_SNAPSHOT_INTERVAL_MINUTES = int(os.environ.get('ADMIN_STATS_SNAPSHOT_INTERVAL_MINUTES', '60'))  # 0 disables snapshots
+ADMIN_STATS_SNAPSHOT_RETENTION_DAYS = 90
+
+class StaleWhileRevalidateCache:
     """
-    Get system-wide statistics.
-    Admin-only endpoint.
+    Single cached value. Fresh values are returned directly; stale ones are returned while one
+    background refresh runs; missing or too-old values are computed once for all waiting callers.
+    """
+
+    def __init__(self, ttl_seconds: float, max_stale_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self._value: Any = None
+        self._computed_at = 0.0
+        self._refresh: Optional[asyncio.Task] = None
+
+    async def _compute(self, compute) -> None:
+        self._value = await compute()
+        self._computed_at = time.monotonic()
+
+    def _start_refresh(self, compute) -> asyncio.Task:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._compute(compute))
+            self._refresh.add_done_callback(self._log_failure)
+        return self._refresh
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logging.error(f"[cache] Refresh failed: {task.exception()}")
+
+    async def get(self, compute, force: bool = False) -> Tuple[Any, float]:
+        """Returns (value, age in seconds)."""
+        age = time.monotonic() - self._computed_at
+        if self._value is not None and not force:
+            if age < self.ttl_seconds:
+                return self._value, age
+            if age < self.max_stale_seconds:
+                self._start_refresh(compute)
+                return self._value, age
+        # shield: a disconnecting caller must not cancel the refresh other callers wait on
+        await asyncio.shield(self._start_refresh(compute))
+        return self._value, time.monotonic() - self._computed_at
+
+    def clear(self) -> None:
+        self._value = None
+        self._computed_at = 0.0
+
+
+admin_stats_cache = StaleWhileRevalidateCache(ADMIN_STATS_TTL_SECONDS, ADMIN_STATS_MAX_STALE_SECONDS)
+
+def _facet_count(facet: Dict[str, Any], name: str) -> int:
+    rows = facet.get(name) or []
+    return rows[0].get("count", 0) if rows else 0
+
+async def compute_admin_stats() -> Dict[str, Any]:
+    """
+    System-wide statistics: one aggregation per collection ($facet where a collection needs
+    several figures), all collections queried concurrently.
     """
-    # User stats
-    total_users = await db.users.count_documents({})
-    verified_users = await db.users.count_documents({"email_verified": True})
-    admin_users = await db.users.count_documents({"role": UserRole.ADMIN.value})
+    users_pipeline = [{"$facet": {
+        "total": [{"$count": "count"}],
+        "verified": [{"$match": {"email_verified": True}}, {"$count": "count"}],
+        "admins": [{"$match": {"role": UserRole.ADMIN.value}}, {"$count": "count"}],
+        "by_plan": [
+            {"$group": {"_id": "$plan_id", "count": {"$sum": 1}}},
+            {"$lookup": {"from": "plans", "localField": "_id", "foreignField": "id", "as": "plan"}},
+        ],
+    }}]
+    files_pipeline = [{"$facet": {
+        "by_status": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+        "storage": [
+            {"$match": {"status": FileStatus.ACTIVE}},
+            # De-duplicated references share one blob: count its bytes once (as sum_stored_bytes does)
+            {"$group": {"_id": {"$ifNull": ["$blob_id", "$id"]}, "size_bytes": {"$first": "$size_bytes"}}},
+            {"$group": {"_id": None, "total_bytes": {"$sum": {"$ifNull": ["$size_bytes", 0]}}}},
+        ],
+    }}]
+    by_status = [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+    
+    users_facets, subscription_groups, total_workspaces, walkthrough_groups, file_facets = await asyncio.gather(
+        db.users.aggregate(users_pipeline).to_list(1),
+        db.subscriptions.aggregate(by_status).to_list(100),
+        db.workspaces.estimated_document_count(),
+        db.walkthroughs.aggregate(by_status).to_list(100),
+        db.files.aggregate(files_pipeline).to_list(1),
+    )
+    users_facet = users_facets[0] if users_facets else {}
+    files_facet = file_facets[0] if file_facets else {}
     
-    # Plan distribution
+    total_users = _facet_count(users_facet, "total")
+    verified_users = _facet_count(users_facet, "verified")
     plan_distribution = {}
-    users_by_plan = await db.users.aggregate([
-        {"$group": {"_id": "$plan_id", "count": {"$sum": 1}}}
-    ]).to_list(100)
-    
-    for item in users_by_plan:
-        plan_id = item.get("_id")
-        if plan_id:
-            plan = await db.plans.find_one({"id": plan_id}, {"_id": 0, "name": 1, "display_name": 1})
-            if plan:
-                plan_distribution[plan["name"]] = {
-                    "display_name": plan["display_name"],
-                    "count": item.get("count", 0)
-                }
-    
-    # Subscription stats
-    active_subscriptions = await db.subscriptions.count_documents({"status": SubscriptionStatus.ACTIVE.value})
-    cancelled_subscriptions = await db.subscriptions.count_documents({"status": SubscriptionStatus.CANCELLED.value})
-    pending_subscriptions = await db.subscriptions.count_documents({"status": SubscriptionStatus.PENDING.value})
-    
-    # Workspace stats
-    total_workspaces = await db.workspaces.count_documents({})
+    for item in users_facet.get("by_plan") or []:
+        plan = (item.get("plan") or [None])[0]
+        if item.get("_id") and plan:
+            plan_distribution[plan["name"]] = {
+                "display_name": plan.get("display_name"),
+                "count": item.get("count", 0)
+            }
     
-    # Walkthrough stats
-    total_walkthroughs = await db.walkthroughs.count_documents({})
-    published_walkthroughs = await db.walkthroughs.count_documents({"status": WalkthroughStatus.PUBLISHED.value})
+    subscriptions = {item["_id"]: item["count"] for item in subscription_groups}
+    active_subscriptions = subscriptions.get(SubscriptionStatus.ACTIVE.value, 0)
+    cancelled_subscriptions = subscriptions.get(SubscriptionStatus.CANCELLED.value, 0)
+    pending_subscriptions = subscriptions.get(SubscriptionStatus.PENDING.value, 0)
     
-    # File stats
-    total_files = await db.files.count_documents({})
-    active_files = await db.files.count_documents({"status": FileStatus.ACTIVE})
+    walkthroughs = {item["_id"]: item["count"] for item in walkthrough_groups}
+    total_walkthroughs = sum(walkthroughs.values())
+    published_walkthroughs = walkthroughs.get(WalkthroughStatus.PUBLISHED.value, 0)
     
-    # Storage stats
-    active_file_records = await db.files.find({"status": FileStatus.ACTIVE}, {"size_bytes": 1}).to_list(10000)
-    total_storage = sum(f.get("size_bytes", 0) for f in active_file_records)
+    files = {item["_id"]: item["count"] for item in files_facet.get("by_status") or []}
+    storage_rows = files_facet.get("storage") or []
+    total_storage = storage_rows[0].get("total_bytes", 0) if storage_rows else 0
     
     return {
         "users": {
             "total": total_users,
             "verified": verified_users,
-            "admins": admin_users,
+            "admins": _facet_count(users_facet, "admins"),
             "unverified": total_users - verified_users
         },
         "plans": plan_distribution,
@@ -11158,10 +14496,10 @@ async def get_admin_stats(
             "draft": total_walkthroughs - published_walkthroughs
         },
         "files": {
-            "total": total_files,
-            "active": active_files,
-            "pending": await db.files.count_documents({"status": FileStatus.PENDING.value}),
-            "failed": await db.files.count_documents({"status": FileStatus.FAILED.value})
+            "total": sum(files.values()),
+            "active": files.get(FileStatus.ACTIVE.value, 0),
+            "pending": files.get(FileStatus.PENDING.value, 0),
+            "failed": files.get(FileStatus.FAILED.value, 0)
         },
         "storage": {
             "total_bytes": total_storage,
@@ -11170,6 +14508,263 @@ async def get_admin_stats(
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
+@api_router.get("/admin/stats")
+async def get_admin_stats(
+    refresh: bool = Query(False, description="Recompute instead of serving cached figures"),
+    current_user: User = Depends(require_admin)
+):
+    """
+    Get system-wide statistics.
+    Served from a short-lived cache (see StaleWhileRevalidateCache); "timestamp" is when the
+    figures were computed.
+    Admin-only endpoint.
+    """
+    stats, age = await admin_stats_cache.get(compute_admin_stats, force=refresh)
+    return {**stats, "cache_age_seconds": round(age, 1)}
+
+@api_router.get("/admin/stats/history")
+async def get_admin_stats_history(
+    days: int = Query(30, ge=1, le=ADMIN_STATS_SNAPSHOT_RETENTION_DAYS),
+    current_user: User = Depends(require_admin)
+):
+    """Periodic statistics snapshots (oldest first) for trend charts. Admin-only endpoint."""
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+    snapshots = await db.admin_stats_snapshots.find(
+        {"captured_at": {"$gte": since}}, {"_id": 0}
+    ).sort("captured_at", ASCENDING).to_list(None)
+    return {"interval_minutes": ADMIN_STATS_SNAPSHOT_INTERVAL_MINUTES, "snapshots": snapshots}
+
+async def admin_stats_snapshot_job():
+    """
+    Store a statistics snapshot, scheduled every ADMIN_STATS_SNAPSHOT_INTERVAL_MINUTES.
+    Snapshot ids are the interval start, so a rerun within the interval writes nothing new.
+    """
+    interval = ADMIN_STATS_SNAPSHOT_INTERVAL_MINUTES * 60
+    bucket_start = datetime.fromtimestamp(time.time() // interval * interval, tz=timezone.utc).isoformat()
+    if await db.admin_stats_snapshots.find_one({"id": bucket_start}, {"_id": 0, "id": 1}):
+        return
+    stats, _ = await admin_stats_cache.get(compute_admin_stats, force=True)
+    await db.admin_stats_snapshots.update_one(
+        {"id": bucket_start},
+        {"$setOnInsert": {**stats, "id": bucket_start, "captured_at": bucket_start}},
+        upsert=True
+    )
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=ADMIN_STATS_SNAPSHOT_RETENTION_DAYS)).isoformat()
+    await db.admin_stats_snapshots.delete_many({"captured_at": {"$lt": cutoff}})
+
+# ============================================================================
+# CLUSTER LEASES & PERIODIC SCHEDULER
+# ============================================================================
+# startup_event runs in every worker process, so periodic jobs are registered with
+# cluster_scheduler, which runs them only on the holder of the "scheduler" lease.
+# A lease is a TTL'd document in db.leases renewed by its holder; every new acquisition
+# increments its fencing token, so a holder that stalled past the TTL can tell
+# (lease_is_held) that it was replaced before writing anything further.
+
+LEADER_LEASE_TTL_SECONDS = int(os.environ.get('LEADER_LEASE_TTL_SECONDS', '30'))
+LEADER_LEASE_RENEW_SECONDS = max(LEADER_LEASE_TTL_SECONDS // 3, 1)
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def acquire_lease(name: str, holder: str, ttl_seconds: int = LEADER_LEASE_TTL_SECONDS) -> Optional[int]:
+    """
+    Acquire or renew a lease. Returns the fencing token while `holder` holds it, None when
+    someone else does. Renewal keeps the token; taking over an expired lease increments it.
+    """
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
+    expires_at = (now + timedelta(seconds=ttl_seconds)).isoformat()
+    renewed = await db.leases.update_one(
+        {"id": name, "holder": holder, "expires_at": {"$gt": now_iso}},
+        {"$set": {"expires_at": expires_at, "renewed_at": now_iso}}
+    )
+    if not renewed.matched_count:
+        taken = await db.leases.update_one(
+            {"id": name, "expires_at": {"$lte": now_iso}},
+            {"$set": {"holder": holder, "expires_at": expires_at, "acquired_at": now_iso, "renewed_at": now_iso}, "$inc": {"token": 1}}
+        )
+        if not taken.matched_count:
+            try:
+                await db.leases.insert_one({
+                    "id": name, "holder": holder, "token": 1,
+                    "expires_at": expires_at, "acquired_at": now_iso, "renewed_at": now_iso,
+                })
+                return 1
+            except DuplicateKeyError:
+                return None  # Held, unexpired, by another instance
+    # Read back under the holder filter: None if another instance took it over meanwhile
+    lease = await db.leases.find_one({"id": name, "holder": holder}, {"_id": 0, "token": 1})
+    return lease["token"] if lease else None
+
+
+async def release_lease(name: str, holder: str, token: int) -> None:
+    """Expire a held lease now so another instance can take over without waiting for the TTL."""
+    await db.leases.update_one(
+        {"id": name, "holder": holder, "token": token},
+        {"$set": {"expires_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+
+async def lease_is_held(name: str, holder: str, token: int) -> bool:
+    """Fencing check: the lease is still unexpired and still carries this holder's token."""
+    return bool(await db.leases.find_one(
+        {"id": name, "holder": holder, "token": token, "expires_at": {"$gt": datetime.now(timezone.utc).isoformat()}},
+        {"_id": 0, "id": 1}
+    ))
+
+
+def every(seconds: float):
+    """Schedule: a fixed interval after the previous run finished."""
+    return lambda after: after + timedelta(seconds=seconds)
+
+
+def aligned_every(seconds: float):
+    """Schedule: just past the next multiple of `seconds` since the epoch."""
+    return lambda after: datetime.fromtimestamp((after.timestamp() // seconds + 1) * seconds + 1, tz=timezone.utc)
+
+
+def daily_at(hour: int):
+    """Schedule: the next hour:00 UTC."""
+    def next_run(after: datetime) -> datetime:
+        target = after.replace(hour=hour, minute=0, second=0, microsecond=0)
+        return target if target > after else target + timedelta(days=1)
+    return next_run
+
+
+class PeriodicJob:
+    def __init__(self, name: str, func, next_run):
+        self.name = name
+        self.func = func
+        self.next_run = next_run
+        self.task: Optional[asyncio.Task] = None
+
+
+class ClusterScheduler:
+    """
+    Runs registered periodic jobs once per cluster. Every instance competes for the lease;
+    the holder runs jobs whose next_run_at (db.scheduled_jobs) has passed. A job left
+    "running" by a leader that went away is due again immediately on the next leader, and
+    a job's completion is only recorded under the fencing token it started with.
+    """
+    
+    def __init__(self, lease_name: str = "scheduler", holder: str = INSTANCE_ID):
+        self.lease_name = lease_name
+        self.holder = holder
+        self.jobs: Dict[str, PeriodicJob] = {}
+        self.fencing_token: Optional[int] = None
+        self._loop_task: Optional[asyncio.Task] = None
+    
+    def register(self, name: str, func, next_run) -> None:
+        self.jobs[name] = PeriodicJob(name, func, next_run)
+    
+    @property
+    def is_leader(self) -> bool:
+        return self.fencing_token is not None
+    
+    async def holds_lease(self) -> bool:
+        return self.fencing_token is not None and await lease_is_held(self.lease_name, self.holder, self.fencing_token)
+    
+    def start(self) -> None:
+        self._loop_task = asyncio.create_task(self.run())
+    
+    async def stop(self) -> None:
+        if self._loop_task:
+            self._loop_task.cancel()
+        self._cancel_jobs()
+        if self.fencing_token is not None:
+            await release_lease(self.lease_name, self.holder, self.fencing_token)
+            self.fencing_token = None
+    
+    def _cancel_jobs(self) -> None:
+        for job in self.jobs.values():
+            if job.task and not job.task.done():
+                job.task.cancel()
+    
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logging.error(f"[scheduler] Tick failed: {e}", exc_info=True)
+            await asyncio.sleep(LEADER_LEASE_RENEW_SECONDS)
+    
+    async def tick(self) -> None:
+        """Renew or compete for the lease, then start whatever is due."""
+        try:
+            token = await acquire_lease(self.lease_name, self.holder)
+        except Exception as e:
+            logging.error(f"[scheduler] Lease renewal failed: {e}")
+            token = None
+        if token != self.fencing_token:
+            if self.fencing_token is not None:
+                logging.warning(f"[scheduler] {self.holder} lost the {self.lease_name} lease (token {self.fencing_token})")
+                self._cancel_jobs()
+            if token is not None:
+                logging.info(f"[scheduler] {self.holder} is now leader (token {token})")
+            self.fencing_token = token
+        if token is None:
+            return
+        
+        now = datetime.now(timezone.utc)
+        states = {
+            state["id"]: state
+            async for state in db.scheduled_jobs.find({"id": {"$in": list(self.jobs)}}, {"_id": 0})
+        }
+        for job in self.jobs.values():
+            if job.task and not job.task.done():
+                continue
+            state = states.get(job.name)
+            if state is None:
+                await db.scheduled_jobs.update_one(
+                    {"id": job.name},
+                    {"$setOnInsert": {"id": job.name, "status": "scheduled", "next_run_at": job.next_run(now).isoformat()}},
+                    upsert=True
+                )
+                continue
+            if state.get("status") == "running" or state.get("next_run_at", "") <= now.isoformat():
+                job.task = asyncio.create_task(self._run_job(job, token))
+    
+    async def _run_job(self, job: PeriodicJob, token: int) -> None:
+        started = datetime.now(timezone.utc)
+        await db.scheduled_jobs.update_one({"id": job.name}, {"$set": {
+            "status": "running",
+            "leader": self.holder,
+            "fencing_token": token,
+            "last_started_at": started.isoformat(),
+        }})
+        error = None
+        try:
+            await job.func()
+        except asyncio.CancelledError:
+            # Leadership moved; the next leader sees "running" and runs it again
+            logging.warning(f"[scheduler] {job.name} cancelled")
+            raise
+        except Exception as e:
+            error = str(e)
+            logging.error(f"[scheduler] {job.name} failed: {e}", exc_info=True)
+        finished = datetime.now(timezone.utc)
+        await db.scheduled_jobs.update_one({"id": job.name, "fencing_token": token}, {"$set": {
+            "status": "failed" if error else "succeeded",
+            "last_error": error,
+            "last_finished_at": finished.isoformat(),
+            "last_duration_seconds": round((finished - started).total_seconds(), 1),
+            "next_run_at": job.next_run(finished).isoformat(),
+        }})
+    
+    async def status(self) -> Dict[str, Any]:
+        lease = await db.leases.find_one({"id": self.lease_name}, {"_id": 0})
+        jobs = await db.scheduled_jobs.find({"id": {"$in": list(self.jobs)}}, {"_id": 0}).sort("id", ASCENDING).to_list(None)
+        return {"instance": self.holder, "is_leader": self.is_leader, "lease": lease, "jobs": jobs}
+
+
+cluster_scheduler = ClusterScheduler()
+
+
+@api_router.get("/admin/scheduler")
+async def get_scheduler_status(current_user: User = Depends(require_admin)):
+    """Current scheduler lease holder and the state of each periodic job. Admin-only endpoint."""
+    return await cluster_scheduler.status()
+
 # ============================================================================
 # ADDITIONAL ADMIN ENDPOINTS - Extended User Management
 # ============================================================================
@@ -11308,7 +14903,7 @@ async def restore_user(
     logging.info(f"[ADMIN] User {current_user.id} restored user {user_id}")
     return {"success": True, "user_id": user_id, "message": "User restored successfully"}
 
-@api_router.delete("/admin/users/{user_id}")
+@api_router.delete("/admin/users/{user_id}", status_code=202)
 async def hard_delete_user(
     user_id: str,
     confirm: bool = Query(False, description="Must be True to confirm hard delete"),
@@ -11316,6 +14911,7 @@ async def hard_delete_user(
 ):
     """Hard delete user (permanently removes user and all associated data). Admin-only endpoint.
     Requires confirm=True query parameter for safety.
+    Runs as a background job: returns 202, progress at GET /api/jobs/{job_id}.
     """
     if not confirm:
         raise HTTPException(
@@ -11331,44 +14927,15 @@ async def hard_delete_user(
     if user_id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot delete your own account")
     
-    # Delete user's workspaces (cascade delete)
-    workspace_ids = []
-    async for workspace in db.workspaces.find({"owner_id": user_id}, {"_id": 0, "id": 1}):
-        workspace_ids.append(workspace["id"])
-    
-    # Delete workspace memberships
-    await db.workspace_members.delete_many({"user_id": user_id})
-    
-    # Delete workspaces (this will cascade delete walkthroughs, categories, etc. via existing logic)
-    for workspace_id in workspace_ids:
-        # Get all walkthroughs for file cleanup
-        walkthroughs = await db.walkthroughs.find({"workspace_id": workspace_id}, {"_id": 0}).to_list(10000)
-        for walkthrough in walkthroughs:
-            file_urls = await extract_file_urls_from_walkthrough(walkthrough)
-            await delete_files_by_urls(file_urls, workspace_id)
-        
-        await db.walkthroughs.delete_many({"workspace_id": workspace_id})
-        await db.walkthrough_versions.delete_many({"workspace_id": workspace_id})
-        await db.categories.delete_many({"workspace_id": workspace_id})
-        await db.workspaces.delete_one({"id": workspace_id})
-    
-    # Delete user's files
-    await db.files.delete_many({"user_id": user_id})
-    
-    # Delete user's subscriptions
-    await db.subscriptions.delete_many({"user_id": user_id})
-    
-    # Delete user's notifications
-    await db.notifications.delete_many({"user_id": user_id})
-    
-    # Delete workspace locks held by user
-    await db.workspace_locks.delete_many({"locked_by_user_id": user_id})
-    
-    # Finally, delete the user
-    await db.users.delete_one({"id": user_id})
+    # Block login immediately; the data is removed by a background job
+    await db.users.update_one(
+        {"id": user_id},
+        {"$set": {"disabled": True, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    job = await submit_job("user_deletion", user_id, current_user.id)
     
-    logging.warning(f"[ADMIN] User {current_user.id} HARD DELETED user {user_id} and all associated data")
-    return {"success": True, "user_id": user_id, "message": "User and all associated data permanently deleted"}
+    logging.warning(f"[ADMIN] User {current_user.id} started HARD DELETE of user {user_id} (job {job['id']})")
+    return {"success": True, "user_id": user_id, "message": "User deletion started", **_job_view(job)}
 
 @api_router.put("/admin/users/{user_id}/quota")
 async def set_custom_quota(
@@ -11635,99 +15202,1413 @@ async def verify_security_invariants():
     
     logging.info("[SECURITY] All security invariants verified at startup")
 
-async def scheduled_reconciliation_job():
+# Scheduled reconciliation pipeline
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '8'))
+RECONCILE_RATE_PER_SECOND = float(os.environ.get('RECONCILE_RATE_PER_SECOND', '5'))  # Keep under the PayPal API quota
+RECONCILE_BURST = int(os.environ.get('RECONCILE_BURST', '10'))
+RECONCILE_PAGE_SIZE = 200  # Subscriptions per checkpoint
+RECONCILE_BILLING_HORIZON_HOURS = 48  # next_billing_time within this window goes before the rest
+RECONCILE_RUN_RETENTION = 60  # Most recent run documents kept
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, at most `capacity` banked for bursts."""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+        self.waited_seconds = 0.0
+    
+    async def acquire(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Holding the lock while sleeping queues callers in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited_seconds += wait
+                await asyncio.sleep(wait)
+
+
+def reconciliation_tiers(horizon: str, now: str) -> List[Tuple[str, Dict[str, Any]]]:
     """
-    PRODUCTION HARDENING: Daily reconciliation safety net
-    
-    Reconciles all subscriptions in non-terminal-for-access states.
-    Ensures eventual consistency even if webhooks fail.
+    Disjoint subscription sets in reconciliation order: subscriptions in grace first, then
+    those billing before the horizon, then everything else. All exclude terminal-for-access
+    states (EXPIRED, SUSPENDED), where no PayPal timestamp can grant access.
     
-    Runs daily at 03:00 UTC (low traffic period).
+    grace_ends_at is not cleared when a grace period runs out, so "in grace" means it ends at
+    or after now (the run's start, so a resumed run keeps the same tiers).
     """
-    import asyncio
-    
-    while True:
+    base = {"provider": "paypal", "status": {"$nin": ["expired", "suspended"]}}
+    not_in_grace = {"grace_ends_at": {"$not": {"$gte": now}}}  # Never in grace, or grace over
+    billing_due = {"next_billing_time": {"$ne": None, "$lte": horizon}}
+    return [
+        ("grace", {**base, "grace_ends_at": {"$gte": now}}),
+        ("billing_due", {**base, **not_in_grace, **billing_due}),
+        ("rest", {**base, **not_in_grace, "$nor": [billing_due]}),
+    ]
+
+
+async def _reconcile_one(subscription_id: str, bucket: TokenBucket, workers: asyncio.Semaphore, counts: Dict[str, int]) -> None:
+    async with workers:
+        await bucket.acquire()
         try:
-            # Wait 24 hours between runs
-            # First run: wait until 03:00 UTC
-            now = datetime.now(timezone.utc)
-            target_time = now.replace(hour=3, minute=0, second=0, microsecond=0)
-            if target_time <= now:
-                target_time += timedelta(days=1)
-            
-            wait_seconds = (target_time - now).total_seconds()
-            logging.info(f"[SCHEDULED_RECONCILE] Next run in {wait_seconds/3600:.1f} hours at {target_time.isoformat()}")
-            await asyncio.sleep(wait_seconds)
-            
-            # KILL SWITCH: Check if scheduled reconciliation is enabled
-            if not kill_switch.scheduled_reconciliation_enabled:
-                logging.warning("[SCHEDULED_RECONCILE] Skipped (disabled by kill switch)")
-                continue
-            
-            # Run reconciliation for all non-terminal subscriptions
-            logging.info("[SCHEDULED_RECONCILE] Starting daily reconciliation job")
-            await metrics.increment('scheduled_reconcile_run')
-            
-            # Find all PayPal subscriptions not in terminal-for-access states
-            # Terminal-for-access: EXPIRED, SUSPENDED (no timestamps can grant access)
-            # Non-terminal: ACTIVE, CANCELLED, PENDING, APPROVAL_PENDING
-            subscriptions = await db.subscriptions.find(
-                {
-                    "provider": "paypal",
-                    "status": {"$nin": [SubscriptionStatus.EXPIRED, SubscriptionStatus.SUSPENDED]}
-                },
-                {"id": 1, "user_id": 1, "status": 1, "_id": 0}
-            ).to_list(10000)
-            
-            total = len(subscriptions)
-            success_count = 0
-            error_count = 0
-            
-            logging.info(f"[SCHEDULED_RECONCILE] Found {total} subscriptions to reconcile")
-            
-            for sub in subscriptions:
-                try:
-                    result = await reconcile_subscription_with_paypal(sub['id'], force=False)
-                    if result.get("success"):
-                        success_count += 1
-                        if not result.get("access_granted") and result.get("is_terminal_for_polling"):
-                            logging.info(
-                                f"[SCHEDULED_RECONCILE] Subscription {sub['id']} reconciled: "
-                                f"terminal, no access"
-                            )
-                    else:
-                        error_count += 1
-                        logging.error(
-                            f"[SCHEDULED_RECONCILE] Failed to reconcile subscription {sub['id']}: "
-                            f"{result.get('error')}"
-                        )
-                    
-                    # Rate limiting: 100ms between reconciliations (max 600/min)
-                    await asyncio.sleep(0.1)
-                    
-                except Exception as e:
-                    error_count += 1
-                    logging.error(f"[SCHEDULED_RECONCILE] Error reconciling subscription {sub['id']}: {e}")
-            
-            logging.info(
-                f"[SCHEDULED_RECONCILE] Completed: {total} total, "
-                f"{success_count} success, {error_count} errors"
+            result = await reconcile_subscription_with_paypal(subscription_id, force=False)
+        except Exception as e:
+            counts["errors"] += 1
+            logging.error(f"[SCHEDULED_RECONCILE] Error reconciling subscription {subscription_id}: {e}")
+            return
+        if result.get("success"):
+            counts["success"] += 1
+            if not result.get("access_granted") and result.get("is_terminal_for_polling"):
+                logging.info(f"[SCHEDULED_RECONCILE] Subscription {subscription_id} reconciled: terminal, no access")
+        else:
+            counts["errors"] += 1
+            logging.error(f"[SCHEDULED_RECONCILE] Failed to reconcile subscription {subscription_id}: {result.get('error')}")
+
+
+async def run_subscription_reconciliation(run: Optional[dict] = None, fence=None) -> dict:
+    """
+    One reconciliation pass over every non-terminal PayPal subscription, driven by keyset
+    cursors over the priority tiers. RECONCILE_CONCURRENCY calls run at once behind a token
+    bucket of RECONCILE_RATE_PER_SECOND. Progress is checkpointed in db.reconciliation_runs
+    after every page, so passing the interrupted run back resumes where it stopped.
+    `fence` is checked before each page; once it fails the run is left "running" for the
+    instance that replaced this one.
+    """
+    now = datetime.now(timezone.utc)
+    if run is None:
+        run = {
+            "id": str(uuid.uuid4()),
+            "status": "running",
+            "started_at": now.isoformat(),
+            "horizon": (now + timedelta(hours=RECONCILE_BILLING_HORIZON_HOURS)).isoformat(),
+            "checkpoint": {"tier": 0, "last_id": ""},
+            "tiers": {},
+            "rate_limited_seconds": 0.0,
+        }
+        await db.reconciliation_runs.insert_one(dict(run))
+    else:
+        logging.info(f"[SCHEDULED_RECONCILE] Resuming run {run['id']} at {run['checkpoint']}")
+        await db.reconciliation_runs.update_one({"id": run["id"]}, {"$set": {"resumed_at": now.isoformat()}})
+    
+    bucket = TokenBucket(RECONCILE_RATE_PER_SECOND, RECONCILE_BURST)
+    workers = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    started = time.monotonic()
+    processed_this_session = 0
+    tier_index = run["checkpoint"]["tier"]
+    last_id = run["checkpoint"]["last_id"]
+    tiers = reconciliation_tiers(run["horizon"], run["started_at"])
+    status = "completed"
+    
+    while tier_index < len(tiers):
+        tier_name, tier_query = tiers[tier_index]
+        page = await db.subscriptions.find(
+            {**tier_query, "id": {"$gt": last_id}}, {"_id": 0, "id": 1}
+        ).sort("id", ASCENDING).limit(RECONCILE_PAGE_SIZE).to_list(RECONCILE_PAGE_SIZE)
+        if not page:
+            tier_index, last_id = tier_index + 1, ""
+            await db.reconciliation_runs.update_one({"id": run["id"]}, {"$set": {"checkpoint": {"tier": tier_index, "last_id": last_id}}})
+            continue
+        if not kill_switch.scheduled_reconciliation_enabled:
+            logging.warning(f"[SCHEDULED_RECONCILE] Run {run['id']} stopped by kill switch")
+            status = "stopped"
+            break
+        if fence and not await fence():
+            logging.warning(f"[SCHEDULED_RECONCILE] Run {run['id']} lost its lease at {tier_name}/{last_id}; leaving it to the new leader")
+            return run
+        
+        counts = {"success": 0, "errors": 0}
+        await asyncio.gather(*(_reconcile_one(sub["id"], bucket, workers, counts) for sub in page))
+        last_id = page[-1]["id"]
+        processed_this_session += len(page)
+        await db.reconciliation_runs.update_one({"id": run["id"]}, {
+            "$set": {
+                "checkpoint": {"tier": tier_index, "last_id": last_id},
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            },
+            "$inc": {
+                f"tiers.{tier_name}.processed": len(page),
+                f"tiers.{tier_name}.success": counts["success"],
+                f"tiers.{tier_name}.errors": counts["errors"],
+                "rate_limited_seconds": bucket.waited_seconds,
+            }
+        })
+        bucket.waited_seconds = 0.0
+        metrics.increment('scheduled_reconcile_success', counts["success"])
+        metrics.increment('scheduled_reconcile_errors', counts["errors"])
+    
+    elapsed = time.monotonic() - started
+    finished = {
+        "status": status,
+        "completed_at": datetime.now(timezone.utc).isoformat(),
+        "duration_seconds": round(elapsed, 1),
+        "throughput_per_second": round(processed_this_session / elapsed, 2) if elapsed else None,
+    }
+    await db.reconciliation_runs.update_one({"id": run["id"]}, {"$set": finished})
+    run = await db.reconciliation_runs.find_one({"id": run["id"]}, {"_id": 0})
+    totals = {key: sum(tier.get(key, 0) for tier in run.get("tiers", {}).values()) for key in ("processed", "success", "errors")}
+    logging.info(
+        f"[SCHEDULED_RECONCILE] Run {run['id']} {status}: {totals['processed']} total, "
+        f"{totals['success']} success, {totals['errors']} errors, tiers={run.get('tiers')}, "
+        f"{finished['duration_seconds']}s, rate limited {run.get('rate_limited_seconds', 0):.1f}s"
+    )
+    
+    # Keep the most recent runs only
+    stale = await db.reconciliation_runs.find({}, {"_id": 0, "id": 1}).sort("started_at", DESCENDING).skip(RECONCILE_RUN_RETENTION).to_list(None)
+    if stale:
+        await db.reconciliation_runs.delete_many({"id": {"$in": [doc["id"] for doc in stale]}})
+    return run
+
+
+async def scheduled_reconciliation_job():
+    """
+    PRODUCTION HARDENING: Daily reconciliation safety net
+    
+    Reconciles all subscriptions in non-terminal-for-access states.
+    Ensures eventual consistency even if webhooks fail.
+    
+    Scheduled daily at 03:00 UTC (low traffic period) on the cluster leader. A run
+    interrupted by a restart or a leadership change is resumed from its checkpoint.
+    """
+    # KILL SWITCH: Check if scheduled reconciliation is enabled
+    if not kill_switch.scheduled_reconciliation_enabled:
+        logging.warning("[SCHEDULED_RECONCILE] Skipped (disabled by kill switch)")
+        return
+    
+    interrupted = await db.reconciliation_runs.find_one({"status": "running"}, {"_id": 0}, sort=[("started_at", DESCENDING)])
+    if not interrupted:
+        # Run reconciliation for all non-terminal subscriptions
+        logging.info("[SCHEDULED_RECONCILE] Starting daily reconciliation job")
+        metrics.increment('scheduled_reconcile_run')
+    await run_subscription_reconciliation(interrupted, fence=cluster_scheduler.holds_lease)
+
+async def scheduled_media_gc_job():
+    """
+    Orphaned-media collection, scheduled every MEDIA_GC_INTERVAL_HOURS.
+    Only reports (dry run) unless MEDIA_GC_DRY_RUN=false.
+    """
+    if not kill_switch.media_gc_enabled:
+        logging.warning("[MEDIA_GC] Skipped (disabled by kill switch)")
+        return
+    await run_media_gc(dry_run=MEDIA_GC_DRY_RUN)
+
+# ==========================================
+# BACKGROUND JOBS
+# ==========================================
+# Long-running work (workspace and user deletion) runs as durable jobs in db.jobs. The
+# HTTP call records the job and returns 202; a worker task runs the job's phases in order
+# and persists checkpoint/progress as it goes. A job whose worker died (lease expired) is
+# resumed by the watchdog on any instance. Every phase is idempotent - deletes are by id
+# and files are claimed ACTIVE -> DELETING - so re-running a partial phase is safe.
+
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '120'))
+JOB_WATCHDOG_INTERVAL_SECONDS = int(os.environ.get('JOB_WATCHDOG_INTERVAL_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = 5
+DELETION_JOB_FILE_PAGE_SIZE = 500
+
+_running_jobs: Dict[str, asyncio.Task] = {}
+
+
+class JobRun:
+    """Handle passed to phase handlers: the job document plus checkpoint/progress persistence."""
+
+    def __init__(self, job: dict):
+        self.job = job
+
+    @property
+    def checkpoint(self) -> Dict[str, Any]:
+        return self.job.setdefault("checkpoint", {})
+
+    async def save(self, checkpoint: Optional[Dict[str, Any]] = None, progress: Optional[Dict[str, int]] = None) -> None:
+        """
+        Persist checkpoint values and add to progress counters. Also renews the lease (which
+        run_job's heartbeat keeps alive between saves). Nothing is written once another
+        worker has taken the job over.
+        """
+        now = datetime.now(timezone.utc)
+        update: Dict[str, Any] = {"$set": {
+            "updated_at": now.isoformat(),
+            "lease_expires_at": (now + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+        }}
+        for key, value in (checkpoint or {}).items():
+            update["$set"][f"checkpoint.{key}"] = value
+            self.checkpoint[key] = value
+        if progress:
+            update["$inc"] = {f"progress.{key}": value for key, value in progress.items()}
+            for key, value in progress.items():
+                self.job.setdefault("progress", {})[key] = self.job.get("progress", {}).get(key, 0) + value
+        await db.jobs.update_one({"id": self.job["id"], "lease_id": self.job.get("lease_id")}, update)
+
+
+def _job_view(job: dict) -> Dict[str, Any]:
+    return {
+        "job_id": job["id"],
+        "type": job["type"],
+        "target_id": job["target_id"],
+        "status": job["status"],
+        "phase": job.get("phase"),
+        "completed_phases": job.get("completed_phases", []),
+        "phases": [phase for phase, _ in JOB_PHASES.get(job["type"], [])],
+        "progress": job.get("progress", {}),
+        "attempts": job.get("attempts", 0),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+        "completed_at": job.get("completed_at"),
+        "status_url": f"/api/jobs/{job['id']}",
+    }
+
+
+async def submit_job(job_type: str, target_id: str, requested_by: str, params: Optional[Dict[str, Any]] = None) -> dict:
+    """
+    Record a job and start it. Idempotent: while a job of this type for this target is
+    queued or running, that job is returned instead of a new one.
+    """
+    active_key = f"{job_type}:{target_id}"
+    existing = await db.jobs.find_one({"active_key": active_key}, {"_id": 0})
+    if existing:
+        return existing
+    job = Job(type=job_type, target_id=target_id, requested_by=requested_by, params=params or {}, active_key=active_key)
+    job_dict = job.model_dump()
+    job_dict["created_at"] = job_dict["created_at"].isoformat()
+    job_dict["updated_at"] = job_dict["updated_at"].isoformat()
+    try:
+        await db.jobs.insert_one(job_dict)
+    except DuplicateKeyError:
+        # A concurrent request submitted the same job first
+        return await db.jobs.find_one({"active_key": active_key}, {"_id": 0})
+    job_dict.pop("_id", None)
+    spawn_job(job.id)
+    logging.info(f"[jobs] Submitted {job_type} job {job.id} for {target_id}")
+    return job_dict
+
+
+def spawn_job(job_id: str) -> None:
+    """Run a job in this process unless it is already running here."""
+    if job_id in _running_jobs:
+        return
+    task = asyncio.create_task(run_job(job_id))
+    _running_jobs[job_id] = task
+    task.add_done_callback(lambda _: _running_jobs.pop(job_id, None))
+
+
+async def run_job(job_id: str) -> None:
+    """
+    Claim a job (queued, or running with an expired lease) and run its remaining phases.
+    A heartbeat renews the lease every JOB_LEASE_SECONDS / 3, so a phase that runs long
+    without saving is not taken over by another worker.
+    """
+    now = datetime.now(timezone.utc)
+    lease_id = str(uuid.uuid4())
+    job = await db.jobs.find_one_and_update(
+        {"id": job_id, "$or": [
+            {"status": JobStatus.QUEUED},
+            {"status": JobStatus.RUNNING, "lease_expires_at": {"$lt": now.isoformat()}}
+        ]},
+        {
+            "$set": {
+                "status": JobStatus.RUNNING,
+                "lease_id": lease_id,
+                "lease_expires_at": (now + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat(),
+                "updated_at": now.isoformat()
+            },
+            "$inc": {"attempts": 1}
+        },
+        return_document=True
+    )
+    if not job:
+        return  # Finished, or held by a live worker
+    job.pop("_id", None)
+    run = JobRun(job)
+    
+    async def keep_leased():
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            lease_expires_at = (datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+            await db.jobs.update_one({"id": job_id, "lease_id": lease_id}, {"$set": {"lease_expires_at": lease_expires_at}})
+    
+    heartbeat = asyncio.create_task(keep_leased())
+    try:
+        for phase, handler in JOB_PHASES[job["type"]]:
+            if phase in job.get("completed_phases", []):
+                continue
+            if job.get("phase") != phase:
+                # Entering a new phase; a resumed phase keeps its checkpoint
+                job["phase"], job["checkpoint"] = phase, {}
+                await db.jobs.update_one(
+                    {"id": job_id, "lease_id": lease_id},
+                    {"$set": {"phase": phase, "checkpoint": {}, "updated_at": datetime.now(timezone.utc).isoformat()}}
+                )
+            await handler(run)
+            job.setdefault("completed_phases", []).append(phase)
+            await db.jobs.update_one(
+                {"id": job_id, "lease_id": lease_id},
+                {"$push": {"completed_phases": phase}, "$set": {"checkpoint": {}, "updated_at": datetime.now(timezone.utc).isoformat()}}
             )
-            
+        now_iso = datetime.now(timezone.utc).isoformat()
+        await db.jobs.update_one(
+            {"id": job_id, "lease_id": lease_id},
+            {"$set": {"status": JobStatus.COMPLETED, "error": None, "completed_at": now_iso, "updated_at": now_iso},
+             "$unset": {"active_key": "", "lease_expires_at": ""}}
+        )
+        logging.info(f"[jobs] {job['type']} job {job_id} for {job['target_id']} completed: {job.get('progress', {})}")
+    except Exception as e:
+        logging.error(f"[jobs] {job['type']} job {job_id} failed in phase {job.get('phase')} (attempt {job['attempts']}): {e}", exc_info=True)
+        update: Dict[str, Any] = {"$set": {"error": str(e), "updated_at": datetime.now(timezone.utc).isoformat()}}
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            update["$set"]["status"] = JobStatus.FAILED
+            update["$unset"] = {"active_key": "", "lease_expires_at": ""}
+        else:
+            # Re-queued; the watchdog retries it on its next pass
+            update["$set"]["status"] = JobStatus.QUEUED
+        await db.jobs.update_one({"id": job_id, "lease_id": lease_id}, update)
+    finally:
+        heartbeat.cancel()
+
+
+async def job_watchdog():
+    """Start queued jobs and resume running jobs whose worker died (expired lease)."""
+    while True:
+        try:
+            now = datetime.now(timezone.utc).isoformat()
+            jobs = await db.jobs.find(
+                {"$or": [
+                    {"status": JobStatus.QUEUED},
+                    {"status": JobStatus.RUNNING, "lease_expires_at": {"$lt": now}}
+                ]},
+                {"_id": 0, "id": 1}
+            ).to_list(50)
+            for job in jobs:
+                spawn_job(job["id"])
         except Exception as e:
-            logging.error(f"[SCHEDULED_RECONCILE] Job error: {e}", exc_info=True)
-            # Continue loop even on error
-            await asyncio.sleep(3600)  # Wait 1 hour before retry on error
+            logging.error(f"[jobs] Watchdog error: {e}", exc_info=True)
+        await asyncio.sleep(JOB_WATCHDOG_INTERVAL_SECONDS)
+
+
+async def _delete_workspace_files(run: JobRun, workspace_id: str) -> None:
+    """Batch-delete every ACTIVE file of a workspace, a page at a time."""
+    while True:
+        page = await db.files.find(
+            {"workspace_id": workspace_id, "status": FileStatus.ACTIVE, "url": {"$nin": ["", None]}},
+            {"_id": 0, "url": 1}
+        ).limit(DELETION_JOB_FILE_PAGE_SIZE).to_list(None)
+        if not page:
+            return
+        report = await delete_files_batch([f["url"] for f in page], workspace_id)
+        await run.save(progress={"files_deleted": report["deleted"], "files_failed": report["failed"]})
+        if report["deleted"] + report["failed"] == 0:
+            return  # Nothing claimable (concurrent deletion) - avoid spinning
+
+
+async def _record_deleted_extension_entities(run: JobRun) -> None:
+    """Record the changes of a page deleted by an interrupted run (duplicates are harmless)."""
+    pending = run.checkpoint.get("pending_extension_changes")
+    if not pending:
+        return
+    for entity_id in pending["ids"]:
+        await record_extension_change(pending["workspace_id"], pending["kind"], entity_id)
+    await run.save(checkpoint={"pending_extension_changes": None})
+
+
+async def _delete_extension_entities(run: JobRun, workspace_id: str, collection, kind: Literal["target", "walkthrough"], counter: str) -> None:
+    """
+    Delete a workspace's targets or walkthroughs a page at a time, recording an extension
+    change per id: in-memory indexes drop them and sync clients get tombstones. The page's
+    ids are checkpointed before the delete so a resumed job still records them.
+    """
+    while True:
+        page = await collection.find({"workspace_id": workspace_id}, {"_id": 0, "id": 1}).limit(DELETION_JOB_FILE_PAGE_SIZE).to_list(None)
+        if not page:
+            return
+        ids = [doc["id"] for doc in page]
+        await run.save(checkpoint={"pending_extension_changes": {"workspace_id": workspace_id, "kind": kind, "ids": ids}})
+        result = await collection.delete_many({"workspace_id": workspace_id, "id": {"$in": ids}})
+        await run.save(progress={counter: result.deleted_count})
+        await _record_deleted_extension_entities(run)
+
+
+async def _delete_workspace_documents(run: JobRun, workspace_id: str) -> None:
+    """Delete a workspace's documents; the workspace itself goes last so a resumed job still finds it."""
+    await _record_deleted_extension_entities(run)
+    await _delete_extension_entities(run, workspace_id, db.extension_targets, "target", "extension_targets_deleted")
+    await _delete_extension_entities(run, workspace_id, db.walkthroughs, "walkthrough", "walkthroughs_deleted")
+    for collection, counter in (
+        (db.walkthrough_versions, "walkthrough_versions_deleted"),
+        (db.categories, "categories_deleted"),
+        (db.workspace_members, "members_deleted"),
+        (db.workspace_locks, "locks_deleted"),
+        (db.media_references, "media_references_deleted"),
+    ):
+        result = await collection.delete_many({"workspace_id": workspace_id})
+        await run.save(progress={counter: result.deleted_count})
+    await db.workspaces.delete_one({"id": workspace_id})
+    await run.save(progress={"workspaces_deleted": 1})
+
+
+async def _workspace_deletion_announce(run: JobRun) -> None:
+    """Release locks, write the audit entry and notify members (each member once)."""
+    workspace_id = run.job["target_id"]
+    params = run.job.get("params", {})
+    workspace_name = params.get("workspace_name", "Unknown")
+    actor_name = params.get("actor_name", "")
+    actor_id = run.job["requested_by"]
+    
+    # HARDENING LAYER A: Force-release all locks before deletion
+    try:
+        all_locks = await db.workspace_locks.find({"workspace_id": workspace_id}, {"_id": 0}).to_list(100)
+        for lock_doc in all_locks:
+            await release_workspace_lock(workspace_id, lock_doc['locked_by_user_id'], force=True, reason="Workspace deleted")
+    except Exception as lock_error:
+        logging.error(f"Failed to release workspace locks: {lock_error}", exc_info=True)
+        # Continue with deletion even if lock release fails
+    
+    members = await get_workspace_members(workspace_id)
+    
+    # HARDENING LAYER C: Audit log
+    if not run.checkpoint.get("audited"):
+        try:
+            await log_workspace_audit(
+                action_type=WorkspaceAuditAction.WORKSPACE_DELETED,
+                workspace_id=workspace_id,
+                actor_user_id=actor_id,
+                metadata={"workspace_name": workspace_name, "deleted_by_name": actor_name, "member_count": len(members)}
+            )
+        except Exception as audit_error:
+            logging.error(f"Failed to log workspace deletion audit: {audit_error}", exc_info=True)
+        await run.save(checkpoint={"audited": True})
+    
+    # Notify all members that workspace is being deleted; the checkpoint skips members already notified
+    notified = set(run.checkpoint.get("notified_user_ids", []))
+    for member in members:
+        if member.user_id in notified:
+            continue
+        try:
+            await create_notification(
+                user_id=member.user_id,
+                notification_type=NotificationType.WORKSPACE_DELETED,
+                title="Workspace Deleted",
+                message=f"The workspace \"{workspace_name}\" has been deleted by {actor_name}. You no longer have access to this workspace.",
+                metadata={"workspace_id": workspace_id, "deleted_by_id": actor_id, "deleted_by_name": actor_name}
+            )
+        except Exception as notification_error:
+            logging.error(f"Failed to notify member {member.user_id}: {notification_error}", exc_info=True)
+        notified.add(member.user_id)
+        await run.save(checkpoint={"notified_user_ids": sorted(notified)}, progress={"members_notified": 1})
+
+
+async def _workspace_deletion_files(run: JobRun) -> None:
+    await _delete_workspace_files(run, run.job["target_id"])
+
+
+async def _workspace_deletion_documents(run: JobRun) -> None:
+    await _delete_workspace_documents(run, run.job["target_id"])
+
+
+async def _user_deletion_memberships(run: JobRun) -> None:
+    result = await db.workspace_members.delete_many({"user_id": run.job["target_id"]})
+    await run.save(progress={"memberships_deleted": result.deleted_count})
+
+
+async def _user_deletion_workspaces(run: JobRun) -> None:
+    """Delete the user's workspaces one at a time; a deleted workspace is gone, so a resume continues with the next."""
+    user_id = run.job["target_id"]
+    while True:
+        workspace = await db.workspaces.find_one({"owner_id": user_id}, {"_id": 0, "id": 1}, sort=[("id", ASCENDING)])
+        if not workspace:
+            return
+        await run.save(checkpoint={"workspace_id": workspace["id"]})
+        await _delete_workspace_files(run, workspace["id"])
+        await _delete_workspace_documents(run, workspace["id"])
+
+
+async def _user_deletion_records(run: JobRun) -> None:
+    user_id = run.job["target_id"]
+    
+    # Delete user's files
+    media_url_cache.invalidate(*await db.files.distinct("id", {"user_id": user_id}))
+    await db.files.delete_many({"user_id": user_id})
+    await db.media_blobs.delete_many({"user_id": user_id})
+    
+    # Delete user's subscriptions
+    await db.subscriptions.delete_many({"user_id": user_id})
+    
+    # Delete user's notifications
+    await db.notifications.delete_many({"user_id": user_id})
+    
+    # Delete workspace locks held by user
+    await db.workspace_locks.delete_many({"locked_by_user_id": user_id})
+    
+    # Finally, delete the user
+    await db.users.delete_one({"id": user_id})
+    logging.warning(f"[ADMIN] User {run.job['requested_by']} HARD DELETED user {user_id} and all associated data")
+
+
+QUOTA_RECONCILE_ALL_USERS = "all"  # target_id of a reconciliation over every user
+QUOTA_RECONCILE_PAGE_SIZE = 1000
+QUOTA_RECONCILE_WORKERS = 8  # Concurrent storage recomputations while fixing
+
+
+async def _file_bytes_by_owner(user_id: Optional[str] = None) -> Dict[str, int]:
+    """Active stored bytes per quota owner from one $group over files; a de-duplicated blob counts once."""
+    match: Dict[str, Any] = {"status": FileStatus.ACTIVE}
+    if user_id:
+        match["user_id"] = user_id
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": {"user_id": "$user_id", "blob": {"$ifNull": ["$blob_id", "$id"]}}, "size_bytes": {"$first": "$size_bytes"}}},
+        {"$group": {"_id": "$_id.user_id", "total_bytes": {"$sum": {"$ifNull": ["$size_bytes", 0]}}}},
+    ]
+    totals: Dict[str, int] = {}
+    async for row in db.files.aggregate(pipeline, allowDiskUse=True):
+        totals[row["_id"]] = row["total_bytes"]
+    return totals
+
+
+async def _quota_reconciliation_compare(run: JobRun) -> None:
+    """
+    Compare per-owner file totals with each user's recorded file-record figure
+    (storage_file_bytes), in keyset pages of users. storage_used_bytes also holds estimates for
+    walkthrough media without a record, so it is not comparable. Users with no recorded figure
+    have nothing to drift and are only counted.
+    """
+    job_id = run.job["id"]
+    target = run.job["target_id"]
+    only_user = None if target == QUOTA_RECONCILE_ALL_USERS else target
+    totals = await _file_bytes_by_owner(only_user)
+    last_id = run.checkpoint.get("last_user_id", "")
+    while True:
+        query: Dict[str, Any] = {"id": {"$gt": last_id}}
+        if only_user:
+            query = {"$and": [query, {"id": only_user}]}
+        page = await db.users.find(
+            query, {"_id": 0, "id": 1, "storage_file_bytes": 1, "storage_computed_at": 1}
+        ).sort("id", ASCENDING).limit(QUOTA_RECONCILE_PAGE_SIZE).to_list(QUOTA_RECONCILE_PAGE_SIZE)
+        if not page:
+            break
+        now = datetime.now(timezone.utc).isoformat()
+        recorded = [user for user in page if user.get("storage_file_bytes") is not None]
+        mismatched = [
+            {
+                "id": f"{job_id}:{user['id']}",
+                "job_id": job_id,
+                "user_id": user["id"],
+                "file_bytes": totals.get(user["id"], 0),
+                "recorded_bytes": user["storage_file_bytes"],
+                "recorded_at": user.get("storage_computed_at"),
+                "difference": totals.get(user["id"], 0) - user["storage_file_bytes"],
+                "status": "pending",
+                "created_at": now,
+            }
+            for user in recorded
+            if user["storage_file_bytes"] != totals.get(user["id"], 0)
+        ]
+        if mismatched:
+            # Upserts keep a resumed page from recording a user twice
+            await db.quota_reconciliation_items.bulk_write(
+                [UpdateOne({"id": item["id"]}, {"$setOnInsert": item}, upsert=True) for item in mismatched],
+                ordered=False
+            )
+        last_id = page[-1]["id"]
+        await run.save(checkpoint={"last_user_id": last_id}, progress={
+            "users_checked": len(page),
+            "unrecorded": len(page) - len(recorded),
+            "discrepancies": len(mismatched)
+        })
+
+
+async def _quota_reconciliation_fix(run: JobRun) -> None:
+    """
+    Recompute (and record) the storage figure of every mismatched user, QUOTA_RECONCILE_WORKERS
+    at a time. An item is "fixed" only when the figure read back afterwards matches the user's
+    file total; otherwise (the write was lost, or files changed meanwhile) it is "unresolved".
+    """
+    if not run.job.get("params", {}).get("fix_discrepancies"):
+        return
+    job_id = run.job["id"]
+    workers = asyncio.Semaphore(QUOTA_RECONCILE_WORKERS)
+    
+    async def fix(item: dict) -> str:
+        async with workers:
+            try:
+                await get_user_storage_usage(item["user_id"])
+                user = await db.users.find_one({"id": item["user_id"]}, {"_id": 0, "storage_file_bytes": 1})
+                file_bytes = (await _file_bytes_by_owner(item["user_id"])).get(item["user_id"], 0)
+                recorded = (user or {}).get("storage_file_bytes")
+                update = {"status": "fixed" if recorded == file_bytes else "unresolved", "fixed_bytes": recorded, "file_bytes_after": file_bytes}
+            except Exception as e:
+                logging.warning(f"[quota_reconciliation] Fix failed for user {item['user_id']}: {e}")
+                update = {"status": "error", "error": str(e)}
+            update["updated_at"] = datetime.now(timezone.utc).isoformat()
+            await db.quota_reconciliation_items.update_one({"id": item["id"]}, {"$set": update})
+            return update["status"]
+    
+    while True:
+        batch = await db.quota_reconciliation_items.find(
+            {"job_id": job_id, "status": "pending"}, {"_id": 0, "id": 1, "user_id": 1}
+        ).limit(QUOTA_RECONCILE_PAGE_SIZE).to_list(QUOTA_RECONCILE_PAGE_SIZE)
+        if not batch:
+            break
+        results = await asyncio.gather(*(fix(item) for item in batch))
+        await run.save(progress={
+            "fixed": results.count("fixed"),
+            "unresolved": results.count("unresolved"),
+            "fix_errors": results.count("error")
+        })
+
+
+JOB_PHASES: Dict[str, List[Tuple[str, Any]]] = {
+    "workspace_deletion": [
+        ("announce", _workspace_deletion_announce),
+        ("files", _workspace_deletion_files),
+        ("documents", _workspace_deletion_documents),
+    ],
+    "user_deletion": [
+        ("memberships", _user_deletion_memberships),
+        ("workspaces", _user_deletion_workspaces),
+        ("records", _user_deletion_records),
+    ],
+    "quota_reconciliation": [
+        ("compare", _quota_reconciliation_compare),
+        ("fix", _quota_reconciliation_fix),
+    ],
+}
+
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """Progress of a background job. Visible to the user who started it and to admins."""
+    job = await db.jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job or (job["requested_by"] != current_user.id and current_user.role != UserRole.ADMIN):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_view(job)
+
+
+# ==========================================
+# TASK QUEUE
+# ==========================================
+# Short deferred side effects (emails, webhook processing, fan-out) are tasks in db.tasks
+# instead of FastAPI BackgroundTasks, so they survive restarts. A worker claims a task
+# atomically, which hides it for its visibility timeout; a task whose worker died becomes
+# claimable again when that runs out. Failures retry with exponential backoff until
+# max_attempts, then the task is dead-lettered (status "dead") for an admin to inspect
+# or retry. Handlers must be idempotent: a task can run more than once.
+
+class TaskStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    DEAD = "dead"
+
+TASK_QUEUE_CONCURRENCY: Dict[str, int] = {"email": 2, "paypal": 4}  # Concurrent tasks per process; every queue here is polled
+TASK_PRIORITY_HIGH = 10
+TASK_PRIORITY_NORMAL = 0
+TASK_MAX_ATTEMPTS = 6
+TASK_VISIBILITY_TIMEOUT_SECONDS = 300
+TASK_BACKOFF_BASE_SECONDS = 15
+TASK_BACKOFF_MAX_SECONDS = 3600
+TASK_POLL_SECONDS = 5
+TASK_RETENTION_DAYS = 7  # Succeeded tasks are pruned after this
+TASK_DEAD_RETENTION_DAYS = 30  # Dead tasks stay this long for inspection or an admin retry
+
+_task_wakeups: Dict[str, asyncio.Event] = {}
+
+
+def _task_wakeup(queue: str) -> asyncio.Event:
+    if queue not in _task_wakeups:
+        _task_wakeups[queue] = asyncio.Event()
+    return _task_wakeups[queue]
+
+
+async def enqueue_task(
+    name: str,
+    payload: Dict[str, Any],
+    priority: int = TASK_PRIORITY_NORMAL,
+    delay_seconds: float = 0,
+    max_attempts: int = TASK_MAX_ATTEMPTS,
+    dedupe_key: Optional[str] = None
+) -> dict:
+    """
+    Queue a task for TASK_HANDLERS[name]. With a dedupe_key, a task still queued or running
+    under that key is returned instead of queueing a second one.
+    
+    Payloads carry ids only, never tokens or rendered email bodies: dead tasks keep theirs
+    for an admin retry. Handlers load whatever else they need when they run.
+    """
+    queue, _ = TASK_HANDLERS[name]
+    now = datetime.now(timezone.utc)
+    task = {
+        "id": str(uuid.uuid4()),
+        "queue": queue,
+        "name": name,
+        "payload": payload,
+        "priority": priority,
+        "status": TaskStatus.QUEUED,
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "visible_at": (now + timedelta(seconds=delay_seconds)).isoformat(),
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+    }
+    if dedupe_key:
+        task["dedupe_key"] = dedupe_key
+    try:
+        await db.tasks.insert_one(dict(task))
+    except DuplicateKeyError:
+        existing = await db.tasks.find_one({"dedupe_key": dedupe_key}, {"_id": 0})
+        if existing:
+            return existing
+        raise
+    _task_wakeup(queue).set()
+    return task
+
+
+def task_backoff_seconds(attempts: int) -> float:
+    """Delay before retry number `attempts` (1-based): doubling from TASK_BACKOFF_BASE_SECONDS, jittered, capped."""
+    delay = min(TASK_BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)), TASK_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.75, 1.0)
+
+
+async def claim_task(queue: str, worker_id: str) -> Optional[dict]:
+    """Atomically claim the highest-priority visible task of a queue, hiding it for the visibility timeout."""
+    now = datetime.now(timezone.utc)
+    return await db.tasks.find_one_and_update(
+        {
+            "queue": queue,
+            "status": {"$in": [TaskStatus.QUEUED, TaskStatus.RUNNING]},
+            "visible_at": {"$lte": now.isoformat()},
+        },
+        {
+            "$set": {
+                "status": TaskStatus.RUNNING,
+                "claim_id": str(uuid.uuid4()),
+                "claimed_by": worker_id,
+                "visible_at": (now + timedelta(seconds=TASK_VISIBILITY_TIMEOUT_SECONDS)).isoformat(),
+                "updated_at": now.isoformat(),
+            },
+            "$inc": {"attempts": 1}
+        },
+        projection={"_id": 0},
+        sort=[("priority", DESCENDING), ("visible_at", ASCENDING)],
+        return_document=True
+    )
+
+
+async def _finish_task(task: dict, error: Optional[str]) -> None:
+    """Ack or fail a claimed task; a no-op if the claim expired and someone else holds it now."""
+    now = datetime.now(timezone.utc)
+    claim = {"id": task["id"], "claim_id": task["claim_id"]}
+    if error is None:
+        # The payload is not needed once the task has run
+        await db.tasks.update_one(claim, {
+            "$set": {"status": TaskStatus.SUCCEEDED, "completed_at": now.isoformat(), "updated_at": now.isoformat()},
+            "$unset": {"payload": "", "dedupe_key": "", "claim_id": ""}
+        })
+    elif task["attempts"] >= task["max_attempts"]:
+        await db.tasks.update_one(claim, {
+            "$set": {"status": TaskStatus.DEAD, "last_error": error, "dead_at": now.isoformat(), "updated_at": now.isoformat()},
+            "$unset": {"dedupe_key": "", "claim_id": ""}
+        })
+        logging.error(f"[tasks] {task['name']} task {task['id']} dead-lettered after {task['attempts']} attempts: {error}")
+    else:
+        retry_at = now + timedelta(seconds=task_backoff_seconds(task["attempts"]))
+        await db.tasks.update_one(claim, {
+            "$set": {"status": TaskStatus.QUEUED, "last_error": error, "visible_at": retry_at.isoformat(), "updated_at": now.isoformat()},
+            "$unset": {"claim_id": ""}
+        })
+        logging.warning(f"[tasks] {task['name']} task {task['id']} failed (attempt {task['attempts']}), retrying at {retry_at.isoformat()}: {error}")
+
+
+async def run_task(task: dict) -> None:
+    """Run one claimed task, extending its visibility while the handler is still working."""
+    _, handler = TASK_HANDLERS.get(task["name"], (None, None))
+    if handler is None:
+        await _finish_task({**task, "attempts": task["max_attempts"]}, f"No handler for task {task['name']}")
+        return
+    
+    async def keep_hidden():
+        while True:
+            await asyncio.sleep(TASK_VISIBILITY_TIMEOUT_SECONDS / 3)
+            visible_at = (datetime.now(timezone.utc) + timedelta(seconds=TASK_VISIBILITY_TIMEOUT_SECONDS)).isoformat()
+            await db.tasks.update_one({"id": task["id"], "claim_id": task["claim_id"]}, {"$set": {"visible_at": visible_at}})
+    
+    heartbeat = asyncio.create_task(keep_hidden())
+    error = None
+    started = time.perf_counter()
+    try:
+        await handler(**task.get("payload", {}))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        heartbeat.cancel()
+    task_duration.observe(time.perf_counter() - started, task=task["name"], outcome="ok" if error is None else "error")
+    await _finish_task(task, error)
+
+
+class TaskWorker:
+    """In-process runner for one queue: `concurrency` loops that claim and run tasks."""
+    
+    def __init__(self, queue: str, concurrency: int):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.worker_id = f"{INSTANCE_ID}:{queue}"
+        self._loops: List[asyncio.Task] = []
+    
+    def start(self) -> None:
+        self._loops = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+    
+    async def stop(self) -> None:
+        # Tasks cut off here become claimable again once their visibility timeout passes
+        for loop in self._loops:
+            loop.cancel()
+        self._loops = []
+    
+    async def _loop(self) -> None:
+        wakeup = _task_wakeup(self.queue)
+        while True:
+            try:
+                task = await claim_task(self.queue, self.worker_id)
+                if task:
+                    await run_task(task)
+                    continue
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=TASK_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"[tasks] {self.queue} worker error: {e}", exc_info=True)
+                await asyncio.sleep(TASK_POLL_SECONDS)
+
+
+task_workers = [TaskWorker(queue, concurrency) for queue, concurrency in TASK_QUEUE_CONCURRENCY.items()]
+
+
+async def prune_tasks() -> None:
+    """Delete succeeded tasks older than TASK_RETENTION_DAYS and dead ones older than TASK_DEAD_RETENTION_DAYS."""
+    now = datetime.now(timezone.utc)
+    succeeded = await db.tasks.delete_many({
+        "status": TaskStatus.SUCCEEDED,
+        "completed_at": {"$lt": (now - timedelta(days=TASK_RETENTION_DAYS)).isoformat()}
+    })
+    dead = await db.tasks.delete_many({
+        "status": TaskStatus.DEAD,
+        "dead_at": {"$lt": (now - timedelta(days=TASK_DEAD_RETENTION_DAYS)).isoformat()}
+    })
+    if succeeded.deleted_count or dead.deleted_count:
+        logging.info(f"[tasks] Pruned {succeeded.deleted_count} succeeded and {dead.deleted_count} dead tasks")
+
+
+# ==========================================
+# EMAIL OUTBOX
+# ==========================================
+# Outgoing email is rendered once by the request that triggers it and stored in
+# db.email_outbox. A single "deliver_email_outbox" task (deduped cluster-wide) drains it:
+# it claims up to EMAIL_BATCH_SIZE due messages, sends them with one Resend batch call
+# over a pooled aiohttp session, and reschedules failures with backoff until
+# EMAIL_MAX_ATTEMPTS, after which a message is dead. Set EMAIL_SINK_PATH to write
+# deliveries to a local NDJSON file instead of Resend (load tests, local development).
+
+class EmailStatus(str, Enum):
+    QUEUED = "queued"
+    SENDING = "sending"
+    SENT = "sent"
+    DEAD = "dead"
+
+EMAIL_BATCH_SIZE = 100  # Resend batch endpoint limit
+EMAIL_RATE_PER_SECOND = float(os.environ.get('EMAIL_RATE_PER_SECOND', '2'))  # Resend API requests per second
+EMAIL_HTTP_TIMEOUT_SECONDS = 10
+EMAIL_MAX_ATTEMPTS = 6
+EMAIL_CLAIM_SECONDS = 300  # A message stuck in "sending" this long (crashed drain) is claimable again
+EMAIL_OUTBOX_SWEEP_SECONDS = 30
+EMAIL_RETENTION_DAYS = 7  # Sent messages are pruned after this
+EMAIL_DEAD_RETENTION_DAYS = 30  # Dead messages (bodies already cleared) are kept this long for inspection
+EMAIL_SINK_PATH = os.environ.get('EMAIL_SINK_PATH')
+EMAIL_RETRY_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+class ResendTransport:
+    """
+    Resend HTTP API over one long-lived pooled aiohttp session. Every request (single or
+    batch) takes a token from a per-process TokenBucket so sends stay under the API rate limit.
+    Returns (HTTP status, parsed JSON body); connection errors and timeouts propagate.
+    """
+    
+    name = "resend"
+    
+    def __init__(
+        self,
+        api_url: str = RESEND_API_URL,
+        api_key: Optional[str] = RESEND_API_KEY,
+        from_email: str = RESEND_FROM_EMAIL,
+        rate: float = EMAIL_RATE_PER_SECOND,
+        timeout: float = EMAIL_HTTP_TIMEOUT_SECONDS
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.api_key = api_key
+        self.from_email = from_email
+        self.bucket = TokenBucket(rate=rate, capacity=max(1, int(rate)))
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=10, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+    
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    def _payload(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "from": self.from_email,
+            "to": [message["to"]],
+            "subject": message["subject"],
+            "text": message["text"],
+            "html": message["html"]
+        }
+    
+    async def _post(self, url: str, body: Any, idempotency_key: Optional[str]) -> Tuple[int, Any]:
+        await self.bucket.acquire()
+        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        async with self._get_session().post(url, json=body, headers=headers) as response:
+            text = await response.text()
+            try:
+                data = json.loads(text) if text else {}
+            except ValueError:
+                data = {"raw_response": text}
+            return response.status, data
+    
+    async def send(self, message: Dict[str, Any], idempotency_key: Optional[str] = None) -> Tuple[int, Any]:
+        return await self._post(self.api_url, self._payload(message), idempotency_key)
+    
+    async def send_batch(self, messages: List[Dict[str, Any]], idempotency_key: Optional[str] = None) -> Tuple[int, Any]:
+        return await self._post(f"{self.api_url}/batch", [self._payload(message) for message in messages], idempotency_key)
+
+
+class SinkTransport:
+    """Stand-in for Resend that appends each message to an NDJSON file and always succeeds."""
+    
+    name = "sink"
+    
+    def __init__(self, path: str, from_email: str = RESEND_FROM_EMAIL):
+        self.path = path
+        self.from_email = from_email
+    
+    def _write(self, messages: List[Dict[str, Any]]) -> List[str]:
+        ids = [str(uuid.uuid4()) for _ in messages]
+        with open(self.path, "a", encoding="utf-8") as sink:
+            for sink_id, message in zip(ids, messages):
+                sink.write(json.dumps({"id": sink_id, "from": self.from_email, "to": message["to"], "subject": message["subject"],
+                                       "text": message["text"], "html": message["html"]}) + "\n")
+        return ids
+    
+    async def close(self) -> None:
+        return None
+    
+    async def send(self, message: Dict[str, Any], idempotency_key: Optional[str] = None) -> Tuple[int, Any]:
+        ids = await asyncio.to_thread(self._write, [message])
+        return 200, {"id": ids[0]}
+    
+    async def send_batch(self, messages: List[Dict[str, Any]], idempotency_key: Optional[str] = None) -> Tuple[int, Any]:
+        ids = await asyncio.to_thread(self._write, messages)
+        return 200, {"data": [{"id": sink_id} for sink_id in ids]}
+
+
+email_transport = SinkTransport(EMAIL_SINK_PATH) if EMAIL_SINK_PATH else ResendTransport()
+
+
+async def queue_email(message: Dict[str, str], category: str, priority: int = TASK_PRIORITY_NORMAL) -> str:
+    """Store a rendered message (see render_*_email) in the outbox and make sure a drain is queued."""
+    now = datetime.now(timezone.utc).isoformat()
+    email_id = str(uuid.uuid4())
+    await db.email_outbox.insert_one({
+        "id": email_id,
+        "category": category,
+        "to": message["to"],
+        "subject": message["subject"],
+        "text": message["text"],
+        "html": message["html"],
+        "priority": priority,
+        "status": EmailStatus.QUEUED,
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+        "updated_at": now,
+    })
+    logging.info(f"[EMAIL][QUEUED] email={message['to']} category={category} email_id={email_id}")
+    await enqueue_task("deliver_email_outbox", {}, priority=priority, dedupe_key="email-outbox")
+    return email_id
+
+
+def _email_due_query(now: str) -> Dict[str, Any]:
+    return {"$or": [
+        {"status": EmailStatus.QUEUED, "next_attempt_at": {"$lte": now}},
+        {"status": EmailStatus.SENDING, "claimed_until": {"$lt": now}},
+    ]}
+
+
+async def _claim_emails() -> List[dict]:
+    now = datetime.now(timezone.utc)
+    due = _email_due_query(now.isoformat())
+    candidates = await db.email_outbox.find(due, {"_id": 0, "id": 1}).sort(
+        [("priority", DESCENDING), ("created_at", ASCENDING)]
+    ).limit(EMAIL_BATCH_SIZE).to_list(EMAIL_BATCH_SIZE)
+    if not candidates:
+        return []
+    claim_id = str(uuid.uuid4())
+    await db.email_outbox.update_many(
+        {"$and": [{"id": {"$in": [candidate["id"] for candidate in candidates]}}, due]},
+        {
+            "$set": {
+                "status": EmailStatus.SENDING,
+                "claim_id": claim_id,
+                "claimed_until": (now + timedelta(seconds=EMAIL_CLAIM_SECONDS)).isoformat(),
+                "updated_at": now.isoformat(),
+            },
+            "$inc": {"attempts": 1}
+        }
+    )
+    return await db.email_outbox.find({"claim_id": claim_id}, {"_id": 0}).to_list(EMAIL_BATCH_SIZE)
+
+
+async def _email_sent(message: dict, provider_id: Optional[str]) -> None:
+    now = datetime.now(timezone.utc).isoformat()
+    # Bodies can carry verification/reset tokens; they are not needed once delivered
+    await db.email_outbox.update_one(
+        {"id": message["id"], "claim_id": message["claim_id"]},
+        {
+            "$set": {"status": EmailStatus.SENT, "provider_id": provider_id, "sent_at": now, "updated_at": now},
+            "$unset": {"text": "", "html": "", "claim_id": "", "claimed_until": "", "last_error": ""}
+        }
+    )
+    logging.info(f"[EMAIL][SUCCESS] email={message['to']} category={message['category']} provider_id={provider_id}")
+
+
+async def _email_failed(message: dict, error: str, permanent: bool = False) -> None:
+    now = datetime.now(timezone.utc)
+    claim = {"id": message["id"], "claim_id": message["claim_id"]}
+    if permanent or message["attempts"] >= EMAIL_MAX_ATTEMPTS:
+        # A dead message is never sent again, so its tokens need not outlive it either
+        await db.email_outbox.update_one(claim, {
+            "$set": {"status": EmailStatus.DEAD, "last_error": error, "dead_at": now.isoformat(), "updated_at": now.isoformat()},
+            "$unset": {"text": "", "html": "", "claim_id": "", "claimed_until": ""}
+        })
+        logging.error(f"[EMAIL][FAILED] email={message['to']} category={message['category']} attempts={message['attempts']} error={error}")
+        return
+    next_attempt_at = now + timedelta(seconds=task_backoff_seconds(message["attempts"]))
+    await db.email_outbox.update_one(claim, {
+        "$set": {"status": EmailStatus.QUEUED, "last_error": error, "next_attempt_at": next_attempt_at.isoformat(), "updated_at": now.isoformat()},
+        "$unset": {"claim_id": "", "claimed_until": ""}
+    })
+    logging.warning(f"[EMAIL][RETRY] email={message['to']} attempt={message['attempts']} error={error}")
+
+
+def _email_error(status_code: int, data: Any) -> str:
+    detail = data.get("message") if isinstance(data, dict) else None
+    return f"HTTP {status_code}: {detail or data}"
+
+
+async def _send_emails_individually(messages: List[dict]) -> None:
+    for message in messages:
+        try:
+            status_code, data = await email_transport.send(message, idempotency_key=f"email-{message['id']}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await _email_failed(message, f"{type(e).__name__}: {e}")
+            continue
+        if status_code == 200:
+            await _email_sent(message, (data or {}).get("id"))
+        else:
+            await _email_failed(message, _email_error(status_code, data), permanent=status_code not in EMAIL_RETRY_STATUSES)
+
+
+async def _deliver_emails(messages: List[dict]) -> None:
+    """
+    Send one claimed batch. Resend validates a batch as a whole, so a batch rejected with a
+    client error is resent message by message to isolate the bad address.
+    """
+    if len(messages) == 1:
+        await _send_emails_individually(messages)
+        return
+    batch_key = "email-batch-" + hashlib.sha256("|".join(message["id"] for message in messages).encode()).hexdigest()
+    try:
+        status_code, data = await email_transport.send_batch(messages, idempotency_key=batch_key)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        for message in messages:
+            await _email_failed(message, f"{type(e).__name__}: {e}")
+        return
+    if status_code == 200:
+        results = (data or {}).get("data") or []
+        for index, message in enumerate(messages):
+            await _email_sent(message, results[index].get("id") if index < len(results) else None)
+    elif status_code in EMAIL_RETRY_STATUSES:
+        for message in messages:
+            await _email_failed(message, _email_error(status_code, data))
+    else:
+        logging.warning(f"[EMAIL] Batch of {len(messages)} rejected ({_email_error(status_code, data)}), sending individually")
+        await _send_emails_individually(messages)
+
+
+async def deliver_email_outbox() -> None:
+    """Task handler: drain due outbox messages batch by batch until none are left."""
+    while True:
+        messages = await _claim_emails()
+        if not messages:
+            return
+        await _deliver_emails(messages)
+
+
+async def sweep_email_outbox() -> None:
+    """Queue a drain when messages are due (retries whose backoff ran out), and prune old sent and dead messages."""
+    now = datetime.now(timezone.utc)
+    if await db.email_outbox.find_one(_email_due_query(now.isoformat()), {"_id": 0, "id": 1}):
+        await enqueue_task("deliver_email_outbox", {}, dedupe_key="email-outbox")
+    await db.email_outbox.delete_many({
+        "status": EmailStatus.SENT,
+        "sent_at": {"$lt": (now - timedelta(days=EMAIL_RETENTION_DAYS)).isoformat()}
+    })
+    await db.email_outbox.delete_many({
+        "status": EmailStatus.DEAD,
+        "dead_at": {"$lt": (now - timedelta(days=EMAIL_DEAD_RETENTION_DAYS)).isoformat()}
+    })
+
+
+# Task name -> (queue, async handler called with the task payload as keyword arguments)
+TASK_HANDLERS: Dict[str, Tuple[str, Any]] = {
+    "deliver_email_outbox": ("email", deliver_email_outbox),
+    "process_paypal_webhook_events": ("paypal", process_paypal_webhook_events),
+}
+
+
+@api_router.get("/admin/tasks")
+async def list_tasks(
+    queue: Optional[str] = Query(None),
+    status: Optional[TaskStatus] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(require_admin)
+):
+    """
+    Task counts per queue and status (with the oldest queued task's age), plus the most
+    recently updated tasks matching the filters. Payloads are not returned.
+    Admin-only endpoint.
+    """
+    match: Dict[str, Any] = {}
+    if queue:
+        match["queue"] = queue
+    if status:
+        match["status"] = status.value
+    counts_pipeline = [
+        {"$match": {"queue": queue} if queue else {}},
+        {"$group": {"_id": {"queue": "$queue", "status": "$status"}, "count": {"$sum": 1}, "oldest": {"$min": "$created_at"}}},
+    ]
+    counts: Dict[str, Dict[str, Any]] = {}
+    now = datetime.now(timezone.utc)
+    async for row in db.tasks.aggregate(counts_pipeline):
+        queue_counts = counts.setdefault(row["_id"]["queue"], {})
+        queue_counts[row["_id"]["status"]] = row["count"]
+        if row["_id"]["status"] == TaskStatus.QUEUED and row.get("oldest"):
+            queue_counts["oldest_queued_seconds"] = int((now - datetime.fromisoformat(row["oldest"])).total_seconds())
+    tasks = await db.tasks.find(match, {"_id": 0, "payload": 0}).sort("updated_at", DESCENDING).limit(limit).to_list(limit)
+    return {"queues": counts, "tasks": tasks}
+
+
+@api_router.post("/admin/tasks/{task_id}/retry")
+async def retry_task(task_id: str, current_user: User = Depends(require_admin)):
+    """Requeue a dead-lettered task with a fresh attempt budget. Admin-only endpoint."""
+    now = datetime.now(timezone.utc).isoformat()
+    result = await db.tasks.update_one(
+        {"id": task_id, "status": TaskStatus.DEAD},
+        {"$set": {"status": TaskStatus.QUEUED, "attempts": 0, "visible_at": now, "updated_at": now}, "$unset": {"dead_at": ""}}
+    )
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Dead task not found")
+    task = await db.tasks.find_one({"id": task_id}, {"_id": 0, "queue": 1})
+    _task_wakeup(task["queue"]).set()
+    logging.info(f"[ADMIN] User {current_user.id} requeued task {task_id}")
+    return {"success": True, "task_id": task_id}
+
+
+async def ensure_task_indexes():
+    """Claim order per queue, unique active dedupe keys and pruning."""
+    try:
+        await db.tasks.create_index([("id", ASCENDING)], unique=True, name="task_id_unique")
+        await db.tasks.create_index(
+            [("queue", ASCENDING), ("status", ASCENDING), ("priority", DESCENDING), ("visible_at", ASCENDING)],
+            name="task_claim"
+        )
+        await db.tasks.create_index([("dedupe_key", ASCENDING)], unique=True, sparse=True, name="task_dedupe_key_unique")
+        await db.tasks.create_index([("status", ASCENDING), ("completed_at", ASCENDING)], name="task_status_completed")
+        await db.tasks.create_index([("status", ASCENDING), ("dead_at", ASCENDING)], name="task_status_dead")
+        await db.tasks.create_index([("updated_at", DESCENDING)], name="task_updated_at")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create task indexes: {e}", exc_info=True)
+        return False
+
+
+async def ensure_paypal_webhook_indexes():
+    """Composite idempotency key for the webhook inbox and processed events, plus per-subscription pending lookups."""
+    try:
+        await db.paypal_webhook_events.create_index(
+            [("paypal_event_id", ASCENDING), ("transmission_time", ASCENDING)],
+            unique=True, name="paypal_webhook_event_key_unique"
+        )
+        await db.paypal_webhook_events.create_index(
+            [("paypal_subscription_id", ASCENDING), ("status", ASCENDING), ("transmission_time", ASCENDING)],
+            name="paypal_webhook_subscription_status"
+        )
+        await db.paypal_webhook_events.create_index([("status", ASCENDING), ("received_at", ASCENDING)], name="paypal_webhook_status_received")
+        await db.paypal_webhook_events.create_index([("status", ASCENDING), ("updated_at", ASCENDING)], name="paypal_webhook_status_updated")
+        await db.processed_webhook_events.create_index(
+            [("paypal_event_id", ASCENDING), ("transmission_time", ASCENDING)],
+            unique=True, name="processed_webhook_event_key_unique"
+        )
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create PayPal webhook indexes: {e}", exc_info=True)
+        return False
+
+
+async def ensure_email_outbox_indexes():
+    """Due-message claim order and retention pruning for the email outbox."""
+    try:
+        await db.email_outbox.create_index([("id", ASCENDING)], unique=True, name="email_outbox_id_unique")
+        await db.email_outbox.create_index(
+            [("status", ASCENDING), ("next_attempt_at", ASCENDING), ("priority", DESCENDING), ("created_at", ASCENDING)],
+            name="email_outbox_due"
+        )
+        await db.email_outbox.create_index([("claim_id", ASCENDING)], sparse=True, name="email_outbox_claim")
+        await db.email_outbox.create_index([("status", ASCENDING), ("sent_at", ASCENDING)], name="email_outbox_status_sent")
+        await db.email_outbox.create_index([("status", ASCENDING), ("dead_at", ASCENDING)], name="email_outbox_status_dead")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create email outbox indexes: {e}", exc_info=True)
+        return False
+
+
+async def ensure_extension_indexes():
+    """Change log order for extension index refresh, target lookups that rebuild indexes, and binding-token validation."""
+    try:
+        await db.extension_changes.create_index([("seq", ASCENDING)], unique=True, name="extension_change_seq_unique")
+        await db.extension_changes.create_index([("workspace_id", ASCENDING), ("seq", ASCENDING)], name="extension_change_workspace_seq")
+        await db.extension_changes.create_index([("at", ASCENDING)], name="extension_change_at")
+        await db.workspace_binding_tokens.create_index(
+            [("token_hash", ASCENDING), ("revoked_at", ASCENDING), ("created_at", DESCENDING)],
+            name="binding_token_hash_revoked_created"
+        )
+        await db.extension_targets.create_index([("id", ASCENDING)], name="extension_target_id")
+        await db.extension_targets.create_index([("workspace_id", ASCENDING), ("status", ASCENDING)], name="extension_target_workspace_status")
+        await db.extension_targets.create_index(
+            [("workspace_id", ASCENDING), ("walkthrough_id", ASCENDING), ("status", ASCENDING)],
+            name="extension_target_walkthrough_status"
+        )
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create extension indexes: {e}", exc_info=True)
+        return False
+
+
+async def ensure_job_indexes():
+    """
+    Ensure indexes for background jobs.
+    active_key is unique while set (sparse), which makes job submission idempotent.
+    Idempotent: create_index is a no-op when the index already exists.
+    """
+    try:
+        await db.jobs.create_index([("id", ASCENDING)], unique=True, name="job_id_unique")
+        await db.jobs.create_index([("active_key", ASCENDING)], unique=True, sparse=True, name="job_active_key_unique")
+        await db.jobs.create_index([("status", ASCENDING), ("lease_expires_at", ASCENDING)], name="job_status_lease")
+        await db.quota_reconciliation_items.create_index([("id", ASCENDING)], unique=True, name="quota_item_id_unique")
+        await db.quota_reconciliation_items.create_index([("job_id", ASCENDING), ("status", ASCENDING)], name="quota_item_job_status")
+        await db.quota_reconciliation_items.create_index([("job_id", ASCENDING), ("user_id", ASCENDING)], name="quota_item_job_user")
+        logging.info("[startup] Job indexes ensured")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create job indexes: {e}", exc_info=True)
+        return False
+
+async def ensure_user_listing_indexes():
+    """
+    Indexes behind the admin user listing: keyset order, email prefix and name text search,
+    and the plan/subscription $lookup joins.
+    """
+    try:
+        await db.users.create_index([("created_at", DESCENDING), ("id", DESCENDING)], name="users_created_at_id")
+        await db.users.create_index([("email", ASCENDING)], name="users_email")
+        await db.plans.create_index([("id", ASCENDING)], name="plans_id")
+        await db.subscriptions.create_index([("id", ASCENDING)], name="subscriptions_id")
+        await db.users.create_index([("name", "text")], name="users_name_text")
+        logging.info("[startup] User listing indexes ensured")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create user listing indexes: {e}", exc_info=True)
+        return False
+
+async def ensure_export_indexes():
+    """Indexes that keep filtered exports walking in id order instead of sorting in memory."""
+    try:
+        await db.users.create_index([("id", ASCENDING)], name="users_id")
+        await db.workspace_members.create_index([("user_id", ASCENDING), ("id", ASCENDING)], name="members_user_id_id")
+        await db.workspace_members.create_index([("workspace_id", ASCENDING), ("id", ASCENDING)], name="members_workspace_id_id")
+        await db.paypal_audit_logs.create_index([("subscription_id", ASCENDING), ("id", ASCENDING)], name="paypal_audit_subscription_id_id")
+        await db.feedback.create_index([("workspace_id", ASCENDING), ("id", ASCENDING)], name="feedback_workspace_id_id")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create export indexes: {e}", exc_info=True)
+        return False
+
+async def ensure_reconciliation_indexes():
+    """Indexes behind the reconciliation tiers' keyset scans and the run history."""
+    try:
+        await db.subscriptions.create_index([("provider", ASCENDING), ("id", ASCENDING)], name="subscriptions_provider_id")
+        await db.reconciliation_runs.create_index([("id", ASCENDING)], unique=True, name="reconciliation_run_id_unique")
+        await db.reconciliation_runs.create_index([("status", ASCENDING), ("started_at", DESCENDING)], name="reconciliation_run_status_started")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create reconciliation indexes: {e}", exc_info=True)
+        return False
+
+async def ensure_scheduler_indexes():
+    """Unique lease names make concurrent first acquisitions race safely."""
+    try:
+        await db.leases.create_index([("id", ASCENDING)], unique=True, name="lease_id_unique")
+        await db.scheduled_jobs.create_index([("id", ASCENDING)], unique=True, name="scheduled_job_id_unique")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create scheduler indexes: {e}", exc_info=True)
+        return False
+
+async def ensure_admin_stats_indexes():
+    """Indexes for admin statistics snapshots."""
+    try:
+        await db.admin_stats_snapshots.create_index([("id", ASCENDING)], unique=True, name="admin_stats_snapshot_id_unique")
+        await db.admin_stats_snapshots.create_index([("captured_at", ASCENDING)], name="admin_stats_snapshot_captured_at")
+        return True
+    except Exception as e:
+        logging.error(f"[startup] Failed to create admin stats indexes: {e}", exc_info=True)
+        return False
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize default plans and ensure workspace lock index on startup."""
     await initialize_default_plans()
     
-    # Start scheduled reconciliation job in background
-    import asyncio
-    asyncio.create_task(scheduled_reconciliation_job())
-    
     # CRITICAL: Ensure unique index exists for workspace locks
     # This provides database-level enforcement of lock uniqueness
     index_created = await ensure_workspace_lock_index()
@@ -11736,14 +16617,55 @@ async def startup_event():
     # This is a one-time operation - duplicates cannot exist after index is created
     if index_created:
         await cleanup_duplicate_workspace_locks()
+    await ensure_upload_session_indexes()
+    await ensure_media_blob_indexes()
+    await ensure_job_indexes()
+    await ensure_media_reference_indexes()
+    await ensure_user_listing_indexes()
+    await ensure_admin_stats_indexes()
+    await ensure_export_indexes()
+    await ensure_reconciliation_indexes()
+    await ensure_scheduler_indexes()
+    await ensure_task_indexes()
+    await ensure_paypal_webhook_indexes()
+    await ensure_email_outbox_indexes()
+    await ensure_extension_indexes()
     logging.info("Default plans initialized")
     
+    # Start queued deletion jobs and resume jobs interrupted by a restart
+    asyncio.create_task(job_watchdog())
+    if METRICS_MULTIPROC_DIR:
+        asyncio.create_task(metrics_flush_loop())
+    for worker in task_workers:
+        worker.start()
+    
+    # Periodic jobs run once per cluster, on the scheduler lease holder
+    cluster_scheduler.register("subscription_reconciliation", scheduled_reconciliation_job, daily_at(3))
+    cluster_scheduler.register("media_gc", scheduled_media_gc_job, every(MEDIA_GC_INTERVAL_HOURS * 3600))
+    if ADMIN_STATS_SNAPSHOT_INTERVAL_MINUTES > 0:
+        cluster_scheduler.register("admin_stats_snapshot", admin_stats_snapshot_job, aligned_every(ADMIN_STATS_SNAPSHOT_INTERVAL_MINUTES * 60))
+    cluster_scheduler.register("task_prune", prune_tasks, every(3600))
+    cluster_scheduler.register("paypal_webhook_sweep", sweep_paypal_webhook_events, every(PAYPAL_WEBHOOK_SWEEP_SECONDS))
+    cluster_scheduler.register("email_outbox_sweep", sweep_email_outbox, every(EMAIL_OUTBOX_SWEEP_SECONDS))
+    cluster_scheduler.register("extension_change_prune", prune_extension_changes, every(3600))
+    cluster_scheduler.register("file_deletion_retry", retry_file_deletions, every(FILE_DELETION_RETRY_MINUTES * 60))
+    if UPLOAD_CHUNK_DIR:
+        cluster_scheduler.register("upload_chunk_sweep", sweep_upload_chunk_dir, every(UPLOAD_CHUNK_SWEEP_SECONDS))
+    cluster_scheduler.start()
+    
     # SECURITY: Verify critical invariants at startup
     await verify_security_invariants()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await cluster_scheduler.stop()
+    for worker in task_workers:
+        await worker.stop()
     client.close()
+    await storage_provider.close()
+    await paypal_client.close()
+    await email_transport.close()
+    await metrics.flush()
 
 # Include router at the END, after all routes are defined
 # This ensures all routes (including admin routes) are registered
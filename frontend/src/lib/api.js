@@ -90,7 +90,6 @@ export const api = {
     });
     
     const formData = new FormData();
-    formData.append('file', file);
     
     // CRITICAL: Move all metadata to FormData body, NOT headers
     // Headers cannot contain Unicode characters (ISO-8859-1 only)
@@ -108,6 +107,9 @@ export const api = {
     if (options.referenceId) {
       formData.append('reference_id', options.referenceId);
     }
+    // File goes LAST: the backend streams the body and enforces plan/quota limits
+    // while the file arrives, which requires the metadata fields to come first
+    formData.append('file', file);
     
     // Only set Content-Type header - let browser set it with boundary for multipart/form-data
     const headers = {};
@@ -210,8 +212,9 @@ export const api = {
   
   // Admin endpoints
   // Users
-  adminListUsers: (page = 1, limit = 50, search = null) => {
-    const params = { page, limit };
+  adminListUsers: (cursor = null, limit = 50, search = null) => {
+    const params = { limit };
+    if (cursor) params.cursor = cursor;
     if (search) params.search = search;
     return apiClient.get(`/admin/users`, { params });
   },
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useCallback } from 'react';
+import React, { useState, useEffect, useCallback, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useTranslation } from 'react-i18next';
 import { Users, Database, BarChart3, Edit, Trash2, Crown, HardDrive, FileText, FolderOpen, Ban, CheckCircle, ArrowDown, ArrowUp, Clock, Settings, MoreVertical, RotateCcw, Lock, Calendar, Send, AlertCircle } from 'lucide-react';
@@ -30,6 +30,8 @@ const AdminDashboardPage = () => {
   const [usersLimit] = useState(50);
   const [usersTotal, setUsersTotal] = useState(0);
   const [usersSearch, setUsersSearch] = useState('');
+  // Keyset pagination: usersCursors.current[n] is the cursor that loads page n + 1
+  const usersCursors = useRef([null]);
   const [selectedUser, setSelectedUser] = useState(null);
   const [editDialogOpen, setEditDialogOpen] = useState(false);
   const [subscriptionDialogOpen, setSubscriptionDialogOpen] = useState(false);
@@ -86,7 +88,9 @@ const AdminDashboardPage = () => {
   const fetchUsers = useCallback(async () => {
     try {
       setUsersLoading(true);
-      const response = await api.adminListUsers(usersPage, usersLimit, usersSearch || null);
+      const response = await api.adminListUsers(usersCursors.current[usersPage - 1] || null, usersLimit, usersSearch || null);
+      usersCursors.current = usersCursors.current.slice(0, usersPage);
+      usersCursors.current[usersPage] = response.data.next_cursor || null;
       setUsers(response.data.users || []);
       setUsersTotal(response.data.total || 0);
     } catch (error) {
@@ -671,6 +675,7 @@ const AdminDashboardPage = () => {
                       value={usersSearch}
                       onChange={(e) => {
                         setUsersSearch(e.target.value);
+                        usersCursors.current = [null];
                         setUsersPage(1);
                       }}
                       className="w-full"
@@ -998,7 +1003,7 @@ const AdminDashboardPage = () => {
                         <Button
                           variant="outline"
                           size="sm"
-                          disabled={usersPage * usersLimit >= usersTotal}
+                          disabled={!usersCursors.current[usersPage]}
                           onClick={() => setUsersPage(p => p + 1)}
                         >
                           Next
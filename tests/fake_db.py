@@ -0,0 +1,92 @@
+"""
+In-memory MongoDB (mongomock-motor) swapped in for server.db, for tests that run server code
+against real collection semantics.
+"""
+
+from types import SimpleNamespace
+
+import mongomock.collection
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+
+import server
+
+_find_one_and_update = mongomock.collection.Collection.find_one_and_update
+
+
+def _project(doc, projection):
+    if doc is None or not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = [field for field, value in projection.items() if value and field != "_id"]
+    if include:
+        kept = {field: doc[field] for field in include if field in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            kept["_id"] = doc["_id"]
+        return kept
+    return {field: value for field, value in doc.items() if field not in projection}
+
+
+def _find_one_and_update_projected(self, filter, update, projection=None, **kwargs):
+    # mongomock re-reads the updated document by _id only when the projection keeps _id;
+    # otherwise it re-runs the original filter, which misses once the update changed a
+    # filtered field. Read it whole and project afterwards.
+    return _project(_find_one_and_update(self, filter, update, **kwargs), projection)
+
+
+def _bulk_write(self, requests, ordered=True, **kwargs):
+    # mongomock's bulk_write passes newer pymongo operation arguments (sort) it does not accept;
+    # apply the operations one by one instead.
+    counts = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0, "upserted_count": 0}
+    for request in requests:
+        if isinstance(request, InsertOne):
+            self.insert_one(request._doc)
+            counts["inserted_count"] += 1
+        elif isinstance(request, (UpdateOne, UpdateMany)):
+            update = self.update_one if isinstance(request, UpdateOne) else self.update_many
+            result = update(request._filter, request._doc, upsert=bool(request._upsert))
+            counts["matched_count"] += result.matched_count
+            counts["modified_count"] += result.modified_count
+            counts["upserted_count"] += int(result.upserted_id is not None)
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            delete = self.delete_one if isinstance(request, DeleteOne) else self.delete_many
+            counts["deleted_count"] += delete(request._filter).deleted_count
+        else:
+            raise NotImplementedError(type(request).__name__)
+    return SimpleNamespace(acknowledged=True, **counts)
+
+
+def use_fake_db(monkeypatch):
+    """Point server.db at a fresh in-memory database and return it."""
+    monkeypatch.setattr(mongomock.collection.Collection, "find_one_and_update", _find_one_and_update_projected)
+    monkeypatch.setattr(mongomock.collection.Collection, "bulk_write", _bulk_write)
+    database = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+async def seed_workspace_owner(database, user_id="owner-1", workspace_id="ws-1"):
+    """An admin on the Pro plan owning one workspace (enough for authenticated routes)."""
+    await server.initialize_default_plans()
+    await database.users.insert_one({
+        "id": user_id, "email": f"{user_id}@example.com", "name": "Owner", "plan_id": "plan_pro",
+        "email_verified": True, "role": "admin", "created_at": "2024-01-01T00:00:00+00:00"
+    })
+    await database.subscriptions.insert_one({
+        "id": f"sub-{user_id}", "user_id": user_id, "plan_id": "plan_pro", "status": "active", "provider": "manual",
+        "started_at": "2024-01-01T00:00:00+00:00", "created_at": "2024-01-01T00:00:00+00:00",
+        "updated_at": "2024-01-01T00:00:00+00:00"
+    })
+    await database.workspaces.insert_one({
+        "id": workspace_id, "name": "Workspace", "slug": workspace_id, "owner_id": user_id,
+        "created_at": "2024-01-01T00:00:00+00:00"
+    })
+
+
+def authenticate(client, user_id="owner-1"):
+    """Give a TestClient the auth cookie and CSRF header of user_id."""
+    token, csrf_token = server.create_token(user_id)
+    client.cookies.set(server.AUTH_COOKIE_NAME, token)
+    client.headers[server.CSRF_HEADER_NAME] = csrf_token
+    return client
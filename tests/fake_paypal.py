@@ -0,0 +1,96 @@
+"""
+Local stand-in for the PayPal REST API, served by aiohttp on 127.0.0.1 for client tests.
+"""
+
+from aiohttp import web
+
+
+class FakePayPal:
+    """Issues OAuth tokens, serves subscriptions and webhook verification, and injects failures."""
+
+    def __init__(self, expires_in=32400):
+        self.expires_in = expires_in
+        self.token_requests = 0
+        self.requests = []  # (method, path, headers) of every API call
+        self.fail_next = []  # statuses returned (in order) before handling normally
+        self.revoked_tokens = set()
+        self.subscriptions = {}
+        self.base_url = None
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/oauth2/token", self._token)
+        app.router.add_get("/v1/billing/subscriptions/{subscription_id}", self._get_subscription)
+        app.router.add_post("/v1/billing/subscriptions/{subscription_id}/cancel", self._cancel_subscription)
+        app.router.add_post("/v1/notifications/verify-webhook-signature", self._verify_signature)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def _injected_failure(self):
+        if self.fail_next:
+            return web.json_response({"name": "INTERNAL_SERVICE_ERROR"}, status=self.fail_next.pop(0))
+        return None
+
+    def _authorized(self, request):
+        auth = request.headers.get("Authorization", "")
+        return auth.startswith("Bearer fake-token-") and auth[len("Bearer "):] not in self.revoked_tokens
+
+    async def _token(self, request):
+        failure = self._injected_failure()
+        if failure:
+            return failure
+        form = await request.post()
+        if form.get("grant_type") != "client_credentials" or not request.headers.get("Authorization", "").startswith("Basic "):
+            return web.json_response({"error": "invalid_client"}, status=401)
+        self.token_requests += 1
+        return web.json_response({
+            "access_token": f"fake-token-{self.token_requests}",
+            "token_type": "Bearer",
+            "expires_in": self.expires_in,
+        })
+
+    async def _api_call(self, request):
+        self.requests.append((request.method, request.path, dict(request.headers)))
+        failure = self._injected_failure()
+        if failure:
+            return failure
+        if not self._authorized(request):
+            return web.json_response({"error": "invalid_token"}, status=401)
+        return None
+
+    async def _get_subscription(self, request):
+        rejection = await self._api_call(request)
+        if rejection:
+            return rejection
+        subscription = self.subscriptions.get(request.match_info["subscription_id"])
+        if not subscription:
+            return web.json_response({"name": "RESOURCE_NOT_FOUND"}, status=404)
+        return web.json_response(subscription)
+
+    async def _cancel_subscription(self, request):
+        rejection = await self._api_call(request)
+        if rejection:
+            return rejection
+        subscription = self.subscriptions.get(request.match_info["subscription_id"])
+        if not subscription:
+            return web.json_response({"name": "RESOURCE_NOT_FOUND"}, status=404)
+        subscription["status"] = "CANCELLED"
+        return web.Response(status=204)
+
+    async def _verify_signature(self, request):
+        rejection = await self._api_call(request)
+        if rejection:
+            return rejection
+        payload = await request.json()
+        status = "SUCCESS" if payload.get("transmission_sig") == "valid" else "FAILURE"
+        return web.json_response({"verification_status": status})
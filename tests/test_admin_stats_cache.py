@@ -0,0 +1,77 @@
+"""
+Admin stats cache tests: TTL, stale-while-revalidate and single-flight computation.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from server import StaleWhileRevalidateCache
+
+
+def _counting_compute():
+    calls = {"count": 0}
+
+    async def compute():
+        calls["count"] += 1
+        await asyncio.sleep(0.01)
+        return {"value": calls["count"]}
+
+    return compute, calls
+
+
+class TestStaleWhileRevalidateCache:
+
+    def test_concurrent_cold_callers_share_one_computation(self):
+        cache = StaleWhileRevalidateCache(ttl_seconds=60, max_stale_seconds=600)
+        compute, calls = _counting_compute()
+
+        async def scenario():
+            results = await asyncio.gather(*(cache.get(compute) for _ in range(5)))
+            assert {value["value"] for value, _ in results} == {1}
+            assert calls["count"] == 1
+            value, _ = await cache.get(compute)
+            assert value["value"] == 1 and calls["count"] == 1
+
+        asyncio.run(scenario())
+
+    def test_stale_value_is_served_while_refreshing(self):
+        cache = StaleWhileRevalidateCache(ttl_seconds=0, max_stale_seconds=600)
+        compute, calls = _counting_compute()
+
+        async def scenario():
+            await cache.get(compute)
+            value, _ = await cache.get(compute)
+            assert value["value"] == 1  # stale value returned immediately
+            await asyncio.sleep(0.05)
+            value, _ = await cache.get(compute)
+            assert value["value"] == 2  # background refresh landed
+            assert calls["count"] >= 2
+
+        asyncio.run(scenario())
+
+    def test_force_and_expired_values_recompute(self):
+        cache = StaleWhileRevalidateCache(ttl_seconds=60, max_stale_seconds=0)
+        compute, calls = _counting_compute()
+
+        async def scenario():
+            await cache.get(compute)
+            value, _ = await cache.get(compute, force=True)
+            assert value["value"] == 2
+            cache.clear()
+            value, _ = await cache.get(compute)
+            assert value["value"] == 3
+
+        asyncio.run(scenario())
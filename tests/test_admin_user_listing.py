@@ -0,0 +1,152 @@
+"""
+Admin user listing tests: keyset cursors stay stable under created_at ties and inserts, and
+a search combined with a cursor builds an $and that keeps $text at the top level of its clause.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import User, decode_list_cursor, encode_list_cursor, list_users
+
+ADMIN = User(id="admin", email="admin@example.com", name="Admin", role="admin")
+TIE = "2024-01-01T00:00:00+00:00"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    return use_fake_db(monkeypatch)
+
+
+def _user(db, user_id, created_at):
+    user = {
+        "id": user_id, "email": f"{user_id}@example.com", "name": user_id,
+        # A fresh storage figure: no background refresh is scheduled
+        "storage_used_bytes": 0, "storage_computed_at": datetime.now(timezone.utc).isoformat()
+    }
+    if created_at is not None:
+        user["created_at"] = created_at
+    asyncio.run(db.users.insert_one(user))
+
+
+async def _resolved(value):
+    return value
+
+
+def _page(cursor=None, limit=2, search=None):
+    return asyncio.run(list_users(limit=limit, search=search, cursor=cursor, current_user=ADMIN))
+
+
+def _walk(limit=2):
+    seen, cursor = [], None
+    while True:
+        page = _page(cursor, limit)
+        seen.extend(user["id"] for user in page["users"])
+        if not page["has_more"]:
+            assert page["next_cursor"] is None
+            return seen
+        cursor = page["next_cursor"]
+
+
+class TestCursorStability:
+
+    def test_ties_on_created_at_are_broken_by_id(self, db):
+        for user_id in ("u-1", "u-2", "u-3", "u-4", "u-5"):
+            _user(db, user_id, TIE)
+        _user(db, "u-newest", "2025-01-01T00:00:00+00:00")
+        # Every user exactly once, newest first, ties by id descending
+        assert _walk() == ["u-newest", "u-5", "u-4", "u-3", "u-2", "u-1"]
+
+    def test_users_without_created_at_sort_last(self, db):
+        _user(db, "u-a", None)
+        _user(db, "u-b", None)
+        _user(db, "u-c", TIE)
+        _user(db, "u-d", TIE)
+        assert _walk(limit=1) == ["u-d", "u-c", "u-b", "u-a"]
+
+    def test_inserts_ahead_of_the_cursor_do_not_shift_pages(self, db):
+        for user_id in ("u-1", "u-2", "u-3", "u-4"):
+            _user(db, user_id, TIE)
+        first = _page()
+        assert [user["id"] for user in first["users"]] == ["u-4", "u-3"]
+
+        # Newer users, and a tie that sorts before the cursor, appear on no later page
+        _user(db, "u-new", "2025-01-01T00:00:00+00:00")
+        _user(db, "u-9", TIE)
+        second = _page(first["next_cursor"])
+        assert [user["id"] for user in second["users"]] == ["u-2", "u-1"]
+        assert second["has_more"] is False
+
+    def test_cursor_round_trip_and_rejects_garbage(self):
+        cursor = encode_list_cursor({"created_at": TIE, "id": "u-1"})
+        assert "=" not in cursor
+        assert decode_list_cursor(cursor) == {"created_at": TIE, "id": "u-1"}
+        for bad in ("not-base64!", encode_list_cursor([1, 2])):
+            with pytest.raises(server.HTTPException):
+                decode_list_cursor(bad)
+
+
+class TestSearchQueryShape:
+
+    @pytest.fixture
+    def pipelines(self, monkeypatch):
+        """Record list_users' pipelines ($text is not available in the in-memory database)."""
+        recorded = []
+
+        class Users:
+            def aggregate(self, pipeline):
+                recorded.append(pipeline)
+                return SimpleNamespace(to_list=lambda length: _resolved([]))
+
+            def count_documents(self, query):
+                return _resolved(0)
+
+            def estimated_document_count(self):
+                return _resolved(0)
+
+        monkeypatch.setattr(server, "db", SimpleNamespace(users=Users()))
+        return recorded
+
+    def test_search_with_cursor_is_an_and_of_search_and_keyset(self, pipelines):
+        cursor = encode_list_cursor({"created_at": TIE, "id": "u-3"})
+        _page(cursor, search="Alice")
+        match = pipelines[0][0]["$match"]
+
+        search_clause, keyset_clause = match["$and"]
+        assert search_clause == {"$or": [
+            {"email": {"$regex": "^Alice"}},
+            {"email": {"$regex": "^alice"}},
+            {"$text": {"$search": "Alice"}},
+        ]}
+        assert keyset_clause == {"$or": [
+            {"created_at": {"$lt": TIE}},
+            {"created_at": TIE, "id": {"$lt": "u-3"}},
+            {"created_at": None},
+        ]}
+        assert pipelines[0][1] == {"$sort": {"created_at": -1, "id": -1}}
+
+    def test_email_search_skips_text_and_cursor_alone_is_not_wrapped(self, pipelines):
+        _page(search="alice@")
+        assert pipelines[0][0]["$match"] == {"$or": [{"email": {"$regex": "^alice@"}}]}
+
+        _page(encode_list_cursor({"created_at": None, "id": "u-3"}))
+        assert pipelines[1][0]["$match"] == {"created_at": None, "id": {"$lt": "u-3"}}
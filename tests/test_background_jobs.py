@@ -0,0 +1,135 @@
+"""
+Durable job tests: claim, lease heartbeat, lease expiry takeover and resume from checkpoint.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import JobRun, run_job
+
+
+@pytest.fixture
+def db(monkeypatch):
+    return use_fake_db(monkeypatch)
+
+
+@pytest.fixture
+def phases(monkeypatch):
+    """A two-phase test job type; each phase records the checkpoint it started from."""
+    calls = []
+
+    async def first(run):
+        calls.append(("first", dict(run.checkpoint)))
+
+    async def second(run):
+        calls.append(("second", dict(run.checkpoint)))
+        await run.save(checkpoint={"page": run.checkpoint.get("page", 0) + 1}, progress={"items": 1})
+
+    monkeypatch.setitem(server.JOB_PHASES, "test_job", [("first", first), ("second", second)])
+    return calls
+
+
+def _insert_job(db, **fields):
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "id": "job-1", "type": "test_job", "target_id": "t-1", "requested_by": "admin", "params": {},
+        "status": "queued", "completed_phases": [], "checkpoint": {}, "progress": {},
+        "active_key": "test_job:t-1", "attempts": 0, "created_at": now, "updated_at": now,
+        **fields
+    }
+    asyncio.run(db.jobs.insert_one(job))
+
+
+def _lease(seconds):
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+
+def _job(db):
+    return asyncio.run(db.jobs.find_one({"id": "job-1"}, {"_id": 0}))
+
+
+class TestClaim:
+
+    def test_queued_job_runs_all_phases(self, db, phases):
+        _insert_job(db)
+        asyncio.run(run_job("job-1"))
+        job = _job(db)
+        assert job["status"] == "completed"
+        assert job["completed_phases"] == ["first", "second"]
+        assert job["attempts"] == 1
+        assert job["progress"] == {"items": 1}
+        assert "active_key" not in job and "lease_expires_at" not in job
+        assert [name for name, _ in phases] == ["first", "second"]
+
+    def test_live_lease_is_not_taken_over(self, db, phases):
+        _insert_job(db, status="running", lease_id="other", lease_expires_at=_lease(60), attempts=1)
+        asyncio.run(run_job("job-1"))
+        assert phases == []
+        assert _job(db)["lease_id"] == "other"
+
+    def test_finished_job_is_not_run_again(self, db, phases):
+        _insert_job(db, status="completed", completed_phases=["first", "second"])
+        asyncio.run(run_job("job-1"))
+        assert phases == []
+
+
+class TestLeaseExpiry:
+
+    def test_expired_lease_resumes_from_checkpoint(self, db, phases):
+        _insert_job(
+            db, status="running", lease_id="dead-worker", lease_expires_at=_lease(-1), attempts=1,
+            completed_phases=["first"], phase="second", checkpoint={"page": 4}
+        )
+        asyncio.run(run_job("job-1"))
+        # The completed phase is skipped and the interrupted one keeps its checkpoint
+        assert phases == [("second", {"page": 4})]
+        job = _job(db)
+        assert job["status"] == "completed"
+        assert job["attempts"] == 2
+        assert job["lease_id"] != "dead-worker"
+
+    def test_heartbeat_renews_lease_during_a_long_phase(self, db, monkeypatch):
+        monkeypatch.setattr(server, "JOB_LEASE_SECONDS", 0.3)
+        leases = []
+
+        async def slow(run):
+            for _ in range(2):
+                job = await db.jobs.find_one({"id": "job-1"})
+                leases.append(job["lease_expires_at"])
+                await asyncio.sleep(0.25)  # no save() in between
+
+        monkeypatch.setitem(server.JOB_PHASES, "test_job", [("slow", slow)])
+        _insert_job(db)
+        asyncio.run(run_job("job-1"))
+        assert leases[1] > leases[0]
+        assert _job(db)["status"] == "completed"
+
+    def test_stale_holder_cannot_write_after_takeover(self, db, phases):
+        _insert_job(db, status="running", lease_id="stale", lease_expires_at=_lease(-1), attempts=1, phase="second")
+        stale_run = JobRun(_job(db))
+        asyncio.run(run_job("job-1"))
+
+        asyncio.run(stale_run.save(checkpoint={"page": 99}, progress={"items": 10}))
+        job = _job(db)
+        assert job["progress"] == {"items": 1}
+        assert job["checkpoint"] == {}
+
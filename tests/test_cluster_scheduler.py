@@ -0,0 +1,212 @@
+"""
+Cluster scheduler tests: schedule helpers, job registration, leases with fencing tokens and
+leader takeover.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_db import use_fake_db
+from server import (
+    ClusterScheduler,
+    acquire_lease,
+    aligned_every,
+    daily_at,
+    ensure_scheduler_indexes,
+    every,
+    lease_is_held,
+    release_lease,
+)
+
+
+def _at(hour, minute=0, day=1):
+    return datetime(2026, 1, day, hour, minute, tzinfo=timezone.utc)
+
+
+class TestSchedules:
+
+    def test_daily_at_runs_later_today_or_tomorrow(self):
+        next_run = daily_at(3)
+        assert next_run(_at(2, 59)) == _at(3)
+        assert next_run(_at(3)) == _at(3, day=2)
+        assert next_run(_at(23)) == _at(3, day=2)
+
+    def test_every_counts_from_the_previous_finish(self):
+        assert every(90)(_at(1)) == _at(1, 1).replace(second=30)
+
+    def test_aligned_every_lands_just_past_the_boundary(self):
+        next_run = aligned_every(3600)
+        assert next_run(_at(2, 30)) == _at(3).replace(second=1)
+        assert next_run(_at(3)) == _at(4).replace(second=1)
+
+
+class TestClusterScheduler:
+
+    def test_starts_as_follower_with_registered_jobs(self):
+        scheduler = ClusterScheduler(holder="instance-a")
+
+        async def job():
+            return None
+
+        scheduler.register("sweep", job, every(60))
+        assert not scheduler.is_leader
+        assert list(scheduler.jobs) == ["sweep"]
+        assert scheduler.jobs["sweep"].task is None
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = use_fake_db(monkeypatch)
+    asyncio.run(ensure_scheduler_indexes())
+    return database
+
+
+async def _expire(db, name="scheduler"):
+    past = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+    await db.leases.update_one({"id": name}, {"$set": {"expires_at": past}})
+
+
+class TestLeases:
+
+    def test_holder_renews_with_the_same_token_and_others_are_refused(self, db):
+        async def scenario():
+            assert await acquire_lease("scheduler", "a") == 1
+            assert await acquire_lease("scheduler", "a") == 1
+            assert await acquire_lease("scheduler", "b") is None
+            assert await lease_is_held("scheduler", "a", 1)
+            assert not await lease_is_held("scheduler", "b", 1)
+
+        asyncio.run(scenario())
+
+    def test_expired_lease_is_taken_over_with_a_new_token(self, db):
+        async def scenario():
+            assert await acquire_lease("scheduler", "a") == 1
+            await _expire(db)
+            assert not await lease_is_held("scheduler", "a", 1)
+            assert await acquire_lease("scheduler", "b") == 2
+            # The previous holder is fenced out: it can neither renew nor pass the check
+            assert await acquire_lease("scheduler", "a") is None
+            assert not await lease_is_held("scheduler", "a", 1)
+            assert await lease_is_held("scheduler", "b", 2)
+
+        asyncio.run(scenario())
+
+    def test_release_hands_over_without_waiting_for_the_ttl(self, db):
+        async def scenario():
+            assert await acquire_lease("scheduler", "a") == 1
+            await release_lease("scheduler", "a", 2)  # Wrong token: nothing happens
+            assert await acquire_lease("scheduler", "b") is None
+            await release_lease("scheduler", "a", 1)
+            assert await acquire_lease("scheduler", "b") == 2
+
+        asyncio.run(scenario())
+
+
+class TestLeaderTakeover:
+
+    def test_leader_registers_then_runs_due_jobs(self, db):
+        runs = []
+
+        async def job():
+            runs.append("ran")
+
+        async def scenario():
+            scheduler = ClusterScheduler(holder="a")
+            scheduler.register("sweep", job, every(60))
+            await scheduler.tick()
+            assert scheduler.fencing_token == 1
+            state = await db.scheduled_jobs.find_one({"id": "sweep"})
+            assert state["status"] == "scheduled" and runs == []
+
+            await db.scheduled_jobs.update_one({"id": "sweep"}, {"$set": {"next_run_at": "2000-01-01T00:00:00+00:00"}})
+            await scheduler.tick()
+            await scheduler.jobs["sweep"].task
+            state = await db.scheduled_jobs.find_one({"id": "sweep"})
+            assert runs == ["ran"]
+            assert state["status"] == "succeeded" and state["fencing_token"] == 1
+            assert state["next_run_at"] > datetime.now(timezone.utc).isoformat()
+
+        asyncio.run(scenario())
+
+    def test_stale_leader_is_fenced_out_and_its_job_rerun(self, db):
+        release = asyncio.Event()
+        runs = []
+
+        async def scenario():
+            async def job():
+                runs.append(len(runs))
+                await release.wait()
+
+            old, new = ClusterScheduler(holder="a"), ClusterScheduler(holder="b")
+            for scheduler in (old, new):
+                scheduler.register("sweep", job, every(60))
+            await old.tick()
+            await db.scheduled_jobs.update_one({"id": "sweep"}, {"$set": {"next_run_at": "2000-01-01T00:00:00+00:00"}})
+            await old.tick()
+            await asyncio.sleep(0)
+            stale_task = old.jobs["sweep"].task
+
+            # The old leader stalls past its TTL; the new one takes over and re-runs the "running" job
+            await _expire(db)
+            await new.tick()
+            assert new.fencing_token == 2
+            await asyncio.sleep(0)
+            assert runs == [0, 1]
+
+            # The stale run finishes: its completion is not recorded under the old token
+            release.set()
+            await stale_task
+            state = await db.scheduled_jobs.find_one({"id": "sweep"})
+            assert state["fencing_token"] == 2
+
+            await new.jobs["sweep"].task
+            state = await db.scheduled_jobs.find_one({"id": "sweep"})
+            assert state["status"] == "succeeded" and state["leader"] == "b"
+
+            # On its next tick the old leader learns it lost the lease and starts nothing
+            await old.tick()
+            assert not old.is_leader
+            assert not await old.holds_lease()
+            assert runs == [0, 1]
+
+        asyncio.run(scenario())
+
+    def test_losing_the_lease_cancels_running_jobs(self, db):
+        async def scenario():
+            async def job():
+                await asyncio.Event().wait()
+
+            scheduler = ClusterScheduler(holder="a")
+            scheduler.register("sweep", job, every(60))
+            await scheduler.tick()
+            await db.scheduled_jobs.update_one({"id": "sweep"}, {"$set": {"next_run_at": "2000-01-01T00:00:00+00:00"}})
+            await scheduler.tick()
+            await asyncio.sleep(0)
+            task = scheduler.jobs["sweep"].task
+
+            await _expire(db)
+            assert await acquire_lease("scheduler", "b") == 2
+            await scheduler.tick()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # Left "running" for the new leader to pick up
+            assert (await db.scheduled_jobs.find_one({"id": "sweep"}))["status"] == "running"
+
+        asyncio.run(scenario())
@@ -0,0 +1,160 @@
+"""
+Email outbox tests: rendered messages, the local sink transport, and delivery outcomes
+(bodies cleared once sent or dead, old rows pruned).
+"""
+
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import (
+    EmailStatus,
+    ResendTransport,
+    SinkTransport,
+    deliver_email_outbox,
+    queue_email,
+    render_invitation_email,
+    render_password_reset_email,
+    render_verification_email,
+    sweep_email_outbox,
+)
+
+
+class ScriptedTransport:
+    """Answers every send with `status`, recording the recipients."""
+
+    def __init__(self, status=200):
+        self.status = status
+        self.sent = []
+
+    async def send(self, message, idempotency_key=None):
+        self.sent.append(message["to"])
+        return self.status, {"id": "re-1"} if self.status == 200 else {"message": "rejected"}
+
+    async def send_batch(self, messages, idempotency_key=None):
+        self.sent.extend(message["to"] for message in messages)
+        return self.status, {"data": [{"id": "re-1"} for _ in messages]} if self.status == 200 else {"message": "rejected"}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    return use_fake_db(monkeypatch)
+
+
+def _queue_reset(address="ada@example.com"):
+    message = render_password_reset_email(address, "https://app/reset-password?token=secret", "Ada")
+    return asyncio.run(queue_email(message, "password_reset"))
+
+
+def _outbox(db, email_id):
+    return asyncio.run(db.email_outbox.find_one({"id": email_id}, {"_id": 0}))
+
+
+class TestRenderedMessages:
+
+    def test_messages_carry_recipient_subject_and_both_bodies(self):
+        for message in (
+            render_verification_email("ada@example.com", "https://app/verify-email?token=abc"),
+            render_password_reset_email("ada@example.com", "https://app/reset-password?token=abc", "Ada"),
+            render_invitation_email("ada@example.com", "Docs", "Grace", "editor"),
+        ):
+            assert message["to"] == "ada@example.com"
+            assert message["subject"]
+            assert message["text"] and message["html"].startswith("<!DOCTYPE html>")
+
+    def test_verification_link_and_default_name(self):
+        message = render_verification_email("ada.lovelace@example.com", "https://app/verify-email?token=abc")
+        assert "https://app/verify-email?token=abc" in message["text"]
+        assert "Hi Ada Lovelace," in message["html"]
+
+    def test_invitation_escapes_names_in_html(self):
+        message = render_invitation_email("ada@example.com", "<b>Docs</b>", "Grace", "editor")
+        assert "&lt;b&gt;Docs&lt;/b&gt;" in message["html"]
+        assert "<b>Docs</b>" not in message["html"]
+
+
+class TestTransports:
+
+    def test_sink_writes_one_line_per_message(self, tmp_path):
+        sink_path = tmp_path / "outbox.ndjson"
+        sink = SinkTransport(str(sink_path), from_email="noreply@example.com")
+        messages = [render_verification_email(f"user{i}@example.com", "https://app/v") for i in range(3)]
+
+        status, data = asyncio.run(sink.send_batch(messages))
+        assert status == 200
+        lines = [json.loads(line) for line in sink_path.read_text().splitlines()]
+        assert [line["id"] for line in lines] == [item["id"] for item in data["data"]]
+        assert [line["to"] for line in lines] == ["user0@example.com", "user1@example.com", "user2@example.com"]
+        assert lines[0]["from"] == "noreply@example.com"
+
+    def test_resend_payload_uses_configured_sender(self):
+        transport = ResendTransport(api_url="https://api.resend.test/emails/", api_key="key", from_email="noreply@example.com")
+        payload = transport._payload(render_password_reset_email("ada@example.com", "https://app/r"))
+        assert transport.api_url == "https://api.resend.test/emails"
+        assert payload["from"] == "noreply@example.com"
+        assert payload["to"] == ["ada@example.com"]
+
+
+class TestDelivery:
+
+    def test_sent_message_drops_its_body(self, db, monkeypatch):
+        transport = ScriptedTransport(200)
+        monkeypatch.setattr(server, "email_transport", transport)
+        email_id = _queue_reset()
+        asyncio.run(deliver_email_outbox())
+        message = _outbox(db, email_id)
+        assert transport.sent == ["ada@example.com"]
+        assert message["status"] == EmailStatus.SENT and message["provider_id"] == "re-1"
+        assert "text" not in message and "html" not in message
+
+    def test_dead_message_drops_its_body(self, db, monkeypatch):
+        monkeypatch.setattr(server, "email_transport", ScriptedTransport(422))
+        email_id = _queue_reset()
+        asyncio.run(deliver_email_outbox())
+        message = _outbox(db, email_id)
+        assert message["status"] == EmailStatus.DEAD
+        assert message["last_error"] == "HTTP 422: rejected"
+        assert "text" not in message and "html" not in message
+
+    def test_retryable_failure_keeps_the_body_for_the_next_attempt(self, db, monkeypatch):
+        monkeypatch.setattr(server, "email_transport", ScriptedTransport(503))
+        email_id = _queue_reset()
+        asyncio.run(deliver_email_outbox())
+        message = _outbox(db, email_id)
+        assert message["status"] == EmailStatus.QUEUED and message["attempts"] == 1
+        assert "token=secret" in message["text"]
+
+
+class TestSweep:
+
+    def test_prunes_old_sent_and_dead_messages(self, db):
+        now = datetime.now(timezone.utc)
+        old_sent = (now - timedelta(days=server.EMAIL_RETENTION_DAYS + 1)).isoformat()
+        old_dead = (now - timedelta(days=server.EMAIL_DEAD_RETENTION_DAYS + 1)).isoformat()
+        asyncio.run(db.email_outbox.insert_many([
+            {"id": "e-sent-old", "status": EmailStatus.SENT, "sent_at": old_sent},
+            {"id": "e-sent-new", "status": EmailStatus.SENT, "sent_at": now.isoformat()},
+            {"id": "e-dead-old", "status": EmailStatus.DEAD, "dead_at": old_dead},
+            {"id": "e-dead-new", "status": EmailStatus.DEAD, "dead_at": old_sent},
+        ]))
+        asyncio.run(sweep_email_outbox())
+        assert sorted(asyncio.run(db.email_outbox.distinct("id"))) == ["e-dead-new", "e-sent-new"]
@@ -0,0 +1,68 @@
+"""
+Streaming export tests: request validation happens before any row is read.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from server import EXPORT_DATASETS, _export_cell, encode_list_cursor, stream_export
+
+
+def _request(query=""):
+    return Request({"type": "http", "method": "GET", "path": "/api/admin/export", "query_string": query.encode(), "headers": []})
+
+
+class TestStreamExport:
+
+    def test_rejects_unknown_format(self):
+        with pytest.raises(HTTPException) as exc_info:
+            stream_export("users", _request(), "xml", None, None, None, None)
+        assert exc_info.value.status_code == 400
+
+    def test_rejects_fields_outside_the_allow_list(self):
+        with pytest.raises(HTTPException) as exc_info:
+            stream_export("users", _request(), "csv", "id,password_hash", None, None, None)
+        assert exc_info.value.status_code == 400
+        assert "password_hash" in exc_info.value.detail
+
+    def test_rejects_cursor_without_position(self):
+        with pytest.raises(HTTPException) as exc_info:
+            stream_export("users", _request(), "ndjson", None, encode_list_cursor({"id": "x"}), None, None)
+        assert exc_info.value.status_code == 400
+
+    def test_accepted_request_returns_attachment(self):
+        response = stream_export("memberships", _request("user_id=u1"), "csv", "id,role", encode_list_cursor({"after": "m1"}), None, None)
+        assert response.media_type == "text/csv"
+        assert response.headers["content-disposition"].startswith('attachment; filename="memberships-')
+
+    def test_secrets_are_not_exportable(self):
+        assert "invite_token" not in EXPORT_DATASETS["memberships"].fields
+        assert not any("password" in field for field in EXPORT_DATASETS["users"].fields)
+
+    def test_cells_flatten_nested_values(self):
+        assert _export_cell(None) == ""
+        assert _export_cell({"a": 1}) == '{"a": 1}'
+        assert _export_cell(3) == 3
+
+    def test_cells_that_read_as_formulas_are_escaped(self):
+        for text in ("=HYPERLINK(\"http://x\")", "+1+1", "-2+3", "@SUM(A1)", "\tcmd", "\rcmd"):
+            assert _export_cell(text) == "'" + text
+        assert _export_cell("a=b") == "a=b"
+        assert _export_cell(-5) == -5
@@ -0,0 +1,178 @@
+"""
+Extension sync tests: deltas and tombstones since a previous `seq`, and the full-snapshot
+fallbacks (no `since`, pruned log, too many changes, `since` ahead of the index, and
+deltas that would reach below what the index has seen completely).
+"""
+
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+import server
+from fake_db import use_fake_db
+from server import BindingTokenCache, ExtensionTargetIndex, record_extension_change
+
+BINDING_TOKEN = "binding-token-ws-1"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = use_fake_db(monkeypatch)
+    monkeypatch.setattr(server, "extension_target_index", ExtensionTargetIndex())
+    monkeypatch.setattr(server, "binding_token_cache", BindingTokenCache())
+    monkeypatch.setattr(server, "EXTENSION_INDEX_POLL_SECONDS", 0)
+    asyncio.run(database.workspace_binding_tokens.insert_one({
+        "token_hash": server._hash_token(BINDING_TOKEN), "workspace_id": "ws-1",
+        "revoked_at": None, "created_at": "2024-01-01T00:00:00+00:00"
+    }))
+    for walkthrough_id in ("wt-1", "wt-2"):
+        _walkthrough(database, walkthrough_id)
+    _target(database, "t-1", "wt-1")
+    return database
+
+
+@pytest.fixture
+def client(db):
+    return TestClient(server.app)
+
+
+def _walkthrough(db, walkthrough_id, workspace_id="ws-1", **fields):
+    asyncio.run(db.walkthroughs.update_one(
+        {"id": walkthrough_id},
+        {"$set": {"workspace_id": workspace_id, "title": walkthrough_id, "steps": [], **fields}},
+        upsert=True
+    ))
+    return asyncio.run(record_extension_change(workspace_id, "walkthrough", walkthrough_id))
+
+
+def _target(db, target_id, walkthrough_id, workspace_id="ws-1"):
+    asyncio.run(db.extension_targets.insert_one({
+        "id": target_id, "workspace_id": workspace_id, "walkthrough_id": walkthrough_id, "created_by": "owner-1",
+        "url_rule": {"type": "prefix", "value": "https://app.example.com/"}, "status": "active"
+    }))
+    return asyncio.run(record_extension_change(workspace_id, "target", target_id))
+
+
+def _sync(client, since=None):
+    params = {} if since is None else {"since": since}
+    response = client.get("/api/extension/sync", params=params, headers={"X-Workspace-Binding": BINDING_TOKEN})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def _ids(items):
+    return sorted(item["id"] for item in items)
+
+
+class TestDelta:
+
+    def test_first_sync_is_a_full_snapshot(self, db, client):
+        snapshot = _sync(client)
+        assert snapshot["full"] is True
+        assert _ids(snapshot["walkthroughs"]) == ["wt-1", "wt-2"]
+        assert _ids(snapshot["targets"]) == ["t-1"]
+        assert snapshot["seq"] == 3
+
+    def test_delta_carries_changes_and_tombstones(self, db, client):
+        since = _sync(client)["seq"]
+        _walkthrough(db, "wt-2", title="Renamed")
+        _walkthrough(db, "wt-1", archived=True)
+        asyncio.run(db.extension_targets.delete_one({"id": "t-1"}))
+        asyncio.run(record_extension_change("ws-1", "target", "t-1"))
+        _target(db, "t-2", "wt-2")
+        # Another workspace's changes are not included
+        _walkthrough(db, "wt-other", workspace_id="ws-2")
+
+        delta = _sync(client, since)
+        assert delta["full"] is False
+        assert delta["seq"] == since + 5
+        assert [(w["id"], w["title"]) for w in delta["walkthroughs"]] == [("wt-2", "Renamed")]
+        assert _ids(delta["targets"]) == ["t-2"]
+        assert delta["deleted_walkthrough_ids"] == ["wt-1"]
+        assert delta["deleted_target_ids"] == ["t-1"]
+
+        # Nothing new: an empty delta at the same sequence
+        empty = _sync(client, delta["seq"])
+        assert empty["full"] is False and empty["seq"] == delta["seq"]
+        assert empty["walkthroughs"] == [] and empty["targets"] == []
+
+    def test_index_rebuilt_for_age_keeps_deltas(self, db, client):
+        since = _sync(client)["seq"]
+        server.extension_target_index._built_at = time.monotonic() - server.EXTENSION_INDEX_MAX_AGE_SECONDS - 1
+        _walkthrough(db, "wt-3")
+        delta = _sync(client, since)
+        assert delta["full"] is False
+        assert _ids(delta["walkthroughs"]) == ["wt-3"]
+
+
+class TestFullFallbacks:
+
+    def test_since_before_the_pruned_log(self, db, client):
+        since = _sync(client)["seq"]
+        _walkthrough(db, "wt-3")
+        _walkthrough(db, "wt-4")
+        asyncio.run(server.extension_target_index.sync())
+        # Pruning removed the change right after `since`
+        asyncio.run(db.extension_changes.delete_many({"seq": {"$lte": since + 1}}))
+        assert _sync(client, since)["full"] is True
+        assert _sync(client, since + 1)["full"] is False
+
+    def test_too_many_changes(self, db, client, monkeypatch):
+        since = _sync(client)["seq"]
+        monkeypatch.setattr(server, "EXTENSION_CHANGE_BATCH", 2)
+        for walkthrough_id in ("wt-3", "wt-4", "wt-5"):
+            _walkthrough(db, walkthrough_id)
+            asyncio.run(server.extension_target_index.sync())  # The index keeps up one change at a time
+        snapshot = _sync(client, since)
+        assert snapshot["full"] is True
+        assert _ids(snapshot["walkthroughs"]) == ["wt-1", "wt-2", "wt-3", "wt-4", "wt-5"]
+
+    def test_since_ahead_of_the_index(self, db, client):
+        seq = _sync(client)["seq"]
+        snapshot = _sync(client, seq + 10)
+        assert snapshot["full"] is True and snapshot["seq"] == seq
+
+    def test_skipped_gap_forces_a_snapshot(self, db, client, monkeypatch):
+        monkeypatch.setattr(server, "EXTENSION_CHANGE_GAP_SECONDS", 0)
+        since = _sync(client)["seq"]
+        # A writer saved its walkthrough and allocated the next sequence, but has not inserted its change yet
+        asyncio.run(db.walkthroughs.insert_one({"id": "wt-late", "workspace_id": "ws-1", "title": "Late", "steps": []}))
+        asyncio.run(db.counters.update_one({"_id": "extension_changes"}, {"$inc": {"seq": 1}}))
+        _walkthrough(db, "wt-3")
+
+        # The index gives up on the gap and moves past it; a delta over the gap would miss wt-late for good
+        snapshot = _sync(client, since)
+        assert snapshot["full"] is True and snapshot["seq"] == since + 2
+        assert "wt-late" in _ids(snapshot["walkthroughs"])
+
+        asyncio.run(db.extension_changes.insert_one({
+            "seq": since + 1, "workspace_id": "ws-1", "kind": "walkthrough", "entity_id": "wt-late", "at": "2024-01-01T00:00:00+00:00"
+        }))
+        assert _sync(client, snapshot["seq"])["full"] is False
+
+    def test_rebuilt_index_does_not_vouch_for_earlier_sequences(self, db, client):
+        since = _sync(client)["seq"]
+        _walkthrough(db, "wt-3")
+        # A fresh process reads its position from the counter, with writes possibly in flight
+        server.extension_target_index.reset()
+        snapshot = _sync(client, since)
+        assert snapshot["full"] is True
+        assert _sync(client, snapshot["seq"])["full"] is False
@@ -0,0 +1,193 @@
+"""
+Extension URL-rule index tests: compiled matching agrees with url_rule_matches; binding-token cache; ETags;
+workspace deletion drops targets from the index.
+"""
+
+import asyncio
+import os
+import random
+import sys
+from pathlib import Path
+
+import pytest
+from pydantic import ValidationError
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import (
+    EXTENSION_RESOLVE_BATCH_MAX_URLS,
+    BindingTokenCache,
+    ExtensionResolveBatchRequest,
+    ExtensionTargetIndex,
+    JobRun,
+    ExtensionTargetUrlRule,
+    UrlRuleIndex,
+    UrlTargetRecord,
+    etag_matches,
+    url_rule_matches,
+)
+
+
+def _record(target_id):
+    return UrlTargetRecord(target_id, "ws-1", f"wt-{target_id}", None, None)
+
+
+class TestUrlRuleIndex:
+
+    def test_exact_and_prefix_rules(self):
+        index = UrlRuleIndex()
+        index.add("exact", "https://app.example.com/settings", _record("exact"))
+        index.add("prefix", "https://app.example.com/", _record("root"))
+        index.add("prefix", "https://app.example.com/settings/", _record("settings"))
+
+        assert [r.target_id for r in index.match("https://app.example.com/settings")] == ["exact", "root"]
+        assert [r.target_id for r in index.match("https://app.example.com/settings/billing")] == ["root", "settings"]
+        assert index.match("https://other.example.com/") == []
+
+    def test_matches_come_back_in_rule_order(self):
+        index = UrlRuleIndex()
+        index.add("prefix", "https://a.com/x", _record("long"))
+        index.add("exact", "https://a.com/xy", _record("exact"))
+        index.add("prefix", "https://a.com", _record("short"))
+        assert [r.target_id for r in index.match("https://a.com/xy")] == ["long", "exact", "short"]
+
+    def test_update_replaces_rule_and_remove_prunes_trie(self):
+        index = UrlRuleIndex()
+        index.add("prefix", "https://a.com/old", _record("t1"))
+        index.add("prefix", "https://a.com/new", _record("t1"))
+        assert index.match("https://a.com/old/page") == []
+        assert [r.target_id for r in index.match("https://a.com/new/page")] == ["t1"]
+
+        assert index.remove("t1")
+        assert not index.remove("t1")
+        assert len(index) == 0
+        assert index.root.children == {}
+
+    def test_agrees_with_url_rule_matches(self):
+        rng = random.Random(7)
+        alphabet = "ab/"
+        rules = {}
+        index = UrlRuleIndex()
+        for i in range(300):
+            rule = ExtensionTargetUrlRule(
+                type=rng.choice(["exact", "prefix"]),
+                value="https://x/" + "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 5)))
+            )
+            rules[f"t{i}"] = rule
+            index.add(rule.type, rule.value, _record(f"t{i}"))
+        for i in range(0, 300, 3):
+            index.remove(f"t{i}")
+            del rules[f"t{i}"]
+
+        for _ in range(200):
+            url = "https://x/" + "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 7)))
+            expected = [target_id for target_id, rule in rules.items() if url_rule_matches(rule, url)]
+            assert [r.target_id for r in index.match(url)] == expected
+
+
+class TestBindingTokenCache:
+
+    def test_negative_entries_expire_first(self):
+        cache = BindingTokenCache(ttl=60, negative_ttl=0)
+        cache.put("good", "active", "ws-1", "ext-1")
+        cache.put("bad", "invalid", None)
+        assert cache.get("good") == ("active", "ws-1", "ext-1")
+        assert cache.get("bad") is None
+
+    def test_invalidate_workspace_drops_only_its_tokens(self):
+        cache = BindingTokenCache()
+        cache.put("a", "active", "ws-1")
+        cache.put("b", "revoked", "ws-1")
+        cache.put("c", "active", "ws-2")
+        cache.invalidate_workspace("ws-1")
+        assert cache.get("a") is None and cache.get("b") is None
+        assert cache.get("c") == ("active", "ws-2", None)
+
+    def test_least_recently_used_token_is_evicted(self):
+        cache = BindingTokenCache(max_size=2)
+        cache.put("a", "active", "ws-1")
+        cache.put("b", "active", "ws-1")
+        cache.get("a")
+        cache.put("c", "active", "ws-1")
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+
+
+class TestEtagMatches:
+
+    def test_matches_listed_weak_and_wildcard_tags(self):
+        assert etag_matches('"ws-1-4"', '"ws-1-4"')
+        assert etag_matches('"ws-1-3", W/"ws-1-4"', '"ws-1-4"')
+        assert etag_matches("*", '"ws-1-4"')
+
+    def test_missing_or_stale_tag_does_not_match(self):
+        assert not etag_matches(None, '"ws-1-4"')
+        assert not etag_matches('"ws-1-3"', '"ws-1-4"')
+
+
+class TestResolveBatchRequest:
+
+    def test_url_count_is_bounded(self):
+        assert len(ExtensionResolveBatchRequest(urls=["https://a.com"] * EXTENSION_RESOLVE_BATCH_MAX_URLS).urls) == EXTENSION_RESOLVE_BATCH_MAX_URLS
+        with pytest.raises(ValidationError):
+            ExtensionResolveBatchRequest(urls=["https://a.com"] * (EXTENSION_RESOLVE_BATCH_MAX_URLS + 1))
+        with pytest.raises(ValidationError):
+            ExtensionResolveBatchRequest(urls=[])
+
+
+class TestWorkspaceDeletion:
+
+    @pytest.fixture
+    def db(self, monkeypatch):
+        database = use_fake_db(monkeypatch)
+        monkeypatch.setattr(server, "extension_target_index", ExtensionTargetIndex())
+        asyncio.run(database.workspaces.insert_one({"id": "ws-1", "name": "Docs", "owner_id": "owner-1"}))
+        for index in range(3):
+            asyncio.run(database.walkthroughs.insert_one({
+                "id": f"wt-{index}", "workspace_id": "ws-1", "title": f"Guide {index}", "steps": [],
+                "status": server.WalkthroughStatus.PUBLISHED, "privacy": server.Privacy.PUBLIC
+            }))
+            asyncio.run(database.extension_targets.insert_one({
+                "id": f"t-{index}", "workspace_id": "ws-1", "walkthrough_id": f"wt-{index}", "status": "active",
+                "url_rule": {"type": "prefix", "value": "https://app.example.com/"}
+            }))
+        return database
+
+    def _matches(self):
+        index = asyncio.run(server.extension_target_index.public_index())
+        return [record.target_id for record in index.match("https://app.example.com/page")]
+
+    def _changes(self, db):
+        changes = asyncio.run(db.extension_changes.find({}, {"_id": 0, "kind": 1, "entity_id": 1}).to_list(None))
+        return sorted((change["kind"], change["entity_id"]) for change in changes)
+
+    def test_deleted_workspace_leaves_the_public_index(self, db, monkeypatch):
+        monkeypatch.setattr(server, "DELETION_JOB_FILE_PAGE_SIZE", 2)
+        assert self._matches() == ["t-0", "t-1", "t-2"]
+
+        asyncio.run(server._delete_workspace_documents(JobRun({"id": "job-1"}), "ws-1"))
+        assert self._matches() == []
+        assert self._changes(db) == [("target", f"t-{i}") for i in range(3)] + [("walkthrough", f"wt-{i}") for i in range(3)]
+        assert asyncio.run(db.extension_targets.count_documents({})) == 0
+
+    def test_resumed_deletion_records_an_interrupted_page(self, db):
+        # Crashed after deleting a page but before recording its changes
+        asyncio.run(db.walkthroughs.delete_many({"id": {"$in": ["wt-0", "wt-1"]}}))
+        run = JobRun({"id": "job-1", "checkpoint": {
+            "pending_extension_changes": {"workspace_id": "ws-1", "kind": "walkthrough", "ids": ["wt-0", "wt-1"]}
+        }})
+        asyncio.run(server._delete_workspace_documents(run, "ws-1"))
+        assert ("walkthrough", "wt-0") in self._changes(db) and ("walkthrough", "wt-1") in self._changes(db)
+        assert run.checkpoint["pending_extension_changes"] is None
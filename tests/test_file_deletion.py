@@ -0,0 +1,155 @@
+"""
+File deletion tests: de-duplicated blob release, delete ordering and the stuck-DELETING retry sweep.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import LocalStorageProvider, retry_file_deletions
+
+
+class FlakyStorage(LocalStorageProvider):
+    """Local storage whose deletes fail while failing is set."""
+
+    failing = False
+
+    async def delete_batch(self, public_ids, resource_type="image"):
+        if self.failing:
+            return {public_id: "error" for public_id in public_ids}
+        return await super().delete_batch(public_ids, resource_type)
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    provider = FlakyStorage(root=tmp_path, max_workers=1)
+    monkeypatch.setattr(server, "storage_provider", provider)
+    yield provider
+    asyncio.run(provider.close())
+
+
+@pytest.fixture
+def db(monkeypatch, storage):
+    return use_fake_db(monkeypatch)
+
+
+def _store(storage, public_id):
+    path = storage.root / f"{public_id}.png"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"blob")
+    return path
+
+
+async def _seed_shared_blob(db, storage):
+    """One stored blob referenced by two ACTIVE records."""
+    now = datetime.now(timezone.utc).isoformat()
+    await db.media_blobs.insert_one({
+        "id": "blob-1", "user_id": "owner-1", "workspace_id": "ws-1", "content_hash": "abc",
+        "url": "/media/f-1", "public_id": "ws-1/f-1", "resource_type": "image", "size_bytes": 4,
+        "ref_count": 2, "origin_file_id": "f-1", "created_at": now, "updated_at": now
+    })
+    for file_id in ("f-1", "f-2"):
+        await db.files.insert_one({
+            "id": file_id, "user_id": "owner-1", "workspace_id": "ws-1", "status": "active",
+            "size_bytes": 4, "url": "/media/f-1", "public_id": "ws-1/f-1", "resource_type": "image",
+            "blob_id": "blob-1", "created_at": now, "updated_at": now
+        })
+    return _store(storage, "ws-1/f-1")
+
+
+def _delete(file_ids):
+    return asyncio.run(server._delete_file_records(file_ids, {"deleted": 0, "failed": 0, "items": []}))
+
+
+def _age_deleting_records(db, minutes):
+    updated_at = (datetime.now(timezone.utc) - timedelta(minutes=minutes)).isoformat()
+    asyncio.run(db.files.update_many({"status": "deleting"}, {"$set": {"updated_at": updated_at}}))
+
+
+class TestSharedBlobDeletion:
+
+    def test_blob_entry_outlives_a_failed_destroy(self, db, storage):
+        stored = asyncio.run(_seed_shared_blob(db, storage))
+        storage.failing = True
+        report = _delete(["f-1", "f-2"])
+        assert report["failed"] == 1 and report["deleted"] == 1
+
+        # The entry is kept (at zero references) and the failed record carries what to destroy
+        blob = asyncio.run(db.media_blobs.find_one({"id": "blob-1"}))
+        assert blob["ref_count"] == 0
+        failed = asyncio.run(db.files.find_one({"status": "deleting"}))
+        assert failed["public_id"] == "ws-1/f-1"
+        assert failed["released_blob_id"] == "blob-1"
+        assert "blob_id" not in failed
+        assert stored.exists()
+
+    def test_zero_reference_blob_is_not_claimed_again(self, db, storage):
+        asyncio.run(_seed_shared_blob(db, storage))
+        storage.failing = True
+        _delete(["f-1", "f-2"])
+        assert asyncio.run(server._claim_media_blob("ws-1", "abc")) is None
+
+    def test_successful_destroy_drops_the_entry(self, db, storage):
+        stored = asyncio.run(_seed_shared_blob(db, storage))
+        assert _delete(["f-1", "f-2"])["deleted"] == 2
+        assert asyncio.run(db.media_blobs.count_documents({})) == 0
+        assert not stored.exists()
+
+
+class TestRetrySweep:
+
+    def test_retry_destroys_blob_after_failure(self, db, storage):
+        stored = asyncio.run(_seed_shared_blob(db, storage))
+        storage.failing = True
+        _delete(["f-1", "f-2"])
+
+        storage.failing = False
+        # Too recent: a deletion may still be in progress
+        assert asyncio.run(retry_file_deletions())["retried"] == 0
+
+        _age_deleting_records(db, server.FILE_DELETION_RETRY_MINUTES + 1)
+        totals = asyncio.run(retry_file_deletions())
+        assert totals == {"retried": 1, "deleted": 1, "failed": 0}
+        assert asyncio.run(db.files.count_documents({"status": "deleting"})) == 0
+        assert asyncio.run(db.media_blobs.count_documents({})) == 0
+        assert not stored.exists()
+
+    def test_retry_keeps_failing_records_for_the_next_run(self, db, storage):
+        asyncio.run(_seed_shared_blob(db, storage))
+        storage.failing = True
+        _delete(["f-1", "f-2"])
+        _age_deleting_records(db, server.FILE_DELETION_RETRY_MINUTES + 1)
+
+        assert asyncio.run(retry_file_deletions()) == {"retried": 1, "deleted": 0, "failed": 1}
+        assert asyncio.run(db.files.count_documents({"status": "deleting"})) == 1
+        assert asyncio.run(db.media_blobs.count_documents({})) == 1
+
+    def test_retry_recovers_a_deletion_that_died_after_releasing(self, db, storage):
+        # Crash after the last reference was released but before the outcome was recorded
+        stored = asyncio.run(_seed_shared_blob(db, storage))
+        asyncio.run(db.media_blobs.update_one({"id": "blob-1"}, {"$set": {"ref_count": 0}}))
+        asyncio.run(db.files.update_many({}, {"$set": {"status": "deleting", "deletion_batch_id": "dead"}}))
+        _age_deleting_records(db, server.FILE_DELETION_RETRY_MINUTES + 1)
+
+        totals = asyncio.run(retry_file_deletions())
+        assert totals["deleted"] == 2
+        assert asyncio.run(db.media_blobs.count_documents({})) == 0
+        assert not stored.exists()
@@ -0,0 +1,121 @@
+"""
+Media resolution cache tests: LRU eviction, expiry, negative caching and invalidation, and
+the media routes' cache headers (long-lived redirects, revalidated local files).
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+import server
+from fake_db import use_fake_db
+from server import LocalStorageProvider, MediaResolutionCache
+
+
+class TestMediaResolutionCache:
+
+    def test_evicts_least_recently_used(self):
+        cache = MediaResolutionCache(max_entries=2, ttl_seconds=60, negative_ttl_seconds=60)
+        cache.put("a", {"redirect_url": "https://cdn/a"})
+        cache.put("b", {"redirect_url": "https://cdn/b"})
+        assert cache.get("a") is not None  # "a" becomes most recently used
+        cache.put("c", {"redirect_url": "https://cdn/c"})
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.get("c") is not None
+
+    def test_entries_expire(self):
+        cache = MediaResolutionCache(max_entries=10, ttl_seconds=0, negative_ttl_seconds=0)
+        cache.put("a", {"redirect_url": "https://cdn/a"})
+        cache.mark_missing("b")
+        assert cache.get("a") is None
+        assert cache.is_missing("b") is False
+
+    def test_negative_cache_and_invalidation(self):
+        cache = MediaResolutionCache(max_entries=10, ttl_seconds=60, negative_ttl_seconds=60)
+        cache.mark_missing("a")
+        assert cache.is_missing("a") is True
+        cache.put("a", {"redirect_url": "https://cdn/a"})
+        assert cache.is_missing("a") is False
+        cache.invalidate("a", None)
+        assert cache.get("a") is None
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    provider = LocalStorageProvider(root=tmp_path, max_workers=1)
+    monkeypatch.setattr(server, "storage_provider", provider)
+    monkeypatch.setattr(server, "media_url_cache", MediaResolutionCache(max_entries=10, ttl_seconds=60, negative_ttl_seconds=60))
+    return provider
+
+
+@pytest.fixture
+def db(monkeypatch, storage):
+    database = use_fake_db(monkeypatch)
+    asyncio.run(database.files.insert_many([
+        {"id": "f-local", "status": "active", "url": "/api/media/f-local.png", "public_id": "ws-1/f-local"},
+        {"id": "f-cdn", "status": "active", "url": "https://res.cloudinary.com/test/image/upload/f-cdn.png", "public_id": "ws-1/f-cdn"},
+    ]))
+    (storage.root / "ws-1").mkdir()
+    (storage.root / "ws-1" / "f-local.png").write_bytes(b"png")
+    variant = storage.root / server.MEDIA_VARIANT_DIR / "ws-1" / "f-local" / "w320.webp"
+    variant.parent.mkdir(parents=True)
+    variant.write_bytes(b"webp")
+    return database
+
+
+@pytest.fixture
+def client(db):
+    return TestClient(server.app)
+
+
+class TestMediaRoutes:
+
+    def test_redirect_keeps_a_long_max_age(self, client):
+        response = client.get("/api/media/f-cdn.png", follow_redirects=False)
+        assert response.status_code == 307
+        assert response.headers["cache-control"] == f"public, max-age={server.MEDIA_REDIRECT_MAX_AGE_SECONDS}"
+        revalidated = client.get("/api/media/f-cdn.png", headers={"If-None-Match": response.headers["etag"]}, follow_redirects=False)
+        assert revalidated.status_code == 304
+
+    @pytest.mark.parametrize("path", ["/api/media/f-local.png", "/api/media/f-local/variants/w320.webp"])
+    def test_local_files_revalidate_by_etag(self, client, storage, path):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.headers["cache-control"] == f"public, max-age={server.MEDIA_LOCAL_MAX_AGE_SECONDS}"
+        etag = response.headers["etag"]
+        assert client.get(path, headers={"If-None-Match": etag}).status_code == 304
+
+        # A file replaced in place gets a new ETag
+        target = storage.variant_path("ws-1/f-local", "w320.webp") if "variants" in path else storage.local_path("ws-1/f-local")
+        target.write_bytes(b"regenerated")
+        replaced = client.get(path, headers={"If-None-Match": etag})
+        assert replaced.status_code == 200 and replaced.content == b"regenerated"
+        assert replaced.headers["etag"] != etag
+
+    def test_variant_lookups_use_the_negative_cache(self, db, client):
+        assert client.get("/api/media/f-gone/variants/w320.webp").status_code == 404
+        assert server.media_url_cache.is_missing("f-gone") is True
+
+        # Still answered from the negative cache after the record appears
+        asyncio.run(db.files.insert_one({"id": "f-gone", "status": "active", "url": "/api/media/f-gone.png", "public_id": "ws-1/f-local"}))
+        assert client.get("/api/media/f-gone/variants/w320.webp").status_code == 404
+        server.media_url_cache.invalidate("f-gone")
+        assert client.get("/api/media/f-gone/variants/w320.webp").status_code == 200
@@ -0,0 +1,164 @@
+"""
+Orphaned-media GC tests: referenced vs. unreferenced files, the grace period, dry runs and
+the per-workspace sweep in bounded batches.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import LocalStorageProvider, run_media_gc
+
+OLD = (datetime.now(timezone.utc) - timedelta(hours=server.MEDIA_GC_GRACE_HOURS + 1)).isoformat()
+RECENT = datetime.now(timezone.utc).isoformat()
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    provider = LocalStorageProvider(root=tmp_path, max_workers=1)
+    monkeypatch.setattr(server, "storage_provider", provider)
+    monkeypatch.setattr(server, "MEDIA_GC_DELETES_PER_SECOND", 0)
+    yield provider
+    asyncio.run(provider.close())
+
+
+@pytest.fixture
+def db(monkeypatch, storage):
+    database = use_fake_db(monkeypatch)
+    for workspace_id in ("ws-1", "ws-2"):
+        asyncio.run(database.workspaces.insert_one({"id": workspace_id, "name": workspace_id, "owner_id": "owner-1"}))
+    # The reference index counts as backfilled; each workspace is re-indexed before its sweep
+    asyncio.run(database.media_gc_state.insert_one({"id": "reference_index", "backfilled_at": OLD}))
+    return database
+
+
+def _file(db, storage, file_id, workspace_id="ws-1", created_at=OLD, orphaned_at=None):
+    path = storage.root / workspace_id / f"{file_id}.png"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"png")
+    record = {
+        "id": file_id, "user_id": "owner-1", "workspace_id": workspace_id, "status": "active",
+        "size_bytes": 3, "url": f"/api/media/{file_id}", "public_id": f"{workspace_id}/{file_id}",
+        "resource_type": "image", "created_at": created_at, "updated_at": created_at
+    }
+    if orphaned_at:
+        record["orphaned_at"] = orphaned_at
+    asyncio.run(db.files.insert_one(record))
+    return path
+
+
+def _reference(db, file_id, workspace_id="ws-1"):
+    asyncio.run(db.walkthroughs.insert_one({
+        "id": f"wt-{file_id}", "workspace_id": workspace_id,
+        "steps": [{"media_url": f"/api/media/{file_id}"}]
+    }))
+
+
+def _status(db, file_id):
+    return asyncio.run(db.files.find_one({"id": file_id}))
+
+
+class TestMark:
+
+    def test_marks_unreferenced_and_unmarks_referenced(self, db, storage):
+        _file(db, storage, "f-orphan")
+        _file(db, storage, "f-used", orphaned_at=OLD)
+        _reference(db, "f-used")
+        asyncio.run(server.rebuild_media_references())
+
+        report = asyncio.run(run_media_gc(dry_run=False))
+        assert report["scanned"] == 2
+        assert report["referenced"] == 1
+        assert report["newly_marked"] == 1 and report["unmarked"] == 1
+        assert "orphaned_at" in _status(db, "f-orphan")
+        assert "orphaned_at" not in _status(db, "f-used")
+        assert report["deleted"] == 0  # Marked only now: the grace period starts here
+
+    def test_files_younger_than_grace_are_not_scanned(self, db, storage):
+        _file(db, storage, "f-new", created_at=RECENT)
+        report = asyncio.run(run_media_gc(dry_run=False))
+        assert report["scanned"] == 0
+        assert "orphaned_at" not in _status(db, "f-new")
+
+
+class TestSweep:
+
+    def test_deletes_files_marked_longer_than_grace(self, db, storage):
+        stored = _file(db, storage, "f-old", orphaned_at=OLD)
+        recent = _file(db, storage, "f-recent", orphaned_at=RECENT)
+        report = asyncio.run(run_media_gc(dry_run=False))
+        assert report["eligible"] == 1 and report["deleted"] == 1
+        assert _status(db, "f-old")["status"] == "deleted"
+        assert not stored.exists()
+        assert _status(db, "f-recent")["status"] == "active"
+        assert recent.exists()
+
+    def test_rescues_files_referenced_since_marking(self, db, storage):
+        stored = _file(db, storage, "f-back", orphaned_at=OLD)
+        # Referenced by a write whose index refresh was missed: the sweep re-indexes first
+        _reference(db, "f-back")
+        report = asyncio.run(run_media_gc(dry_run=False))
+        assert report["rescued"] == 1 and report["eligible"] == 0
+        assert _status(db, "f-back")["status"] == "active"
+        assert stored.exists()
+
+    def test_dry_run_reports_without_changes(self, db, storage):
+        stored = _file(db, storage, "f-old", orphaned_at=OLD)
+        _file(db, storage, "f-unmarked")
+        report = asyncio.run(run_media_gc(dry_run=True))
+        assert report["eligible"] == 1 and report["deleted"] == 0
+        assert report["newly_marked"] == 1
+        assert report["items"] == [{"file_id": "f-old", "url": "/api/media/f-old", "result": "would_delete", "workspace_id": "ws-1"}]
+        assert "orphaned_at" not in _status(db, "f-unmarked")
+        assert _status(db, "f-old")["status"] == "active"
+        assert stored.exists()
+
+    def test_sweeps_each_workspace_in_bounded_batches(self, db, storage, monkeypatch):
+        monkeypatch.setattr(server, "MEDIA_GC_DELETE_BATCH", 2)
+        deleted_batches = []
+        delete_file_records = server._delete_file_records
+
+        async def recording(selected_ids, report):
+            deleted_batches.append(sorted(selected_ids))
+            return await delete_file_records(selected_ids, report)
+
+        monkeypatch.setattr(server, "_delete_file_records", recording)
+        for index in range(3):
+            _file(db, storage, f"a-{index}", orphaned_at=OLD)
+            _file(db, storage, f"b-{index}", workspace_id="ws-2", orphaned_at=OLD)
+
+        report = asyncio.run(run_media_gc(dry_run=False))
+        assert report["deleted"] == 6
+        assert deleted_batches == [["a-0", "a-1"], ["a-2"], ["b-0", "b-1"], ["b-2"]]
+
+    def test_max_files_bounds_the_sweep_too(self, db, storage):
+        for index in range(3):
+            _file(db, storage, f"f-{index}", orphaned_at=OLD)
+        report = asyncio.run(run_media_gc(dry_run=False, max_files=2))
+        assert report["scanned"] == 2 and report["deleted"] == 2
+        assert _status(db, "f-2")["status"] == "active"
+
+    def test_workspace_being_deleted_is_skipped(self, db, storage):
+        _file(db, storage, "f-old", orphaned_at=OLD)
+        asyncio.run(db.workspaces.update_one({"id": "ws-1"}, {"$set": {"deletion_job_id": "job-1"}}))
+        report = asyncio.run(run_media_gc(dry_run=False))
+        assert report["deleted"] == 0
+        assert _status(db, "f-old")["status"] == "active"
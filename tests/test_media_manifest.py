@@ -0,0 +1,98 @@
+"""
+Media manifest tests: media collection, Cloudinary variant URLs and local variant generation.
+"""
+
+import asyncio
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from server import (
+    CloudinaryStorageProvider,
+    LocalStorageProvider,
+    MEDIA_VARIANT_WIDTHS,
+    collect_walkthrough_media,
+    media_kind,
+)
+
+CLOUDINARY_GIF = "https://res.cloudinary.com/demo/image/upload/v17/guide2026/o/ws/clip.gif"
+
+
+class TestMediaCollection:
+
+    def test_collects_step_media_and_media_blocks_once(self):
+        walkthrough = {
+            "icon_url": "/api/media/icon.png",
+            "steps": [
+                {"media_url": CLOUDINARY_GIF, "media_type": "image", "blocks": [
+                    {"type": "image", "data": {"url": "/api/media/icon.png"}},
+                    {"type": "video", "data": {"url": "https://youtube.com/watch?v=x", "type": "youtube"}},
+                    {"type": "carousel", "data": {"slides": [{"url": "/api/media/slide.webm", "media_type": "video"}]}},
+                    {"type": "text", "data": {"content": "<p>hi</p>"}},
+                ]},
+            ],
+        }
+        assert collect_walkthrough_media(walkthrough) == [
+            ("/api/media/icon.png", "image"),
+            (CLOUDINARY_GIF, "image"),
+            ("/api/media/slide.webm", "video"),
+        ]
+
+    def test_kind_prefers_the_url_over_the_hint(self):
+        assert media_kind(CLOUDINARY_GIF, "image") == "gif"
+        assert media_kind("https://res.cloudinary.com/demo/video/upload/v1/a/b", "image") == "video"
+        assert media_kind("/api/media/logo.svg", "image") is None
+
+
+class TestCloudinaryVariants:
+
+    def test_gif_gets_video_alternates_and_poster(self):
+        variants = asyncio.run(CloudinaryStorageProvider(max_workers=1).media_variants(CLOUDINARY_GIF, "gif"))
+        assert [source["type"] for source in variants["sources"]] == ["video/webm", "video/mp4"]
+        assert variants["sources"][1]["url"] == "https://res.cloudinary.com/demo/image/upload/q_auto/v17/guide2026/o/ws/clip.mp4"
+        assert variants["poster"].endswith("/image/upload/pg_1,q_auto/v17/guide2026/o/ws/clip.jpg")
+
+    def test_image_srcset_uses_every_width_bucket(self):
+        url = "https://res.cloudinary.com/demo/image/upload/v17/a/photo.png"
+        variants = asyncio.run(CloudinaryStorageProvider(max_workers=1).media_variants(url, "image"))
+        assert [item["width"] for item in variants["srcset"]] == list(MEDIA_VARIANT_WIDTHS)
+        assert variants["srcset"][0]["url"] == "https://res.cloudinary.com/demo/image/upload/c_limit,w_320,q_auto,f_auto/v17/a/photo.png"
+
+
+class TestLocalVariants:
+
+    def test_generates_only_buckets_below_the_original_width(self, tmp_path):
+        Image = pytest.importorskip("PIL.Image")
+        provider = LocalStorageProvider(root=tmp_path, max_workers=1)
+        buffer = io.BytesIO()
+        Image.new("RGB", (700, 350)).save(buffer, "PNG")
+
+        async def scenario():
+            stored = await provider.upload(buffer.getvalue(), public_id="file-1", folder="f", filename="a.png")
+            variants = await provider.media_variants(stored["secure_url"], "image", stored["public_id"])
+            assert [item["url"] for item in variants["srcset"]] == [
+                "/api/media/file-1/variants/w320.webp",
+                "/api/media/file-1/variants/w640.webp",
+            ]
+            with Image.open(provider.variant_path(stored["public_id"], "w320.webp")) as variant:
+                assert variant.size == (320, 160)
+            assert provider.variant_path(stored["public_id"], "../a.png") is None
+            await provider.destroy(stored["public_id"])
+            assert provider.variant_path(stored["public_id"], "w320.webp") is None
+            await provider.close()
+
+        asyncio.run(scenario())
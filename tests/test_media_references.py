@@ -0,0 +1,44 @@
+"""
+Media reference index tests: media keys are extracted from anywhere in a document.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from server import extract_media_keys, media_key_from_url
+
+
+class TestMediaReferenceKeys:
+
+    def test_key_is_the_file_id_for_both_url_forms(self):
+        file_id = "0b6f1f3e-1d2c-4c55-9a2e-5d1f8a7c9b10"
+        cloudinary_url = f"https://res.cloudinary.com/demo/image/upload/v17/guide2026/owner/ws/cat/wt/{file_id}.png"
+        assert media_key_from_url(cloudinary_url) == file_id
+        assert media_key_from_url(f"/api/media/{file_id}.gif?w=640") == file_id
+        assert media_key_from_url("") is None
+
+    def test_extracts_from_nested_fields_and_rich_text(self):
+        document = {
+            "icon_url": "/api/media/icon-1.png",
+            "steps": [
+                {"content": '<p>See <img src="https://res.cloudinary.com/demo/video/upload/v1/a/clip-2.mp4"></p>'},
+                {"blocks": [{"type": "carousel", "data": {"slides": [{"url": "/api/media/slide-3.webp"}]}}]},
+            ],
+            "snapshot": {"logo": "https://example.com/not-ours.png"},
+        }
+        assert extract_media_keys(document) == ["clip-2", "icon-1", "slide-3"]
+
+    def test_ignores_documents_without_media(self):
+        assert extract_media_keys({"title": "Hello", "count": 3, "tags": [None, True]}) == []
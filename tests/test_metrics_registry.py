@@ -0,0 +1,118 @@
+"""
+Metrics registry tests: labelled families, histogram buckets, multiprocess merge, Prometheus text.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from server import (
+    MetricsRegistry,
+    histogram_quantile,
+    merge_metric_snapshots,
+    render_metrics_json,
+    render_metrics_prometheus,
+)
+
+
+class TestRegistry:
+
+    def test_counters_by_label_and_unlabelled_shorthand(self):
+        registry = MetricsRegistry()
+        events = registry.counter("events_total", "Events", ("kind",))
+        events.inc(kind="a")
+        events.inc(2, kind="a")
+        events.inc(kind="b")
+        registry.increment("reconcile_total")
+        registry.increment("reconcile_total", 4)
+
+        flat, _ = render_metrics_json(registry.snapshot())
+        assert flat == {'events_total{kind="a"}': 3, 'events_total{kind="b"}': 1, "reconcile_total": 5}
+
+    def test_reregistering_with_other_labels_is_rejected(self):
+        registry = MetricsRegistry()
+        registry.counter("requests_total", labelnames=("route",))
+        assert registry.counter("requests_total", labelnames=("route",)) is registry.counter("requests_total", labelnames=("route",))
+        with pytest.raises(ValueError):
+            registry.gauge("requests_total")
+        with pytest.raises(ValueError):
+            registry.counter("requests_total").inc()
+
+    def test_histogram_buckets_and_quantiles(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram("latency_seconds", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            latency.observe(value)
+
+        counts, total = registry.snapshot()["latency_seconds"]["values"][()]
+        assert counts == [2, 1, 1]  # <=0.1, <=1.0, +Inf
+        assert total == pytest.approx(5.65)
+        assert histogram_quantile(0.5, [0.1, 1.0], counts) == pytest.approx(0.1)
+        assert histogram_quantile(0.99, [0.1, 1.0], counts) == 1.0
+        assert histogram_quantile(0.5, [0.1, 1.0], [0, 0, 0]) is None
+
+
+class TestMultiprocess:
+
+    def test_merge_sums_counters_and_histograms_and_respects_gauge_mode(self):
+        first, second = MetricsRegistry(), MetricsRegistry()
+        for registry, depth in ((first, 3), (second, 5)):
+            registry.increment("jobs_total", depth)
+            registry.gauge("in_flight").set(depth)
+            registry.gauge("queue_depth", multiprocess_mode="max").set(depth)
+            registry.histogram("latency_seconds", buckets=(1.0,)).observe(depth / 10)
+
+        merged = merge_metric_snapshots([first.snapshot(), second.snapshot()])
+        flat, histograms = render_metrics_json(merged)
+        assert flat == {"in_flight": 8, "jobs_total": 8, "queue_depth": 5}
+        assert histograms["latency_seconds"]["count"] == 2
+        assert histograms["latency_seconds"]["sum"] == pytest.approx(0.8)
+
+    def test_collect_reads_other_workers_files(self, tmp_path):
+        worker = MetricsRegistry(str(tmp_path))
+        worker.increment("jobs_total", 2)
+        worker.gauge("in_flight").set(4)
+        asyncio.run(worker.flush())
+        (tmp_path / f"metrics-{os.getpid()}.json").rename(tmp_path / "metrics-1.json")
+
+        stale = MetricsRegistry(str(tmp_path))
+        stale.increment("jobs_total", 10)
+        stale.gauge("in_flight").set(100)
+        asyncio.run(stale.flush())
+        stale_file = tmp_path / "metrics-2.json"
+        (tmp_path / f"metrics-{os.getpid()}.json").rename(stale_file)
+        os.utime(stale_file, (0, 0))
+
+        local = MetricsRegistry(str(tmp_path))
+        local.increment("jobs_total")
+        flat, _ = render_metrics_json(asyncio.run(local.collect()))
+        assert flat == {"in_flight": 4, "jobs_total": 13}
+
+
+class TestPrometheusText:
+
+    def test_exposition_format(self):
+        registry = MetricsRegistry()
+        registry.counter("webhooks_total", "Webhooks received", ("event",)).inc(event='say "hi"')
+        registry.histogram("latency_seconds", buckets=(0.5,)).observe(0.2)
+
+        text = render_metrics_prometheus(registry.snapshot())
+        assert "# HELP webhooks_total Webhooks received\n# TYPE webhooks_total counter\n" in text
+        assert 'webhooks_total{event="say \\"hi\\""} 1\n' in text
+        assert 'latency_seconds_bucket{le="0.5"} 1\n' in text
+        assert 'latency_seconds_bucket{le="+Inf"} 1\n' in text
+        assert "latency_seconds_count 1\n" in text
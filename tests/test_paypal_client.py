@@ -0,0 +1,115 @@
+"""
+PayPal client tests against a local fake PayPal server: token caching, retries, pooling.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_paypal import FakePayPal
+from server import PayPalClient
+
+
+def _run(scenario, **fake_kwargs):
+    async def wrapper():
+        fake = await FakePayPal(**fake_kwargs).start()
+        paypal = PayPalClient(fake.base_url, "client-id", "client-secret", max_retries=2, backoff=0)
+        try:
+            await scenario(fake, paypal)
+        finally:
+            await paypal.close()
+            await fake.stop()
+
+    asyncio.run(wrapper())
+
+
+class TestPayPalClient:
+
+    def test_token_is_cached_and_refreshed_once_under_concurrency(self):
+        async def scenario(fake, paypal):
+            tokens = await asyncio.gather(*(paypal.access_token() for _ in range(10)))
+            assert set(tokens) == {"fake-token-1"}
+            assert await paypal.access_token() == "fake-token-1"
+            assert fake.token_requests == 1
+
+        _run(scenario)
+
+    def test_token_inside_refresh_margin_is_not_reused(self):
+        async def scenario(fake, paypal):
+            assert await paypal.access_token() == "fake-token-1"
+            assert await paypal.access_token() == "fake-token-2"
+
+        _run(scenario, expires_in=30)
+
+    def test_session_is_reused_across_requests(self):
+        async def scenario(fake, paypal):
+            fake.subscriptions["I-1"] = {"id": "I-1", "status": "ACTIVE"}
+            first = await paypal.request("GET", "/v1/billing/subscriptions/I-1")
+            session = paypal._session
+            second = await paypal.request("GET", "/v1/billing/subscriptions/I-1")
+            assert first.status == second.status == 200
+            assert second.data["status"] == "ACTIVE"
+            assert paypal._session is session
+
+        _run(scenario)
+
+    def test_transient_failures_are_retried_with_one_request_id(self):
+        async def scenario(fake, paypal):
+            fake.subscriptions["I-2"] = {"id": "I-2", "status": "ACTIVE"}
+            await paypal.access_token()
+            fake.fail_next = [503, 502]
+            response = await paypal.request("POST", "/v1/billing/subscriptions/I-2/cancel", json_body={"reason": "test"})
+            assert response.status == 204
+            request_ids = {headers["PayPal-Request-Id"] for _, _, headers in fake.requests}
+            assert len(fake.requests) == 3
+            assert len(request_ids) == 1
+            assert fake.subscriptions["I-2"]["status"] == "CANCELLED"
+
+        _run(scenario)
+
+    def test_retries_give_up_with_last_response(self):
+        async def scenario(fake, paypal):
+            await paypal.access_token()
+            fake.fail_next = [503, 503, 503, 503]
+            response = await paypal.request("GET", "/v1/billing/subscriptions/I-3")
+            assert response.status == 503
+            assert len(fake.requests) == 3
+
+        _run(scenario)
+
+    def test_revoked_token_is_replaced_once(self):
+        async def scenario(fake, paypal):
+            fake.subscriptions["I-4"] = {"id": "I-4", "status": "ACTIVE"}
+            fake.revoked_tokens.add(await paypal.access_token())
+            response = await paypal.request("GET", "/v1/billing/subscriptions/I-4")
+            assert response.status == 200
+            assert fake.token_requests == 2
+
+        _run(scenario)
+
+    def test_token_failure_returns_none(self):
+        async def scenario(fake, paypal):
+            fake.fail_next = [500, 500, 500]
+            assert await paypal.request("GET", "/v1/billing/subscriptions/I-5") is None
+
+        _run(scenario)
+
+    def test_webhook_verification_round_trip(self):
+        async def scenario(fake, paypal):
+            response = await paypal.request("POST", "/v1/notifications/verify-webhook-signature", json_body={"transmission_sig": "valid"})
+            assert response.data == {"verification_status": "SUCCESS"}
+
+        _run(scenario)
@@ -0,0 +1,187 @@
+"""
+PayPal webhook inbox tests: the (event_id, transmission_time) idempotency key, the body size
+cap, and per-subscription processing (rejected signatures, unavailable verification, and
+one ordered reconciliation for every pending event).
+"""
+
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+import server
+from fake_db import use_fake_db
+from server import PayPalWebhookStatus, process_paypal_webhook_events
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = use_fake_db(monkeypatch)
+    monkeypatch.setattr(server, "PAYPAL_WEBHOOK_ID", "WH-TEST")
+    asyncio.run(server.ensure_paypal_webhook_indexes())
+    asyncio.run(server.ensure_task_indexes())
+    asyncio.run(database.subscriptions.insert_one({
+        "id": "sub-1", "user_id": "u-1", "provider": "paypal", "provider_subscription_id": "I-SUB1", "status": "active"
+    }))
+    return database
+
+
+@pytest.fixture
+def paypal(monkeypatch):
+    """Stub signature checks (by transmission_sig) and reconciliation, recording both."""
+
+    class Stub:
+        signatures = {}  # transmission_sig -> True / False / None; unknown signatures are valid
+        reconcile_error = None
+        verified = []
+        reconciled = []
+
+    async def verify(**kwargs):
+        Stub.verified.append(kwargs["transmission_time"])
+        return Stub.signatures.get(kwargs["transmission_sig"], True)
+
+    async def reconcile(subscription_id, force=False):
+        Stub.reconciled.append(subscription_id)
+        if Stub.reconcile_error:
+            return {"success": False, "error": Stub.reconcile_error}
+        return {"success": True}
+
+    async def log_action(**kwargs):
+        pass
+
+    monkeypatch.setattr(server, "verify_paypal_webhook_signature", verify)
+    monkeypatch.setattr(server, "reconcile_subscription_with_paypal", reconcile)
+    monkeypatch.setattr(server, "log_paypal_action", log_action)
+    return Stub
+
+
+@pytest.fixture
+def client(db):
+    return TestClient(server.app)
+
+
+def _post(client, event_id="WH-1", transmission_time="2024-01-01T00:00:00Z", sig="sig", body=None):
+    body = body if body is not None else json.dumps({
+        "id": event_id, "event_type": "BILLING.SUBSCRIPTION.UPDATED", "resource": {"id": "I-SUB1"}
+    })
+    return client.post("/api/billing/paypal/webhook", content=body, headers={
+        "Content-Type": "application/json",
+        "PAYPAL-TRANSMISSION-ID": f"tx-{event_id}",
+        "PAYPAL-CERT-URL": "https://api.paypal.com/cert",
+        "PAYPAL-AUTH-ALGO": "SHA256withRSA",
+        "PAYPAL-TRANSMISSION-SIG": sig,
+        "PAYPAL-TRANSMISSION-TIME": transmission_time,
+    })
+
+
+def _events(db):
+    return asyncio.run(db.paypal_webhook_events.find({}, {"_id": 0}).sort("transmission_time", 1).to_list(None))
+
+
+class TestInbox:
+
+    def test_duplicate_delivery_is_stored_once(self, db, client):
+        assert _post(client).json() == {"status": "success"}
+        duplicate = _post(client)
+        assert duplicate.status_code == 200
+        assert duplicate.json()["message"] == "Event already processed"
+        assert len(_events(db)) == 1
+        # One queued task for the subscription
+        assert asyncio.run(db.tasks.count_documents({"name": "process_paypal_webhook_events"})) == 1
+
+    def test_same_event_resent_later_is_a_new_delivery(self, db, client):
+        _post(client, transmission_time="2024-01-01T00:00:00Z")
+        _post(client, transmission_time="2024-01-01T00:05:00Z")
+        assert len(_events(db)) == 2
+
+    def test_oversized_body_is_refused_before_storing(self, db, client):
+        padding = "x" * server.PAYPAL_WEBHOOK_MAX_BODY_BYTES
+        body = json.dumps({"id": "WH-big", "event_type": "X", "resource": {"id": "I-SUB1"}, "padding": padding})
+        response = _post(client, body=body)
+        assert response.status_code == 413
+        assert _events(db) == []
+
+    def test_missing_signature_headers_are_refused(self, db, client):
+        assert _post(client, sig="").status_code == 400
+        assert _events(db) == []
+
+
+class TestProcessing:
+
+    def test_rejected_signature_is_not_reconciled(self, db, client, paypal):
+        paypal.signatures["forged"] = False
+        _post(client, sig="forged")
+        asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        assert _events(db)[0]["status"] == PayPalWebhookStatus.REJECTED
+        assert paypal.reconciled == []
+
+    def test_unavailable_verification_raises_for_a_retry(self, db, client, paypal):
+        paypal.signatures["unknown"] = None
+        _post(client, sig="unknown")
+        with pytest.raises(RuntimeError):
+            asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        assert _events(db)[0]["status"] == PayPalWebhookStatus.RECEIVED
+
+        # Once PayPal answers again the retry processes it
+        paypal.signatures["unknown"] = True
+        asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        assert _events(db)[0]["status"] == PayPalWebhookStatus.PROCESSED
+
+    def test_pending_events_are_coalesced_in_transmission_order(self, db, client, paypal):
+        for index, transmission_time in enumerate(["2024-01-01T00:02:00Z", "2024-01-01T00:00:00Z", "2024-01-01T00:01:00Z"]):
+            _post(client, event_id=f"WH-{index}", transmission_time=transmission_time)
+        paypal.signatures["forged"] = False
+        _post(client, event_id="WH-forged", transmission_time="2024-01-01T00:03:00Z", sig="forged")
+
+        asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        assert paypal.verified == ["2024-01-01T00:00:00Z", "2024-01-01T00:01:00Z", "2024-01-01T00:02:00Z", "2024-01-01T00:03:00Z"]
+        # One reconciliation covers every verified event
+        assert paypal.reconciled == ["sub-1"]
+        statuses = [event["status"] for event in _events(db)]
+        assert statuses == [PayPalWebhookStatus.PROCESSED] * 3 + [PayPalWebhookStatus.REJECTED]
+        assert asyncio.run(db.processed_webhook_events.count_documents({})) == 3
+
+    def test_verified_events_are_not_verified_again_after_a_failed_reconcile(self, db, client, paypal):
+        _post(client)
+        paypal.reconcile_error = "PayPal down"
+        with pytest.raises(RuntimeError):
+            asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        assert _events(db)[0]["status"] == PayPalWebhookStatus.VERIFIED
+
+        paypal.reconcile_error = None
+        asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        assert len(paypal.verified) == 1
+        assert _events(db)[0]["status"] == PayPalWebhookStatus.PROCESSED
+
+    def test_other_subscriptions_are_left_alone(self, db, client, paypal):
+        _post(client)
+        asyncio.run(process_paypal_webhook_events("I-OTHER"))
+        assert paypal.verified == []
+        assert _events(db)[0]["status"] == PayPalWebhookStatus.RECEIVED
+
+    def test_retry_after_a_lost_status_update_records_events_once(self, db, client, paypal):
+        _post(client)
+        asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        # The worker died after recording the processed events but before marking them PROCESSED
+        asyncio.run(db.paypal_webhook_events.update_many({}, {"$set": {"status": PayPalWebhookStatus.VERIFIED}}))
+
+        asyncio.run(process_paypal_webhook_events("I-SUB1"))
+        assert _events(db)[0]["status"] == PayPalWebhookStatus.PROCESSED
+        assert asyncio.run(db.processed_webhook_events.count_documents({})) == 1
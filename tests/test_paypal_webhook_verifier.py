@@ -0,0 +1,137 @@
+"""
+Local PayPal webhook signature verification tests: cert allow-list, chain trust, LRU cache.
+"""
+
+import asyncio
+import base64
+import os
+import sys
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from server import PayPalWebhookVerifier
+
+CERT_URL = "https://api.paypal.com/v1/notifications/certs/CERT-360caa42"
+HOSTNAME = "messageverificationcerts.paypal.com"
+BODY = b'{"id":"WH-1","event_type":"BILLING.SUBSCRIPTION.ACTIVATED","resource":{"id":"I-1"}}'
+
+
+def _name(common_name):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+
+
+def _certificate(subject, subject_key, issuer, issuer_key, ca):
+    now = datetime.now(timezone.utc)
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(_name(subject))
+        .issuer_name(_name(issuer))
+        .public_key(subject_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(subject_key.public_key()), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+    )
+    if ca:
+        builder = builder.add_extension(
+            x509.KeyUsage(False, False, False, False, False, True, True, False, False), critical=True
+        )
+    else:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(subject)]), critical=False)
+        builder = builder.add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+    return builder.sign(issuer_key, hashes.SHA256())
+
+
+def _key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+CA_KEY = _key()
+CA = _certificate("Test Root CA", CA_KEY, "Test Root CA", CA_KEY, ca=True)
+LEAF_KEY = _key()
+LEAF_PEM = _certificate(HOSTNAME, LEAF_KEY, "Test Root CA", CA_KEY, ca=False).public_bytes(serialization.Encoding.PEM)
+
+
+def _signature(transmission_id="T-1", transmission_time="2026-01-01T00:00:00Z", webhook_id="WH-ID", body=BODY):
+    message = f"{transmission_id}|{transmission_time}|{webhook_id}|{zlib.crc32(body)}".encode()
+    return base64.b64encode(LEAF_KEY.sign(message, padding.PKCS1v15(), hashes.SHA256())).decode()
+
+
+class _Fetcher:
+
+    def __init__(self, pem=LEAF_PEM):
+        self.pem = pem
+        self.urls = []
+
+    async def __call__(self, url):
+        self.urls.append(url)
+        return self.pem
+
+
+def _verify(verifier, cert_url=CERT_URL, auth_algo="SHA256withRSA", body=BODY, signature=None):
+    return asyncio.run(verifier.verify(
+        webhook_id="WH-ID",
+        transmission_id="T-1",
+        cert_url=cert_url,
+        auth_algo=auth_algo,
+        transmission_sig=signature or _signature(),
+        transmission_time="2026-01-01T00:00:00Z",
+        webhook_body=body
+    ))
+
+
+class TestPayPalWebhookVerifier:
+
+    def test_valid_signature_and_certificate_is_cached(self):
+        fetch = _Fetcher()
+        verifier = PayPalWebhookVerifier(fetch, trust_roots=[CA])
+        assert _verify(verifier) is True
+        assert _verify(verifier) is True
+        assert fetch.urls == [CERT_URL]
+
+    def test_tampered_body_is_rejected(self):
+        verifier = PayPalWebhookVerifier(_Fetcher(), trust_roots=[CA])
+        assert _verify(verifier, body=BODY.replace(b"I-1", b"I-2")) is False
+
+    def test_cert_url_outside_allow_list_is_rejected_without_fetching(self):
+        fetch = _Fetcher()
+        verifier = PayPalWebhookVerifier(fetch, trust_roots=[CA])
+        assert _verify(verifier, cert_url="https://evil.example.com/cert.pem") is False
+        assert _verify(verifier, cert_url="http://api.paypal.com/cert.pem") is False
+        assert fetch.urls == []
+
+    def test_untrusted_chain_falls_back(self):
+        verifier = PayPalWebhookVerifier(_Fetcher(), trust_roots=[_certificate("Other CA", _key(), "Other CA", CA_KEY, ca=True)])
+        assert _verify(verifier) is None
+
+    def test_unknown_algorithm_falls_back(self):
+        verifier = PayPalWebhookVerifier(_Fetcher(), trust_roots=[CA])
+        assert _verify(verifier, auth_algo="SHA512withECDSA") is None
+
+    def test_cache_evicts_least_recently_used_url(self):
+        fetch = _Fetcher()
+        verifier = PayPalWebhookVerifier(fetch, trust_roots=[CA], cache_size=1)
+        other_url = "https://api.sandbox.paypal.com/v1/notifications/certs/CERT-2"
+        assert _verify(verifier) is True
+        assert _verify(verifier, cert_url=other_url) is True
+        assert _verify(verifier) is True
+        assert fetch.urls == [CERT_URL, other_url, CERT_URL]
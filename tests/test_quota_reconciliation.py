@@ -0,0 +1,120 @@
+"""
+Quota reconciliation job tests: recorded file figures vs. file totals, unrecorded users, and
+fixes that are verified by reading the figure back.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import run_job
+
+NOW = datetime.now(timezone.utc).isoformat()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    return use_fake_db(monkeypatch)
+
+
+def _user(db, user_id, **figures):
+    asyncio.run(db.users.insert_one({"id": user_id, "email": f"{user_id}@example.com", "name": user_id, **figures}))
+
+
+def _file(db, file_id, user_id, size_bytes, blob_id=None):
+    record = {"id": file_id, "user_id": user_id, "workspace_id": "ws-1", "status": "active", "size_bytes": size_bytes, "url": f"/api/media/{file_id}"}
+    if blob_id:
+        record["blob_id"] = blob_id
+    asyncio.run(db.files.insert_one(record))
+
+
+def _reconcile(db, fix=False, target="all"):
+    asyncio.run(db.jobs.insert_one({
+        "id": "job-1", "type": "quota_reconciliation", "target_id": target, "requested_by": "admin",
+        "params": {"fix_discrepancies": fix}, "status": "queued", "completed_phases": [], "checkpoint": {},
+        "progress": {}, "attempts": 0, "created_at": NOW, "updated_at": NOW
+    }))
+    asyncio.run(run_job("job-1"))
+    job = asyncio.run(db.jobs.find_one({"id": "job-1"}, {"_id": 0}))
+    assert job["status"] == "completed", job.get("error")
+    items = asyncio.run(db.quota_reconciliation_items.find({}, {"_id": 0}).to_list(None))
+    return job["progress"], {item["user_id"]: item for item in items}
+
+
+class TestCompare:
+
+    def test_users_without_a_recorded_figure_are_skipped(self, db):
+        _user(db, "u-1")
+        _user(db, "u-2", storage_used_bytes=None, storage_file_bytes=None)
+        _file(db, "f-1", "u-1", 100)
+        progress, items = _reconcile(db)
+        assert items == {}
+        assert progress == {"users_checked": 2, "unrecorded": 2, "discrepancies": 0}
+
+    def test_compares_file_figure_not_total_with_estimates(self, db):
+        # storage_used_bytes includes estimates for walkthrough media without a record
+        _user(db, "u-1", storage_used_bytes=100 + 200 * 1024, storage_file_bytes=100)
+        _file(db, "f-1", "u-1", 100)
+        progress, items = _reconcile(db)
+        assert items == {}
+        assert progress["discrepancies"] == 0
+
+    def test_shared_blob_counts_once(self, db):
+        _user(db, "u-1", storage_file_bytes=100)
+        _file(db, "f-1", "u-1", 100, blob_id="b-1")
+        _file(db, "f-2", "u-1", 100, blob_id="b-1")
+        _, items = _reconcile(db)
+        assert items == {}
+
+    def test_records_drift(self, db):
+        _user(db, "u-1", storage_file_bytes=50)
+        _user(db, "u-2", storage_file_bytes=10)  # Files all deleted since
+        _file(db, "f-1", "u-1", 100)
+        progress, items = _reconcile(db)
+        assert progress["discrepancies"] == 2
+        assert items["u-1"]["difference"] == 50 and items["u-1"]["recorded_bytes"] == 50
+        assert items["u-2"]["file_bytes"] == 0 and items["u-2"]["difference"] == -10
+        assert {item["status"] for item in items.values()} == {"pending"}
+
+
+class TestFix:
+
+    def test_fix_recomputes_and_verifies(self, db):
+        _user(db, "u-1", storage_file_bytes=50)
+        _file(db, "f-1", "u-1", 100)
+        progress, items = _reconcile(db, fix=True)
+        assert progress["fixed"] == 1 and progress["unresolved"] == 0
+        assert items["u-1"]["status"] == "fixed"
+        user = asyncio.run(db.users.find_one({"id": "u-1"}))
+        assert user["storage_file_bytes"] == 100
+        assert user["storage_used_bytes"] == 100
+
+    def test_lost_write_is_unresolved_not_fixed(self, db, monkeypatch):
+        async def recompute_without_recording(user_id):
+            return await server._compute_user_storage_usage(user_id)
+
+        monkeypatch.setattr(server, "get_user_storage_usage", recompute_without_recording)
+        _user(db, "u-1", storage_file_bytes=50)
+        _file(db, "f-1", "u-1", 100)
+        progress, items = _reconcile(db, fix=True)
+        assert progress["fixed"] == 0 and progress["unresolved"] == 1
+        assert items["u-1"]["status"] == "unresolved"
+        assert items["u-1"]["fixed_bytes"] == 50 and items["u-1"]["file_bytes_after"] == 100
@@ -0,0 +1,95 @@
+"""
+Scheduled reconciliation pipeline tests: rate limiting and tier selection.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_db import use_fake_db
+from server import TokenBucket, reconciliation_tiers
+
+NOW = "2026-01-01T00:00:00+00:00"
+HORIZON = "2026-01-02T00:00:00+00:00"
+
+
+class TestTokenBucket:
+
+    def test_burst_is_immediate_then_rate_limited(self):
+        async def scenario():
+            bucket = TokenBucket(rate=20, capacity=5)
+            started = time.monotonic()
+            for _ in range(5):
+                await bucket.acquire()
+            assert time.monotonic() - started < 0.05
+            for _ in range(4):
+                await bucket.acquire()
+            assert time.monotonic() - started >= 0.15
+            assert bucket.waited_seconds > 0
+
+        asyncio.run(scenario())
+
+    def test_concurrent_callers_share_the_rate(self):
+        async def scenario():
+            bucket = TokenBucket(rate=50, capacity=1)
+            started = time.monotonic()
+            await asyncio.gather(*(bucket.acquire() for _ in range(6)))
+            assert time.monotonic() - started >= 0.09
+
+        asyncio.run(scenario())
+
+
+class TestReconciliationTiers:
+
+    def test_tiers_run_grace_then_billing_then_rest(self):
+        tiers = reconciliation_tiers(HORIZON, NOW)
+        assert [name for name, _ in tiers] == ["grace", "billing_due", "rest"]
+
+    def test_tiers_skip_terminal_for_access_states(self):
+        for _, query in reconciliation_tiers(HORIZON, NOW):
+            assert query["provider"] == "paypal"
+            assert query["status"] == {"$nin": ["expired", "suspended"]}
+
+    def test_rest_is_the_complement_of_billing_due(self):
+        _, (_, billing_due), (_, rest) = reconciliation_tiers(HORIZON, NOW)
+        assert billing_due["grace_ends_at"] == rest["grace_ends_at"] == {"$not": {"$gte": NOW}}
+        assert rest["$nor"] == [{"next_billing_time": billing_due["next_billing_time"]}]
+
+    def test_each_subscription_lands_in_exactly_one_tier(self, monkeypatch):
+        db = use_fake_db(monkeypatch)
+        subscriptions = {
+            "in-grace": {"grace_ends_at": "2026-01-05T00:00:00+00:00"},
+            "grace-over": {"grace_ends_at": "2025-12-01T00:00:00+00:00", "next_billing_time": "2026-01-01T12:00:00+00:00"},
+            "billing": {"next_billing_time": "2026-01-01T12:00:00+00:00"},
+            "later": {"next_billing_time": "2026-02-01T00:00:00+00:00"},
+            "grace-over-later": {"grace_ends_at": "2025-12-01T00:00:00+00:00"},
+        }
+        for subscription_id, fields in subscriptions.items():
+            asyncio.run(db.subscriptions.insert_one({"id": subscription_id, "provider": "paypal", "status": "active", **fields}))
+
+        placed = {}
+        for name, query in reconciliation_tiers(HORIZON, NOW):
+            for document in asyncio.run(db.subscriptions.find(query).to_list(None)):
+                assert document["id"] not in placed
+                placed[document["id"]] = name
+        assert placed == {
+            "in-grace": "grace",
+            "grace-over": "billing_due",
+            "billing": "billing_due",
+            "later": "rest",
+            "grace-over-later": "rest",
+        }
@@ -0,0 +1,84 @@
+"""
+Storage provider tests (local filesystem backend).
+"""
+
+import asyncio
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from server import LocalStorageProvider, StorageProvider
+
+
+@pytest.fixture
+def provider(tmp_path):
+    local = LocalStorageProvider(root=tmp_path, max_workers=2)
+    yield local
+    asyncio.run(local.close())
+
+
+class TestLocalStorageProvider:
+
+    def test_upload_stat_destroy_roundtrip(self, provider):
+        async def scenario():
+            result = await provider.upload(
+                b"gif-bytes", public_id="file-1", folder="guide2026/owner/ws", resource_type="image", filename="a.GIF"
+            )
+            assert result["secure_url"] == "/api/media/file-1.gif"
+            assert result["public_id"] == "guide2026/owner/ws/file-1"
+            assert result["bytes"] == len(b"gif-bytes")
+
+            info = await provider.stat(result["public_id"])
+            assert info["bytes"] == len(b"gif-bytes")
+            assert provider.local_path(result["public_id"]).read_bytes() == b"gif-bytes"
+
+            assert await provider.destroy(result["public_id"]) is True
+            assert await provider.stat(result["public_id"]) is None
+
+        asyncio.run(scenario())
+
+    def test_upload_accepts_file_objects(self, provider):
+        async def scenario():
+            result = await provider.upload(io.BytesIO(b"x" * 4096), public_id="file-2", folder="f", filename="b.png")
+            assert result["bytes"] == 4096
+
+        asyncio.run(scenario())
+
+    def test_delete_batch_reports_per_item(self, provider):
+        async def scenario():
+            await provider.upload(b"1", public_id="a", folder="f", filename="a.png")
+            results = await provider.delete_batch(["f/a", "f/missing"])
+            assert results == {"f/a": "deleted", "f/missing": "not_found"}
+            assert provider.local_path("f/a") is None
+
+        asyncio.run(scenario())
+
+    def test_public_id_cannot_escape_root(self, provider):
+        assert provider.local_path("../../etc/passwd") is None
+        with pytest.raises(ValueError):
+            asyncio.run(provider.upload(b"x", public_id="../../escape", folder="", filename="x.png"))
+
+
+class TestStorageProviderInterface:
+
+    def test_provider_missing_a_method_fails_at_construction(self):
+        class UploadOnly(StorageProvider):
+            async def upload(self, source, *, public_id, folder, resource_type="auto", filename=None, size=None, options=None):
+                return {}
+
+        with pytest.raises(TypeError):
+            UploadOnly(max_workers=1)
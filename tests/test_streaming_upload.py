@@ -0,0 +1,125 @@
+"""
+Streaming upload reader tests: limits are enforced while the body arrives.
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from server import StreamingUploadReader, UploadLimits
+
+BOUNDARY = "testboundary"
+
+
+def _multipart(fields, file_bytes, file_first=False):
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n".encode()
+        )
+    file_part = (
+        f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"clip.mp4\"\r\n"
+        f"Content-Type: video/mp4\r\n\r\n"
+    ).encode() + file_bytes + b"\r\n"
+    parts.insert(0 if file_first else len(parts), file_part)
+    return b"".join(parts) + f"--{BOUNDARY}--\r\n".encode()
+
+
+def _request(body, chunk_size=1024):
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    consumed = {"count": 0}
+
+    async def receive():
+        if consumed["count"] < len(chunks):
+            chunk = chunks[consumed["count"]]
+            consumed["count"] += 1
+            return {"type": "http.request", "body": chunk, "more_body": consumed["count"] < len(chunks)}
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/upload",
+        "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())],
+    }
+    return Request(scope, receive), consumed, len(chunks)
+
+
+class TestStreamingUploadReader:
+
+    def test_reads_fields_and_spools_file(self):
+        body = _multipart({"workspace_id": "ws-1", "reference_type": "step_media"}, b"a" * 5000)
+        request, _, _ = _request(body)
+        reader = StreamingUploadReader(request)
+        seen = {}
+
+        async def on_file_start(upload_reader):
+            seen.update(upload_reader.fields)
+
+        asyncio.run(reader.read(on_file_start))
+        assert seen == {"workspace_id": "ws-1", "reference_type": "step_media"}
+        assert reader.filename == "clip.mp4"
+        assert reader.size == 5000
+        assert reader.file.read() == b"a" * 5000
+        assert reader.sha256.hexdigest() == hashlib.sha256(b"a" * 5000).hexdigest()
+        reader.close()
+
+    def test_rejects_mid_stream_when_plan_limit_crossed(self):
+        body = _multipart({"workspace_id": "ws-1"}, b"b" * 64 * 1024)
+        request, consumed, total_chunks = _request(body)
+        reader = StreamingUploadReader(request)
+
+        async def on_file_start(upload_reader):
+            upload_reader.limits = UploadLimits(max_file_size_bytes=4096)
+
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(reader.read(on_file_start))
+        assert exc_info.value.status_code == 413
+        assert consumed["count"] < total_chunks
+        reader.close()
+
+    def test_rejects_when_quota_would_be_exceeded(self):
+        body = _multipart({"workspace_id": "ws-1"}, b"c" * 8192)
+        request, _, _ = _request(body)
+        reader = StreamingUploadReader(request)
+
+        async def on_file_start(upload_reader):
+            upload_reader.limits = UploadLimits(max_file_size_bytes=10 ** 9, storage_used=1000, storage_allowed=5000)
+
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(reader.read(on_file_start))
+        assert exc_info.value.status_code == 402
+        reader.close()
+
+    def test_file_before_fields_still_collects_fields(self):
+        body = _multipart({"workspace_id": "ws-2"}, b"d" * 100, file_first=True)
+        request, _, _ = _request(body, chunk_size=64)
+        reader = StreamingUploadReader(request)
+        seen = {}
+
+        async def on_file_start(upload_reader):
+            seen.update(upload_reader.fields)
+
+        asyncio.run(reader.read(on_file_start))
+        assert seen == {}
+        assert reader.fields == {"workspace_id": "ws-2"}
+        assert reader.size == 100
+        reader.close()
@@ -0,0 +1,204 @@
+"""
+Task queue tests: retry backoff, handler registration, claims and the visibility timeout,
+the visibility heartbeat, dead-lettering and pruning.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import server
+from fake_db import use_fake_db
+from server import (
+    TASK_BACKOFF_BASE_SECONDS,
+    TASK_BACKOFF_MAX_SECONDS,
+    TASK_HANDLERS,
+    TASK_QUEUE_CONCURRENCY,
+    TaskStatus,
+    claim_task,
+    enqueue_task,
+    prune_tasks,
+    run_task,
+    task_backoff_seconds,
+)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    return use_fake_db(monkeypatch)
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    """A "test_task" handler on the email queue; set `fail` to make it raise."""
+    state = SimpleNamespace(fail=False, calls=[])
+
+    async def test_task(**payload):
+        state.calls.append(payload)
+        if state.fail:
+            raise RuntimeError("boom")
+
+    monkeypatch.setitem(server.TASK_HANDLERS, "test_task", ("email", test_task))
+    return state
+
+
+def _task(db, task_id):
+    return asyncio.run(db.tasks.find_one({"id": task_id}, {"_id": 0}))
+
+
+def _make_visible(db, task_id):
+    past = (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+    asyncio.run(db.tasks.update_one({"id": task_id}, {"$set": {"visible_at": past}}))
+
+
+class TestTaskBackoff:
+
+    def test_backoff_doubles_within_jitter(self):
+        for attempts in range(1, 5):
+            delay = task_backoff_seconds(attempts)
+            ceiling = TASK_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1)
+            assert 0.75 * ceiling <= delay <= ceiling
+
+    def test_backoff_is_capped(self):
+        assert task_backoff_seconds(50) <= TASK_BACKOFF_MAX_SECONDS
+
+
+class TestTaskHandlers:
+
+    def test_every_handler_targets_a_worker_queue(self):
+        for name, (queue, handler) in TASK_HANDLERS.items():
+            assert queue in TASK_QUEUE_CONCURRENCY, name
+            assert callable(handler)
+
+    def test_every_worker_queue_has_a_handler(self):
+        # A queue without handlers would only poll MongoDB
+        assert set(TASK_QUEUE_CONCURRENCY) == {queue for queue, _ in TASK_HANDLERS.values()}
+
+    def test_email_outbox_drain_is_registered(self):
+        assert TASK_HANDLERS["deliver_email_outbox"][0] == "email"
+
+
+class TestClaim:
+
+    def test_claim_hides_the_task(self, db, handler):
+        task = asyncio.run(enqueue_task("test_task", {"item_id": "i-1"}))
+        claimed = asyncio.run(claim_task("email", "worker-1"))
+        assert claimed["id"] == task["id"]
+        assert claimed["status"] == TaskStatus.RUNNING and claimed["attempts"] == 1
+        assert claimed["visible_at"] > datetime.now(timezone.utc).isoformat()
+        assert asyncio.run(claim_task("email", "worker-2")) is None
+
+    def test_expired_claim_is_taken_over_and_fenced(self, db, handler):
+        task = asyncio.run(enqueue_task("test_task", {}))
+        stale = asyncio.run(claim_task("email", "worker-1"))
+        # worker-1 stalls past the visibility timeout
+        _make_visible(db, task["id"])
+        fresh = asyncio.run(claim_task("email", "worker-2"))
+        assert fresh["attempts"] == 2 and fresh["claim_id"] != stale["claim_id"]
+
+        # The stale worker's late ack changes nothing; the new holder's does
+        asyncio.run(server._finish_task(stale, None))
+        assert _task(db, task["id"])["status"] == TaskStatus.RUNNING
+        asyncio.run(server._finish_task(fresh, None))
+        done = _task(db, task["id"])
+        assert done["status"] == TaskStatus.SUCCEEDED
+        assert "payload" not in done and "claim_id" not in done
+
+    def test_dedupe_key_returns_the_active_task(self, db, handler):
+        assert asyncio.run(server.ensure_task_indexes())
+        first = asyncio.run(enqueue_task("test_task", {}, dedupe_key="k"))
+        second = asyncio.run(enqueue_task("test_task", {}, dedupe_key="k"))
+        assert second["id"] == first["id"]
+        assert asyncio.run(db.tasks.count_documents({})) == 1
+
+
+class TestVisibilityHeartbeat:
+
+    def test_long_running_handler_stays_hidden(self, db, monkeypatch):
+        monkeypatch.setattr(server, "TASK_VISIBILITY_TIMEOUT_SECONDS", 0.3)
+        seen = []
+
+        async def slow_task():
+            for _ in range(2):
+                task = await db.tasks.find_one({"name": "slow_task"})
+                seen.append(task["visible_at"])
+                # Nobody else can claim it while the heartbeat runs
+                assert await claim_task("email", "worker-2") is None
+                await asyncio.sleep(0.25)
+
+        monkeypatch.setitem(server.TASK_HANDLERS, "slow_task", ("email", slow_task))
+
+        async def scenario():
+            await enqueue_task("slow_task", {})
+            await run_task(await claim_task("email", "worker-1"))
+
+        asyncio.run(scenario())
+        assert seen[1] > seen[0]
+        assert asyncio.run(db.tasks.find_one({"name": "slow_task"}))["status"] == TaskStatus.SUCCEEDED
+
+
+class TestDeadLetter:
+
+    def test_failures_retry_then_dead_letter(self, db, handler):
+        handler.fail = True
+        task = asyncio.run(enqueue_task("test_task", {"item_id": "i-1"}, max_attempts=2, dedupe_key="k"))
+
+        asyncio.run(run_task(asyncio.run(claim_task("email", "worker-1"))))
+        retried = _task(db, task["id"])
+        assert retried["status"] == TaskStatus.QUEUED and retried["last_error"] == "RuntimeError: boom"
+        assert retried["visible_at"] > datetime.now(timezone.utc).isoformat()
+        assert asyncio.run(claim_task("email", "worker-1")) is None  # Backing off
+
+        _make_visible(db, task["id"])
+        asyncio.run(run_task(asyncio.run(claim_task("email", "worker-1"))))
+        dead = _task(db, task["id"])
+        assert dead["status"] == TaskStatus.DEAD and dead["attempts"] == 2
+        assert "dead_at" in dead and "dedupe_key" not in dead
+        # Kept for an admin retry, and never claimed again on its own
+        assert dead["payload"] == {"item_id": "i-1"}
+        _make_visible(db, task["id"])
+        assert asyncio.run(claim_task("email", "worker-1")) is None
+        assert len(handler.calls) == 2
+
+    def test_unknown_handler_dead_letters_at_once(self, db, handler):
+        task = asyncio.run(enqueue_task("test_task", {}))
+        claimed = asyncio.run(claim_task("email", "worker-1"))
+        asyncio.run(run_task({**claimed, "name": "removed_task"}))
+        assert _task(db, task["id"])["status"] == TaskStatus.DEAD
+
+
+class TestPrune:
+
+    def test_prunes_old_succeeded_and_dead_tasks(self, db):
+        now = datetime.now(timezone.utc)
+        old_done = (now - timedelta(days=server.TASK_RETENTION_DAYS + 1)).isoformat()
+        old_dead = (now - timedelta(days=server.TASK_DEAD_RETENTION_DAYS + 1)).isoformat()
+        recent = now.isoformat()
+        asyncio.run(db.tasks.insert_many([
+            {"id": "t-done-old", "status": TaskStatus.SUCCEEDED, "completed_at": old_done},
+            {"id": "t-done-new", "status": TaskStatus.SUCCEEDED, "completed_at": recent},
+            {"id": "t-dead-old", "status": TaskStatus.DEAD, "dead_at": old_dead},
+            # Past the succeeded retention but not the dead one
+            {"id": "t-dead-new", "status": TaskStatus.DEAD, "dead_at": old_done},
+            {"id": "t-queued", "status": TaskStatus.QUEUED, "created_at": old_dead},
+        ]))
+        asyncio.run(prune_tasks())
+        remaining = asyncio.run(db.tasks.distinct("id"))
+        assert sorted(remaining) == ["t-dead-new", "t-done-new", "t-queued"]
@@ -0,0 +1,287 @@
+"""
+Resumable upload session tests: create, chunk, commit, abort, stale-commit recovery, de-duplication
+and the spooled chunk store.
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/test")
+os.environ.setdefault("JWT_SECRET", "test-secret-key-32-chars-minimum")
+os.environ.setdefault("CLOUDINARY_CLOUD_NAME", "test")
+os.environ.setdefault("CLOUDINARY_API_KEY", "test")
+os.environ.setdefault("CLOUDINARY_API_SECRET", "test")
+os.environ.setdefault("RESEND_API_KEY", "test")
+os.environ.setdefault("RESEND_FROM_EMAIL", "test@example.com")
+
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.insert(0, str(backend_path))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.testclient import TestClient
+
+import server
+from fake_db import authenticate, seed_workspace_owner, use_fake_db
+from server import UPLOAD_SESSION_MIN_CHUNK_BYTES, LocalStorageProvider, get_reserved_upload_bytes
+
+CHUNK = UPLOAD_SESSION_MIN_CHUNK_BYTES
+CONTENT = os.urandom(CHUNK * 2 + 1000)
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    database = use_fake_db(monkeypatch)
+    provider = LocalStorageProvider(root=tmp_path, max_workers=1)
+    monkeypatch.setattr(server, "storage_provider", provider)
+    asyncio.run(seed_workspace_owner(database))
+    yield database
+    asyncio.run(provider.close())
+
+
+@pytest.fixture
+def client(db):
+    return authenticate(TestClient(server.app))
+
+
+def _create(client, content=CONTENT, **extra):
+    response = client.post("/api/uploads/sessions", json={
+        "workspace_id": "ws-1",
+        "filename": "clip.png",
+        "size_bytes": len(content),
+        "chunk_size": CHUNK,
+        **extra
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def _put(client, session_id, index, content=CONTENT):
+    data = content[index * CHUNK:(index + 1) * CHUNK]
+    return client.put(
+        f"/api/uploads/sessions/{session_id}/chunks/{index}",
+        content=data,
+        headers={"X-Chunk-SHA256": hashlib.sha256(data).hexdigest()}
+    )
+
+
+class TestUploadSessionLifecycle:
+
+    def test_create_reserves_quota_and_lists_missing_chunks(self, client, db):
+        session = _create(client)
+        assert session["total_chunks"] == 3
+        assert session["missing_chunks"] == [0, 1, 2]
+        assert asyncio.run(get_reserved_upload_bytes("owner-1")) == len(CONTENT)
+        file_record = asyncio.run(db.files.find_one({"id": session["file_id"]}))
+        assert file_record["status"] == "pending"
+
+    def test_chunks_are_checked_and_resumable(self, client):
+        session = _create(client, idempotency_key="resume-me")
+        assert _put(client, session["session_id"], 0).status_code == 200
+        bad = client.put(
+            f"/api/uploads/sessions/{session['session_id']}/chunks/1",
+            content=CONTENT[CHUNK:2 * CHUNK],
+            headers={"X-Chunk-SHA256": "0" * 64}
+        )
+        assert bad.status_code == 422
+
+        resumed = _create(client, idempotency_key="resume-me")
+        assert resumed["session_id"] == session["session_id"]
+        assert resumed["received_chunks"] == [0]
+        assert resumed["received_ranges"] == [{"start": 0, "end": CHUNK - 1}]
+
+    def test_commit_assembles_and_activates_file(self, client, db):
+        session = _create(client)
+        for index in range(3):
+            assert _put(client, session["session_id"], index).status_code == 200
+
+        result = client.post(f"/api/uploads/sessions/{session['session_id']}/commit").json()
+        assert result["status"] == "active"
+        stored = server.storage_provider.local_path(result["public_id"]).read_bytes()
+        assert stored == CONTENT
+
+        file_record = asyncio.run(db.files.find_one({"id": session["file_id"]}))
+        assert file_record["status"] == "active"
+        assert file_record["content_hash"] == hashlib.sha256(CONTENT).hexdigest()
+        assert asyncio.run(db.upload_chunks.count_documents({})) == 0
+        assert asyncio.run(get_reserved_upload_bytes("owner-1")) == 0
+        # Committing again returns the stored result
+        again = client.post(f"/api/uploads/sessions/{session['session_id']}/commit")
+        assert again.json() == result
+
+    def test_incomplete_commit_reopens_session(self, client):
+        session = _create(client)
+        _put(client, session["session_id"], 0)
+        response = client.post(f"/api/uploads/sessions/{session['session_id']}/commit")
+        assert response.status_code == 409
+        assert client.get(f"/api/uploads/sessions/{session['session_id']}").json()["status"] == "open"
+
+    def test_abort_releases_quota_and_fails_file(self, client, db):
+        session = _create(client)
+        _put(client, session["session_id"], 0)
+        assert client.delete(f"/api/uploads/sessions/{session['session_id']}").json()["status"] == "aborted"
+        assert asyncio.run(get_reserved_upload_bytes("owner-1")) == 0
+        assert asyncio.run(db.upload_chunks.count_documents({})) == 0
+        assert asyncio.run(db.files.find_one({"id": session["file_id"]}))["status"] == "failed"
+        assert client.delete(f"/api/uploads/sessions/{session['session_id']}").status_code == 409
+
+
+class TestChunkStorage:
+
+    @pytest.fixture
+    def spool(self, monkeypatch, tmp_path):
+        chunk_dir = tmp_path / "chunks"
+        monkeypatch.setattr(server, "UPLOAD_CHUNK_DIR", str(chunk_dir))
+        return chunk_dir
+
+    def test_chunks_expire_with_their_session(self, client, db):
+        session = _create(client)
+        _put(client, session["session_id"], 0)
+        chunk = asyncio.run(db.upload_chunks.find_one({"session_id": session["session_id"]}))
+        expected = datetime.fromisoformat(session["expires_at"]) + timedelta(hours=server.UPLOAD_CHUNK_TTL_GRACE_HOURS)
+        # Stored as a BSON date (what a TTL index needs): naive UTC, millisecond precision
+        assert isinstance(chunk["expires_at"], datetime)
+        assert abs(chunk["expires_at"].replace(tzinfo=timezone.utc) - expected) < timedelta(milliseconds=1)
+
+    def test_spooled_chunks_keep_only_metadata_in_mongo(self, client, db, spool):
+        session = _create(client)
+        for index in range(3):
+            assert _put(client, session["session_id"], index).status_code == 200
+        chunk = asyncio.run(db.upload_chunks.find_one({"session_id": session["session_id"], "index": 0}))
+        assert "data" not in chunk and chunk["size"] == CHUNK
+        assert (spool / session["session_id"] / "0.part").read_bytes() == CONTENT[:CHUNK]
+
+        result = client.post(f"/api/uploads/sessions/{session['session_id']}/commit").json()
+        assert server.storage_provider.local_path(result["public_id"]).read_bytes() == CONTENT
+        assert not (spool / session["session_id"]).exists()
+
+    def test_missing_spooled_chunk_is_asked_for_again(self, client, db, spool):
+        session = _create(client)
+        for index in range(3):
+            _put(client, session["session_id"], index)
+        (spool / session["session_id"] / "1.part").unlink()
+
+        response = client.post(f"/api/uploads/sessions/{session['session_id']}/commit")
+        assert response.status_code == 409
+        state = client.get(f"/api/uploads/sessions/{session['session_id']}").json()
+        assert state["status"] == "open" and state["missing_chunks"] == [1]
+
+    def test_abort_and_sweep_remove_spooled_chunks(self, client, db, spool):
+        aborted = _create(client, idempotency_key="a")
+        _put(client, aborted["session_id"], 0)
+        client.delete(f"/api/uploads/sessions/{aborted['session_id']}")
+        assert not (spool / aborted["session_id"]).exists()
+
+        live = _create(client, idempotency_key="b")
+        expired = _create(client, idempotency_key="c")
+        for session in (live, expired):
+            _put(client, session["session_id"], 0)
+        past = (datetime.now(timezone.utc) - timedelta(hours=server.UPLOAD_CHUNK_TTL_GRACE_HOURS + 1)).isoformat()
+        asyncio.run(db.upload_sessions.update_one({"id": expired["session_id"]}, {"$set": {"expires_at": past}}))
+        (spool / "unknown-session").mkdir()
+
+        asyncio.run(server.sweep_upload_chunk_dir())
+        assert sorted(entry.name for entry in spool.iterdir()) == [live["session_id"]]
+
+
+class TestStaleCommitRecovery:
+
+    def _mark_committing(self, db, session_id, age_seconds):
+        updated_at = (datetime.now(timezone.utc) - timedelta(seconds=age_seconds)).isoformat()
+        asyncio.run(db.upload_sessions.update_one(
+            {"id": session_id}, {"$set": {"status": "committing", "updated_at": updated_at}}
+        ))
+
+    def test_live_commit_cannot_be_aborted_or_recommitted(self, client, db):
+        session = _create(client)
+        self._mark_committing(db, session["session_id"], age_seconds=10)
+        assert client.delete(f"/api/uploads/sessions/{session['session_id']}").status_code == 409
+        assert client.post(f"/api/uploads/sessions/{session['session_id']}/commit").status_code == 409
+
+    def test_stale_commit_can_be_aborted(self, client, db):
+        session = _create(client)
+        self._mark_committing(db, session["session_id"], age_seconds=server.UPLOAD_COMMIT_STALE_SECONDS + 60)
+        assert client.delete(f"/api/uploads/sessions/{session['session_id']}").status_code == 200
+        assert asyncio.run(get_reserved_upload_bytes("owner-1")) == 0
+
+    def test_stale_commit_can_be_retried(self, client, db):
+        session = _create(client)
+        for index in range(3):
+            _put(client, session["session_id"], index)
+        self._mark_committing(db, session["session_id"], age_seconds=server.UPLOAD_COMMIT_STALE_SECONDS + 60)
+        response = client.post(f"/api/uploads/sessions/{session['session_id']}/commit")
+        assert response.status_code == 200
+        assert response.json()["status"] == "active"
+
+    def test_cleanup_reopens_stale_commits_and_expires_old_ones(self, client, db):
+        reopened = _create(client)
+        expired = _create(client, content=CONTENT[:CHUNK])
+        stale = server.UPLOAD_COMMIT_STALE_SECONDS + 60
+        self._mark_committing(db, reopened["session_id"], age_seconds=stale)
+        self._mark_committing(db, expired["session_id"], age_seconds=stale)
+        past = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+        asyncio.run(db.upload_sessions.update_one({"id": expired["session_id"]}, {"$set": {"expires_at": past}}))
+
+        report = client.post("/api/admin/cleanup-files", params={"dry_run": False}).json()
+        assert report["stale_commits_reopened"] == 1
+        assert report["expired_upload_sessions_collected"] == 1
+        assert client.get(f"/api/uploads/sessions/{reopened['session_id']}").json()["status"] == "open"
+        assert client.get(f"/api/uploads/sessions/{expired['session_id']}").json()["status"] == "expired"
+
+
+class TestContentDeduplication:
+
+    def _upload(self, client, content=CONTENT, **extra):
+        session = _create(client, content=content, **extra)
+        for index in range(session["total_chunks"]):
+            assert _put(client, session["session_id"], index, content=content).status_code == 200
+        response = client.post(f"/api/uploads/sessions/{session['session_id']}/commit")
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    def test_identical_commit_references_existing_blob(self, client, db):
+        first = self._upload(client)
+        second = self._upload(client)
+        assert second["public_id"] == first["public_id"]
+        assert second["file_id"] != first["file_id"]
+
+        blob = asyncio.run(db.media_blobs.find_one({"workspace_id": "ws-1"}))
+        assert blob["ref_count"] == 2
+        records = asyncio.run(db.files.find({"status": "active"}).to_list(None))
+        assert {record["blob_id"] for record in records} == {blob["id"]}
+
+    def test_client_checksum_alone_never_claims_a_blob(self, client, db):
+        first = self._upload(client)
+        session = _create(client, sha256=hashlib.sha256(CONTENT).hexdigest())
+        # A session is opened and the bytes must still be sent
+        assert session["missing_chunks"] == [0, 1, 2]
+        assert asyncio.run(db.media_blobs.find_one({}))["ref_count"] == 1
+        assert first["file_id"] != session["file_id"]
+
+    def test_blobs_are_not_shared_across_workspaces(self, client, db):
+        asyncio.run(db.workspaces.insert_one({
+            "id": "ws-2", "name": "Other", "slug": "ws-2", "owner_id": "owner-1",
+            "created_at": "2024-01-01T00:00:00+00:00"
+        }))
+        first = self._upload(client)
+        other = self._upload(client, workspace_id="ws-2")
+        assert other["public_id"] != first["public_id"]
+        assert asyncio.run(db.media_blobs.count_documents({})) == 2
+
+    def test_release_destroys_blob_with_last_reference(self, client, db):
+        first = self._upload(client)
+        second = self._upload(client)
+        stored = server.storage_provider.local_path(first["public_id"])
+
+        asyncio.run(server._delete_file_records([first["file_id"]], {"deleted": 0, "failed": 0, "items": []}))
+        assert asyncio.run(db.media_blobs.find_one({}))["ref_count"] == 1
+        assert stored.exists()
+
+        asyncio.run(server._delete_file_records([second["file_id"]], {"deleted": 0, "failed": 0, "items": []}))
+        assert asyncio.run(db.media_blobs.count_documents({})) == 0
+        assert not stored.exists()